@@ -0,0 +1,187 @@
+"""
+Python API for backing up and restoring databases without going through the
+management commands.  Backups can be written to and read from paths,
+file-like objects or callbacks, which makes it possible to hand them to any
+transport without an intermediate file::
+
+    from backupdb import api
+
+    with open('default.pgsql.gz', 'wb') as f:
+        result = api.backup('default', f)
+
+    print(result.bytes, result.duration, result.checksum)
+"""
+from __future__ import absolute_import
+import hashlib
+import os
+import time
+
+from backupdb.utils.commands import do_postgresql_backup
+from backupdb.utils.exceptions import BackupError, RestoreError
+from backupdb.utils.processes import is_stream
+from backupdb.utils.settings import BACKUP_CONFIG
+
+
+class BackupResult(object):
+    """
+    Statistics about a completed backup or restore.
+
+    `bytes` is the size of the compressed backup data that was written or
+    read, `duration` the total time taken in seconds, `checksum` the hex
+    digest of the compressed backup data and `stages` a list of
+    `(cmd_str, seconds)` tuples with the time at which each stage of the
+    pipeline finished relative to its start.
+    """
+    def __init__(self, db_name, engine, bytes, duration, checksum, stages):
+        self.db_name = db_name
+        self.engine = engine
+        self.bytes = bytes
+        self.duration = duration
+        self.checksum = checksum
+        self.stages = stages
+
+    def __repr__(self):
+        return '<BackupResult {0!r}: {1} bytes in {2:.2f}s>'.format(
+            self.db_name, self.bytes, self.duration)
+
+
+class HashingWriter(object):
+    """
+    Writable file-like object which counts and hashes the data written to it
+    before passing it on to `sink`, which is either a writable file-like
+    object or a callable accepting each chunk of data.
+    """
+    def __init__(self, sink, algorithm='sha256'):
+        self.sink = sink
+        self.hash = hashlib.new(algorithm)
+        self.bytes = 0
+
+    def write(self, data):
+        self.hash.update(data)
+        self.bytes += len(data)
+        if callable(getattr(self.sink, 'write', None)):
+            self.sink.write(data)
+        else:
+            self.sink(data)
+
+
+class HashingReader(object):
+    """
+    Readable file-like object which counts and hashes the data read from
+    `stream`.
+    """
+    def __init__(self, stream, algorithm='sha256'):
+        self.stream = stream
+        self.hash = hashlib.new(algorithm)
+        self.bytes = 0
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        self.hash.update(data)
+        self.bytes += len(data)
+        return data
+
+
+def get_db_config(db_name, db_config=None):
+    """
+    Returns `db_config` if given or the configuration of `db_name` in
+    `settings.DATABASES` otherwise.
+    """
+    if db_config is not None:
+        return db_config
+
+    from django.conf import settings
+    return settings.DATABASES[db_name]
+
+
+def get_backup_config(db_config, error_class=BackupError):
+    """
+    Returns the entry of `BACKUP_CONFIG` for the engine of `db_config` or
+    raises `error_class` if it is not supported.
+    """
+    engine = db_config['ENGINE']
+    backup_config = BACKUP_CONFIG.get(engine)
+    if not backup_config:
+        raise error_class("Backup for '{0}' engine not implemented".format(engine))
+    return backup_config
+
+
+def backup(db_name, output, db_config=None, pg_dump_options=None,
+           show_output=False, compress_threads=1, compress_level=None, algorithm='sha256'):
+    """
+    Backs up the database `db_name` into `output`, which may be a path, a
+    writable binary file-like object or a callable which is passed each chunk
+    of compressed data.  The configuration is taken from
+    `settings.DATABASES` unless `db_config` is given.  Returns a
+    `BackupResult`.
+    """
+    db_config = get_db_config(db_name, db_config)
+    backup_config = get_backup_config(db_config)
+
+    backup_func = backup_config['backup_func']
+    backup_kwargs = {
+        'db_config': db_config,
+        'show_output': show_output,
+        'compress_threads': compress_threads,
+        'compress_level': compress_level,
+    }
+    if backup_func is do_postgresql_backup:
+        backup_kwargs['pg_dump_options'] = pg_dump_options
+
+    started = time.time()
+    if is_stream(output) or callable(output):
+        writer = HashingWriter(output, algorithm)
+        stages = backup_func(backup_file=writer, **backup_kwargs)
+    else:
+        with open(output, 'wb') as f:
+            writer = HashingWriter(f, algorithm)
+            stages = backup_func(backup_file=writer, **backup_kwargs)
+
+    return BackupResult(
+        db_name=db_name,
+        engine=db_config['ENGINE'],
+        bytes=writer.bytes,
+        duration=time.time() - started,
+        checksum=writer.hash.hexdigest(),
+        stages=stages,
+    )
+
+
+def restore(db_name, input, db_config=None, drop_tables=False,
+            show_output=False, decompress_threads=1, algorithm='sha256'):
+    """
+    Restores the database `db_name` from `input`, which may be a path or a
+    readable binary file-like object.  The configuration is taken from
+    `settings.DATABASES` unless `db_config` is given.  Returns a
+    `BackupResult`.
+    """
+    db_config = get_db_config(db_name, db_config)
+    backup_config = get_backup_config(db_config, error_class=RestoreError)
+
+    restore_func = backup_config['restore_func']
+    restore_kwargs = {
+        'db_config': db_config,
+        'drop_tables': drop_tables,
+        'show_output': show_output,
+        'decompress_threads': decompress_threads,
+    }
+
+    started = time.time()
+    if is_stream(input):
+        reader = HashingReader(input, algorithm)
+        stages = restore_func(backup_file=reader, **restore_kwargs)
+    else:
+        if not os.path.exists(input):
+            raise RestoreError("Could not find file '{0}'".format(input))
+        with open(input, 'rb') as f:
+            reader = HashingReader(f, algorithm)
+            stages = restore_func(backup_file=reader, **restore_kwargs)
+
+    return BackupResult(
+        db_name=db_name,
+        engine=db_config['ENGINE'],
+        bytes=reader.bytes,
+        duration=time.time() - started,
+        checksum=reader.hash.hexdigest(),
+        stages=stages,
+    )
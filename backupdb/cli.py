@@ -0,0 +1,240 @@
+"""
+Standalone command-line entry point for backing up and restoring databases
+without booting the Django project.
+
+Only `DATABASES` and the `BACKUPDB_*` settings are read, either from a JSON
+config file given with `--config` or from the settings module given with
+`--settings` or `DJANGO_SETTINGS_MODULE`.  The settings module is imported on
+its own, so neither `django.setup()` nor the project's apps are loaded::
+
+    backupdb --settings=myproject.settings backup --backup-name=nightly
+    backupdb --config=/etc/backupdb.json restore --database=default
+"""
+from __future__ import absolute_import
+from subprocess import CalledProcessError
+import argparse
+import importlib
+import json
+import logging
+import os
+import sys
+import time
+
+from backupdb.utils.frames import parse_level
+
+LOG_FORMAT = '%(asctime)s - %(levelname)-8s: %(message)s'
+LOG_LEVELS = {
+    0: logging.ERROR,
+    1: logging.INFO,
+    2: logging.DEBUG,
+    3: logging.DEBUG,
+}
+
+
+def load_config(config_file=None, settings_module=None):
+    """
+    Returns a dict with the `DATABASES` and `BACKUPDB_*` settings read from the
+    JSON file `config_file` or from the module `settings_module`.
+    """
+    if config_file:
+        with open(config_file) as f:
+            values = json.load(f)
+    else:
+        settings_module = settings_module or os.environ.get('DJANGO_SETTINGS_MODULE')
+        if not settings_module:
+            raise ValueError('Either a config file or a settings module must be given')
+        module = importlib.import_module(settings_module)
+        values = vars(module)
+
+    config = dict(
+        (k, v) for k, v in values.items()
+        if k == 'DATABASES' or k.startswith('BACKUPDB_')
+    )
+    if 'DATABASES' not in config:
+        raise ValueError('No DATABASES found in configuration')
+    return config
+
+
+def configure(config):
+    """
+    Configures `django.conf.settings` with `config` unless settings have
+    already been configured.
+    """
+    from django.conf import settings
+    if not settings.configured:
+        settings.configure(**config)
+
+
+def get_db_names(config, names=None):
+    db_names = names or sorted(config['DATABASES'])
+    for db_name in db_names:
+        if db_name not in config['DATABASES']:
+            raise ValueError("Database '{0}' is not configured".format(db_name))
+    return db_names
+
+
+def do_list(config, options):
+    for db_name in get_db_names(config, options.database):
+        print('{0}\t{1}'.format(db_name, config['DATABASES'][db_name]['ENGINE']))
+    return True
+
+
+def do_backup(config, options):
+    from backupdb import api
+    from backupdb.utils.exceptions import BackupError
+    from backupdb.utils.files import get_backup_file
+    from backupdb.utils.log import section, SectionError, SectionWarning
+    from backupdb.utils.settings import BACKUP_DIR, BACKUP_CONFIG
+
+    logger = logging.getLogger('backupdb.cli')
+    backup_name = options.backup_name or time.strftime('%F-%s')
+
+    # Ensure backup dir present
+    if not os.path.exists(BACKUP_DIR):
+        os.makedirs(BACKUP_DIR)
+
+    succeeded = []
+    db_names = get_db_names(config, options.database)
+    for db_name in db_names:
+        with section("Backing up '{0}'...".format(db_name)):
+            engine = config['DATABASES'][db_name]['ENGINE']
+            backup_config = BACKUP_CONFIG.get(engine)
+            if not backup_config:
+                raise SectionWarning("Backup for '{0}' engine not implemented".format(engine))
+
+            backup_file = get_backup_file(db_name, backup_name, backup_config['backup_extension'])
+            try:
+                result = api.backup(
+                    db_name,
+                    backup_file,
+                    pg_dump_options=options.pg_dump_options,
+                    show_output=options.show_output,
+                    compress_threads=options.compress_threads,
+                    compress_level=options.compress_level,
+                )
+            except (BackupError, CalledProcessError) as e:
+                raise SectionError(e)
+            logger.info("Backup of '{0}' saved in '{1}' ({2} bytes in {3:.1f}s)".format(
+                db_name, backup_file, result.bytes, result.duration))
+            succeeded.append(db_name)
+
+    return len(succeeded) == len(db_names)
+
+
+def do_restore(config, options):
+    from backupdb import api
+    from backupdb.utils.exceptions import RestoreError
+    from backupdb.utils.files import get_backup_file, get_latest_timestamped_file
+    from backupdb.utils.log import section, SectionError, SectionWarning
+    from backupdb.utils.settings import BACKUP_DIR, BACKUP_CONFIG
+
+    logger = logging.getLogger('backupdb.cli')
+
+    # Ensure backup dir present
+    if not os.path.exists(BACKUP_DIR):
+        logger.error("Backup dir '{0}' does not exist!".format(BACKUP_DIR))
+        return False
+
+    succeeded = []
+    db_names = get_db_names(config, options.database)
+    for db_name in db_names:
+        with section("Restoring '{0}'...".format(db_name)):
+            engine = config['DATABASES'][db_name]['ENGINE']
+            backup_config = BACKUP_CONFIG.get(engine)
+            if not backup_config:
+                raise SectionWarning("Restore for '{0}' engine not implemented".format(engine))
+
+            backup_extension = backup_config['backup_extension']
+            try:
+                if options.backup_name:
+                    backup_file = get_backup_file(db_name, options.backup_name, backup_extension)
+                else:
+                    backup_file = get_latest_timestamped_file(backup_extension)
+
+                api.restore(
+                    db_name,
+                    backup_file,
+                    drop_tables=options.drop_tables,
+                    show_output=options.show_output,
+                    decompress_threads=options.decompress_threads,
+                )
+            except (RestoreError, CalledProcessError) as e:
+                raise SectionError(e)
+            logger.info("Restored '{0}' from '{1}'".format(db_name, backup_file))
+            succeeded.append(db_name)
+
+    return len(succeeded) == len(db_names)
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        prog='backupdb',
+        description='Backs up and restores the databases of a Django project without loading it.',
+    )
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument(
+        '--config',
+        help='Path of a JSON file containing DATABASES and BACKUPDB_* settings.',
+    )
+    source.add_argument(
+        '--settings',
+        help=(
+            'Python path of a settings module to read DATABASES and '
+            'BACKUPDB_* settings from.  Defaults to DJANGO_SETTINGS_MODULE.'
+        ),
+    )
+    parser.add_argument(
+        '-v', '--verbosity',
+        type=int,
+        choices=sorted(LOG_LEVELS),
+        default=1,
+    )
+
+    subparsers = parser.add_subparsers(dest='action')
+    subparsers.required = True
+
+    list_parser = subparsers.add_parser('list', help='List configured databases.')
+    list_parser.set_defaults(func=do_list)
+
+    backup_parser = subparsers.add_parser('backup', help='Back up databases.')
+    backup_parser.set_defaults(func=do_backup)
+    backup_parser.add_argument('--backup-name')
+    backup_parser.add_argument('--pg-dump-options')
+    backup_parser.add_argument('--compress-threads', type=int, default=1)
+    backup_parser.add_argument('--compress-level', type=parse_level)
+    backup_parser.add_argument('--show-output', action='store_true', default=False)
+
+    restore_parser = subparsers.add_parser('restore', help='Restore databases.')
+    restore_parser.set_defaults(func=do_restore)
+    restore_parser.add_argument('--backup-name')
+    restore_parser.add_argument('--drop-tables', action='store_true', default=False)
+    restore_parser.add_argument('--decompress-threads', type=int, default=1)
+    restore_parser.add_argument('--show-output', action='store_true', default=False)
+
+    for subparser in (list_parser, backup_parser, restore_parser):
+        subparser.add_argument(
+            '--database',
+            action='append',
+            help='Name of a database to act on.  May be repeated.  Defaults to all databases.',
+        )
+
+    return parser
+
+
+def main(argv=None):
+    options = get_parser().parse_args(argv)
+    logging.basicConfig(format=LOG_FORMAT, level=LOG_LEVELS[options.verbosity])
+
+    try:
+        config = load_config(options.config, options.settings)
+        get_db_names(config, options.database)
+    except (ImportError, IOError, ValueError) as e:
+        logging.getLogger('backupdb.cli').error(e)
+        return 2
+
+    configure(config)
+    return 0 if options.func(config, options) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,135 @@
+from __future__ import absolute_import
+import logging
+import multiprocessing
+import os
+
+from django.core.management.base import CommandError
+
+from backupdb.utils.audit import (
+    OK,
+    ORPHANED,
+    audit_files,
+    find_backup_files,
+    is_unchanged,
+    load_catalog,
+    load_report,
+)
+from backupdb.utils.commands import BaseBackupDbCommand
+from backupdb.utils.scheduler import ResultLog
+from backupdb.utils.settings import (
+    AUDIT_REPORT_FILE,
+    BACKUP_CONFIG,
+    BACKUP_DIR,
+    DAEMON_RESULTS_FILE,
+    HISTORY_FILE,
+    PORTABLE_CONFIG,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseBackupDbCommand):
+    help = 'Checks that the backups in the backup directory can still be read.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--processes',
+            type=int,
+            default=multiprocessing.cpu_count(),
+            help=(
+                'Number of backups to check at the same time.  Defaults to '
+                'the number of CPUs.'
+            ),
+        )
+        parser.add_argument(
+            '--io-limit',
+            type=int,
+            default=2,
+            help=(
+                'Maximum number of processes which may read from disk at the '
+                'same time.  Defaults to 2.'
+            ),
+        )
+        parser.add_argument(
+            '--catalog',
+            default=DAEMON_RESULTS_FILE,
+            help=(
+                'JSON lines file recording the checksums of backups, such as '
+                'the results file written by `backupdbd`.  Backups listed in '
+                'it are checked against their checksum and reported as '
+                'missing if they no longer exist.  Defaults to '
+                'settings.BACKUPDB_DAEMON_RESULTS_FILE.'
+            ),
+        )
+        parser.add_argument(
+            '--report',
+            default=AUDIT_REPORT_FILE,
+            help=(
+                'Path of the JSON lines report with one result per file.  '
+                'Defaults to settings.BACKUPDB_AUDIT_REPORT_FILE.'
+            ),
+        )
+        parser.add_argument(
+            '--resume',
+            action='store_true',
+            default=False,
+            help=(
+                'Keep the results already in the report and only check files '
+                'which are not in it or have changed since.'
+            ),
+        )
+
+    def handle(self, *args, **options):
+        super(Command, self).handle(*args, **options)
+
+        report_file = options['report']
+        catalog_file = options['catalog']
+
+        if not os.path.exists(BACKUP_DIR):
+            raise CommandError("Backup dir '{0}' does not exist!".format(BACKUP_DIR))
+
+        extensions = set(c['backup_extension'] for c in BACKUP_CONFIG.values())
+        extensions.add(PORTABLE_CONFIG['backup_extension'])
+        backups, orphans = find_backup_files(BACKUP_DIR, extensions, ignore=[report_file, catalog_file, HISTORY_FILE])
+        catalog = load_catalog(catalog_file)
+        paths = sorted(set(backups) | set(catalog))
+
+        if options['resume']:
+            previous = load_report(report_file)
+        else:
+            previous = {}
+            if os.path.exists(report_file):
+                os.remove(report_file)
+        report = ResultLog(report_file)
+
+        results = {}
+        for path in paths:
+            if path in previous and is_unchanged(previous[path], path):
+                results[path] = previous[path]
+        pending = [p for p in paths if p not in results]
+        logger.info('Auditing {0} of {1} backups...'.format(len(pending), len(paths)))
+
+        for path in orphans:
+            if path in previous:
+                results[path] = previous[path]
+                continue
+            logger.warning("'{0}' is not a backup".format(path))
+            results[path] = {'path': path, 'status': ORPHANED}
+            report.record(**results[path])
+
+        for result in audit_files(
+            pending,
+            catalog=catalog,
+            processes=options['processes'],
+            io_limit=options['io_limit'],
+        ):
+            report.record(**result)
+            results[result['path']] = result
+            if result['status'] != OK:
+                logger.error("'{0}' is {1}: {2}".format(
+                    result['path'], result['status'], result.get('error', '')))
+
+        problems = [r for r in results.values() if r['status'] != OK]
+        if problems:
+            raise CommandError('Found {0} problems, see {1}'.format(len(problems), report_file))
+        logger.info('All {0} backups are readable'.format(len(paths)))
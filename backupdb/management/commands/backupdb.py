@@ -3,12 +3,61 @@ from optparse import make_option
 from subprocess import CalledProcessError
 import logging
 import os
+import sys
 import time
 
-from backupdb.utils.commands import BaseBackupDbCommand, do_postgresql_backup
+from django.core.management.base import CommandError
+
+from backupdb.utils.commands import (
+    BaseBackupDbCommand,
+    do_mysql_backup,
+    do_postgresql_backup,
+    do_sqlite_backup,
+    get_db_host,
+)
 from backupdb.utils.exceptions import BackupError
+from backupdb.utils.files import get_backup_file
+from backupdb.utils.frames import parse_level
+from backupdb.utils.history import (
+    check_estimate,
+    estimate_backup,
+    estimate_total,
+    format_duration,
+    format_size,
+    get_db_size,
+    get_free_space,
+    load_history,
+    record_backup,
+)
 from backupdb.utils.log import section, SectionError, SectionWarning
-from backupdb.utils.settings import BACKUP_DIR, BACKUP_CONFIG
+from backupdb.utils.parallel import FAILED, Job, parse_job_count, run_jobs
+from backupdb.utils.pitr import get_pitr_dir
+from backupdb.utils.portable import do_portable_backup
+from backupdb.utils.resumable import do_postgresql_resumable_backup
+from backupdb.utils.scheduler import ResultLog
+from backupdb.utils.sinks import get_fan_out
+from backupdb.utils.snapshots import get_snapshot_ttl, release_snapshots, take_snapshots
+from backupdb.utils.settings import (
+    BACKUP_DIR,
+    BACKUP_CONFIG,
+    COPY_BUFFER_SIZE,
+    COPY_DESTINATIONS,
+    COPY_STALL_TIMEOUT,
+    HISTORY_FILE,
+    HOT_RELATIONS,
+    MAX_DURATION,
+    MAX_JOBS_PER_HOST,
+    PG_CONSISTENT_SNAPSHOT_TTL,
+    PG_SNAPSHOT_TTL,
+    PITR_DIR,
+    PORTABLE_BATCH_SIZE,
+    PORTABLE_CONFIG,
+    SUBSET_FULL_TABLES,
+)
+from backupdb.utils.streams import BackupWriter, StreamWriter
+from backupdb.utils.subset import do_subset_backup, parse_root
+from backupdb.utils.volumes import VolumeWriter, parse_size
+from backupdb.utils.warmup import capture_hot_relations
 
 logger = logging.getLogger(__name__)
 
@@ -25,6 +74,75 @@ class Command(BaseBackupDbCommand):
                 'files that look like "default-test.pgsql.gz".'
             ),
         )
+        parser.add_argument(
+            '--database',
+            action='append',
+            help=(
+                'Name of a database to back up.  May be repeated.  Defaults '
+                'to all databases in settings.DATABASES.'
+            ),
+        )
+        parser.add_argument(
+            '--output',
+            help=(
+                'Write the backups to this file, or to stdout if `-`, instead '
+                'of to the backup directory.  The backup of a single database '
+                'is written as is and can be read with `gunzip`; backups of '
+                'several databases are written one after another as a backup '
+                'stream.  Either can be restored with `restoredb --input`.'
+            ),
+        )
+        parser.add_argument(
+            '--copy-to',
+            action='append',
+            default=[],
+            metavar='DIR',
+            help=(
+                'Also write each backup to this directory while it is being '
+                'made, in addition to settings.BACKUPDB_COPY_DESTINATIONS.  '
+                'May be repeated.  The backup only fails if it could not be '
+                'written to the backup directory; failed copies are '
+                'reported.'
+            ),
+        )
+        parser.add_argument(
+            '--volume-size',
+            type=parse_size,
+            default=None,
+            metavar='SIZE',
+            help=(
+                'Split each backup into volumes of this size, such as `4G`, '
+                'named "<backup>.000", "<backup>.001", ... with a manifest '
+                'holding the hash of each volume in "<backup>.manifest".  '
+                'Backups compressed into frames (see --compress-threads) are '
+                'cut between frames.  Finished volumes are hashed and copied '
+                'to the --copy-to destinations while the next ones are '
+                'written.  `restoredb` reads volumed backups as a whole.'
+            ),
+        )
+        parser.add_argument(
+            '--portable',
+            action='store_true',
+            default=False,
+            help=(
+                'Back up the rows of the models of each database through the '
+                'Django ORM, into files named "<database>-<name>.portable.gz" '
+                'which `restoredb --portable` can restore into a database of '
+                'any engine.  Databases of engines which backupdb can not '
+                'dump otherwise are backed up as well.'
+            ),
+        )
+        parser.add_argument(
+            '--portable-jobs',
+            type=int,
+            default=4,
+            help=(
+                'With --portable, number of connections reading the rows of '
+                'the models of each database.  Postgres connections read the '
+                'same snapshot; those of other engines each read the models '
+                'they are given in their own transaction.  Defaults to 4.'
+            ),
+        )
         parser.add_argument(
             '--pg-dump-options',
             help=(
@@ -33,6 +151,175 @@ class Command(BaseBackupDbCommand):
                 '`--pg-dump-options="--inserts --no-owner"`'
             ),
         )
+        parser.add_argument(
+            '--compress-threads',
+            type=int,
+            default=1,
+            help=(
+                'Number of threads used to compress backups.  With more than '
+                'one thread, backups are written as independent gzip frames '
+                'which can also be decompressed in parallel when restoring.  '
+                'Defaults to 1, which uses `gzip`.'
+            ),
+        )
+        parser.add_argument(
+            '--compress-level',
+            type=parse_level,
+            default=None,
+            help=(
+                "Compression level from 1 to 9, or 'auto' to adjust the level "
+                'while backing up so that compression keeps up with the '
+                'database dump without slowing it down.  Adaptive backups are '
+                'written as gzip frames.  Defaults to the level of the '
+                'compressor.'
+            ),
+        )
+        parser.add_argument(
+            '--resumable',
+            action='store_true',
+            default=False,
+            help=(
+                'For postgres backups, dump each table separately from one '
+                'snapshot and record the finished tables in a checkpoint, so '
+                'that rerunning with the same --backup-name after a failure '
+                'skips them.  The snapshot is kept for '
+                'settings.BACKUPDB_PG_SNAPSHOT_TTL seconds (a day by '
+                'default); a rerun after that starts over.'
+            ),
+        )
+        parser.add_argument(
+            '--consistent-snapshot',
+            action='store_true',
+            default=False,
+            help=(
+                'Export a snapshot of every postgres database before backing '
+                'any of them up and dump each database from its snapshot.  '
+                'The snapshots of databases on the same server are taken at '
+                'the same instant, so that their backups match each other.  '
+                'Nothing is locked while the snapshots are held.  They are '
+                'held for twice the predicted duration of the backups or for '
+                '--max-duration, whichever is longer, or else for '
+                'settings.BACKUPDB_PG_CONSISTENT_SNAPSHOT_TTL seconds (six '
+                'hours by default).  With --resumable, a rerun starts over '
+                'from new snapshots.'
+            ),
+        )
+        parser.add_argument(
+            '--capture-hot',
+            action='store_true',
+            default=False,
+            help=(
+                'Save the names of the settings.BACKUPDB_HOT_RELATIONS most '
+                'used tables and indexes of each database next to its backup, '
+                'so that `restoredb --prewarm` can load them into the cache '
+                'after restoring.'
+            ),
+        )
+        parser.add_argument(
+            '--subset-root',
+            action='append',
+            type=parse_root,
+            default=[],
+            dest='subset_roots',
+            metavar='TABLE[:PREDICATE]',
+            help=(
+                'Back up only the rows of TABLE matching the SQL PREDICATE, '
+                'or all of its rows without a predicate, along with every row '
+                'they reference through foreign keys.  May be given several '
+                'times.  The tables in settings.BACKUPDB_SUBSET_FULL_TABLES '
+                'are backed up in full.  The result is restored with '
+                '`restoredb` like a full backup.  Requires a single '
+                '--database.'
+            ),
+        )
+        parser.add_argument(
+            '--subset-sample',
+            type=float,
+            default=None,
+            metavar='PERCENT',
+            help=(
+                'With --subset-root, select only a random PERCENT of the rows '
+                'matching each root.'
+            ),
+        )
+        parser.add_argument(
+            '--base-backup',
+            action='store_true',
+            default=False,
+            help=(
+                'Instead of a regular backup, take a base backup for '
+                'point-in-time recovery into the archive of each database in '
+                'settings.BACKUPDB_PITR_DIRECTORY: a copy of the whole server '
+                'made by `pg_basebackup` for postgres, a dump recording the '
+                'binary log position for mysql.'
+            ),
+        )
+        parser.add_argument(
+            '--archive-logs',
+            action='store_true',
+            default=False,
+            help=(
+                'Instead of a regular backup, copy the binary logs written by '
+                'mysql servers since the last run into the archive of each '
+                'database, which allows `restoredb --until` to recover them '
+                'up to this point.  Postgres servers archive their WAL '
+                'themselves; for them, check that archive_command is set up '
+                'and switch to a new WAL segment.  Run it often.'
+            ),
+        )
+        parser.add_argument(
+            '--jobs',
+            type=int,
+            default=1,
+            help=(
+                'Number of databases to back up at the same time.  Defaults '
+                'to 1.'
+            ),
+        )
+        parser.add_argument(
+            '--jobs-per-host',
+            type=parse_job_count,
+            default=MAX_JOBS_PER_HOST,
+            help=(
+                'Maximum number of databases on the same server (HOST and '
+                'PORT) to back up at the same time.  Databases on different '
+                'servers are backed up in turns so that every server is kept '
+                'busy.  Defaults to settings.BACKUPDB_MAX_JOBS_PER_HOST or no '
+                'limit.'
+            ),
+        )
+        parser.add_argument(
+            '--estimate',
+            action='store_true',
+            default=False,
+            help=(
+                'Only predict how long backing up each database will take and '
+                'how much space it will need, from the history of previous '
+                'backups and the current size of the databases.  Fails if the '
+                'total goes over --max-duration or the free space in the '
+                'backup directory.'
+            ),
+        )
+        parser.add_argument(
+            '--enforce-estimate',
+            action='store_true',
+            default=False,
+            help=(
+                'Refuse to start backing up if the prediction goes over '
+                '--max-duration or the free space in the backup directory, '
+                'instead of only warning.'
+            ),
+        )
+        parser.add_argument(
+            '--max-duration',
+            type=int,
+            default=MAX_DURATION,
+            help=(
+                'Number of seconds which the backups are allowed to take, '
+                'checked against the prediction.  Defaults to '
+                'settings.BACKUPDB_MAX_DURATION or no limit.'
+            ),
+        )
         parser.add_argument(
             '--show-output',
             action='store_true',
@@ -50,48 +337,351 @@ class Command(BaseBackupDbCommand):
     def handle(self, *args, **options):
         super(Command, self).handle(*args, **options)
 
-        from django.conf import settings
-
         current_time = time.strftime('%F-%s')
         backup_name = options['backup_name'] or current_time
-        show_output = options['show_output']
+        databases = self.get_databases(options['database'])
+
+        if options['subset_sample'] is not None and not options['subset_roots']:
+            raise CommandError('--subset-sample requires --subset-root')
+        if options['subset_roots']:
+            if options['resumable']:
+                raise CommandError('--resumable can not be used with --subset-root')
+            if len(databases) != 1:
+                raise CommandError('--subset-root requires a single --database')
+            if options['consistent_snapshot']:
+                raise CommandError('--consistent-snapshot can not be used with --subset-root')
+
+        if options['base_backup'] or options['archive_logs']:
+            if options['output'] or options['subset_roots'] or options['resumable']:
+                raise CommandError(
+                    '--base-backup and --archive-logs can not be used with --output, --subset-root or --resumable')
+
+        if options['portable']:
+            if (options['output'] or options['subset_roots'] or options['resumable'] or options['capture_hot'] or
+                    options['base_backup'] or options['archive_logs']):
+                raise CommandError(
+                    '--portable can not be used with --output, --subset-root, --resumable, --capture-hot, '
+                    '--base-backup or --archive-logs')
+
+        self.snapshots = {}
+        self.expected_duration = None
+        if options['output']:
+            if options['resumable']:
+                raise CommandError('--resumable can not be used with --output')
+            if options['capture_hot']:
+                raise CommandError('--capture-hot can not be used with --output')
+            if options['copy_to']:
+                raise CommandError('--copy-to can not be used with --output')
+            if options['volume_size']:
+                raise CommandError('--volume-size can not be used with --output')
+            self.take_snapshots(databases, options)
+            try:
+                return self.backup_to_output(databases, options)
+            finally:
+                release_snapshots(self.snapshots, databases)
+        if options['volume_size'] and options['resumable']:
+            raise CommandError('--volume-size can not be used with --resumable')
 
         # Ensure backup dir present
         if not os.path.exists(BACKUP_DIR):
             os.makedirs(BACKUP_DIR)
 
-        # Loop through databases
-        for db_name, db_config in settings.DATABASES.items():
-            with section("Backing up '{0}'...".format(db_name)):
-                # Get backup config for this engine type
-                engine = db_config['ENGINE']
-                backup_config = BACKUP_CONFIG.get(engine)
-                if not backup_config:
-                    raise SectionWarning("Backup for '{0}' engine not implemented".format(engine))
-
-                # Get backup file name
-                backup_base_name = '{db_name}-{backup_name}.{backup_extension}.gz'.format(
-                    db_name=db_name,
-                    backup_name=backup_name,
-                    backup_extension=backup_config['backup_extension'],
+        if options['base_backup'] or options['archive_logs']:
+            return self.archive_databases(databases, options)
+
+        self.history = ResultLog(HISTORY_FILE)
+        self.db_sizes = {}
+        if options['estimate']:
+            self.check_estimates(databases, options, enforce=True)
+            return
+        if not options['subset_roots'] and not options['portable']:
+            self.check_estimates(databases, options, enforce=options['enforce_estimate'])
+
+        jobs = []
+        for db_name, db_config in databases:
+            jobs.append(Job(
+                db_name,
+                self.get_backup_func(db_name, db_config, backup_name, options),
+                host=get_db_host(db_config),
+            ))
+
+        self.take_snapshots(databases, options)
+        try:
+            results = run_jobs(jobs, max_workers=options['jobs'], max_per_host=options['jobs_per_host'])
+        finally:
+            release_snapshots(self.snapshots, databases)
+
+        failed = [j.name for j in jobs if results[j.name] == FAILED]
+        if failed:
+            logger.error('Failed to back up: {0}'.format(', '.join(failed)))
+
+    def archive_databases(self, databases, options):
+        """
+        Takes base backups of `databases` or archives their logs for
+        point-in-time recovery.
+        """
+        jobs = []
+        for db_name, db_config in databases:
+            jobs.append(Job(
+                db_name,
+                self.get_archive_func(db_name, db_config, options),
+                host=get_db_host(db_config),
+            ))
+
+        results = run_jobs(jobs, max_workers=options['jobs'], max_per_host=options['jobs_per_host'])
+
+        failed = [j.name for j in jobs if results[j.name] == FAILED]
+        if failed:
+            logger.error('Failed to archive: {0}'.format(', '.join(failed)))
+
+    def get_archive_func(self, db_name, db_config, options):
+        def archive():
+            return self.archive_database(db_name, db_config, options)
+        return archive
+
+    def archive_database(self, db_name, db_config, options):
+        """
+        Takes a base backup of a single database or archives its logs, as
+        requested by `options`.  Returns True if it was archived.
+        """
+        show_output = options['show_output']
+
+        archived = False
+        with section("Archiving '{0}'...".format(db_name)):
+            engine = db_config['ENGINE']
+            backup_config = BACKUP_CONFIG.get(engine)
+            if not backup_config or not backup_config['base_backup_func']:
+                raise SectionWarning("Point-in-time recovery for '{0}' engine not implemented".format(engine))
+
+            pitr_dir = get_pitr_dir(db_name, PITR_DIR)
+            try:
+                if options['base_backup']:
+                    base_file = backup_config['base_backup_func'](
+                        pitr_dir,
+                        db_config,
+                        show_output=show_output,
+                        compress_threads=options['compress_threads'],
+                        compress_level=options['compress_level'],
+                    )
+                    logger.info("Base backup of '{0}' saved in '{1}'".format(db_name, base_file))
+                if options['archive_logs']:
+                    backup_config['archive_logs_func'](pitr_dir, db_config, show_output=show_output)
+                    logger.info("Logs of '{0}' archived in '{1}'".format(db_name, pitr_dir))
+            except (BackupError, CalledProcessError) as e:
+                raise SectionError(e)
+            archived = True
+        return archived
+
+    def take_snapshots(self, databases, options):
+        """
+        With `--consistent-snapshot`, exports the snapshots from which the
+        postgres databases among `databases` are backed up.
+        """
+        if not options['consistent_snapshot']:
+            return
+        postgresql_databases = [
+            (db_name, db_config) for db_name, db_config in databases
+            if BACKUP_CONFIG.get(db_config['ENGINE'], {}).get('backup_func') is do_postgresql_backup
+        ]
+        if len(postgresql_databases) < len(databases):
+            logger.warning('Consistent snapshots are only supported for postgres databases')
+        try:
+            ttl = get_snapshot_ttl(self.expected_duration, options['max_duration'], PG_CONSISTENT_SNAPSHOT_TTL)
+            self.snapshots = take_snapshots(postgresql_databases, ttl)
+        except BackupError as e:
+            raise CommandError(str(e))
+        for db_name, (snapshot_id, _, _, _) in sorted(self.snapshots.items()):
+            logger.debug("Backing up '{0}' from snapshot '{1}'".format(db_name, snapshot_id))
+
+    def check_estimates(self, databases, options, enforce=False):
+        """
+        Predicts the duration and size of the backups of `databases` from the
+        history of previous backups and warns about predictions going over
+        the allowed duration or the free space.  Raises CommandError instead
+        if `enforce` is True.
+        """
+        history = load_history(HISTORY_FILE)
+        log = logger.info if options['estimate'] else logger.debug
+
+        estimates = []
+        for db_name, db_config in databases:
+            backup_config = BACKUP_CONFIG.get(db_config['ENGINE'])
+            if not backup_config:
+                continue
+            db_size = get_db_size(backup_config['db_size_func'], db_config, options['show_output'])
+            self.db_sizes[db_name] = db_size
+            estimate = estimate_backup(db_name, history.get(db_name, []), db_size)
+            estimates.append(estimate)
+            log(self.format_estimate(estimate))
+
+        total = estimate_total(estimates, options['jobs'])
+        self.expected_duration = total.duration
+        if len(estimates) > 1:
+            log(self.format_estimate(total))
+
+        problems = check_estimate(total, options['max_duration'], get_free_space(BACKUP_DIR))
+        for problem in problems:
+            logger.warning(problem)
+        if problems and enforce:
+            raise CommandError('Backups would not fit: {0}'.format('; '.join(problems)))
+
+    def format_estimate(self, estimate):
+        name = 'Total' if estimate.db_name == 'total' else "'{0}'".format(estimate.db_name)
+        if estimate.db_size is None:
+            return '{0}: database size unknown'.format(name)
+        if not estimate.known:
+            return '{0}: {1} database, no previous backups'.format(name, format_size(estimate.db_size))
+        return '{0}: {1} database, about {2} and {3} (from {4} backups)'.format(
+            name,
+            format_size(estimate.db_size),
+            format_duration(estimate.duration),
+            format_size(estimate.bytes),
+            estimate.samples,
+        )
+
+    def backup_to_output(self, databases, options):
+        """
+        Backs up `databases` one after another into the file or stdout given
+        by `--output`.
+        """
+        to_stdout = options['output'] == '-'
+        if to_stdout:
+            output = getattr(sys.stdout, 'buffer', sys.stdout)
+        else:
+            output = open(options['output'], 'wb')
+
+        try:
+            if len(databases) == 1:
+                db_name, db_config = databases[0]
+                backed_up = [self.backup_database(db_name, db_config, None, options, output=output)]
+            else:
+                writer = StreamWriter(output)
+                backed_up = [
+                    self.backup_database(db_name, db_config, None, options, output=writer)
+                    for db_name, db_config in databases
+                ]
+                writer.close()
+            output.flush()
+        finally:
+            if not to_stdout:
+                output.close()
+
+        if not all(backed_up):
+            raise CommandError('Failed to back up some databases')
+
+    def get_backup_func(self, db_name, db_config, backup_name, options):
+        def backup():
+            return self.backup_database(db_name, db_config, backup_name, options)
+        return backup
+
+    def backup_database(self, db_name, db_config, backup_name, options, output=None):
+        """
+        Backs up a single database into the backup directory or, if given,
+        into the writable binary file-like object or `StreamWriter` `output`.
+        Returns True if it was backed up.
+        """
+        show_output = options['show_output']
+
+        backed_up = False
+        with section("Backing up '{0}'...".format(db_name)):
+            # Get backup config for this engine type
+            engine = db_config['ENGINE']
+            backup_config = BACKUP_CONFIG.get(engine)
+            if options['portable']:
+                backup_config = PORTABLE_CONFIG
+            elif not backup_config:
+                raise SectionWarning("Backup for '{0}' engine not implemented".format(engine))
+
+            # Get backup file name
+            if output is None:
+                backup_file = get_backup_file(db_name, backup_name, backup_config['backup_extension'])
+                destination = backup_file
+            elif isinstance(output, StreamWriter):
+                backup_file = output.begin(db_name, {
+                    'engine': engine,
+                    'extension': backup_config['backup_extension'],
+                })
+                destination = options['output']
+            else:
+                backup_file = output
+                destination = options['output']
+
+            # Find backup command and get kwargs
+            backup_func = backup_config['backup_func']
+            backup_kwargs = {
+                'backup_file': backup_file,
+                'db_config': db_config,
+                'show_output': show_output,
+                'compress_threads': options['compress_threads'],
+                'compress_level': options['compress_level'],
+            }
+            if backup_func is do_portable_backup:
+                del backup_kwargs['db_config']
+                backup_kwargs.update(
+                    using=db_name,
+                    jobs=options['portable_jobs'],
+                    batch_size=PORTABLE_BATCH_SIZE,
                 )
-                backup_file = os.path.join(BACKUP_DIR, backup_base_name)
-
-                # Find backup command and get kwargs
-                backup_func = backup_config['backup_func']
-                backup_kwargs = {
-                    'backup_file': backup_file,
-                    'db_config': db_config,
-                    'show_output': show_output,
-                }
-                if backup_func is do_postgresql_backup:
-                    backup_kwargs['pg_dump_options'] = options['pg_dump_options']
-
-                # Run backup command
-                try:
-                    backup_func(**backup_kwargs)
-                    logger.info("Backup of '{db_name}' saved in '{backup_file}'".format(
-                        db_name=db_name,
-                        backup_file=backup_file))
-                except (BackupError, CalledProcessError) as e:
-                    raise SectionError(e)
+                if db_name in self.snapshots:
+                    backup_kwargs['snapshot'] = self.snapshots[db_name][0]
+            elif options['subset_roots']:
+                backup_func = do_subset_backup
+                backup_kwargs.update(
+                    roots=options['subset_roots'],
+                    sample=options['subset_sample'],
+                    full_tables=SUBSET_FULL_TABLES,
+                )
+            elif backup_func is do_postgresql_backup:
+                backup_kwargs['pg_dump_options'] = options['pg_dump_options']
+                if db_name in self.snapshots:
+                    backup_kwargs['snapshot'] = self.snapshots[db_name][0]
+                if options['resumable']:
+                    backup_func = do_postgresql_resumable_backup
+                    backup_kwargs['snapshot_ttl'] = PG_SNAPSHOT_TTL
+            elif options['resumable']:
+                logger.warning("Resumable backups are not supported for '{0}' databases".format(engine))
+
+            # Write volumes and copies from the same pass
+            writer = None
+            destinations = list(COPY_DESTINATIONS) + options['copy_to']
+            if output is None and options['volume_size']:
+                writer = VolumeWriter(backup_file, options['volume_size'], destinations)
+                backup_kwargs['backup_file'] = writer
+            elif output is None and destinations:
+                if backup_func is do_postgresql_resumable_backup:
+                    logger.warning('Resumable backups are not copied to other destinations')
+                else:
+                    writer = get_fan_out(
+                        backup_file, destinations, buffer_size=COPY_BUFFER_SIZE, stall_timeout=COPY_STALL_TIMEOUT)
+                    backup_kwargs['backup_file'] = writer
+
+            # Run backup command
+            started = time.time()
+            try:
+                backup_func(**backup_kwargs)
+                if writer is not None:
+                    writer.close()
+                logger.info("Backup of '{db_name}' saved in '{backup_file}'".format(
+                    db_name=db_name,
+                    backup_file=destination))
+            except (BackupError, CalledProcessError) as e:
+                if isinstance(backup_file, BackupWriter):
+                    backup_file.abort()
+                if writer is not None:
+                    writer.abort()
+                raise SectionError(e)
+            if isinstance(backup_file, BackupWriter):
+                backup_file.end()
+            backed_up = True
+
+            # Resumed backups and subsets say nothing about the next full
+            # backup, and volumed backups are not a single file
+            if output is None and not options['volume_size'] and backup_func in (
+                    do_mysql_backup, do_postgresql_backup, do_sqlite_backup):
+                record_backup(
+                    self.history, db_name, backup_file, self.db_sizes.get(db_name), started, time.time() - started)
+
+            if options['capture_hot'] and output is None:
+                capture_hot_relations(
+                    backup_file, db_config, backup_config['hot_relations_func'], HOT_RELATIONS, show_output)
+        return backed_up
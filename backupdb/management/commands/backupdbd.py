@@ -0,0 +1,130 @@
+from __future__ import absolute_import
+from subprocess import CalledProcessError
+import logging
+import os
+import signal
+import threading
+import time
+
+from django.core.management.base import CommandError
+
+from backupdb import api
+from backupdb.utils.commands import BaseBackupDbCommand
+from backupdb.utils.exceptions import BackupError
+from backupdb.utils.files import get_new_backup_file
+from backupdb.utils.scheduler import ResultLog, Schedule, Scheduler
+from backupdb.utils.settings import (
+    BACKUP_DIR,
+    BACKUP_SCHEDULES,
+    DAEMON_MAX_JOBS,
+    DAEMON_RESULTS_FILE,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseBackupDbCommand):
+    help = 'Runs backups of the databases in settings.BACKUPDB_SCHEDULES until stopped.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--max-jobs',
+            type=int,
+            default=DAEMON_MAX_JOBS,
+            help=(
+                'Maximum number of backups which may run at the same time '
+                'across all databases.  Defaults to '
+                'settings.BACKUPDB_DAEMON_MAX_JOBS or 1.'
+            ),
+        )
+        parser.add_argument(
+            '--show-output',
+            action='store_true',
+            default=False,
+            help=(
+                'Display the output of stderr for processes that are run '
+                'while backing up databases.'
+            ),
+        )
+
+    def handle(self, *args, **options):
+        super(Command, self).handle(*args, **options)
+
+        from django.conf import settings
+
+        schedules = Schedule.from_settings(BACKUP_SCHEDULES)
+        if not schedules:
+            raise CommandError('No backups scheduled in settings.BACKUPDB_SCHEDULES')
+        for schedule in schedules:
+            if schedule.db_name not in settings.DATABASES:
+                raise CommandError("Scheduled database '{0}' is not in settings.DATABASES".format(schedule.db_name))
+
+        # Ensure backup dir present
+        if not os.path.exists(BACKUP_DIR):
+            os.makedirs(BACKUP_DIR)
+
+        result_log = ResultLog(DAEMON_RESULTS_FILE)
+        show_output = options['show_output']
+
+        # Backup files of the runs in progress
+        reserved = set()
+        reserved_lock = threading.Lock()
+
+        def run_job(schedule):
+            db_config = settings.DATABASES[schedule.db_name]
+            started = time.time()
+            backup_file = None
+            try:
+                backup_config = api.get_backup_config(db_config)
+                # Runs of the same database may start in the same second
+                with reserved_lock:
+                    backup_file = get_new_backup_file(
+                        schedule.db_name, backup_config['backup_extension'], reserved)
+                    reserved.add(backup_file)
+
+                logger.info("Backing up '{0}'...".format(schedule.db_name))
+                result = api.backup(
+                    schedule.db_name,
+                    backup_file,
+                    pg_dump_options=schedule.options.get('pg_dump_options'),
+                    compress_threads=schedule.options.get('compress_threads', 1),
+                    compress_level=schedule.options.get('compress_level'),
+                    show_output=show_output,
+                )
+            except (BackupError, CalledProcessError) as e:
+                logger.error("Backup of '{0}' failed: {1}".format(schedule.db_name, e))
+                result_log.record(
+                    database=schedule.db_name,
+                    backup_file=backup_file,
+                    started=started,
+                    duration=time.time() - started,
+                    status='error',
+                    error=str(e),
+                )
+            else:
+                logger.info("Backup of '{db_name}' saved in '{backup_file}'".format(
+                    db_name=schedule.db_name,
+                    backup_file=backup_file))
+                result_log.record(
+                    database=schedule.db_name,
+                    backup_file=backup_file,
+                    started=started,
+                    duration=result.duration,
+                    bytes=result.bytes,
+                    checksum=result.checksum,
+                    status='ok',
+                )
+            finally:
+                with reserved_lock:
+                    reserved.discard(backup_file)
+
+        scheduler = Scheduler(schedules, run_job, max_jobs=options['max_jobs'])
+
+        def stop(signum, frame):
+            logger.info('Stopping, waiting for running backups to finish...')
+            scheduler.stop()
+
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+
+        scheduler.run()
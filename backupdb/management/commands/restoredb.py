@@ -3,15 +3,36 @@ from optparse import make_option
 from subprocess import CalledProcessError
 import logging
 import os
+import sys
 
 from django.core.management.base import CommandError
-from django.conf import settings
 
-from backupdb.utils.commands import BaseBackupDbCommand
+from backupdb.utils.cache import RestoreCache
+from backupdb.utils.commands import BaseBackupDbCommand, do_mysql_restore, do_postgresql_restore, get_db_host
 from backupdb.utils.exceptions import RestoreError
 from backupdb.utils.files import get_latest_timestamped_file
 from backupdb.utils.log import section, SectionError, SectionWarning
-from backupdb.utils.settings import BACKUP_DIR, BACKUP_CONFIG
+from backupdb.utils.parallel import FAILED, SKIPPED, Job, parse_job_count, run_jobs
+from backupdb.utils.pitr import format_until, get_pitr_dir, parse_until
+from backupdb.utils.portable import do_portable_restore
+from backupdb.utils.processes import is_stream
+from backupdb.utils.streams import StreamError, open_input
+from backupdb.utils.volumes import VolumeReader, is_volumed
+from backupdb.utils.warmup import read_hot_relations
+from backupdb.utils.settings import (
+    BACKUP_DIR,
+    BACKUP_CONFIG,
+    MAX_JOBS_PER_HOST,
+    PG_MAINTENANCE_DB,
+    PG_MAINTENANCE_WORK_MEM,
+    PITR_DIR,
+    PORTABLE_BATCH_SIZE,
+    PORTABLE_CONFIG,
+    RESTORE_CACHE_DIR,
+    RESTORE_CACHE_SIZE,
+    RESTORE_DEPENDENCIES,
+    RESTORE_PRIORITIES,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -19,6 +40,8 @@ logger = logging.getLogger(__name__)
 class Command(BaseBackupDbCommand):
     help = 'Restores each database in settings.DATABASES from latest db backup.'
 
+    cache = None
+
     def add_arguments(self, parser):
 
         parser.add_argument(
@@ -30,6 +53,25 @@ class Command(BaseBackupDbCommand):
                 'timestamped backup name.'
             ),
         )
+        parser.add_argument(
+            '--database',
+            action='append',
+            help=(
+                'Name of a database to restore.  May be repeated.  Defaults '
+                'to all databases in settings.DATABASES.'
+            ),
+        )
+        parser.add_argument(
+            '--input',
+            help=(
+                'Restore from this file, or from stdin if `-`, instead of '
+                'from the backup directory.  The input may be the backup of a '
+                'single database, which requires exactly one database to be '
+                'selected, or a backup stream written by `backupdb --output`, '
+                'whose backups are restored into the databases of the same '
+                'name in the order they appear.'
+            ),
+        )
         parser.add_argument(
             '--drop-tables',
             action='store_true',
@@ -41,6 +83,191 @@ class Command(BaseBackupDbCommand):
                 'necessary.'
             ),
         )
+        parser.add_argument(
+            '--portable',
+            action='store_true',
+            default=False,
+            help=(
+                'Restore portable backups made with `backupdb --portable` '
+                'through the Django ORM, into databases of any engine whose '
+                'tables have been created with `migrate`.  Rows are inserted '
+                'in batches in a single transaction with constraint checks '
+                'deferred.  With --drop-tables, the rows of the models are '
+                'deleted first.'
+            ),
+        )
+        parser.add_argument(
+            '--bulk-load',
+            action='store_true',
+            default=False,
+            help=(
+                'For mysql databases, restore in a session with foreign key '
+                'and unique checks disabled, binary logging disabled where '
+                'permitted and inserts committed in batches.  For postgres '
+                'databases, restore in a single transaction with '
+                'synchronous_commit off, maintenance_work_mem set to '
+                'settings.BACKUPDB_PG_MAINTENANCE_WORK_MEM and foreign keys '
+                'validated once the data is loaded.'
+            ),
+        )
+        parser.add_argument(
+            '--load-data',
+            action='store_true',
+            default=False,
+            help=(
+                'With --bulk-load, load the extended inserts of mysql dumps '
+                'with LOAD DATA LOCAL INFILE.  The server must have '
+                'local_infile enabled.'
+            ),
+        )
+        parser.add_argument(
+            '--unlogged',
+            action='store_true',
+            default=False,
+            help=(
+                'With --bulk-load, create postgres tables as UNLOGGED while '
+                'loading them and make them logged afterwards.'
+            ),
+        )
+        parser.add_argument(
+            '--staging',
+            action='store_true',
+            default=False,
+            help=(
+                'For postgres databases, restore into a new staging database '
+                'and then swap it with the live database by renaming both.  '
+                'The live database stays available until the swap.  '
+                'Connections to it are terminated during the swap.'
+            ),
+        )
+        parser.add_argument(
+            '--keep-old',
+            action='store_true',
+            default=False,
+            help=(
+                'With --staging, keep the previous database as '
+                '"<name>_old_<timestamp>" instead of dropping it.'
+            ),
+        )
+        parser.add_argument(
+            '--cache',
+            action='store_true',
+            default=False,
+            help=(
+                'Keep a pristine copy of each restored backup and restore '
+                'the same backup again by cloning it: postgres backups are '
+                'kept as template databases on the server, which replace the '
+                'restored database, and sqlite backups as files in '
+                'settings.BACKUPDB_RESTORE_CACHE_DIR.  The least recently '
+                'used copies are removed once they take up more than '
+                'settings.BACKUPDB_RESTORE_CACHE_SIZE bytes.  Mysql databases '
+                'are restored without the cache.'
+            ),
+        )
+        parser.add_argument(
+            '--until',
+            type=parse_until,
+            default=None,
+            metavar='"YYYY-MM-DD HH:MM:SS"',
+            help=(
+                'Recover each database to this local time from its archive '
+                'in settings.BACKUPDB_PITR_DIRECTORY, made with `backupdb '
+                '--base-backup` and `backupdb --archive-logs`.  Mysql '
+                'databases are restored from the latest base backup before '
+                'that time and their binary logs replayed up to it.  Postgres '
+                'servers are recovered into --pgdata.'
+            ),
+        )
+        parser.add_argument(
+            '--pgdata',
+            help=(
+                'With --until, the empty directory into which the base backup '
+                'of a postgres server is extracted.  The WAL is replayed up '
+                'to the requested time when a server (PostgreSQL 12 or '
+                'later) is started on this directory.'
+            ),
+        )
+        parser.add_argument(
+            '--jobs',
+            type=int,
+            default=1,
+            help=(
+                'Number of databases to restore at the same time.  Databases '
+                'listed in settings.BACKUPDB_RESTORE_DEPENDENCIES only start '
+                'once the databases they depend on have been restored, and '
+                'databases with a higher priority in '
+                'settings.BACKUPDB_RESTORE_PRIORITIES start first.  Defaults '
+                'to 1.'
+            ),
+        )
+        parser.add_argument(
+            '--jobs-per-host',
+            type=parse_job_count,
+            default=MAX_JOBS_PER_HOST,
+            help=(
+                'Maximum number of databases on the same server (HOST and '
+                'PORT) to restore at the same time.  Defaults to '
+                'settings.BACKUPDB_MAX_JOBS_PER_HOST or no limit.'
+            ),
+        )
+        parser.add_argument(
+            '--decompress-threads',
+            type=int,
+            default=1,
+            help=(
+                'Number of threads used to decompress backups.  Framed '
+                'backups are decompressed frame by frame; other backups are '
+                'decompressed by `rapidgzip` if it is installed, which caches '
+                'an index next to the backup file.  Defaults to 1, which uses '
+                '`gunzip`.'
+            ),
+        )
+        parser.add_argument(
+            '--replay-jobs',
+            type=int,
+            default=1,
+            help=(
+                'Number of connections used to restore each plain postgres or '
+                'mysql dump.  The dump is split as it is read: definitions '
+                'are run first, the data of each table is loaded on one of '
+                'the connections and, for postgres, indexes and constraints '
+                'are built on them once the data is loaded.  Defaults to 1, '
+                'which restores the dump on a single connection.'
+            ),
+        )
+        parser.add_argument(
+            '--warm-up',
+            action='store_true',
+            default=False,
+            help=(
+                'Refresh the planner statistics of each database after it is '
+                'restored: postgres tables are vacuumed and analyzed, mysql '
+                'and sqlite tables analyzed.  Tables are processed on '
+                '--warm-up-jobs connections.'
+            ),
+        )
+        parser.add_argument(
+            '--prewarm',
+            action='store_true',
+            default=False,
+            help=(
+                'Implies --warm-up.  Also load the tables and indexes which '
+                'were the most used when the backup was made with '
+                '`backupdb --capture-hot` into the cache of the database '
+                '(with pg_prewarm for postgres and the InnoDB buffer pool for '
+                'mysql).  Sqlite database files are read into the system '
+                'cache.'
+            ),
+        )
+        parser.add_argument(
+            '--warm-up-jobs',
+            type=int,
+            default=4,
+            help=(
+                'Number of connections used to warm up each restored '
+                'database.  Defaults to 4.'
+            ),
+        )
         parser.add_argument(
             '--show-output',
             action='store_true',
@@ -58,25 +285,156 @@ class Command(BaseBackupDbCommand):
     def handle(self, *args, **options):
         super(Command, self).handle(*args, **options)
 
+        databases = self.get_databases(options['database'])
+        if options['until'] is not None:
+            if options['input'] or options['backup_name'] or options['staging']:
+                raise CommandError('--until can not be used with --input, --backup-name or --staging')
+            postgresql_databases = [
+                db_name for db_name, db_config in databases
+                if BACKUP_CONFIG.get(db_config['ENGINE'], {}).get('restore_func') is do_postgresql_restore
+            ]
+            if len(postgresql_databases) > 1:
+                raise CommandError('--until recovers a single postgres server into --pgdata, use --database')
+        elif options['pgdata']:
+            raise CommandError('--pgdata requires --until')
+        if options['portable']:
+            if (options['bulk_load'] or options['staging'] or options['cache'] or options['until'] is not None or
+                    options['replay_jobs'] > 1):
+                raise CommandError(
+                    '--portable can not be used with --bulk-load, --staging, --cache, --until or --replay-jobs')
+        if options['replay_jobs'] > 1 and (options['bulk_load'] or options['staging']):
+            raise CommandError('--replay-jobs can not be used with --bulk-load or --staging')
+        self.cache = None
+        if options['cache']:
+            if options['input'] or options['staging'] or options['until'] is not None:
+                raise CommandError('--cache can not be used with --input, --staging or --until')
+            self.cache = RestoreCache(
+                RESTORE_CACHE_DIR,
+                RESTORE_CACHE_SIZE,
+                db_configs=[db_config for db_name, db_config in databases],
+                maintenance_db=PG_MAINTENANCE_DB,
+                show_output=options['show_output'],
+            )
+        if options['input']:
+            return self.restore_from_input(databases, options)
+
         # Ensure backup dir present
         if not os.path.exists(BACKUP_DIR):
             raise CommandError("Backup dir '{0}' does not exist!".format(BACKUP_DIR))
 
+        jobs = []
+        for db_name, db_config in databases:
+            jobs.append(Job(
+                db_name,
+                self.get_restore_func(db_name, db_config, options),
+                depends_on=RESTORE_DEPENDENCIES.get(db_name, ()),
+                priority=RESTORE_PRIORITIES.get(db_name, 0),
+                host=get_db_host(db_config),
+            ))
+
+        try:
+            results = run_jobs(jobs, max_workers=options['jobs'], max_per_host=options['jobs_per_host'])
+        except ValueError as e:
+            raise CommandError(e)
+
+        failed = [j.name for j in jobs if results[j.name] == FAILED]
+        skipped = [j.name for j in jobs if results[j.name] == SKIPPED]
+        if failed:
+            logger.error('Failed to restore: {0}'.format(', '.join(failed)))
+        if skipped:
+            logger.error('Skipped because a dependency failed: {0}'.format(', '.join(skipped)))
+
+    def restore_from_input(self, databases, options):
+        """
+        Restores `databases` from the file or stdin given by `--input`.
+        """
+        from_stdin = options['input'] == '-'
+        if from_stdin:
+            input = getattr(sys.stdin, 'buffer', sys.stdin)
+        else:
+            try:
+                input = open(options['input'], 'rb')
+            except IOError as e:
+                raise CommandError(e)
+
+        try:
+            is_backup_stream, reader = open_input(input)
+            if not is_backup_stream:
+                if len(databases) != 1:
+                    raise CommandError('A single backup can only be restored into one database, use --database')
+                db_name, db_config = databases[0]
+                restored = [self.restore_database(db_name, db_config, options, backup_file=reader)]
+            else:
+                restored = [self.restore_backup(backup, dict(databases), options) for backup in reader]
+        except StreamError as e:
+            raise CommandError(e)
+        finally:
+            if not from_stdin:
+                input.close()
+
+        if not all(restored):
+            raise CommandError('Failed to restore some databases')
+
+    def restore_backup(self, backup, databases, options):
+        """
+        Restores a backup read from a backup stream into the database of the
+        same name.  Returns False if the restore failed.
+        """
+        db_config = databases.get(backup.name)
+        if db_config is None:
+            logger.warning("Skipping backup of '{0}' which is not selected".format(backup.name))
+            return True
+
+        backup_config = BACKUP_CONFIG.get(db_config['ENGINE'], {})
+        if backup_config.get('backup_extension') != backup.info.get('extension'):
+            logger.error("Backup of '{0}' was made from a '{1}' database".format(
+                backup.name, backup.info.get('engine')))
+            return False
+
+        if not self.restore_database(backup.name, db_config, options, backup_file=backup):
+            return False
+        try:
+            backup.finish()
+        except StreamError as e:
+            logger.error(e)
+            return False
+        return True
+
+    def get_restore_func(self, db_name, db_config, options):
+        def restore():
+            return self.restore_database(db_name, db_config, options)
+        return restore
+
+    def restore_database(self, db_name, db_config, options, backup_file=None):
+        """
+        Restores a single database from the backup directory or, if given,
+        from the readable binary file-like object `backup_file`.  Returns True
+        if it was restored.
+        """
         backup_name = options['backup_name']
         drop_tables = options['drop_tables']
         show_output = options['show_output']
 
-        # Loop through databases
-        for db_name, db_config in settings.DATABASES.items():
-            with section("Restoring '{0}'...".format(db_name)):
-                # Get backup config for this engine type
-                engine = db_config['ENGINE']
-                backup_config = BACKUP_CONFIG.get(engine)
-                if not backup_config:
-                    raise SectionWarning("Restore for '{0}' engine not implemented".format(engine))
-
-                # Get backup file name
-                backup_extension = backup_config['backup_extension']
+        restored = False
+        with section("Restoring '{0}'...".format(db_name)):
+            # Get backup config for this engine type
+            engine = db_config['ENGINE']
+            backup_config = BACKUP_CONFIG.get(engine)
+            if options['portable']:
+                # Restored databases are still warmed up for their engine
+                backup_config = dict(
+                    PORTABLE_CONFIG, warm_up_func=backup_config['warm_up_func'] if backup_config else None)
+            elif not backup_config:
+                raise SectionWarning("Restore for '{0}' engine not implemented".format(engine))
+
+            if options['until'] is not None:
+                return self.recover_database(db_name, db_config, backup_config, options)
+
+            # Get backup file name
+            backup_extension = backup_config['backup_extension']
+            if backup_file is not None:
+                source = options['input']
+            else:
                 if backup_name:
                     backup_file = '{dir}/{db_name}-{backup_name}.{ext}.gz'.format(
                         dir=BACKUP_DIR,
@@ -89,21 +447,123 @@ class Command(BaseBackupDbCommand):
                         backup_file = get_latest_timestamped_file(backup_extension)
                     except RestoreError as e:
                         raise SectionError(e)
+                source = backup_file
+
+            # Find restore command and get kwargs
+            restore_func = backup_config['restore_func']
+            if options['replay_jobs'] > 1:
+                if backup_config['replay_func']:
+                    restore_func = backup_config['replay_func']
+                else:
+                    logger.warning("Restoring '{0}' on a single connection, '{1}' backups can't be replayed".format(
+                        db_name, engine))
+            restore_kwargs = {
+                'backup_file': backup_file,
+                'db_config': db_config,
+                'drop_tables': drop_tables,
+                'show_output': show_output,
+                'decompress_threads': options['decompress_threads'],
+            }
+            if restore_func is do_mysql_restore:
+                restore_kwargs['bulk_load'] = options['bulk_load']
+                restore_kwargs['load_data'] = options['load_data']
+            if restore_func is do_postgresql_restore:
+                restore_kwargs['staging'] = options['staging']
+                restore_kwargs['keep_old'] = options['keep_old']
+                restore_kwargs['maintenance_db'] = PG_MAINTENANCE_DB
+                restore_kwargs['bulk_load'] = options['bulk_load']
+                restore_kwargs['unlogged'] = options['unlogged']
+                restore_kwargs['maintenance_work_mem'] = PG_MAINTENANCE_WORK_MEM
+            if restore_func is backup_config['replay_func']:
+                restore_kwargs['jobs'] = options['replay_jobs']
+            if restore_func is do_portable_restore:
+                del restore_kwargs['db_config']
+                restore_kwargs['using'] = db_name
+                restore_kwargs['batch_size'] = PORTABLE_BATCH_SIZE
+
+            # Run restore command
+            reader = None
+            try:
+                if not is_stream(backup_file) and is_volumed(backup_file):
+                    # Volumes are read back as a single stream
+                    reader = VolumeReader(backup_file)
+                    restore_kwargs['backup_file'] = reader
 
-                # Find restore command and get kwargs
-                restore_func = backup_config['restore_func']
-                restore_kwargs = {
-                    'backup_file': backup_file,
-                    'db_config': db_config,
-                    'drop_tables': drop_tables,
-                    'show_output': show_output,
-                }
-
-                # Run restore command
-                try:
+                if self.cache is not None and self.cache.can_restore(db_config):
+                    if self.cache.restore(backup_file=restore_kwargs['backup_file'], db_config=db_config,
+                                          restore_func=restore_func, restore_kwargs=restore_kwargs):
+                        source = '{0} (cached)'.format(source)
+                else:
+                    if self.cache is not None:
+                        logger.warning("Restoring '{0}' without the cache, which does not support '{1}'".format(
+                            db_name, engine))
                     restore_func(**restore_kwargs)
-                    logger.info("Restored '{db_name}' from '{backup_file}'".format(
-                        db_name=db_name,
-                        backup_file=backup_file))
-                except (RestoreError, CalledProcessError) as e:
-                    raise SectionError(e)
+                logger.info("Restored '{db_name}' from '{backup_file}'".format(
+                    db_name=db_name,
+                    backup_file=source))
+            except (RestoreError, CalledProcessError, StreamError) as e:
+                raise SectionError(e)
+            finally:
+                if reader is not None:
+                    reader.close()
+            restored = True
+
+            if options['warm_up'] or options['prewarm']:
+                self.warm_up_database(db_name, db_config, backup_config, backup_file, options)
+        return restored
+
+    def recover_database(self, db_name, db_config, backup_config, options):
+        """
+        Recovers a single database to the time given by `--until` from its
+        point-in-time recovery archive.  Returns True if it was recovered.
+        """
+        restore_func = backup_config['pitr_restore_func']
+        if not restore_func:
+            raise SectionWarning("Point-in-time recovery for '{0}' engine not implemented".format(
+                db_config['ENGINE']))
+
+        try:
+            restore_func(
+                get_pitr_dir(db_name, PITR_DIR),
+                db_config,
+                options['until'],
+                target_dir=options['pgdata'],
+                drop_tables=options['drop_tables'],
+                show_output=options['show_output'],
+                decompress_threads=options['decompress_threads'],
+            )
+        except (RestoreError, CalledProcessError) as e:
+            raise SectionError(e)
+        if options['pgdata']:
+            logger.info("Set up '{0}' to recover '{1}' until {2}".format(
+                options['pgdata'], db_name, format_until(options['until'])))
+        else:
+            logger.info("Recovered '{0}' until {1}".format(db_name, format_until(options['until'])))
+
+        # A server recovered into a data directory is not running yet
+        if (options['warm_up'] or options['prewarm']) and not options['pgdata']:
+            self.warm_up_database(db_name, db_config, backup_config, None, options)
+        return True
+
+    def warm_up_database(self, db_name, db_config, backup_config, backup_file, options):
+        if not backup_config['warm_up_func']:
+            logger.warning("Warm-up for '{0}' engine not implemented".format(db_config['ENGINE']))
+            return
+
+        hot_relations = None
+        if options['prewarm']:
+            hot_relations = read_hot_relations(backup_file)
+            if hot_relations is None:
+                logger.info("No hot relations were captured with the backup of '{0}'".format(db_name))
+
+        logger.info("Warming up '{0}'...".format(db_name))
+        warmed_up = backup_config['warm_up_func'](
+            db_config,
+            jobs=options['warm_up_jobs'],
+            prewarm=options['prewarm'],
+            hot_relations=hot_relations,
+            show_output=options['show_output'],
+        )
+        if not warmed_up:
+            # The database is usable without statistics and caches
+            logger.warning("Warm-up of '{0}' did not complete".format(db_name))
@@ -1,21 +1,81 @@
 import unittest
 
+from . import api
+from . import audit
+from . import cache
+from . import cli
 from . import commands
 from . import files
+from . import frames
+from . import history
 from . import log
+from . import parallel
+from . import pitr
+from . import portable
 from . import processes
+from . import replay
+from . import resources
+from . import resumable
+from . import scheduler
+from . import sinks
+from . import snapshots
+from . import sqlfilters
+from . import streams
+from . import subset
+from . import volumes
+from . import warmup
 
 
 loader = unittest.TestLoader()
 
+api_tests = loader.loadTestsFromModule(api)
+audit_tests = loader.loadTestsFromModule(audit)
+cache_tests = loader.loadTestsFromModule(cache)
+cli_tests = loader.loadTestsFromModule(cli)
 commands_tests = loader.loadTestsFromModule(commands)
 files_tests = loader.loadTestsFromModule(files)
+frames_tests = loader.loadTestsFromModule(frames)
+history_tests = loader.loadTestsFromModule(history)
 log_tests = loader.loadTestsFromModule(log)
+parallel_tests = loader.loadTestsFromModule(parallel)
+pitr_tests = loader.loadTestsFromModule(pitr)
+portable_tests = loader.loadTestsFromModule(portable)
 processes_tests = loader.loadTestsFromModule(processes)
+replay_tests = loader.loadTestsFromModule(replay)
+resources_tests = loader.loadTestsFromModule(resources)
+resumable_tests = loader.loadTestsFromModule(resumable)
+scheduler_tests = loader.loadTestsFromModule(scheduler)
+sinks_tests = loader.loadTestsFromModule(sinks)
+snapshots_tests = loader.loadTestsFromModule(snapshots)
+sqlfilters_tests = loader.loadTestsFromModule(sqlfilters)
+streams_tests = loader.loadTestsFromModule(streams)
+subset_tests = loader.loadTestsFromModule(subset)
+volumes_tests = loader.loadTestsFromModule(volumes)
+warmup_tests = loader.loadTestsFromModule(warmup)
 
 all_tests = unittest.TestSuite([
+    api_tests,
+    audit_tests,
+    cache_tests,
+    cli_tests,
     commands_tests,
     files_tests,
+    frames_tests,
+    history_tests,
     log_tests,
+    parallel_tests,
+    pitr_tests,
+    portable_tests,
     processes_tests,
+    replay_tests,
+    resources_tests,
+    resumable_tests,
+    scheduler_tests,
+    sinks_tests,
+    snapshots_tests,
+    sqlfilters_tests,
+    streams_tests,
+    subset_tests,
+    volumes_tests,
+    warmup_tests,
 ])
@@ -0,0 +1,85 @@
+import gzip
+import hashlib
+import io
+import sqlite3
+
+from backupdb import api
+from backupdb.utils.exceptions import BackupError, RestoreError
+
+from .utils import FileSystemScratchTestCase
+
+
+def make_sqlite_config(path):
+    return {'ENGINE': 'django.db.backends.sqlite3', 'NAME': path}
+
+
+class ApiTestCase(FileSystemScratchTestCase):
+    def setUp(self):
+        super(ApiTestCase, self).setUp()
+        self.db_path = self.get_path('api.db')
+        conn = sqlite3.connect(self.db_path)
+        conn.execute('CREATE TABLE spam (id INTEGER PRIMARY KEY, name TEXT)')
+        conn.executemany('INSERT INTO spam (name) VALUES (?)', [('eggs',)] * 100)
+        conn.commit()
+        conn.close()
+
+    def get_db_content(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def test_backup_writes_to_a_stream_and_returns_stats(self):
+        output = io.BytesIO()
+        result = api.backup('default', output, db_config=make_sqlite_config(self.db_path))
+
+        data = output.getvalue()
+        self.assertEqual(result.bytes, len(data))
+        self.assertEqual(result.checksum, hashlib.sha256(data).hexdigest())
+        self.assertEqual(len(result.stages), 2)
+        self.assertTrue(result.duration >= 0)
+        self.assertEqual(gzip.GzipFile(fileobj=io.BytesIO(data)).read(), self.get_db_content(self.db_path))
+
+    def test_backup_writes_to_a_callback(self):
+        chunks = []
+        result = api.backup('default', chunks.append, db_config=make_sqlite_config(self.db_path))
+
+        self.assertEqual(result.bytes, sum(len(c) for c in chunks))
+
+    def test_backup_writes_to_a_path(self):
+        path = self.get_path('api.sqlite.gz')
+        result = api.backup('default', path, db_config=make_sqlite_config(self.db_path))
+
+        self.assertFileExists('api.sqlite.gz')
+        self.assertEqual(result.checksum, hashlib.sha256(self.get_db_content(path)).hexdigest())
+
+    def test_restore_reads_from_a_stream(self):
+        output = io.BytesIO()
+        backup_result = api.backup('default', output, db_config=make_sqlite_config(self.db_path))
+
+        restored_path = self.get_path('restored.db')
+        result = api.restore(
+            'default',
+            io.BytesIO(output.getvalue()),
+            db_config=make_sqlite_config(restored_path),
+        )
+
+        self.assertEqual(result.checksum, backup_result.checksum)
+        self.assertEqual(result.bytes, backup_result.bytes)
+        self.assertEqual(self.get_db_content(restored_path), self.get_db_content(self.db_path))
+
+    def test_it_round_trips_framed_backups_with_several_threads(self):
+        output = io.BytesIO()
+        api.backup('default', output, db_config=make_sqlite_config(self.db_path), compress_threads=2)
+
+        restored_path = self.get_path('restored.db')
+        api.restore(
+            'default',
+            io.BytesIO(output.getvalue()),
+            db_config=make_sqlite_config(restored_path),
+            decompress_threads=2,
+        )
+
+        self.assertEqual(self.get_db_content(restored_path), self.get_db_content(self.db_path))
+
+    def test_it_raises_errors_for_unknown_engines_and_missing_files(self):
+        self.assertRaises(BackupError, api.backup, 'default', io.BytesIO(), db_config={'ENGINE': 'spam'})
+        self.assertRaises(RestoreError, api.restore, 'default', 'i_dont_exist', db_config=make_sqlite_config('x'))
@@ -0,0 +1,23 @@
+from django.db import models
+
+
+class Author(models.Model):
+    name = models.CharField(max_length=100)
+    updated = models.DateTimeField(auto_now=True)
+
+
+class Tag(models.Model):
+    name = models.CharField(max_length=100)
+
+
+class Book(models.Model):
+    author = models.ForeignKey(Author, on_delete=models.CASCADE)
+    title = models.CharField(max_length=100)
+    price = models.DecimalField(max_digits=6, decimal_places=2)
+    code = models.UUIDField()
+    cover = models.BinaryField(null=True)
+    tags = models.ManyToManyField(Tag)
+
+
+class Ebook(Book):
+    url = models.CharField(max_length=200)
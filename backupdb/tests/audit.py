@@ -0,0 +1,175 @@
+import gzip
+import hashlib
+import json
+import os
+
+from django.core.management import call_command
+from mock import patch
+
+from backupdb.utils.audit import (
+    CHECKSUM_MISMATCH,
+    CORRUPT,
+    MISSING,
+    OK,
+    TRUNCATED,
+    audit_file,
+    audit_files,
+    find_backup_files,
+    load_catalog,
+    load_report,
+)
+from backupdb.utils.frames import compress_frame
+from backupdb.utils.volumes import VolumeWriter, get_volume_file
+
+from .utils import FileSystemScratchTestCase
+
+DATA = b''.join(b'INSERT INTO spam VALUES (' + str(i).encode() + b');\n' for i in range(5000))
+
+
+class AuditTestCase(FileSystemScratchTestCase):
+    def write(self, name, data):
+        path = self.get_path(name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def write_gzip(self, name):
+        path = self.get_path(name)
+        with gzip.open(path, 'wb') as f:
+            f.write(DATA)
+        return path
+
+    def write_volumes(self, name):
+        path = self.get_path(name)
+        writer = VolumeWriter(path, volume_size=4096)
+        writer.write(gzip.compress(DATA))
+        writer.close()
+        return path
+
+
+class AuditFileTestCase(AuditTestCase):
+    def test_it_accepts_readable_backups(self):
+        path = self.write_gzip('default-1.pgsql.gz')
+        with open(path, 'rb') as f:
+            checksum = hashlib.sha256(f.read()).hexdigest()
+
+        result = audit_file(path, checksum)
+
+        self.assertEqual(result['status'], OK)
+        self.assertEqual(result['checksum'], checksum)
+
+    def test_it_accepts_framed_backups(self):
+        path = self.write('default-1.pgsql.gz', compress_frame(DATA[:1000]) + compress_frame(DATA[1000:]))
+
+        self.assertEqual(audit_file(path)['status'], OK)
+
+    def test_it_detects_truncated_backups(self):
+        data = gzip.compress(DATA)
+        self.assertEqual(audit_file(self.write('a.pgsql.gz', data[:len(data) // 2]))['status'], TRUNCATED)
+        self.assertEqual(audit_file(self.write('b.pgsql.gz', compress_frame(DATA)[:-10]))['status'], TRUNCATED)
+        self.assertEqual(audit_file(self.write('c.pgsql.gz', b''))['status'], TRUNCATED)
+
+    def test_it_detects_corrupt_backups(self):
+        data = bytearray(gzip.compress(DATA))
+        data[-6] ^= 0xff
+
+        self.assertEqual(audit_file(self.write('a.pgsql.gz', bytes(data)))['status'], CORRUPT)
+        self.assertEqual(audit_file(self.write('b.pgsql.gz', DATA))['status'], CORRUPT)
+
+    def test_it_detects_checksum_mismatches(self):
+        result = audit_file(self.write_gzip('default-1.pgsql.gz'), 'abc')
+
+        self.assertEqual(result['status'], CHECKSUM_MISMATCH)
+        self.assertEqual(result['expected_checksum'], 'abc')
+
+    def test_it_detects_missing_backups(self):
+        self.assertEqual(audit_file(self.get_path('default-1.pgsql.gz'))['status'], MISSING)
+
+    def test_it_checks_the_volumes_of_volumed_backups(self):
+        path = self.write_volumes('default-1.pgsql.gz')
+        self.assertEqual(audit_file(path, hashlib.sha256(gzip.compress(DATA)).hexdigest())['status'], OK)
+
+        volume = get_volume_file(path, 1)
+        with open(volume, 'rb') as f:
+            data = bytearray(f.read())
+        data[0] ^= 0xff
+        with open(volume, 'wb') as f:
+            f.write(bytes(data))
+        self.assertEqual(audit_file(path)['status'], CHECKSUM_MISMATCH)
+
+        with open(volume, 'wb') as f:
+            f.write(bytes(data[:-1]))
+        self.assertEqual(audit_file(path)['status'], TRUNCATED)
+
+        os.remove(volume)
+        self.assertEqual(audit_file(path)['status'], MISSING)
+
+
+class AuditFilesTestCase(AuditTestCase):
+    def test_it_audits_files_on_several_processes(self):
+        good = self.write_gzip('default-1.pgsql.gz')
+        bad = self.write('default-2.pgsql.gz', DATA)
+
+        results = dict((r['path'], r['status']) for r in audit_files([good, bad], processes=2, io_limit=1))
+
+        self.assertEqual(results, {good: OK, bad: CORRUPT})
+
+
+class FindBackupFilesTestCase(AuditTestCase):
+    def test_it_separates_backups_from_orphans(self):
+        backup = self.write_gzip('default-1.pgsql.gz')
+        self.write('default-1.pgsql.gz.gzindex', b'')
+        self.write('default-1.pgsql.gz.hot', b'[]')
+        orphaned_index = self.write('default-0.pgsql.gz.gzindex', b'')
+        orphaned_hot = self.write('default-0.pgsql.gz.hot', b'[]')
+        unknown = self.write('default-1.pgsql.gz.part', b'')
+        report = self.write('audit.jsonl', b'')
+
+        backups, orphans = find_backup_files(self.SCRATCH_DIR, ['pgsql', 'mysql'], ignore=[report])
+
+        self.assertEqual(backups, [backup])
+        self.assertEqual(orphans, [orphaned_index, orphaned_hot, unknown])
+
+    def test_it_finds_volumed_backups_by_their_manifest(self):
+        backup = self.write_volumes('default-1.pgsql.gz')
+        self.write('default-1.pgsql.gz.hot', b'[]')
+        orphaned_volume = self.write('default-0.pgsql.gz.000', b'')
+
+        backups, orphans = find_backup_files(self.SCRATCH_DIR, ['pgsql'])
+
+        self.assertEqual(backups, [backup])
+        self.assertEqual(orphans, [orphaned_volume])
+
+
+class AuditBackupsCommandTestCase(AuditTestCase):
+    def test_it_audits_portable_backups(self):
+        self.write_gzip('default-1.portable.gz')
+        report = self.get_path('audit.jsonl')
+
+        with patch('backupdb.management.commands.auditbackups.BACKUP_DIR', self.SCRATCH_DIR):
+            call_command('auditbackups', processes=1, catalog=self.get_path('results.jsonl'), report=report)
+
+        self.assertEqual(
+            [r['status'] for r in load_report(report).values()], [OK])
+
+
+class LoadCatalogTestCase(AuditTestCase):
+    def test_it_reads_checksums_of_successful_backups(self):
+        path = self.write('results.jsonl', '\n'.join([
+            json.dumps({'backup_file': 'backups/./a.pgsql.gz', 'status': 'ok', 'checksum': 'abc'}),
+            json.dumps({'backup_file': 'backups/b.pgsql.gz', 'status': 'error', 'error': 'oops'}),
+        ]).encode())
+
+        self.assertEqual(load_catalog(path), {'backups/a.pgsql.gz': 'abc'})
+        self.assertEqual(load_catalog(self.get_path('missing.jsonl')), {})
+
+
+class LoadReportTestCase(AuditTestCase):
+    def test_it_ignores_an_incomplete_last_line(self):
+        path = self.write('audit.jsonl', (
+            json.dumps({'path': 'a.pgsql.gz', 'status': 'ok'}) + '\n' +
+            json.dumps({'path': 'a.pgsql.gz', 'status': 'corrupt'}) + '\n' +
+            '{"path": "b.pg'
+        ).encode())
+
+        self.assertEqual(load_report(path), {'a.pgsql.gz': {'path': 'a.pgsql.gz', 'status': 'corrupt'}})
@@ -0,0 +1,193 @@
+import gzip
+import logging
+import os
+import shutil
+import sqlite3
+import stat
+import tempfile
+import unittest
+
+from mock import patch
+
+from backupdb.utils.cache import RestoreCache, get_backup_key
+from backupdb.utils.commands import do_postgresql_restore, do_sqlite_restore
+from backupdb.utils.exceptions import RestoreError
+
+PG_CONFIG = {'ENGINE': 'django.db.backends.postgresql_psycopg2', 'NAME': 'test_db', 'USER': 'test_user'}
+
+
+class CacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.cache = RestoreCache(os.path.join(self.dir, 'cache'), 1024 ** 3)
+
+    def get_path(self, name):
+        return os.path.join(self.dir, name)
+
+    def write_backup(self, name, data=b'backup'):
+        with gzip.open(self.get_path(name), 'wb') as f:
+            f.write(data)
+        return self.get_path(name)
+
+
+class BackupKeyTestCase(CacheTestCase):
+    def test_replaced_backups_get_another_key(self):
+        backup_file = self.write_backup('default.sqlite.gz')
+        key = get_backup_key(backup_file)
+        self.assertEqual(get_backup_key(backup_file), key)
+
+        self.write_backup('default.sqlite.gz', b'other backup')
+        os.utime(backup_file, (0, 0))
+        self.assertNotEqual(get_backup_key(backup_file), key)
+
+
+class SqliteCacheTestCase(CacheTestCase):
+    def make_backup(self, name, value):
+        db_file = self.get_path('source.db')
+        conn = sqlite3.connect(db_file)
+        conn.execute('CREATE TABLE spam (value text)')
+        conn.execute('INSERT INTO spam VALUES (?)', (value,))
+        conn.commit()
+        conn.close()
+        with open(db_file, 'rb') as f:
+            backup_file = self.write_backup(name, f.read())
+        os.remove(db_file)
+        return backup_file
+
+    def read(self, db_file):
+        conn = sqlite3.connect(db_file)
+        try:
+            return conn.execute('SELECT value FROM spam').fetchall()
+        finally:
+            conn.close()
+
+    def restore(self, backup_file, db_file, restore_func=do_sqlite_restore):
+        db_config = {'ENGINE': 'django.db.backends.sqlite3', 'NAME': db_file}
+        return self.cache.restore(
+            backup_file=backup_file,
+            db_config=db_config,
+            restore_func=restore_func,
+            restore_kwargs={'backup_file': backup_file, 'db_config': db_config},
+        )
+
+    def test_it_restores_again_from_the_cached_copy(self):
+        backup_file = self.make_backup('default.sqlite.gz', 'eggs')
+        db_file = self.get_path('default.db')
+
+        self.assertFalse(self.restore(backup_file, db_file))
+        with sqlite3.connect(db_file) as conn:
+            conn.execute("UPDATE spam SET value = 'changed'")
+        with patch('backupdb.tests.cache.do_sqlite_restore') as restore_func:
+            self.assertTrue(self.restore(backup_file, db_file, restore_func))
+
+        self.assertFalse(restore_func.called)
+        self.assertEqual(self.read(db_file), [('eggs',)])
+        self.assertEqual(sorted(os.listdir(self.dir)), ['cache', 'default.db', 'default.sqlite.gz'])
+
+    def test_copies_keep_the_permissions_of_the_database(self):
+        backup_file = self.make_backup('default.sqlite.gz', 'eggs')
+        db_file = self.get_path('default.db')
+        self.restore(backup_file, db_file)
+        os.chmod(db_file, 0o640)
+
+        self.assertTrue(self.restore(backup_file, db_file))
+
+        self.assertEqual(stat.S_IMODE(os.stat(db_file).st_mode), 0o640)
+
+    def test_it_removes_the_least_recently_used_copies(self):
+        backups = [self.make_backup('{0}.sqlite.gz'.format(i), str(i)) for i in range(3)]
+        self.restore(backups[0], self.get_path('default.db'))
+        size = self.cache.read_index().popitem()[1]['size']
+        self.cache.max_size = 2 * size
+
+        self.restore(backups[1], self.get_path('default.db'))
+        self.restore(backups[0], self.get_path('default.db'))
+        self.restore(backups[2], self.get_path('default.db'))
+
+        self.assertEqual(
+            sorted(self.cache.read_index()),
+            sorted([get_backup_key(backups[0]), get_backup_key(backups[2])]),
+        )
+        self.assertEqual(len([f for f in os.listdir(self.cache.dir) if f.endswith('.sqlite')]), 2)
+
+    def test_failed_restores_are_not_cached(self):
+        backup_file = self.write_backup('default.sqlite.gz', b'not a database')
+        logging.disable(logging.CRITICAL)
+        self.addCleanup(logging.disable, logging.NOTSET)
+
+        self.assertRaises(RestoreError, self.restore, backup_file, self.get_path('default.db'))
+        self.assertRaises(RestoreError, self.restore, self.get_path('missing.sqlite.gz'), self.get_path('default.db'))
+
+        self.assertEqual(self.cache.read_index(), {})
+        self.assertFalse(os.path.exists(self.get_path('default.db')))
+
+
+class PostgresqlCacheTestCase(CacheTestCase):
+    @patch('backupdb.utils.cache.run_postgresql_sql')
+    def test_it_clones_a_template_database(self, run_postgresql_sql):
+        backup_file = self.write_backup('default.pgsql.gz')
+        template = 'backupdb_cache_' + get_backup_key(backup_file)
+        restore_kwargs = {'backup_file': backup_file, 'db_config': PG_CONFIG, 'drop_tables': True}
+        run_postgresql_sql.side_effect = lambda db_config, sql, **kwargs: (
+            '4096\n' if sql.startswith('SELECT pg_database_size') else '')
+
+        with patch('backupdb.tests.cache.do_postgresql_restore') as restore_func:
+            hit = self.cache.restore(
+                backup_file=backup_file, db_config=PG_CONFIG,
+                restore_func=restore_func, restore_kwargs=restore_kwargs)
+
+        self.assertFalse(hit)
+        self.assertEqual(restore_func.call_args[1]['db_config']['NAME'], template)
+        self.assertFalse(restore_func.call_args[1]['drop_tables'])
+        statements = [(c[0][0]['NAME'], c[0][1]) for c in run_postgresql_sql.call_args_list]
+        self.assertTrue(statements[-4][1].startswith('SELECT string_agg(statement'))
+        del statements[-4]
+        self.assertEqual(statements[-6:], [
+            (template, 'ANALYZE'),
+            ('postgres', 'ALTER DATABASE "{0}" WITH IS_TEMPLATE true ALLOW_CONNECTIONS false'.format(template)),
+            ('postgres', "SELECT pg_database_size('{0}')".format(template)),
+            ('postgres', "SELECT pg_terminate_backend(pid) FROM pg_stat_activity "
+                         "WHERE datname = 'test_db' AND pid <> pg_backend_pid()"),
+            ('postgres', 'DROP DATABASE IF EXISTS "test_db"'),
+            ('postgres', 'CREATE DATABASE "test_db" TEMPLATE "{0}" OWNER "test_user"'.format(template)),
+        ])
+        self.assertIn(('postgres', 'CREATE DATABASE "{0}" TEMPLATE template0'.format(template)), statements)
+
+        # The template exists on the server
+        run_postgresql_sql.side_effect = lambda db_config, sql, **kwargs: '1\n' if sql.startswith('SELECT 1') else ''
+        run_postgresql_sql.reset_mock()
+        self.assertTrue(self.cache.restore(
+            backup_file=backup_file, db_config=PG_CONFIG,
+            restore_func=do_postgresql_restore, restore_kwargs=restore_kwargs))
+        self.assertEqual(run_postgresql_sql.call_args[0][1], statements[-1][1])
+
+    @patch('backupdb.utils.cache.run_postgresql_sql')
+    def test_clones_keep_the_owner_and_settings_of_the_database(self, run_postgresql_sql):
+        backup_file = self.write_backup('default.pgsql.gz')
+        template = 'backupdb_cache_' + get_backup_key(backup_file)
+        settings_sql = 'ALTER DATABASE "test_db" OWNER TO owner;\nALTER DATABASE "test_db" SET work_mem TO \'64MB\''
+
+        def run(db_config, sql, **kwargs):
+            if sql.startswith('SELECT pg_database_size'):
+                return '4096\n'
+            if sql.startswith('SELECT string_agg'):
+                self.assertIn("d.datname = 'test_db'", sql)
+                return settings_sql + '\n'
+            return ''
+        run_postgresql_sql.side_effect = run
+
+        with patch('backupdb.tests.cache.do_postgresql_restore') as restore_func:
+            self.cache.restore(
+                backup_file=backup_file, db_config=PG_CONFIG, restore_func=restore_func,
+                restore_kwargs={'backup_file': backup_file, 'db_config': PG_CONFIG})
+
+        statements = [c[0][1] for c in run_postgresql_sql.call_args_list]
+        self.assertEqual(statements[-2:], [
+            'CREATE DATABASE "test_db" TEMPLATE "{0}"'.format(template),
+            settings_sql,
+        ])
+        self.assertLess(
+            [i for i, sql in enumerate(statements) if sql.startswith('SELECT string_agg')][0],
+            statements.index('DROP DATABASE IF EXISTS "test_db"'),
+        )
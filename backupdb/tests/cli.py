@@ -0,0 +1,42 @@
+import json
+
+from backupdb import cli
+
+from .utils import FileSystemScratchTestCase
+
+
+class LoadConfigTestCase(FileSystemScratchTestCase):
+    def test_it_reads_a_json_config_file(self):
+        with open(self.get_path('config.json'), 'w') as f:
+            json.dump({
+                'DATABASES': {'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': 'db'}},
+                'BACKUPDB_DIRECTORY': '/backups',
+                'SECRET_KEY': 'ignored',
+            }, f)
+
+        config = cli.load_config(config_file=self.get_path('config.json'))
+
+        self.assertEqual(sorted(config), ['BACKUPDB_DIRECTORY', 'DATABASES'])
+        self.assertEqual(config['BACKUPDB_DIRECTORY'], '/backups')
+
+    def test_it_reads_only_databases_and_backupdb_settings_from_a_settings_module(self):
+        config = cli.load_config(settings_module='test_settings')
+
+        self.assertEqual(sorted(config), ['BACKUPDB_DIRECTORY', 'DATABASES'])
+
+    def test_it_raises_an_error_without_databases(self):
+        with open(self.get_path('config.json'), 'w') as f:
+            json.dump({'BACKUPDB_DIRECTORY': '/backups'}, f)
+
+        self.assertRaises(ValueError, cli.load_config, config_file=self.get_path('config.json'))
+
+
+class GetDbNamesTestCase(FileSystemScratchTestCase):
+    CONFIG = {'DATABASES': {'default': {}, 'other': {}}}
+
+    def test_it_defaults_to_all_databases(self):
+        self.assertEqual(cli.get_db_names(self.CONFIG), ['default', 'other'])
+
+    def test_it_rejects_unknown_databases(self):
+        self.assertEqual(cli.get_db_names(self.CONFIG, ['other']), ['other'])
+        self.assertRaises(ValueError, cli.get_db_names, self.CONFIG, ['spam'])
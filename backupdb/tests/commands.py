@@ -1,4 +1,12 @@
 from mock import call, patch
+from subprocess import CalledProcessError
+import gzip
+import io
+import os
+import sqlite3
+import stat
+import subprocess
+import sys
 import unittest
 
 from backupdb.utils.commands import (
@@ -12,8 +20,17 @@ from backupdb.utils.commands import (
     do_mysql_restore,
     do_postgresql_restore,
     do_sqlite_restore,
+    get_compress_cmd,
+    get_db_host,
+    get_decompress_cmds,
+    get_frames_cmd,
+    get_script_cmd,
 )
 from backupdb.utils.exceptions import RestoreError
+from backupdb.utils import sqlfilters
+from backupdb.utils.frames import compress_frame
+
+from .utils import FileSystemScratchTestCase
 
 
 DB_CONFIG = {
@@ -75,6 +92,72 @@ class RequireBackupExistsTestCase(unittest.TestCase):
         self.assertRaises(RestoreError, do_sqlite_restore, backup_file='i_dont_exist', db_config={})
 
 
+class GetCompressCmdTestCase(unittest.TestCase):
+    def test_it_uses_gzip_for_a_single_thread(self):
+        self.assertEqual(get_compress_cmd(), ['gzip'])
+
+    def test_it_uses_frames_for_several_threads(self):
+        cmd = get_compress_cmd(4)
+        self.assertEqual(cmd[0], sys.executable)
+        self.assertTrue(cmd[1].endswith('frames.py'))
+        self.assertEqual(cmd[2:], ['--threads=4'])
+
+    def test_it_passes_the_level_to_the_compressor(self):
+        self.assertEqual(get_compress_cmd(level=9), ['gzip', '-9'])
+        self.assertEqual(get_compress_cmd(4, 9)[2:], ['--threads=4', '--level=9'])
+
+    def test_it_uses_frames_for_an_adaptive_level(self):
+        cmd = get_compress_cmd(level='auto')
+        self.assertTrue(cmd[1].endswith('frames.py'))
+        self.assertEqual(cmd[2:], ['--threads=1', '--level=auto'])
+
+
+class GetDecompressCmdsTestCase(FileSystemScratchTestCase):
+    def test_it_uses_gunzip_for_a_single_thread(self):
+        kwargs = {}
+        self.assertEqual(get_decompress_cmds('test.gz', kwargs), [['cat', 'test.gz'], ['gunzip']])
+        self.assertEqual(kwargs, {})
+
+    def test_it_decompresses_streams_with_frames(self):
+        kwargs = {}
+        stream = io.BytesIO()
+
+        self.assertEqual(get_decompress_cmds(stream, kwargs, 4), [get_frames_cmd('-d', '--threads=4')])
+        self.assertTrue(kwargs['stdin'] is stream)
+
+    def test_it_decompresses_framed_files_in_parallel(self):
+        path = self.get_path('framed.gz')
+        with open(path, 'wb') as f:
+            f.write(compress_frame(b'spam'))
+
+        self.assertEqual(get_decompress_cmds(path, {}, 4), [get_frames_cmd('-d', '--threads=4', path)])
+
+    @patch('shutil.which', return_value='/usr/bin/rapidgzip')
+    def test_it_uses_rapidgzip_with_a_cached_index_for_plain_gzip_files(self, which):
+        path = self.get_path('plain.gz')
+        with open(path, 'wb') as f:
+            f.write(gzip.compress(b'spam'))
+
+        self.assertEqual(
+            get_decompress_cmds(path, {}, 4),
+            [['rapidgzip', '-d', '-c', '-P', '4', '--export-index', path + '.gzindex', path]],
+        )
+
+        open(path + '.gzindex', 'w').close()
+        self.assertEqual(
+            get_decompress_cmds(path, {}, 4),
+            [['rapidgzip', '-d', '-c', '-P', '4', '--import-index', path + '.gzindex', path]],
+        )
+
+    @patch('shutil.which', return_value=None)
+    def test_it_falls_back_to_gunzip_for_plain_gzip_files(self, which):
+        path = self.get_path('plain.gz')
+        with open(path, 'wb') as f:
+            f.write(gzip.compress(b'spam'))
+
+        self.assertEqual(get_decompress_cmds(path, {}, 4), [['cat', path], ['gunzip']])
+
+
 class GetMysqlArgsTestCase(unittest.TestCase):
     def test_it_builds_the_correct_args(self):
         self.assertEqual(
@@ -113,6 +196,18 @@ class GetMysqlArgsTestCase(unittest.TestCase):
         )
 
 
+class GetDbHostTestCase(unittest.TestCase):
+    def test_it_identifies_the_server(self):
+        self.assertEqual(get_db_host(make_db_config('NAME', 'HOST', 'PORT')), ('test_host', '12345'))
+        self.assertEqual(get_db_host(make_db_config('NAME', 'HOST')), ('test_host', None))
+        self.assertEqual(get_db_host({'NAME': 'test_db', 'HOST': '', 'PORT': ''}), ('localhost', None))
+
+    def test_it_identifies_sqlite_databases_by_their_file(self):
+        db_config = {'ENGINE': 'django.db.backends.sqlite3', 'NAME': 'db.sqlite3', 'HOST': '', 'PORT': ''}
+        self.assertEqual(get_db_host(db_config), (os.path.abspath('db.sqlite3'), None))
+        self.assertNotEqual(get_db_host(db_config), get_db_host(dict(db_config, NAME='other.sqlite3')))
+
+
 class GetPostgresqlArgsTestCase(unittest.TestCase):
     def test_it_builds_the_correct_args(self):
         self.assertEqual(
@@ -208,6 +303,12 @@ class DoPostgresqlBackupTestCase(PatchPipeCommandsTestCase):
             show_stderr=False,
         ))
 
+    def test_it_dumps_from_an_exported_snapshot(self):
+        do_postgresql_backup('test.pgsql.gz', DB_CONFIG, snapshot='00000003-0000001B-1')
+
+        cmds = self.mock_pipe_commands_to_file.call_args[0][0]
+        self.assertEqual(cmds[0][:3], ['pg_dump', '--snapshot=00000003-0000001B-1', '--clean'])
+
 
 class DoSqliteBackupTestCase(PatchPipeCommandsTestCase):
     def test_it_makes_correct_calls_to_processes_api(self):
@@ -356,12 +457,257 @@ class DoPostgresqlRestoreTestCase(PatchPipeCommandsTestCase):
         )
 
 
-class DoSqliteRestoreTestCase(PatchPipeCommandsTestCase):
-    def test_it_makes_correct_calls_to_processes_api(self):
-        do_sqlite_restore(backup_file='test.sqlite.gz', db_config=DB_CONFIG)
+class DoMysqlBulkRestoreTestCase(PatchPipeCommandsTestCase):
+    def setUp(self):
+        super(DoMysqlBulkRestoreTestCase, self).setUp()
+        self.output_patcher = patch('backupdb.utils.commands.get_command_output')
+        self.mock_output = self.output_patcher.start()
 
-        self.assertPipeCommandsToFileCallsEqual(call(
-            [['cat', 'test.sqlite.gz'], ['gunzip']],
-            path='test_db',
-            show_stderr=False,
+    def tearDown(self):
+        super(DoMysqlBulkRestoreTestCase, self).tearDown()
+        self.output_patcher.stop()
+
+    def test_it_filters_the_dump_and_disables_the_binlog_when_permitted(self):
+        do_mysql_restore(backup_file='test.mysql.gz', db_config=DB_CONFIG, bulk_load=True)
+
+        cmds = self.mock_pipe_commands.call_args[0][0]
+        self.assertEqual(cmds[2], get_script_cmd(sqlfilters, 'mysql', '--bulk-load', '--disable-binlog'))
+        self.assertEqual(cmds[3][0], 'mysql')
+
+    def test_it_keeps_the_binlog_when_not_permitted(self):
+        self.mock_output.side_effect = CalledProcessError(cmd='mysql', returncode=1)
+        do_mysql_restore(backup_file='test.mysql.gz', db_config=DB_CONFIG, bulk_load=True)
+
+        cmds = self.mock_pipe_commands.call_args[0][0]
+        self.assertEqual(cmds[2], get_script_cmd(sqlfilters, 'mysql', '--bulk-load'))
+
+    def test_it_enables_local_infile_for_load_data(self):
+        do_mysql_restore(backup_file='test.mysql.gz', db_config=DB_CONFIG, bulk_load=True, load_data=True)
+
+        cmds = self.mock_pipe_commands.call_args[0][0]
+        self.assertTrue(cmds[2][-1].startswith('--load-data-dir='))
+        self.assertEqual(cmds[3][:2], ['mysql', '--local-infile=1'])
+        self.assertFalse(os.path.isdir(cmds[2][-1].split('=', 1)[1]))
+
+
+class DoPostgresqlStagingRestoreTestCase(PatchPipeCommandsTestCase):
+    def setUp(self):
+        super(DoPostgresqlStagingRestoreTestCase, self).setUp()
+        self.output_patcher = patch(
+            'backupdb.utils.commands.get_command_output',
+            return_value='owner|UTF8|en_US.UTF-8|en_US.UTF-8\n',
+        )
+        self.time_patcher = patch('time.strftime', return_value='20140101000000')
+        self.mock_output = self.output_patcher.start()
+        self.time_patcher.start()
+
+    def tearDown(self):
+        super(DoPostgresqlStagingRestoreTestCase, self).tearDown()
+        self.output_patcher.stop()
+        self.time_patcher.stop()
+
+    def get_sql_calls(self):
+        return [c[0][0][0][-1] for c in self.mock_pipe_commands.call_args_list if len(c[0][0]) == 1]
+
+    def test_it_restores_into_a_staging_database_and_swaps_it_in(self):
+        do_postgresql_restore(backup_file='test.pgsql.gz', db_config=DB_CONFIG, staging=True)
+
+        sql = self.get_sql_calls()
+        self.assertEqual(sql[0], (
+            'CREATE DATABASE "test_db_restore_20140101000000" TEMPLATE template0 OWNER "owner" '
+            "ENCODING 'UTF8' LC_COLLATE 'en_US.UTF-8' LC_CTYPE 'en_US.UTF-8'"
+        ))
+        self.assertEqual(sql[1], 'ANALYZE')
+        self.assertEqual(sql[2], 'ALTER DATABASE "test_db" ALLOW_CONNECTIONS false')
+        self.assertTrue(sql[3].endswith(
+            'ALTER DATABASE "test_db" RENAME TO "test_db_old_20140101000000"; '
+            'ALTER DATABASE "test_db_restore_20140101000000" RENAME TO "test_db";'
+        ))
+        self.assertEqual(sql[4], 'DROP DATABASE "test_db_old_20140101000000"')
+
+        load_call = self.mock_pipe_commands.call_args_list[1]
+        self.assertEqual(load_call[0][0], [
+            ['cat', 'test.pgsql.gz'],
+            ['gunzip'],
+            get_script_cmd(sqlfilters, 'postgresql', '--strip-clean'),
+            [
+                'psql',
+                '-v',
+                'ON_ERROR_STOP=1',
+                '--username=test_user',
+                '--host=test_host',
+                '--port=12345',
+                'test_db_restore_20140101000000',
+            ],
+        ])
+        self.assertEqual(load_call[1]['extra_env']['PGOPTIONS'], '-c synchronous_commit=off')
+
+    def test_it_keeps_the_old_database_if_specified(self):
+        do_postgresql_restore(backup_file='test.pgsql.gz', db_config=DB_CONFIG, staging=True, keep_old=True)
+
+        self.assertEqual(len(self.get_sql_calls()), 4)
+
+    def test_it_shortens_long_database_names(self):
+        name = 'd' * 39 + '\xe9' * 10
+        do_postgresql_restore(backup_file='test.pgsql.gz', db_config=dict(DB_CONFIG, NAME=name), staging=True)
+
+        sql = self.get_sql_calls()
+        staging_name = 'd' * 39 + '_restore_20140101000000'
+        old_name = 'd' * 39 + '\xe9\xe9_old_20140101000000'
+        self.assertTrue(sql[0].startswith('CREATE DATABASE "{0}" '.format(staging_name)))
+        self.assertTrue(sql[3].endswith('RENAME TO "{0}"; ALTER DATABASE "{1}" RENAME TO "{2}";'.format(
+            old_name, staging_name, name)))
+
+    def test_it_drops_the_staging_database_if_loading_fails(self):
+        def fail_on_load(cmds, **kwargs):
+            if len(cmds) > 1:
+                raise CalledProcessError(cmd='psql', returncode=3)
+        self.mock_pipe_commands.side_effect = fail_on_load
+
+        self.assertRaises(
+            CalledProcessError,
+            do_postgresql_restore,
+            backup_file='test.pgsql.gz',
+            db_config=DB_CONFIG,
+            staging=True,
+        )
+        self.assertEqual(self.get_sql_calls()[-1], 'DROP DATABASE IF EXISTS "test_db_restore_20140101000000"')
+
+
+class DoPostgresqlBulkRestoreTestCase(PatchPipeCommandsTestCase):
+    def test_it_loads_in_a_single_transaction_and_runs_deferred_statements(self):
+        do_postgresql_restore(
+            backup_file='test.pgsql.gz',
+            db_config=DB_CONFIG,
+            bulk_load=True,
+            unlogged=True,
+            maintenance_work_mem='1GB',
+        )
+
+        clean_call, load_call, deferred_call = self.mock_pipe_commands.call_args_list
+        self.assertEqual(clean_call[0][0], [
+            ['cat', 'test.pgsql.gz'],
+            ['gunzip'],
+            get_script_cmd(sqlfilters, 'postgresql', '--only-clean', '--stop-after-clean'),
+            ['psql', '--username=test_user', '--host=test_host', '--port=12345', 'test_db'],
+        ])
+        # The decompression is cut short once the clean block is read
+        self.assertEqual(clean_call[1]['early_exit'], 2)
+        psql_cmd = [
+            'psql',
+            '-v',
+            'ON_ERROR_STOP=1',
+            '--single-transaction',
+            '--username=test_user',
+            '--host=test_host',
+            '--port=12345',
+            'test_db',
+        ]
+        filter_cmd = load_call[0][0][2]
+        deferred_file = filter_cmd[-2].split('=', 1)[1]
+        self.assertEqual(load_call[0][0], [
+            ['cat', 'test.pgsql.gz'],
+            ['gunzip'],
+            get_script_cmd(sqlfilters, 'postgresql', '--strip-clean', '--deferred-file=' + deferred_file, '--unlogged'),
+            psql_cmd,
+        ])
+        self.assertEqual(
+            load_call[1]['extra_env']['PGOPTIONS'],
+            '-c synchronous_commit=off -c maintenance_work_mem=1GB',
+        )
+        self.assertEqual(deferred_call[0][0], [psql_cmd + ['--file=' + deferred_file]])
+        self.assertFalse(os.path.isfile(deferred_file))
+
+    def test_it_loads_clean_dumps_into_empty_databases(self):
+        with patch('backupdb.utils.commands.drop_postgresql_tables'):
+            do_postgresql_restore(backup_file='test.pgsql.gz', db_config=DB_CONFIG, drop_tables=True, bulk_load=True)
+
+        # The tables are already dropped, so the clean block isn't run on its own
+        load_call, deferred_call = self.mock_pipe_commands.call_args_list
+        filter_cmd = [
+            '--deferred-file=' + os.devnull if arg.startswith('--deferred-file=') else arg
+            for arg in load_call[0][0][2]
+        ]
+        dump = (
+            'SET statement_timeout = 0;\n'
+            'ALTER TABLE ONLY public.spam DROP CONSTRAINT spam_pkey;\n'
+            'DROP TABLE public.spam;\n'
+            'CREATE TABLE public.spam (\n    id integer NOT NULL\n);\n'
+        )
+        loaded = subprocess.run(filter_cmd, input=dump.encode('utf-8'), stdout=subprocess.PIPE, check=True).stdout
+        self.assertEqual(loaded.decode('utf-8'), (
+            'SET statement_timeout = 0;\n'
+            'CREATE TABLE public.spam (\n    id integer NOT NULL\n);\n'
         ))
+
+    def test_it_strips_clean_statements_when_loading_a_staging_database(self):
+        with patch('backupdb.utils.commands.get_command_output', return_value=''):
+            do_postgresql_restore(backup_file='test.pgsql.gz', db_config=DB_CONFIG, staging=True, bulk_load=True)
+
+        load_call = self.mock_pipe_commands.call_args_list[1]
+        self.assertEqual(load_call[0][0][2][-2], '--strip-clean')
+        self.assertTrue(load_call[0][0][3][-1].startswith('test_db_restore_'))
+
+
+class DoSqliteRestoreTestCase(FileSystemScratchTestCase):
+    def create_db(self, name, rows):
+        conn = sqlite3.connect(self.get_path(name))
+        conn.execute('CREATE TABLE spam (id INTEGER PRIMARY KEY, name TEXT)')
+        conn.executemany('INSERT INTO spam (name) VALUES (?)', [(r,) for r in rows])
+        conn.commit()
+        conn.close()
+
+    def get_rows(self, name):
+        conn = sqlite3.connect(self.get_path(name))
+        try:
+            return [r[0] for r in conn.execute('SELECT name FROM spam ORDER BY id')]
+        finally:
+            conn.close()
+
+    def test_it_swaps_the_restored_database_into_place(self):
+        self.create_db('backup.db', ['eggs', 'ham'])
+        do_sqlite_backup(self.get_path('test.sqlite.gz'), {'NAME': self.get_path('backup.db')})
+        self.create_db('live.db', ['spam'])
+        with open(self.get_path('live.db-wal'), 'wb') as f:
+            f.write(b'stale')
+
+        do_sqlite_restore(backup_file=self.get_path('test.sqlite.gz'), db_config={'NAME': self.get_path('live.db')})
+
+        self.assertEqual(self.get_rows('live.db'), ['eggs', 'ham'])
+        self.assertEqual(sorted(os.listdir(self.SCRATCH_DIR)), ['.gitkeep', 'backup.db', 'live.db', 'test.sqlite.gz'])
+
+    def test_it_keeps_the_permissions_of_the_live_database(self):
+        self.create_db('backup.db', ['eggs'])
+        do_sqlite_backup(self.get_path('test.sqlite.gz'), {'NAME': self.get_path('backup.db')})
+        self.create_db('live.db', ['spam'])
+        os.chmod(self.get_path('live.db'), 0o640)
+
+        do_sqlite_restore(backup_file=self.get_path('test.sqlite.gz'), db_config={'NAME': self.get_path('live.db')})
+
+        self.assertEqual(stat.S_IMODE(os.stat(self.get_path('live.db')).st_mode), 0o640)
+
+    def test_new_databases_get_the_permissions_of_new_files(self):
+        self.create_db('backup.db', ['eggs'])
+        do_sqlite_backup(self.get_path('test.sqlite.gz'), {'NAME': self.get_path('backup.db')})
+        old_umask = os.umask(0o022)
+        self.addCleanup(os.umask, old_umask)
+
+        do_sqlite_restore(backup_file=self.get_path('test.sqlite.gz'), db_config={'NAME': self.get_path('new.db')})
+
+        self.assertEqual(self.get_rows('new.db'), ['eggs'])
+        self.assertEqual(stat.S_IMODE(os.stat(self.get_path('new.db')).st_mode), 0o644)
+
+    def test_it_leaves_the_live_database_untouched_if_the_backup_is_corrupt(self):
+        with gzip.open(self.get_path('test.sqlite.gz'), 'wb') as f:
+            f.write(b'this is not a database' * 100)
+        self.create_db('live.db', ['spam'])
+
+        self.assertRaises(
+            RestoreError,
+            do_sqlite_restore,
+            backup_file=self.get_path('test.sqlite.gz'),
+            db_config={'NAME': self.get_path('live.db')},
+        )
+
+        self.assertEqual(self.get_rows('live.db'), ['spam'])
+        self.assertEqual(sorted(os.listdir(self.SCRATCH_DIR)), ['.gitkeep', 'live.db', 'test.sqlite.gz'])
@@ -1,9 +1,26 @@
 from backupdb.utils.exceptions import RestoreError
-from backupdb.utils.files import get_latest_timestamped_file
+from backupdb.utils.files import get_latest_timestamped_file, get_new_backup_file
 
 from backupdb.tests.utils import FileSystemScratchTestCase
 
 
+class GetNewBackupFileTestCase(FileSystemScratchTestCase):
+    def test_it_names_backups_after_the_next_free_second(self):
+        now = 1370580510
+        first = get_new_backup_file('default', 'pgsql', dir=self.SCRATCH_DIR, now=now)
+        self.assertEqual(first, self.get_path('default-2013-06-06-1370580510.pgsql.gz'))
+
+        self.assertEqual(
+            get_new_backup_file('default', 'pgsql', [first], dir=self.SCRATCH_DIR, now=now),
+            self.get_path('default-2013-06-06-1370580511.pgsql.gz'))
+
+        open(first + '.manifest', 'a').close()
+        open(self.get_path('default-2013-06-06-1370580511.pgsql.gz'), 'a').close()
+        self.assertEqual(
+            get_new_backup_file('default', 'pgsql', dir=self.SCRATCH_DIR, now=now),
+            self.get_path('default-2013-06-06-1370580512.pgsql.gz'))
+
+
 class GetLatestTimestampedFileTestCase(FileSystemScratchTestCase):
     def create_files(self, *args):
         for file in args:
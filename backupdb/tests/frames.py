@@ -0,0 +1,156 @@
+import argparse
+import gzip
+import io
+import os
+import unittest
+
+from backupdb.utils.frames import (
+    AUTO_LEVEL,
+    MAX_LEVEL,
+    MIN_LEVEL,
+    FrameError,
+    LevelController,
+    compress,
+    compress_frame,
+    decompress,
+    decompress_frame,
+    get_frame_size,
+    get_uncompressed_size,
+    is_framed,
+    parse_level,
+)
+
+from .utils import FileSystemScratchTestCase
+
+
+DATA = b''.join(('line {0}\n'.format(i)).encode('ascii') for i in range(100000)) + os.urandom(50000)
+
+
+def compress_data(data, **kwargs):
+    output = io.BytesIO()
+    compress(io.BytesIO(data), output, **kwargs)
+    return output.getvalue()
+
+
+def decompress_data(data, **kwargs):
+    output = io.BytesIO()
+    decompress(io.BytesIO(data), output, **kwargs)
+    return output.getvalue()
+
+
+class FrameTestCase(unittest.TestCase):
+    def test_frames_round_trip_and_record_their_size(self):
+        frame = compress_frame(b'spam' * 1000)
+
+        self.assertEqual(get_frame_size(frame), len(frame))
+        self.assertEqual(decompress_frame(frame), b'spam' * 1000)
+
+    def test_frames_are_readable_by_gzip(self):
+        frame = compress_frame(b'spam' * 1000)
+
+        self.assertEqual(gzip.GzipFile(fileobj=io.BytesIO(frame)).read(), b'spam' * 1000)
+
+    def test_corrupt_frames_are_detected(self):
+        frame = bytearray(compress_frame(b'spam' * 1000))
+        frame[-5] ^= 0xff
+
+        self.assertRaises(FrameError, decompress_frame, bytes(frame))
+
+    def test_plain_gzip_data_is_not_a_frame(self):
+        self.assertTrue(get_frame_size(gzip.compress(b'spam')) is None)
+
+
+class CompressTestCase(unittest.TestCase):
+    def test_it_round_trips_with_several_threads(self):
+        compressed = compress_data(DATA, threads=4, frame_size=64 * 1024)
+
+        self.assertEqual(decompress_data(compressed, threads=4), DATA)
+        self.assertEqual(gzip.GzipFile(fileobj=io.BytesIO(compressed)).read(), DATA)
+
+    def test_it_round_trips_with_a_single_thread(self):
+        compressed = compress_data(DATA, frame_size=64 * 1024)
+
+        self.assertEqual(decompress_data(compressed), DATA)
+
+    def test_it_decompresses_plain_gzip_data(self):
+        self.assertEqual(decompress_data(gzip.compress(DATA), threads=4), DATA)
+        self.assertEqual(decompress_data(gzip.compress(DATA) + gzip.compress(DATA)), DATA + DATA)
+
+    def test_it_raises_an_error_on_truncated_data(self):
+        framed = compress_data(DATA, frame_size=64 * 1024)
+        plain = gzip.compress(DATA)
+
+        self.assertRaises(FrameError, decompress_data, framed[:-10])
+        self.assertRaises(FrameError, decompress_data, plain[:len(plain) // 2])
+
+    def test_it_round_trips_with_an_adaptive_level(self):
+        for threads in (1, 4):
+            compressed = compress_data(DATA, threads=threads, level=AUTO_LEVEL, frame_size=16 * 1024)
+
+            self.assertEqual(decompress_data(compressed, threads=threads), DATA)
+            self.assertEqual(gzip.GzipFile(fileobj=io.BytesIO(compressed)).read(), DATA)
+
+
+class LevelControllerTestCase(unittest.TestCase):
+    def record(self, controller, input_wait, output_wait, frames=1):
+        for _ in range(frames):
+            controller.record(input_wait, output_wait)
+
+    def test_it_lowers_the_level_when_the_compressor_is_the_bottleneck(self):
+        controller = LevelController(level=6, interval=4)
+
+        self.record(controller, 0.001, 0.01, frames=3)
+        self.assertEqual(controller.level, 6)
+        self.record(controller, 0.001, 0.01)
+        self.assertEqual(controller.level, 5)
+
+        self.record(controller, 0.001, 0.01, frames=40)
+        self.assertEqual(controller.level, MIN_LEVEL)
+
+    def test_it_raises_the_level_when_the_compressor_waits_for_input(self):
+        controller = LevelController(level=6, interval=4)
+
+        self.record(controller, 0.01, 0.001, frames=4)
+        self.assertEqual(controller.level, 7)
+
+        self.record(controller, 0.01, 0.001, frames=40)
+        self.assertEqual(controller.level, MAX_LEVEL)
+
+    def test_it_keeps_the_level_when_the_compressor_just_keeps_up(self):
+        controller = LevelController(level=6, interval=4)
+
+        self.record(controller, 0.01, 0.005, frames=40)
+        self.assertEqual(controller.level, 6)
+
+
+class ParseLevelTestCase(unittest.TestCase):
+    def test_it_accepts_levels_and_auto(self):
+        self.assertEqual(parse_level('1'), 1)
+        self.assertEqual(parse_level('9'), 9)
+        self.assertEqual(parse_level('auto'), AUTO_LEVEL)
+
+    def test_it_rejects_invalid_levels(self):
+        for value in ('0', '10', 'fast'):
+            self.assertRaises(argparse.ArgumentTypeError, parse_level, value)
+
+
+class IsFramedTestCase(FileSystemScratchTestCase):
+    def test_it_detects_framed_files(self):
+        with open(self.get_path('framed.gz'), 'wb') as f:
+            f.write(compress_data(b'spam'))
+        with open(self.get_path('plain.gz'), 'wb') as f:
+            f.write(gzip.compress(b'spam'))
+
+        self.assertTrue(is_framed(self.get_path('framed.gz')))
+        self.assertFalse(is_framed(self.get_path('plain.gz')))
+
+
+class GetUncompressedSizeTestCase(FileSystemScratchTestCase):
+    def test_it_returns_the_size_of_framed_and_plain_files(self):
+        with open(self.get_path('framed.gz'), 'wb') as f:
+            f.write(compress_data(DATA, frame_size=64 * 1024))
+        with open(self.get_path('plain.gz'), 'wb') as f:
+            f.write(gzip.compress(DATA))
+
+        self.assertEqual(get_uncompressed_size(self.get_path('framed.gz')), len(DATA))
+        self.assertEqual(get_uncompressed_size(self.get_path('plain.gz')), len(DATA))
@@ -0,0 +1,124 @@
+import gzip
+import io
+import json
+import unittest
+
+from backupdb.utils.frames import compress
+from backupdb.utils.history import (
+    Estimate,
+    check_estimate,
+    estimate_backup,
+    estimate_total,
+    format_duration,
+    format_size,
+    get_sqlite_db_size,
+    load_history,
+    record_backup,
+)
+from backupdb.utils.scheduler import ResultLog
+
+from .utils import FileSystemScratchTestCase
+
+
+def make_record(db_size, duration, bytes):
+    return {'database': 'default', 'db_size': db_size, 'duration': duration, 'bytes': bytes}
+
+
+class EstimateBackupTestCase(unittest.TestCase):
+    def test_it_scales_the_median_rates_to_the_current_size(self):
+        records = [
+            make_record(1000, 10, 100),
+            make_record(1000, 500, 100),  # An outlier, e.g. a busy night
+            make_record(2000, 24, 240),
+        ]
+
+        estimate = estimate_backup('default', records, 4000)
+
+        self.assertTrue(estimate.known)
+        self.assertEqual(estimate.duration, 48)
+        self.assertEqual(estimate.bytes, 400)
+        self.assertEqual(estimate.samples, 3)
+
+    def test_it_only_uses_recent_usable_records(self):
+        records = [make_record(1000, 1000, 1000)] * 5 + [make_record(None, 1, 1)] + [make_record(1000, 10, 100)] * 2
+
+        estimate = estimate_backup('default', records, 1000, samples=2)
+
+        self.assertEqual(estimate.duration, 10)
+        self.assertEqual(estimate.samples, 2)
+
+    def test_it_is_unknown_without_history_or_size(self):
+        self.assertFalse(estimate_backup('default', [], 1000).known)
+        self.assertFalse(estimate_backup('default', [make_record(1000, 10, 100)], None).known)
+
+
+class EstimateTotalTestCase(unittest.TestCase):
+    def test_it_adds_up_sizes_and_spreads_durations_over_jobs(self):
+        estimates = [
+            Estimate('a', 1000, 60, 100, 3),
+            Estimate('b', 1000, 30, 200, 5),
+            Estimate('c', 1000, 30, 300, 2),
+            Estimate('d', 1000),
+        ]
+
+        self.assertEqual(estimate_total(estimates).duration, 120)
+        self.assertEqual(estimate_total(estimates, jobs=2).duration, 60)
+        self.assertEqual(estimate_total(estimates, jobs=8).duration, 60)
+        self.assertEqual(estimate_total(estimates).bytes, 600)
+        self.assertEqual(estimate_total(estimates).samples, 2)
+        self.assertFalse(estimate_total([Estimate('d', 1000)]).known)
+
+
+class CheckEstimateTestCase(unittest.TestCase):
+    def test_it_reports_going_over_the_window_or_free_space(self):
+        total = Estimate('total', 1000, 3600, 5000, 3)
+
+        self.assertEqual(check_estimate(total, max_duration=7200, free_space=10000), [])
+        self.assertEqual(check_estimate(total, max_duration=1800, free_space=1000), [
+            'Backups are expected to take 01:00:00, more than the allowed 00:30:00',
+            'Backups are expected to need 4.9 KiB, more than the 1000 bytes available',
+        ])
+        self.assertEqual(check_estimate(Estimate('total'), max_duration=0, free_space=0), [])
+
+    def test_it_formats_sizes_and_durations(self):
+        self.assertEqual(format_size(512), '512 bytes')
+        self.assertEqual(format_size(3 * 1024 ** 3), '3.0 GiB')
+        self.assertEqual(format_duration(3725), '01:02:05')
+        self.assertEqual(format_duration(36 * 60 * 60), '1.5 days')
+
+
+class HistoryFileTestCase(FileSystemScratchTestCase):
+    def test_it_records_and_loads_backups(self):
+        data = b'spam' * 100000
+        framed_file = self.get_path('default-1.sqlite.gz')
+        with open(framed_file, 'wb') as f:
+            compress(io.BytesIO(data), f, threads=2)
+        plain_file = self.get_path('default-2.sqlite.gz')
+        with gzip.open(plain_file, 'wb') as f:
+            f.write(data)
+
+        history_file = self.get_path('history.jsonl')
+        history = ResultLog(history_file)
+        record_backup(history, 'default', framed_file, 1000, 1.0, 2.0)
+        record_backup(history, 'default', plain_file, 1000, 3.0, 2.0)
+        with open(history_file, 'a') as f:
+            f.write('{"database": "other", "dura')
+
+        records = load_history(history_file)
+
+        self.assertEqual(list(records), ['default'])
+        self.assertEqual([r['started'] for r in records['default']], [1.0, 3.0])
+        self.assertEqual(records['default'][0]['dump_bytes'], len(data))
+        self.assertEqual(records['default'][1]['dump_bytes'], None)
+        self.assertTrue(0 < records['default'][0]['bytes'] < len(data))
+        self.assertEqual(json.loads(open(history_file).readline())['db_size'], 1000)
+
+    def test_missing_history_is_empty(self):
+        self.assertEqual(load_history(self.get_path('missing.jsonl')), {})
+
+    def test_it_measures_sqlite_databases(self):
+        path = self.get_path('db.sqlite')
+        with open(path, 'wb') as f:
+            f.write(b'x' * 4096)
+
+        self.assertEqual(get_sqlite_db_size({'NAME': path}), 4096)
@@ -0,0 +1,135 @@
+import argparse
+import logging
+import threading
+import time
+import unittest
+
+from backupdb.utils.parallel import (
+    FAILED,
+    OK,
+    SKIPPED,
+    HostJobRunner,
+    Job,
+    check_dependencies,
+    parse_job_count,
+    run_jobs,
+)
+
+
+class RunJobsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.lock = threading.Lock()
+        self.events = []
+        logging.disable(logging.CRITICAL)
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+
+    def make_func(self, name, result=True, delay=0.0):
+        def func():
+            with self.lock:
+                self.events.append(('start', name))
+            time.sleep(delay)
+            with self.lock:
+                self.events.append(('end', name))
+            if isinstance(result, Exception):
+                raise result
+            return result
+        return func
+
+    def test_it_runs_dependencies_first(self):
+        results = run_jobs([
+            Job('billing', self.make_func('billing'), depends_on=['default']),
+            Job('default', self.make_func('default', delay=0.05)),
+        ], max_workers=2)
+
+        self.assertEqual(results, {'billing': OK, 'default': OK})
+        self.assertEqual(self.events.index(('start', 'billing')), 2)
+
+    def test_it_starts_higher_priority_jobs_first(self):
+        run_jobs([
+            Job('a', self.make_func('a')),
+            Job('b', self.make_func('b'), priority=10),
+            Job('c', self.make_func('c'), priority=5),
+        ], max_workers=1)
+
+        starts = [name for event, name in self.events if event == 'start']
+        self.assertEqual(starts, ['b', 'c', 'a'])
+
+    def test_it_runs_jobs_concurrently(self):
+        run_jobs([
+            Job('a', self.make_func('a', delay=0.05)),
+            Job('b', self.make_func('b', delay=0.05)),
+        ], max_workers=2)
+
+        self.assertEqual([event for event, name in self.events], ['start', 'start', 'end', 'end'])
+
+    def test_it_reports_failures_and_skips_dependents_without_aborting_others(self):
+        results = run_jobs([
+            Job('a', self.make_func('a', result=False)),
+            Job('b', self.make_func('b', result=ValueError('spam'))),
+            Job('c', self.make_func('c'), depends_on=['a']),
+            Job('d', self.make_func('d'), depends_on=['c']),
+            Job('e', self.make_func('e')),
+        ], max_workers=2)
+
+        self.assertEqual(results, {'a': FAILED, 'b': FAILED, 'c': SKIPPED, 'd': SKIPPED, 'e': OK})
+
+    def test_it_ignores_unknown_dependencies(self):
+        results = run_jobs([Job('a', self.make_func('a'), depends_on=['spam'])])
+
+        self.assertEqual(results, {'a': OK})
+
+    def test_it_detects_dependency_cycles(self):
+        self.assertRaises(ValueError, check_dependencies, [
+            Job('a', None, depends_on=['b']),
+            Job('b', None, depends_on=['a']),
+        ])
+
+
+class HostJobRunnerTestCase(RunJobsTestCase):
+    def get_max_concurrency(self, names):
+        running = max_running = 0
+        for event, name in self.events:
+            if name in names:
+                running += 1 if event == 'start' else -1
+                max_running = max(max_running, running)
+        return max_running
+
+    def test_it_limits_jobs_per_host(self):
+        run_jobs([
+            Job('a1', self.make_func('a1', delay=0.02), host='a'),
+            Job('a2', self.make_func('a2', delay=0.02), host='a'),
+            Job('a3', self.make_func('a3', delay=0.02), host='a'),
+            Job('b1', self.make_func('b1', delay=0.02), host='b'),
+        ], max_workers=3, max_per_host=2)
+
+        self.assertEqual(self.get_max_concurrency(['a1', 'a2', 'a3']), 2)
+        self.assertEqual(self.get_max_concurrency(['a1', 'a2', 'a3', 'b1']), 3)
+
+    def test_it_requires_at_least_one_job_per_host(self):
+        self.assertRaises(ValueError, run_jobs, [Job('a', self.make_func('a'), host='a')], max_per_host=0)
+        self.assertEqual(parse_job_count('2'), 2)
+        self.assertRaises(argparse.ArgumentTypeError, parse_job_count, '0')
+        self.assertRaises(argparse.ArgumentTypeError, parse_job_count, '-1')
+        self.assertRaises(argparse.ArgumentTypeError, parse_job_count, 'many')
+
+    def test_it_fails_when_no_job_can_ever_start(self):
+        class StuckRunner(HostJobRunner):
+            def can_start(self, job):
+                return False
+
+        self.assertRaises(ValueError, StuckRunner([Job('a', self.make_func('a'), host='a')]).run)
+
+    def test_it_interleaves_hosts(self):
+        run_jobs([
+            Job('a1', self.make_func('a1'), host='a'),
+            Job('a2', self.make_func('a2'), host='a'),
+            Job('a3', self.make_func('a3'), host='a', priority=1),
+            Job('b1', self.make_func('b1'), host='b'),
+            Job('b2', self.make_func('b2'), host='b'),
+            Job('c1', self.make_func('c1'), host='c'),
+        ], max_workers=1)
+
+        starts = [name for event, name in self.events if event == 'start']
+        self.assertEqual(starts, ['a3', 'b1', 'c1', 'a1', 'b2', 'a2'])
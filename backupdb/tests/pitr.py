@@ -0,0 +1,224 @@
+from subprocess import CalledProcessError
+import argparse
+import gzip
+import io
+import os
+import shutil
+import tarfile
+import tempfile
+import time
+import unittest
+
+from mock import patch
+
+from backupdb.utils.exceptions import BackupError, RestoreError
+from backupdb.utils.pitr import (
+    archive_mysql_logs,
+    archive_postgresql_logs,
+    do_mysql_pitr_restore,
+    do_postgresql_pitr_restore,
+    find_base_backup,
+    get_pg_archive_command,
+    parse_until,
+    read_catalog,
+    read_mysql_binlog_position,
+)
+from backupdb.utils.walarchive import ArchiveError, archive_wal, main, record, restore_wal
+
+PG_CONFIG = {'ENGINE': 'django.db.backends.postgresql_psycopg2', 'NAME': 'test_db', 'USER': 'test_user'}
+MYSQL_CONFIG = {'ENGINE': 'django.db.backends.mysql', 'NAME': 'test_db', 'USER': 'test_user'}
+
+
+class ArchiveTestCase(unittest.TestCase):
+    def setUp(self):
+        self.pitr_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.pitr_dir)
+
+    def get_path(self, *names):
+        return os.path.join(self.pitr_dir, *names)
+
+    def write(self, name, data):
+        with open(self.get_path(name), 'wb') as f:
+            f.write(data)
+
+    def write_gzip(self, path, data):
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with gzip.open(path, 'wb') as f:
+            f.write(data)
+
+
+class WalArchiveTestCase(ArchiveTestCase):
+    def test_it_archives_and_restores_segments(self):
+        segment = os.urandom(1024) * 16
+        self.write('000000010000000000000001', segment)
+
+        archive_wal(self.get_path('000000010000000000000001'), '000000010000000000000001', self.pitr_dir)
+        restored = restore_wal('000000010000000000000001', self.get_path('restored'), self.pitr_dir)
+
+        self.assertTrue(restored)
+        with open(self.get_path('restored'), 'rb') as f:
+            self.assertEqual(f.read(), segment)
+        self.assertEqual([(r['kind'], r['name'], r['file']) for r in read_catalog(self.pitr_dir)], [
+            ('wal', '000000010000000000000001', os.path.join('wal', '000000010000000000000001.gz')),
+        ])
+
+    def test_it_only_accepts_the_same_segment_twice(self):
+        self.write('segment', b'spam')
+        archive_wal(self.get_path('segment'), '000000010000000000000001', self.pitr_dir)
+        archive_wal(self.get_path('segment'), '000000010000000000000001', self.pitr_dir)
+
+        self.write('segment', b'eggs')
+        self.assertRaises(ArchiveError, archive_wal, self.get_path('segment'), '000000010000000000000001',
+                          self.pitr_dir)
+        self.assertEqual(len(read_catalog(self.pitr_dir)), 1)
+
+    def test_missing_segments_make_the_restore_command_fail(self):
+        self.assertFalse(restore_wal('00000002.history', self.get_path('restored'), self.pitr_dir))
+        self.assertEqual(main(['restore', '00000002.history', self.get_path('restored'), self.pitr_dir]), 1)
+
+    def test_the_archive_command_runs_this_module(self):
+        command = get_pg_archive_command(self.pitr_dir)
+
+        self.assertTrue(command.endswith('walarchive.py archive %p %f {0}'.format(self.pitr_dir)))
+
+
+class CatalogTestCase(ArchiveTestCase):
+    def test_it_finds_the_latest_base_backup_before_a_time(self):
+        record(self.pitr_dir, kind='base', file='base/1.tar.gz', recoverable_from=100.0)
+        record(self.pitr_dir, kind='wal', name='000000010000000000000001', file='wal/1.gz')
+        record(self.pitr_dir, kind='base', file='base/2.tar.gz', recoverable_from=200.0)
+        with open(self.get_path('catalog.jsonl'), 'a') as f:
+            f.write('{"kind": "ba')
+        records = read_catalog(self.pitr_dir)
+
+        self.assertEqual(find_base_backup(records, 150.0)['file'], 'base/1.tar.gz')
+        self.assertEqual(find_base_backup(records, 200.0)['file'], 'base/2.tar.gz')
+        self.assertRaises(RestoreError, find_base_backup, records, 50.0)
+
+    def test_it_parses_local_times(self):
+        self.assertEqual(parse_until('2024-01-31 23:59:00'), time.mktime((2024, 1, 31, 23, 59, 0, 0, 0, -1)))
+        self.assertRaises(argparse.ArgumentTypeError, parse_until, 'yesterday')
+
+    def test_it_reads_the_binlog_position_of_mysql_dumps(self):
+        self.write_gzip(self.get_path('base.mysql.gz'), (
+            b'-- MySQL dump 10.13\n'
+            b"-- CHANGE MASTER TO MASTER_LOG_FILE='binlog.000042', MASTER_LOG_POS=157;\n"
+            b'CREATE TABLE spam (id int);\n'
+        ))
+        self.write_gzip(self.get_path('other.mysql.gz'), b'-- MySQL dump 10.13\n')
+
+        self.assertEqual(read_mysql_binlog_position(self.get_path('base.mysql.gz')), ('binlog.000042', 157))
+        self.assertEqual(read_mysql_binlog_position(self.get_path('other.mysql.gz')), None)
+
+
+class PostgresqlPitrTestCase(ArchiveTestCase):
+    @patch('backupdb.utils.pitr.run_postgresql_sql')
+    def test_it_requires_the_server_to_archive_its_wal(self, run_postgresql_sql):
+        run_postgresql_sql.return_value = 'on|/bin/true\n'
+        self.assertRaises(BackupError, archive_postgresql_logs, self.pitr_dir, PG_CONFIG)
+
+        run_postgresql_sql.side_effect = [
+            'on|{0}\n'.format(get_pg_archive_command(self.pitr_dir)),
+            CalledProcessError(cmd='psql', returncode=1),
+        ]
+        archive_postgresql_logs(self.pitr_dir, PG_CONFIG)
+        self.assertEqual(run_postgresql_sql.call_args[0][1], 'SELECT pg_switch_wal()')
+
+    def test_it_sets_up_a_data_directory_to_recover(self):
+        data = io.BytesIO()
+        with tarfile.open(fileobj=data, mode='w') as tar:
+            info = tarfile.TarInfo('PG_VERSION')
+            info.size = 3
+            tar.addfile(info, io.BytesIO(b'16\n'))
+        self.write_gzip(self.get_path('base', '1.tar.gz'), data.getvalue())
+        record(self.pitr_dir, kind='base', file='base/1.tar.gz', recoverable_from=100.0)
+        target_dir = self.get_path('pgdata')
+
+        do_postgresql_pitr_restore(self.pitr_dir, PG_CONFIG, 150.0, target_dir=target_dir)
+
+        self.assertEqual(sorted(os.listdir(target_dir)), ['PG_VERSION', 'postgresql.auto.conf', 'recovery.signal'])
+        with open(os.path.join(target_dir, 'postgresql.auto.conf')) as f:
+            conf = f.read()
+        self.assertIn("walarchive.py restore %f %p {0}'".format(self.pitr_dir), conf)
+        self.assertIn("recovery_target_time = '{0}".format(
+            time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(150.0))), conf)
+        self.assertRaises(RestoreError, do_postgresql_pitr_restore, self.pitr_dir, PG_CONFIG, 150.0,
+                          target_dir=target_dir)
+        self.assertRaises(RestoreError, do_postgresql_pitr_restore, self.pitr_dir, PG_CONFIG, 150.0)
+
+
+class MysqlPitrTestCase(ArchiveTestCase):
+    @patch('backupdb.utils.pitr.pipe_commands')
+    @patch('backupdb.utils.pitr.run_mysql_sql')
+    def test_it_archives_closed_binlogs_once(self, run_mysql_sql, pipe_commands):
+        def mysqlbinlog(cmds, **kwargs):
+            result_file = [a for a in cmds[0] if a.startswith('--result-file=')][0].split('=', 1)[1]
+            with open(result_file + cmds[0][-1], 'wb') as f:
+                f.write(b'binlog')
+        pipe_commands.side_effect = mysqlbinlog
+        run_mysql_sql.side_effect = lambda db_config, sql, show_output: (
+            [['binlog.000001', '100'], ['binlog.000002', '200'], ['binlog.000003', '157']]
+            if sql == 'SHOW BINARY LOGS' else [])
+
+        self.assertEqual(archive_mysql_logs(self.pitr_dir, MYSQL_CONFIG), ['binlog.000001', 'binlog.000002'])
+        self.assertEqual(archive_mysql_logs(self.pitr_dir, MYSQL_CONFIG), [])
+
+        with gzip.open(self.get_path('binlog', 'binlog.000002.gz')) as f:
+            self.assertEqual(f.read(), b'binlog')
+        self.assertEqual(sorted(os.listdir(self.pitr_dir)), ['binlog', 'catalog.jsonl'])
+
+    @patch('backupdb.utils.pitr.pipe_commands')
+    @patch('backupdb.utils.pitr.do_mysql_restore')
+    def test_it_replays_binlogs_from_the_base_position(self, do_mysql_restore, pipe_commands):
+        record(self.pitr_dir, kind='binlog', name='binlog.000001', file='binlog/binlog.000001.gz')
+        record(self.pitr_dir, kind='base', file='base/1.mysql.gz', recoverable_from=100.0,
+               binlog_file='binlog.000002', binlog_position=157)
+        for name in ('binlog.000001', 'binlog.000002', 'binlog.000003'):
+            self.write_gzip(self.get_path('binlog', name + '.gz'), name.encode())
+            if name != 'binlog.000001':
+                record(self.pitr_dir, kind='binlog', name=name, file='binlog/{0}.gz'.format(name))
+
+        do_mysql_pitr_restore(self.pitr_dir, MYSQL_CONFIG, 150.0, drop_tables=True)
+
+        self.assertEqual(do_mysql_restore.call_args[0], (self.get_path('base', '1.mysql.gz'), MYSQL_CONFIG))
+        self.assertTrue(do_mysql_restore.call_args[1]['drop_tables'])
+        mysqlbinlog, mysql = pipe_commands.call_args[0][0]
+        self.assertEqual(mysqlbinlog[:4], [
+            'mysqlbinlog',
+            '--start-position=157',
+            '--stop-datetime={0}'.format(time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(150.0))),
+            '--database=test_db',
+        ])
+        self.assertEqual([os.path.basename(p) for p in mysqlbinlog[4:]], ['binlog.000002', 'binlog.000003'])
+        self.assertEqual(mysql, ['mysql', '--user=test_user', 'test_db'])
+        self.assertEqual(sorted(os.listdir(self.pitr_dir)), ['binlog', 'catalog.jsonl'])
+
+    @patch('backupdb.utils.pitr.pipe_commands')
+    @patch('backupdb.utils.pitr.do_mysql_restore')
+    def test_it_refuses_to_replay_binlogs_with_gaps(self, do_mysql_restore, pipe_commands):
+        record(self.pitr_dir, kind='base', file='base/1.mysql.gz', recoverable_from=100.0,
+               binlog_file='binlog.000002', binlog_position=157)
+        for name in ('binlog.000002', 'binlog.000004'):
+            record(self.pitr_dir, kind='binlog', name=name, file='binlog/{0}.gz'.format(name), archived=200.0)
+
+        self.assertRaises(RestoreError, do_mysql_pitr_restore, self.pitr_dir, MYSQL_CONFIG, 150.0)
+
+        record(self.pitr_dir, kind='base', file='base/2.mysql.gz', recoverable_from=110.0,
+               binlog_file='binlog.000001', binlog_position=4)
+        self.assertRaises(RestoreError, do_mysql_pitr_restore, self.pitr_dir, MYSQL_CONFIG, 150.0)
+        self.assertFalse(do_mysql_restore.called)
+
+    @patch('backupdb.utils.pitr.pipe_commands')
+    @patch('backupdb.utils.pitr.do_mysql_restore')
+    def test_it_warns_when_the_archive_ends_before_the_time(self, do_mysql_restore, pipe_commands):
+        record(self.pitr_dir, kind='base', file='base/1.mysql.gz', recoverable_from=100.0,
+               binlog_file='binlog.000001', binlog_position=157)
+        self.write_gzip(self.get_path('binlog', 'binlog.000001.gz'), b'binlog')
+        record(self.pitr_dir, kind='binlog', name='binlog.000001', file='binlog/binlog.000001.gz', archived=200.0)
+
+        with patch('backupdb.utils.pitr.logger') as logger:
+            do_mysql_pitr_restore(self.pitr_dir, MYSQL_CONFIG, 150.0)
+            self.assertFalse(logger.warning.called)
+            do_mysql_pitr_restore(self.pitr_dir, MYSQL_CONFIG, 300.0)
+            self.assertIn("can't be recovered", logger.warning.call_args[0][0])
@@ -0,0 +1,220 @@
+import datetime
+import decimal
+import io
+import logging
+import os
+import pickle
+import shutil
+import tempfile
+import threading
+import unittest
+import uuid
+
+import mock
+from django.apps import apps
+from django.db import connection
+
+from backupdb.utils.exceptions import BackupError, RestoreError
+from backupdb.utils.portable import (
+    FORMAT,
+    VERSION,
+    do_portable_backup,
+    do_portable_restore,
+    export_database,
+    export_in_parallel,
+    iter_records,
+    load_database,
+)
+
+
+LAST_YEAR = datetime.datetime(2023, 6, 1, 12, 30, tzinfo=datetime.timezone.utc)
+
+
+class PortableTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        # The test models can't be imported before the apps are loaded
+        cls.Author, cls.Tag, cls.Book, cls.Ebook = [
+            apps.get_model('app', name) for name in ('Author', 'Tag', 'Book', 'Ebook')]
+        cls.models = [cls.Author, cls.Tag, cls.Book, cls.Ebook]
+        with connection.schema_editor() as editor:
+            for model in cls.models:
+                editor.create_model(model)
+
+    @classmethod
+    def tearDownClass(cls):
+        with connection.schema_editor() as editor:
+            for model in reversed(cls.models):
+                editor.delete_model(model)
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        logging.disable(logging.CRITICAL)
+        self.addCleanup(logging.disable, logging.NOTSET)
+
+        self.author = self.Author.objects.create(name='Eric')
+        self.Author.objects.filter(pk=self.author.pk).update(updated=LAST_YEAR)
+        self.tag = self.Tag.objects.create(name='spam')
+        self.book = self.Book.objects.create(
+            author=self.author, title='Spam', price=decimal.Decimal('9.99'), code=uuid.uuid4(), cover=b'\x00\xff')
+        self.book.tags.add(self.tag)
+        self.ebook = self.Ebook.objects.create(
+            author=self.author, title='Eggs', price=decimal.Decimal('5.00'), code=uuid.uuid4(), url='http://eggs')
+        self.addCleanup(self.delete_rows)
+
+    def delete_rows(self):
+        for model in reversed(self.models):
+            model.objects.all().delete()
+
+    def export(self, **kwargs):
+        output = io.BytesIO()
+        counts = export_database(output, jobs=1, **kwargs)
+        output.seek(0)
+        return output, counts
+
+    def assertRestored(self):
+        author = self.Author.objects.get()
+        self.assertEqual((author.pk, author.name, author.updated), (self.author.pk, 'Eric', LAST_YEAR))
+        book = self.Book.objects.get(title='Spam')
+        self.assertEqual(book.price, decimal.Decimal('9.99'))
+        self.assertEqual(book.code, self.book.code)
+        self.assertEqual(bytes(book.cover), b'\x00\xff')
+        self.assertEqual(list(book.tags.all()), [self.tag])
+        ebook = self.Ebook.objects.get()
+        self.assertEqual((ebook.pk, ebook.title, ebook.url), (self.ebook.pk, 'Eggs', 'http://eggs'))
+
+
+class ExportDatabaseTestCase(PortableTestCase):
+    def test_it_writes_a_header_batches_and_counts(self):
+        output, counts = self.export(batch_size=1)
+        records = list(iter_records(output))
+
+        header = records[0]
+        self.assertEqual((header['format'], header['version'], header['vendor']), (FORMAT, VERSION, 'sqlite'))
+        self.assertIn(('app.Ebook', ['book_ptr_id', 'url']), header['models'])
+        self.assertEqual(records[-1], ('end', counts))
+        self.assertEqual(counts['app.Book'], 2)
+        self.assertEqual(counts['app.Ebook'], 1)
+        books = [rows for kind, label, rows in records[1:-1] if label == 'app.Book']
+        self.assertEqual([len(rows) for rows in books], [1, 1])
+
+
+class ExportInParallelTestCase(unittest.TestCase):
+    def test_it_writes_the_batches_of_every_thread(self):
+        def export_models(models, using, batch_size, write, snapshot=None):
+            while True:
+                try:
+                    model = models.get_nowait()
+                except Exception:
+                    break
+                for i in range(3):
+                    write((model, [i]))
+
+        written = []
+        with mock.patch('backupdb.utils.portable.export_models', side_effect=export_models):
+            export_in_parallel(['a', 'b', 'c', 'd'], 'default', 10, 2, written.append)
+
+        self.assertEqual(sorted(written), sorted((model, [i]) for model in 'abcd' for i in range(3)))
+
+    def test_it_raises_the_error_of_a_thread(self):
+        calls = []
+
+        def export_models(models, using, batch_size, write, snapshot=None):
+            calls.append(threading.current_thread())
+            if len(calls) == 1:
+                raise BackupError('spam')
+            for i in range(100):
+                write(('eggs', [i]))
+
+        with mock.patch('backupdb.utils.portable.export_models', side_effect=export_models):
+            with self.assertRaises(BackupError):
+                export_in_parallel(['a', 'b'], 'default', 10, 2, lambda record: None)
+
+
+class LoadDatabaseTestCase(PortableTestCase):
+    def test_it_restores_the_rows_of_every_model(self):
+        output, counts = self.export(batch_size=1)
+        self.delete_rows()
+
+        loaded = load_database(output, batch_size=1)
+
+        self.assertEqual(loaded, counts)
+        self.assertRestored()
+        # Sequences continue after the restored rows
+        self.assertGreater(self.Author.objects.create(name='Graham').pk, self.author.pk)
+
+    def test_it_replaces_the_rows_when_flushing(self):
+        output, counts = self.export()
+        self.Author.objects.create(name='Graham')
+        self.Tag.objects.all().delete()
+
+        load_database(output, flush=True)
+
+        self.assertRestored()
+
+    def test_it_ignores_unknown_models_and_columns(self):
+        output = io.BytesIO()
+        pickle.dump({
+            'format': FORMAT,
+            'version': VERSION,
+            'vendor': 'postgresql',
+            'models': [('app.Tag', ['id', 'colour', 'name']), ('other.Spam', ['id'])],
+        }, output)
+        pickle.dump(('rows', 'app.Tag', [(7, 'red', 'eggs')]), output)
+        pickle.dump(('rows', 'other.Spam', [(1,)]), output)
+        pickle.dump(('end', {'app.Tag': 1, 'other.Spam': 1}), output)
+        output.seek(0)
+        self.delete_rows()
+
+        self.assertEqual(load_database(output), {'app.Tag': 1})
+        self.assertEqual(list(self.Tag.objects.values_list('id', 'name')), [(7, 'eggs')])
+
+    def test_it_rejects_incomplete_backups(self):
+        output, counts = self.export()
+        truncated = io.BytesIO(output.getvalue()[:-10])
+        self.delete_rows()
+
+        with self.assertRaises((RestoreError, pickle.UnpicklingError)):
+            load_database(truncated)
+        self.assertFalse(self.Author.objects.exists())
+
+    def test_it_only_unpickles_field_values(self):
+        output = io.BytesIO()
+        pickle.dump({'format': FORMAT, 'version': VERSION, 'vendor': 'sqlite', 'models': []}, output)
+        pickle.dump(('rows', 'app.Tag', [(1, os.getcwd)]), output)
+        output.seek(0)
+
+        with self.assertRaises(pickle.UnpicklingError):
+            list(iter_records(output))
+
+    def test_it_rejects_other_files(self):
+        with self.assertRaises(RestoreError):
+            list(iter_records(io.BytesIO(pickle.dumps(['spam']))))
+
+
+class PortableBackupTestCase(PortableTestCase):
+    def test_backups_can_be_restored(self):
+        backup_file = os.path.join(self.dir, 'default.portable.gz')
+
+        do_portable_backup(backup_file, jobs=1)
+        self.delete_rows()
+        do_portable_restore(backup_file=backup_file)
+
+        self.assertRestored()
+
+    def test_failed_backups_are_removed(self):
+        backup_file = os.path.join(self.dir, 'default.portable.gz')
+
+        with mock.patch('backupdb.utils.portable.export_database', side_effect=BackupError('spam')):
+            with self.assertRaises(BackupError):
+                do_portable_backup(backup_file, jobs=1)
+        self.assertFalse(os.path.exists(backup_file))
+
+    def test_failed_restores_raise_restore_errors(self):
+        backup_file = os.path.join(self.dir, 'default.portable.gz')
+        do_portable_backup(backup_file, jobs=1)
+
+        # The rows are already there
+        with self.assertRaises(RestoreError):
+            do_portable_restore(backup_file=backup_file)
@@ -1,4 +1,5 @@
 from subprocess import CalledProcessError
+import io
 import os
 import unittest
 
@@ -11,6 +12,7 @@ except ImportError:
 
 from backupdb.utils.processes import (
     extend_env,
+    get_command_output,
     get_env_str,
     pipe_commands,
     pipe_commands_to_file,
@@ -84,6 +86,13 @@ for i in range(4):
             'spam\nspam\nspam\nspam\n',
         )
 
+    def test_it_ignores_broken_pipes_before_a_command_exiting_early(self):
+        self.assertRaises(CalledProcessError, pipe_commands, [['yes'], ['head', '-n', '1']])
+
+        pipe_commands([['yes'], ['head', '-n', '1']], early_exit=1)
+
+        self.assertRaises(CalledProcessError, pipe_commands, [['yes'], ['head', '-n', '1'], ['false']], early_exit=1)
+
     def test_it_works_when_large_amounts_of_data_are_being_piped(self):
         pipe_commands([
             ['echo', r"""
@@ -116,6 +125,15 @@ sys.stdout.write(os.environ['TEST_VAR'])
     def test_it_correctly_raises_a_called_process_error_when_necessary(self):
         self.assertRaises(CalledProcessError, pipe_commands, [['false'], ['true']])
 
+    def test_it_feeds_a_stream_to_the_first_command(self):
+        timings = pipe_commands(
+            [['cat'], ['tee', self.get_path('pipe_commands.out')]],
+            stdin=io.BytesIO(b'spam\n' * 100000),
+        )
+
+        self.assertFileHasLength('pipe_commands.out', 500000)
+        self.assertEqual([cmd_str for cmd_str, seconds in timings], ['cat', 'tee ' + self.get_path('pipe_commands.out')])
+
 
 class PipeCommandsToFileTestCase(FileSystemScratchTestCase):
     def test_it_pipes_a_list_of_commands_into_each_other_and_then_into_a_file(self):
@@ -168,3 +186,31 @@ sys.stdout.write(os.environ['TEST_VAR'])
             [['false'], ['true']],
             self.get_path('pipe_commands.out'),
         )
+
+    def test_it_writes_into_a_stream_when_given_one(self):
+        output = io.BytesIO()
+        pipe_commands_to_file([['cat']], output, stdin=io.BytesIO(b'spam\n' * 4))
+
+        self.assertEqual(output.getvalue(), b'spam\n' * 4)
+
+    def test_it_raises_errors_reading_the_stream(self):
+        class BrokenStream(object):
+            def read(self, size=-1):
+                raise IOError('spam')
+
+        output = io.BytesIO()
+        self.assertRaises(IOError, pipe_commands_to_file, [['cat']], output, stdin=BrokenStream())
+
+
+class GetCommandOutputTestCase(unittest.TestCase):
+    def test_it_returns_the_output_of_a_command(self):
+        self.assertEqual(get_command_output(['echo', 'spam']), 'spam\n')
+
+    def test_it_allows_you_to_specify_extra_environment_variables(self):
+        self.assertEqual(
+            get_command_output(['python', '-c', 'import os; print(os.environ["TEST_VAR"])'], extra_env={'TEST_VAR': 'spam'}),
+            'spam\n',
+        )
+
+    def test_it_raises_a_called_process_error_when_necessary(self):
+        self.assertRaises(CalledProcessError, get_command_output, ['false'])
@@ -0,0 +1,265 @@
+import gzip
+import io
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import mock
+
+from backupdb.utils.exceptions import RestoreError
+from backupdb.utils.replay import (
+    PG_STOP_ON_ERROR,
+    Replay,
+    do_postgresql_replay,
+    replay_mysql_dump,
+    replay_pg_dump,
+)
+
+
+PG_DUMP = """--
+-- PostgreSQL database dump
+--
+
+SET statement_timeout = 0;
+SELECT pg_catalog.set_config('search_path', '', false);
+
+DROP TABLE public.spam;
+DROP TABLE public.eggs;
+
+CREATE TABLE public.spam (
+    id integer NOT NULL,
+    name text
+);
+
+CREATE TABLE public.eggs (
+    id integer NOT NULL,
+    spam_id integer
+);
+
+COPY public.spam (id, name) FROM stdin;
+1\tone
+2\ttwo
+\\.
+
+COPY public.eggs (id, spam_id) FROM stdin;
+1\t1
+\\.
+
+SELECT pg_catalog.setval('public.spam_id_seq', 2, true);
+
+ALTER TABLE ONLY public.spam
+    ADD CONSTRAINT spam_pkey PRIMARY KEY (id);
+
+SET default_tablespace = fast;
+
+CREATE INDEX spam_name ON public.spam USING btree (name);
+
+ALTER TABLE ONLY public.eggs
+    ADD CONSTRAINT eggs_pkey PRIMARY KEY (id);
+
+ALTER TABLE ONLY public.eggs
+    ADD CONSTRAINT eggs_spam_id_fk FOREIGN KEY (spam_id) REFERENCES public.spam(id);
+
+GRANT SELECT ON TABLE public.spam TO reader;
+"""
+
+MYSQL_DUMP = """-- MySQL dump 10.13
+/*!40101 SET @OLD_CHARACTER_SET_CLIENT=@@CHARACTER_SET_CLIENT */;
+/*!40103 SET TIME_ZONE='+00:00' */;
+
+DROP TABLE IF EXISTS `spam`;
+CREATE TABLE `spam` (
+  `id` int NOT NULL,
+  PRIMARY KEY (`id`)
+);
+
+LOCK TABLES `spam` WRITE;
+/*!40000 ALTER TABLE `spam` DISABLE KEYS */;
+INSERT INTO `spam` VALUES (1),(2);
+INSERT INTO `spam` VALUES (3);
+/*!40000 ALTER TABLE `spam` ENABLE KEYS */;
+UNLOCK TABLES;
+
+DELIMITER ;;
+/*!50003 CREATE TRIGGER `spam_ai` AFTER INSERT ON `spam` FOR EACH ROW SET @n = 1 */;;
+DELIMITER ;
+
+DROP TABLE IF EXISTS `eggs`;
+CREATE TABLE `eggs` (
+  `id` int NOT NULL
+);
+
+LOCK TABLES `eggs` WRITE;
+INSERT INTO `eggs` VALUES (1);
+UNLOCK TABLES;
+
+/*!40103 SET TIME_ZONE=@OLD_TIME_ZONE */;
+"""
+
+
+class ScriptRecorder(object):
+    """
+    Records the scripts run by a replay in the order in which they finish.
+    """
+    def __init__(self, slow=(), fail=()):
+        self.slow = slow
+        self.fail = fail
+        self.scripts = []
+        self.lock = threading.Lock()
+
+    def __call__(self, path):
+        name = os.path.basename(path).split('-', 1)[1][:-len('.sql')]
+        with open(path) as f:
+            contents = f.read()
+        if name in self.slow:
+            time.sleep(0.1)
+        if name in self.fail:
+            raise RestoreError('failed')
+        with self.lock:
+            self.scripts.append((name, contents))
+        return [(name, 0)]
+
+    def names(self):
+        return [name for name, contents in self.scripts]
+
+    def get(self, name):
+        return dict(self.scripts)[name]
+
+
+class ReplayTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        logging.disable(logging.CRITICAL)
+        self.addCleanup(logging.disable, logging.NOTSET)
+
+    def replay(self, replay_func, dump, stop_on_error='', **kwargs):
+        recorder = ScriptRecorder(**kwargs)
+        replay = Replay(recorder, jobs=2, stop_on_error=stop_on_error, spool_dir=self.dir)
+        try:
+            replay_func(io.StringIO(dump), replay)
+        finally:
+            replay.close()
+        self.assertEqual(os.listdir(self.dir), [])
+        return recorder
+
+
+class ReplayPgDumpTestCase(ReplayTestCase):
+    def test_it_splits_the_dump_into_pre_data_data_and_post_data(self):
+        recorder = self.replay(replay_pg_dump, PG_DUMP, stop_on_error=PG_STOP_ON_ERROR)
+        names = recorder.names()
+
+        self.assertEqual(names[0], 'pre_data')
+        self.assertEqual(sorted(names[1:3]), ['data_public_eggs', 'data_public_spam'])
+        self.assertEqual(names[3], 'sequences')
+        self.assertEqual(sorted(names[4:6]), ['post_data_public_eggs', 'post_data_public_spam'])
+        self.assertEqual(names[6], 'post_data')
+
+        # Every script starts with the setup statements
+        for name, contents in recorder.scripts:
+            self.assertTrue(contents.startswith('SET statement_timeout = 0;\nSELECT pg_catalog.set_config('))
+
+        # Definitions and the remaining post-data don't stop at errors
+        pre_data = recorder.get('pre_data')
+        self.assertNotIn(PG_STOP_ON_ERROR, pre_data)
+        self.assertIn('DROP TABLE public.spam;', pre_data)
+        self.assertIn('CREATE TABLE public.eggs', pre_data)
+        self.assertNotIn('COPY', pre_data)
+        self.assertNotIn(PG_STOP_ON_ERROR, recorder.get('post_data'))
+
+        spam = recorder.get('data_public_spam')
+        self.assertIn(PG_STOP_ON_ERROR, spam)
+        self.assertTrue(spam.endswith('COPY public.spam (id, name) FROM stdin;\n1\tone\n2\ttwo\n\\.\n'))
+        self.assertNotIn('eggs', spam)
+        self.assertIn('setval', recorder.get('sequences'))
+
+    def test_it_builds_indexes_by_table_with_their_settings(self):
+        recorder = self.replay(replay_pg_dump, PG_DUMP, stop_on_error=PG_STOP_ON_ERROR)
+
+        spam = recorder.get('post_data_public_spam')
+        self.assertIn(PG_STOP_ON_ERROR, spam)
+        self.assertLess(spam.index('spam_pkey'), spam.index('SET default_tablespace = fast;'))
+        self.assertLess(spam.index('SET default_tablespace = fast;'), spam.index('CREATE INDEX spam_name'))
+        self.assertIn('eggs_pkey', recorder.get('post_data_public_eggs'))
+        self.assertNotIn('FOREIGN KEY', spam + recorder.get('post_data_public_eggs'))
+
+        post_data = recorder.get('post_data')
+        self.assertIn('eggs_spam_id_fk FOREIGN KEY', post_data)
+        self.assertIn('GRANT SELECT', post_data)
+        self.assertNotIn('PRIMARY KEY', post_data)
+        self.assertNotIn('CREATE INDEX', post_data)
+
+    def test_it_raises_if_a_block_fails(self):
+        with self.assertRaises(RestoreError):
+            self.replay(replay_pg_dump, PG_DUMP, fail=['data_public_eggs'])
+
+    def test_it_replays_dumps_without_data(self):
+        recorder = self.replay(replay_pg_dump, PG_DUMP.split('COPY')[0])
+
+        self.assertEqual(recorder.names(), ['pre_data'])
+
+
+class ReplayMysqlDumpTestCase(ReplayTestCase):
+    def test_it_splits_the_dump_into_definitions_and_data(self):
+        recorder = self.replay(replay_mysql_dump, MYSQL_DUMP)
+
+        self.assertEqual(sorted(recorder.names()), ['data_eggs_', 'data_spam_'] + ['definitions'] * 3)
+        for name, contents in recorder.scripts:
+            self.assertTrue(contents.startswith('/*!40101 SET @OLD_CHARACTER_SET_CLIENT'))
+
+        spam = recorder.get('data_spam_')
+        self.assertIn('LOCK TABLES `spam` WRITE;', spam)
+        self.assertIn('INSERT INTO `spam` VALUES (3);', spam)
+        self.assertTrue(spam.endswith('UNLOCK TABLES;\n'))
+        self.assertNotIn('eggs', spam)
+
+        definitions = [contents for name, contents in recorder.scripts if name == 'definitions']
+        self.assertIn('CREATE TABLE `spam`', definitions[0])
+        self.assertIn('DELIMITER ;;\n/*!50003 CREATE TRIGGER', definitions[1])
+        self.assertIn('CREATE TABLE `eggs`', definitions[1])
+        self.assertIn('SET TIME_ZONE=@OLD_TIME_ZONE', definitions[2])
+
+    def test_definitions_wait_for_the_tables_they_name(self):
+        recorder = self.replay(replay_mysql_dump, MYSQL_DUMP, slow=['data_spam_'])
+        names = recorder.names()
+
+        self.assertLess(names.index('data_spam_'), names.index('definitions', 1))
+
+
+class DoPostgresqlReplayTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        logging.disable(logging.CRITICAL)
+        self.addCleanup(logging.disable, logging.NOTSET)
+
+        self.backup_file = os.path.join(self.dir, 'default.pgsql.gz')
+        with gzip.open(self.backup_file, 'wb') as f:
+            f.write(PG_DUMP.encode('utf-8'))
+
+    def test_it_runs_each_block_with_psql(self):
+        cmds = []
+
+        def pipe_commands(cmds_, **kwargs):
+            cmds.append(cmds_[0])
+            return [('psql', 0)]
+
+        with mock.patch('backupdb.utils.replay.pipe_commands', side_effect=pipe_commands):
+            timings = do_postgresql_replay(
+                backup_file=self.backup_file,
+                db_config={'NAME': 'spam', 'USER': 'eggs', 'PASSWORD': 'secret'},
+                jobs=2,
+                spool_dir=self.dir,
+            )
+
+        self.assertEqual(len(cmds), 7)
+        for cmd in cmds:
+            self.assertEqual(cmd[:2], ['psql', '--username=eggs'])
+            self.assertTrue(cmd[2].startswith('--file={0}'.format(self.dir)))
+            self.assertEqual(cmd[3], 'spam')
+        self.assertEqual(len(timings), 2 + 7)
+        self.assertEqual(os.listdir(self.dir), ['default.pgsql.gz'])
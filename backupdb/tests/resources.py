@@ -0,0 +1,106 @@
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from mock import patch
+
+from backupdb.utils.processes import get_command_output, pipe_commands_to_file
+from backupdb.utils.resources import (
+    Cgroup,
+    LimitedStages,
+    get_limits,
+    get_stage_names,
+    parse_cpus,
+    parse_ionice,
+)
+
+from .utils import FileSystemScratchTestCase
+
+PRINT_LIMITS = (
+    'import os; '
+    'print(os.getpriority(os.PRIO_PROCESS, 0), sorted(os.sched_getaffinity(0)))'
+)
+
+
+class ParseTestCase(unittest.TestCase):
+    def test_it_parses_cpu_lists(self):
+        self.assertEqual(parse_cpus('0-3, 6'), set([0, 1, 2, 3, 6]))
+        self.assertEqual(parse_cpus([1, '2']), set([1, 2]))
+        self.assertRaises(ValueError, parse_cpus, 'all')
+
+    def test_it_parses_io_scheduling_classes(self):
+        self.assertEqual(parse_ionice('idle'), 3 << 13)
+        self.assertEqual(parse_ionice('best-effort'), 2 << 13 | 4)
+        self.assertEqual(parse_ionice('best-effort:7'), 2 << 13 | 7)
+        self.assertRaises(ValueError, parse_ionice, 'best-effort:8')
+        self.assertRaises(ValueError, parse_ionice, 'lazy')
+
+
+class GetLimitsTestCase(unittest.TestCase):
+    def test_it_names_stages_after_programs_and_scripts(self):
+        self.assertEqual(get_stage_names(['/usr/bin/gzip', '-c']), ['gzip'])
+        self.assertEqual(get_stage_names([sys.executable, '/backupdb/utils/frames.py', '-d']), [
+            os.path.basename(sys.executable), 'frames'])
+
+    def test_it_merges_stage_limits_over_the_defaults(self):
+        config = {'default': {'nice': 10, 'ionice': 'idle'}, 'gzip': {'nice': 19, 'cpus': '0'}}
+
+        self.assertEqual(get_limits(['gzip'], config), {'nice': 19, 'ionice': 'idle', 'cpus': '0'})
+        self.assertEqual(get_limits(['pg_dump'], config), {'nice': 10, 'ionice': 'idle'})
+        self.assertEqual(get_limits(['pg_dump'], {}), {})
+
+
+class LimitedStagesTestCase(FileSystemScratchTestCase):
+    def setUp(self):
+        super(LimitedStagesTestCase, self).setUp()
+        logging.disable(logging.CRITICAL)
+        self.addCleanup(logging.disable, logging.NOTSET)
+
+    def test_stages_without_limits_have_no_preexec_fn(self):
+        with LimitedStages([['gzip'], ['cat']], {'cat': {'cpus': [100000]}}) as stages:
+            self.assertEqual(stages[0], None)
+            # None of the CPUs exist
+            self.assertEqual(stages[1], None)
+
+    @patch('backupdb.utils.settings.PROCESS_LIMITS', {'default': {'nice': 7, 'ionice': 'idle', 'cpus': [0]}})
+    def test_limits_are_applied_to_the_processes(self):
+        output = get_command_output([sys.executable, '-c', PRINT_LIMITS])
+        self.assertEqual(output.strip(), '7 [0]')
+
+        pipe_commands_to_file([[sys.executable, '-c', PRINT_LIMITS], ['cat']], self.get_path('limits'))
+        with open(self.get_path('limits')) as f:
+            self.assertEqual(f.read().strip(), '7 [0]')
+
+    @patch('backupdb.utils.settings.PROCESS_LIMITS', {'default': {'nice': 7}})
+    def test_processes_are_left_alone_without_limits_for_them(self):
+        with patch('backupdb.utils.settings.PROCESS_LIMITS', {'gzip': {'nice': 7}}):
+            output = get_command_output([sys.executable, '-c', PRINT_LIMITS])
+        self.assertEqual(output.split()[0], str(os.getpriority(os.PRIO_PROCESS, 0)))
+
+
+class CgroupTestCase(unittest.TestCase):
+    def setUp(self):
+        self.parent = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.parent)
+
+    def test_it_writes_the_limits_of_transient_cgroups(self):
+        cgroup = Cgroup(self.parent, cpu_max='50000 100000', io_max='8:0 rbps=52428800')
+
+        self.assertEqual(os.path.dirname(cgroup.path), self.parent)
+        with open(os.path.join(cgroup.path, 'cpu.max')) as f:
+            self.assertEqual(f.read(), '50000 100000')
+        with open(os.path.join(cgroup.path, 'io.max')) as f:
+            self.assertEqual(f.read(), '8:0 rbps=52428800')
+        self.assertNotEqual(Cgroup(self.parent).path, cgroup.path)
+
+    def test_stages_are_not_limited_when_cgroups_can_not_be_created(self):
+        logging.disable(logging.CRITICAL)
+        self.addCleanup(logging.disable, logging.NOTSET)
+
+        with LimitedStages([['pg_dump']], {'pg_dump': {'cpu_max': 'max'}}, os.path.join(self.parent, 'missing')) as s:
+            self.assertEqual(s[0], None)
+        with LimitedStages([['pg_dump']], {'pg_dump': {'cpu_max': 'max'}}) as s:
+            self.assertEqual(s[0], None)
@@ -0,0 +1,186 @@
+from mock import Mock, patch
+from subprocess import CalledProcessError
+import gzip
+import json
+import logging
+import os
+import signal
+import unittest
+
+from backupdb.utils.resumable import (
+    do_postgresql_resumable_backup,
+    get_parts_dir,
+    open_snapshot_holder,
+    read_snapshot_holder,
+    stop_snapshot_holder,
+)
+
+from .utils import FileSystemScratchTestCase
+
+DB_CONFIG = {
+    'ENGINE': 'django.db.backends.postgresql_psycopg2',
+    'NAME': 'test_db',
+    'USER': 'test_user',
+}
+
+RELATIONS = 'r|public.eggs\nr|public.spam\nS|public.spam_id_seq\n'
+
+
+class DoPostgresqlResumableBackupTestCase(FileSystemScratchTestCase):
+    def setUp(self):
+        super(DoPostgresqlResumableBackupTestCase, self).setUp()
+        self.dumped = []
+        self.fail_on = None
+        self.snapshots = iter([('snap-1', 101, 1001), ('snap-2', 102, 1002)])
+
+        patchers = [
+            patch('backupdb.utils.resumable.start_snapshot_holder', side_effect=lambda *a, **kw: next(self.snapshots)),
+            patch('backupdb.utils.resumable.stop_snapshot_holder'),
+            patch('backupdb.utils.resumable.get_command_output', return_value=RELATIONS),
+            patch('backupdb.utils.resumable.pipe_commands_to_file', side_effect=self.pipe_commands_to_file),
+            patch('backupdb.utils.resumable.get_process_identity', side_effect=self.get_process_identity),
+        ]
+        self.mock_start, self.mock_stop, self.mock_output, _, _ = [p.start() for p in patchers]
+        self.processes = {101: 'Mon Jan  1 00:00:00 2024 psql', 102: 'Mon Jan  1 00:01:00 2024 psql'}
+        for p in patchers:
+            self.addCleanup(p.stop)
+
+        self.backup_file = self.get_path('default-test.pgsql.gz')
+        logging.disable(logging.CRITICAL)
+        self.addCleanup(logging.disable, logging.NOTSET)
+
+    def tearDown(self):
+        for name in os.listdir(self.SCRATCH_DIR):
+            path = self.get_path(name)
+            if os.path.isdir(path):
+                for part in os.listdir(path):
+                    os.remove(os.path.join(path, part))
+                os.rmdir(path)
+        super(DoPostgresqlResumableBackupTestCase, self).tearDown()
+
+    def pipe_commands_to_file(self, cmds, path, **kwargs):
+        dump_cmd = cmds[0]
+        if self.fail_on and self.fail_on in dump_cmd:
+            raise CalledProcessError(cmd='pg_dump', returncode=1)
+        self.dumped.append(dump_cmd)
+        with gzip.open(path, 'wb') as f:
+            f.write(' '.join(dump_cmd[2:-2]).encode() + b'\n')
+        return [(' '.join(dump_cmd), 0.0)]
+
+    def get_process_identity(self, pid):
+        return self.processes.get(pid)
+
+    def test_it_dumps_each_unit_from_the_snapshot_and_assembles_them(self):
+        do_postgresql_resumable_backup(self.backup_file, DB_CONFIG)
+
+        self.assertTrue(all(cmd[1] == '--snapshot=snap-1' for cmd in self.dumped))
+        with gzip.open(self.backup_file) as f:
+            self.assertEqual(f.read().decode().splitlines(), [
+                '--clean --schema-only',
+                '--section=pre-data',
+                '--section=data --table=public.eggs',
+                '--section=data --table=public.spam',
+                '--section=data --blobs --schema=pg_catalog --table=public.spam_id_seq',
+                '--section=post-data',
+            ])
+        self.assertFalse(os.path.exists(get_parts_dir(self.backup_file)))
+        self.mock_stop.assert_called_once_with(101, DB_CONFIG, 1001)
+
+    def test_it_resumes_after_the_finished_units(self):
+        self.fail_on = '--table=public.spam'
+        self.assertRaises(CalledProcessError, do_postgresql_resumable_backup, self.backup_file, DB_CONFIG)
+        self.assertEqual(len(self.dumped), 3)
+        self.assertFalse(os.path.exists(self.backup_file))
+
+        with open(os.path.join(get_parts_dir(self.backup_file), 'checkpoint.json')) as f:
+            checkpoint = json.load(f)
+        self.assertEqual([u['done'] for u in checkpoint['units']], [True, True, True, False, False, False])
+
+        self.fail_on = None
+        self.dumped = []
+        do_postgresql_resumable_backup(self.backup_file, DB_CONFIG)
+
+        self.assertEqual(self.dumped[0][3], '--table=public.spam')
+        self.assertEqual(len(self.dumped), 3)
+        self.assertTrue(all(cmd[1] == '--snapshot=snap-1' for cmd in self.dumped))
+        with gzip.open(self.backup_file) as f:
+            self.assertEqual(len(f.read().decode().splitlines()), 6)
+
+    def test_it_starts_over_when_the_snapshot_has_expired(self):
+        self.fail_on = '--table=public.spam'
+        self.assertRaises(CalledProcessError, do_postgresql_resumable_backup, self.backup_file, DB_CONFIG)
+
+        self.fail_on = None
+        self.dumped = []
+        self.mock_output.side_effect = [CalledProcessError(cmd='psql', returncode=1), RELATIONS]
+        do_postgresql_resumable_backup(self.backup_file, DB_CONFIG)
+
+        self.assertEqual(len(self.dumped), 6)
+        self.assertTrue(all(cmd[1] == '--snapshot=snap-2' for cmd in self.dumped))
+        self.assertEqual(self.mock_stop.call_args_list[0][0], (101, DB_CONFIG, 1001))
+
+    def test_it_dumps_from_a_given_snapshot(self):
+        self.fail_on = '--table=public.spam'
+        self.assertRaises(CalledProcessError, do_postgresql_resumable_backup, self.backup_file, DB_CONFIG)
+
+        self.fail_on = None
+        self.dumped = []
+        do_postgresql_resumable_backup(self.backup_file, DB_CONFIG, snapshot='shared')
+
+        # The checkpoint from another snapshot is discarded
+        self.assertEqual(len(self.dumped), 6)
+        self.assertTrue(all(cmd[1] == '--snapshot=shared' for cmd in self.dumped))
+        self.assertEqual(self.mock_start.call_count, 1)
+        self.assertEqual([c[0] for c in self.mock_stop.call_args_list], [(101, DB_CONFIG, 1001)])
+
+    def test_it_only_stops_the_holder_of_an_old_checkpoint_if_it_is_still_running(self):
+        self.fail_on = '--table=public.spam'
+        self.assertRaises(CalledProcessError, do_postgresql_resumable_backup, self.backup_file, DB_CONFIG)
+
+        # The process id now belongs to another process
+        self.processes[101] = 'Tue Jan  2 00:00:00 2024 postgres'
+        self.fail_on = None
+        self.mock_output.side_effect = [CalledProcessError(cmd='psql', returncode=1), RELATIONS]
+        do_postgresql_resumable_backup(self.backup_file, DB_CONFIG)
+
+        # Its backend is still terminated
+        self.assertEqual([c[0] for c in self.mock_stop.call_args_list], [(None, DB_CONFIG, 1001), (102, DB_CONFIG, 1002)])
+
+
+class OpenSnapshotHolderTestCase(unittest.TestCase):
+    @patch('backupdb.utils.resumable.Popen')
+    def test_only_detached_sessions_get_their_own_process_group(self, mock_popen):
+        open_snapshot_holder(DB_CONFIG, ttl=600)
+        self.assertIsNone(mock_popen.call_args[1]['preexec_fn'])
+        self.assertIn('SELECT pg_sleep(600);', mock_popen.return_value.stdin.write.call_args[0][0])
+
+        open_snapshot_holder(DB_CONFIG, detach=True)
+        self.assertEqual(mock_popen.call_args[1]['preexec_fn'], os.setsid)
+
+
+class StopSnapshotHolderTestCase(unittest.TestCase):
+    def test_it_reads_the_backend_of_the_session(self):
+        p = Mock(pid=101)
+        p.stdout.readline.return_value = '00000003-00000002-1|10:12:10|1001\n'
+
+        self.assertEqual(read_snapshot_holder(p), ('00000003-00000002-1', '10:12:10', 101, 1001))
+
+    @patch('backupdb.utils.resumable.os.kill')
+    @patch('backupdb.utils.resumable.run_postgresql_sql')
+    def test_it_terminates_the_backend_of_the_session(self, run_postgresql_sql, kill):
+        stop_snapshot_holder(101, DB_CONFIG, 1001)
+
+        db_config, sql = run_postgresql_sql.call_args[0]
+        self.assertEqual(db_config, DB_CONFIG)
+        self.assertIn('pg_terminate_backend(pid) FROM pg_stat_activity WHERE pid = 1001', sql)
+        kill.assert_called_once_with(101, signal.SIGTERM)
+
+    @patch('backupdb.utils.resumable.os.kill')
+    @patch('backupdb.utils.resumable.run_postgresql_sql', side_effect=CalledProcessError(cmd='psql', returncode=2))
+    def test_it_still_stops_the_session_if_the_server_is_unreachable(self, run_postgresql_sql, kill):
+        logging.disable(logging.CRITICAL)
+        self.addCleanup(logging.disable, logging.NOTSET)
+
+        stop_snapshot_holder(101, DB_CONFIG, 1001)
+
+        kill.assert_called_once_with(101, signal.SIGTERM)
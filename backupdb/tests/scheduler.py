@@ -0,0 +1,134 @@
+import json
+import threading
+import unittest
+
+from backupdb.utils.scheduler import ResultLog, Schedule, Scheduler
+
+from .utils import FileSystemScratchTestCase
+
+
+class FakeClock(object):
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class SchedulerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.release = threading.Event()
+        self.runs = []
+
+    def tearDown(self):
+        self.release.set()
+
+    def run_job(self, schedule):
+        self.runs.append(schedule.db_name)
+        self.release.wait(5)
+
+    def make_scheduler(self, schedules, max_jobs=10, random=lambda: 0.5):
+        return Scheduler(schedules, self.run_job, max_jobs=max_jobs, clock=self.clock, random=random)
+
+    def test_from_settings_builds_schedules(self):
+        schedules = Schedule.from_settings({
+            'default': {'interval': 60, 'jitter': 10, 'pg_dump_options': '--no-owner'},
+            'other': {'interval': 120},
+        })
+
+        self.assertEqual([s.db_name for s in schedules], ['default', 'other'])
+        self.assertEqual(schedules[0].jitter, 10)
+        self.assertEqual(schedules[0].options, {'pg_dump_options': '--no-owner'})
+        self.assertEqual(schedules[1].max_jobs, 1)
+
+    def test_it_staggers_start_times_with_jitter(self):
+        scheduler = self.make_scheduler([
+            Schedule('default', interval=60, jitter=100),
+        ])
+
+        self.assertEqual(scheduler.tick(), [])
+        self.clock.now += 50
+        self.assertEqual([s.db_name for s in scheduler.tick()], ['default'])
+        self.assertEqual(scheduler.next_runs['default'], 1000 + 60 + 50)
+
+    def test_it_limits_global_concurrency(self):
+        scheduler = self.make_scheduler([
+            Schedule('a', interval=60),
+            Schedule('b', interval=60),
+            Schedule('c', interval=60),
+        ], max_jobs=2)
+
+        self.assertEqual(len(scheduler.tick()), 2)
+        self.assertEqual(scheduler.tick(), [])
+
+        self.release.set()
+        scheduler.join()
+        self.assertEqual([s.db_name for s in scheduler.tick()], ['c'])
+
+    def test_it_limits_per_database_concurrency(self):
+        scheduler = self.make_scheduler([Schedule('a', interval=60)])
+
+        self.assertEqual(len(scheduler.tick()), 1)
+        self.clock.now += 60
+        self.assertEqual(scheduler.tick(), [])
+
+        self.release.set()
+        scheduler.join()
+        self.assertEqual(len(scheduler.tick()), 1)
+
+    def test_it_sleeps_while_due_jobs_are_blocked(self):
+        scheduler = self.make_scheduler([Schedule('a', interval=60), Schedule('b', interval=60)], max_jobs=1)
+
+        scheduler.tick()
+        self.assertEqual(scheduler.get_sleep_time(poll_interval=5), 5)
+
+        scheduler = self.make_scheduler([Schedule('a', interval=1), Schedule('b', interval=60, jitter=20)])
+        scheduler.tick()
+        self.clock.now += 2
+        # 'a' is due again but still running, 'b' is due in 8 seconds
+        self.assertEqual(scheduler.get_sleep_time(poll_interval=30), 8)
+
+    def test_it_wakes_up_when_a_job_finishes(self):
+        scheduler = self.make_scheduler([Schedule('a', interval=60), Schedule('b', interval=60)], max_jobs=1)
+        ticks = []
+        tick = scheduler.tick
+
+        def counting_tick():
+            ticks.append(self.clock())
+            started = tick()
+            if len(self.runs) == 2:
+                scheduler.stop()
+            return started
+        scheduler.tick = counting_tick
+
+        thread = threading.Thread(target=scheduler.run, kwargs={'poll_interval': 30})
+        thread.start()
+        self.release.set()
+        thread.join(5)
+
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(self.runs, ['a', 'b'])
+        self.assertLess(len(ticks), 5)
+
+    def test_it_skips_missed_slots(self):
+        scheduler = self.make_scheduler([Schedule('a', interval=60)])
+
+        scheduler.tick()
+        self.release.set()
+        scheduler.join()
+        self.clock.now += 1000
+
+        scheduler.tick()
+        self.assertEqual(scheduler.slots['a'], 1000 + 960)
+
+
+class ResultLogTestCase(FileSystemScratchTestCase):
+    def test_it_appends_json_lines(self):
+        log = ResultLog(self.get_path('results.jsonl'))
+        log.record(database='default', status='ok')
+        log.record(database='other', status='error')
+
+        with open(self.get_path('results.jsonl')) as f:
+            lines = [json.loads(l) for l in f]
+        self.assertEqual([l['database'] for l in lines], ['default', 'other'])
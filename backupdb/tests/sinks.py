@@ -0,0 +1,117 @@
+import logging
+import os
+import shutil
+import stat
+import tempfile
+import threading
+import unittest
+
+from django.core.files.storage import FileSystemStorage
+
+from backupdb.utils.exceptions import BackupError
+from backupdb.utils.processes import pipe_commands_to_file
+from backupdb.utils.sinks import FanOut, FileSink, Sink, StorageSink, get_fan_out
+
+
+class FailingSink(Sink):
+    name = 'failing'
+
+    def write(self, data):
+        raise IOError('No space left on device')
+
+
+class BlockedSink(Sink):
+    name = 'blocked'
+
+    def __init__(self):
+        self.unblocked = threading.Event()
+
+    def write(self, data):
+        self.unblocked.wait()
+
+
+class SinksTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        logging.disable(logging.CRITICAL)
+        self.addCleanup(logging.disable, logging.NOTSET)
+
+    def get_path(self, *names):
+        return os.path.join(self.dir, *names)
+
+    def read(self, *names):
+        with open(self.get_path(*names), 'rb') as f:
+            return f.read()
+
+    def test_it_writes_every_destination_from_one_pass(self):
+        fan_out = get_fan_out(self.get_path('default.sqlite.gz'), [self.get_path('copy'), self.get_path('other')])
+
+        pipe_commands_to_file([['printf', 'spam']], path=fan_out)
+        results = fan_out.close()
+
+        self.assertEqual([(r.bytes, r.error) for r in results], [(4, None)] * 3)
+        for names in (['default.sqlite.gz'], ['copy', 'default.sqlite.gz'], ['other', 'default.sqlite.gz']):
+            self.assertEqual(self.read(*names), b'spam')
+        self.assertEqual(os.listdir(self.get_path('copy')), ['default.sqlite.gz'])
+
+    def test_files_get_the_permissions_of_new_files(self):
+        old_umask = os.umask(0o027)
+        self.addCleanup(os.umask, old_umask)
+        sink = FileSink(self.get_path('backup'))
+
+        sink.open()
+        sink.write(b'spam')
+        sink.close()
+
+        self.assertEqual(stat.S_IMODE(os.stat(self.get_path('backup')).st_mode), 0o640)
+
+    def test_failed_copies_are_reported(self):
+        fan_out = FanOut([FileSink(self.get_path('backup')), FailingSink()])
+
+        fan_out.write(b'spam')
+        results = fan_out.close()
+
+        self.assertEqual(self.read('backup'), b'spam')
+        self.assertEqual(results[0].error, None)
+        self.assertIsInstance(results[1].error, IOError)
+
+    def test_failing_to_write_the_backup_fails(self):
+        fan_out = FanOut([FailingSink(), FileSink(self.get_path('copy'))])
+
+        fan_out.write(b'spam')
+        self.assertRaises(BackupError, fan_out.close)
+        fan_out.abort()
+
+    def test_it_gives_up_on_stalled_sinks(self):
+        blocked = BlockedSink()
+        self.addCleanup(blocked.unblocked.set)
+        fan_out = FanOut([FileSink(self.get_path('backup')), blocked], buffer_size=4, stall_timeout=0.2)
+
+        for i in range(10):
+            fan_out.write(b'spam')
+        results = fan_out.close()
+
+        self.assertEqual(self.read('backup'), b'spam' * 10)
+        self.assertEqual(results[1].bytes, 0)
+        self.assertIsInstance(results[1].error, BackupError)
+
+    def test_aborted_backups_leave_nothing_behind(self):
+        storage = FileSystemStorage(location=self.get_path('storage'))
+        fan_out = FanOut([FileSink(self.get_path('backup')), StorageSink(storage, 'backup')])
+
+        fan_out.write(b'spam')
+        fan_out.abort()
+
+        self.assertEqual(os.listdir(self.dir), ['storage'])
+        self.assertEqual(os.listdir(self.get_path('storage')), [])
+
+    def test_it_saves_to_storages(self):
+        storage = FileSystemStorage(location=self.get_path('storage'))
+        fan_out = FanOut([FileSink(self.get_path('backup')), StorageSink(storage, 'db/backup')])
+
+        fan_out.write(b'spam')
+        fan_out.write(b'eggs')
+        fan_out.close()
+
+        self.assertEqual(self.read('storage', 'db', 'backup'), b'spameggs')
@@ -0,0 +1,121 @@
+from subprocess import CalledProcessError
+import logging
+import time
+import unittest
+
+from django.conf import settings
+from mock import patch
+
+from backupdb.utils.commands import run_postgresql_sql
+from backupdb.utils.exceptions import BackupError
+from backupdb.utils.snapshots import MIN_TTL, get_snapshot_ttl, group_by_server, release_snapshots, take_snapshots
+
+DEFAULT = {'ENGINE': 'django.db.backends.postgresql_psycopg2', 'NAME': 'default', 'HOST': 'db1'}
+BILLING = {'ENGINE': 'django.db.backends.postgresql_psycopg2', 'NAME': 'billing', 'HOST': 'db1'}
+OTHER = {'ENGINE': 'django.db.backends.postgresql_psycopg2', 'NAME': 'other', 'HOST': 'db2'}
+
+DATABASES = [('default', DEFAULT), ('billing', BILLING), ('other', OTHER)]
+
+
+class GroupByServerTestCase(unittest.TestCase):
+    def test_it_groups_databases_by_host_and_port(self):
+        servers = group_by_server(DATABASES)
+
+        self.assertEqual(list(servers), [('db1', None), ('db2', None)])
+        self.assertEqual(servers[('db1', None)], [('default', DEFAULT), ('billing', BILLING)])
+
+
+class GetSnapshotTtlTestCase(unittest.TestCase):
+    def test_it_holds_snapshots_for_as_long_as_the_backups_may_take(self):
+        self.assertEqual(get_snapshot_ttl(3600), 7200)
+        self.assertEqual(get_snapshot_ttl(3600, 10000), 10000)
+        self.assertEqual(get_snapshot_ttl(None, 5000), 5000)
+        self.assertEqual(get_snapshot_ttl(1), MIN_TTL)
+        self.assertEqual(get_snapshot_ttl(default=42), 42)
+
+
+class TakeSnapshotsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.txid_snapshots = {}
+        self.pids = iter(range(100, 200))
+
+        patchers = [
+            patch('backupdb.utils.snapshots.open_snapshot_holder', side_effect=lambda db_config, ttl: db_config),
+            patch('backupdb.utils.snapshots.read_snapshot_holder', side_effect=self.read_snapshot_holder),
+            patch('backupdb.utils.snapshots.stop_snapshot_holder'),
+        ]
+        self.mock_open, _, self.mock_stop = [p.start() for p in patchers]
+        for p in patchers:
+            self.addCleanup(p.stop)
+        logging.disable(logging.CRITICAL)
+        self.addCleanup(logging.disable, logging.NOTSET)
+
+    def read_snapshot_holder(self, db_config):
+        txid_snapshots = self.txid_snapshots.get(db_config['NAME'], ['10:10:'])
+        if not txid_snapshots:
+            raise CalledProcessError(cmd='psql', returncode=2)
+        pid = next(self.pids)
+        txid_snapshot = txid_snapshots.pop(0) if len(txid_snapshots) > 1 else txid_snapshots[0]
+        return 'snap-{0}'.format(pid), txid_snapshot, pid, pid + 1000
+
+    def test_it_takes_one_snapshot_per_database(self):
+        snapshots = take_snapshots(DATABASES)
+
+        self.assertEqual(sorted(snapshots), ['billing', 'default', 'other'])
+        self.assertEqual(len(set(s[0] for s in snapshots.values())), 3)
+        self.assertFalse(self.mock_stop.called)
+
+        release_snapshots(snapshots, DATABASES)
+        self.assertEqual(sorted(c[0] for c in self.mock_stop.call_args_list), [
+            (100, DEFAULT, 1100),
+            (101, BILLING, 1101),
+            (102, OTHER, 1102),
+        ])
+
+    def test_it_takes_the_snapshots_of_a_server_again_until_they_match(self):
+        self.txid_snapshots = {'billing': ['10:12:10', '10:12:10', '12:12:'], 'default': ['12:12:']}
+
+        snapshots = take_snapshots(DATABASES)
+
+        self.assertEqual(snapshots['default'][1], snapshots['billing'][1])
+        self.assertEqual(snapshots['default'][2], 104)
+        self.assertEqual(sorted(c[0][0] for c in self.mock_stop.call_args_list), [100, 101, 102, 103])
+        # Snapshots of other servers are not compared
+        self.assertEqual(snapshots['other'][2], 106)
+
+    def test_it_gives_up_matching_snapshots(self):
+        self.txid_snapshots = {'billing': ['10:12:10'], 'default': ['12:12:']}
+
+        snapshots = take_snapshots(DATABASES[:2], attempts=3)
+
+        self.assertNotEqual(snapshots['default'][1], snapshots['billing'][1])
+        self.assertEqual(self.mock_stop.call_count, 4)
+
+    def test_it_stops_all_sessions_when_one_fails(self):
+        self.txid_snapshots = {'other': []}
+
+        self.assertRaises(BackupError, take_snapshots, DATABASES)
+        self.assertEqual(sorted(c[0][0] for c in self.mock_stop.call_args_list), [100, 101])
+
+
+@unittest.skipUnless(
+    'postgresql' in settings.DATABASES['default']['ENGINE'], 'DATABASE_URL is not a PostgreSQL database')
+class ReleaseSnapshotsOnServerTestCase(unittest.TestCase):
+    def count_backends(self, backend_pid):
+        sql = 'SELECT count(*) FROM pg_stat_activity WHERE pid = {0}'.format(backend_pid)
+        return int(run_postgresql_sql(settings.DATABASES['default'], sql, output=True).strip())
+
+    def test_it_ends_the_sessions_on_the_server(self):
+        databases = [('default', settings.DATABASES['default'])]
+        snapshots = take_snapshots(databases, ttl=MIN_TTL)
+        backend_pid = snapshots['default'][3]
+        self.assertEqual(self.count_backends(backend_pid), 1)
+
+        release_snapshots(snapshots, databases)
+
+        # Terminated backends take a moment to exit
+        for _ in range(50):
+            if not self.count_backends(backend_pid):
+                break
+            time.sleep(0.1)
+        self.assertEqual(self.count_backends(backend_pid), 0)
@@ -0,0 +1,301 @@
+import errno
+import io
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from backupdb.utils.sqlfilters import (
+    filter_mysql,
+    filter_postgresql,
+    iter_mysql_dump,
+    iter_pg_dump,
+    open_fifo_for_writing,
+    parse_mysql_insert,
+)
+
+
+PG_DUMP = """--
+-- PostgreSQL database dump
+--
+
+SET statement_timeout = 0;
+SELECT pg_catalog.set_config('search_path', '', false);
+
+ALTER TABLE ONLY public.spam DROP CONSTRAINT spam_pkey;
+DROP TABLE public.spam;
+DROP FUNCTION public.eggs();
+
+CREATE FUNCTION public.eggs() RETURNS integer
+    LANGUAGE sql
+    AS $_$
+SELECT 1;
+$_$;
+
+CREATE TABLE public.spam (
+    id integer NOT NULL,
+    name text DEFAULT 'semi;colon'
+);
+
+COMMENT ON TABLE public.spam IS 'it''s
+multi-line; really';
+
+COPY public.spam (id, name) FROM stdin;
+1\tDROP TABLE public.spam;
+2\teggs
+\\.
+
+ALTER TABLE ONLY public.spam
+    ADD CONSTRAINT spam_pkey PRIMARY KEY (id);
+"""
+
+
+class IterPgDumpTestCase(unittest.TestCase):
+    def test_it_splits_statements_and_copy_data(self):
+        items = list(iter_pg_dump(io.StringIO(PG_DUMP)))
+        statements = [text for kind, text in items if kind == 'statement']
+
+        self.assertEqual(len(statements), 10)
+        self.assertTrue(statements[5].startswith('CREATE FUNCTION') and statements[5].endswith('$_$;\n'))
+        self.assertTrue(statements[6].endswith(');\n'))
+        self.assertTrue(statements[7].endswith("really';\n"))
+        self.assertEqual(
+            [text for kind, text in items if kind == 'copy'],
+            ['1\tDROP TABLE public.spam;\n', '2\teggs\n'],
+        )
+        self.assertEqual([kind for kind, text in items if kind == 'copy_end'], ['copy_end'])
+
+    def test_items_add_up_to_the_original_dump(self):
+        self.assertEqual(''.join(text for kind, text in iter_pg_dump(io.StringIO(PG_DUMP))), PG_DUMP)
+
+
+class FilterPostgresqlTestCase(unittest.TestCase):
+    def test_it_strips_clean_statements(self):
+        output = io.StringIO()
+        filter_postgresql(io.StringIO(PG_DUMP), output, strip_clean=True)
+        result = output.getvalue()
+
+        self.assertFalse('DROP CONSTRAINT' in result)
+        self.assertFalse('DROP FUNCTION' in result)
+        self.assertTrue('SET statement_timeout' in result)
+        self.assertTrue('1\tDROP TABLE public.spam;\n' in result)
+
+    def test_it_keeps_only_clean_statements_and_reads_the_whole_dump(self):
+        input = io.StringIO(PG_DUMP)
+        output = io.StringIO()
+        filter_postgresql(input, output, only_clean=True)
+        result = output.getvalue()
+
+        self.assertTrue('SET statement_timeout' in result)
+        self.assertTrue('DROP FUNCTION public.eggs();' in result)
+        self.assertFalse('CREATE' in result)
+        self.assertEqual(input.read(), '')
+
+    def test_it_can_stop_reading_after_the_clean_statements(self):
+        input = io.StringIO(PG_DUMP)
+        output = io.StringIO()
+        filter_postgresql(input, output, only_clean=True, drain=False)
+
+        self.assertTrue('DROP FUNCTION public.eggs();' in output.getvalue())
+        self.assertTrue('CREATE' in input.read())
+
+
+PG_FOREIGN_KEY_DUMP = """CREATE TABLE public.spam (
+    id integer NOT NULL
+);
+
+CREATE TABLE public."Eggs" (
+    id integer NOT NULL,
+    spam_id integer
+);
+
+CREATE TABLE public.ham (
+    id integer NOT NULL
+)
+PARTITION BY RANGE (id);
+
+ALTER TABLE ONLY public."Eggs"
+    ADD CONSTRAINT "Eggs_spam_id_fk" FOREIGN KEY (spam_id) REFERENCES public.spam(id) DEFERRABLE INITIALLY DEFERRED;
+
+ALTER TABLE public.ham
+    ADD CONSTRAINT ham_id_fk FOREIGN KEY (id) REFERENCES public.spam(id);
+"""
+
+
+class PgBulkLoadTestCase(unittest.TestCase):
+    def filter(self, unlogged):
+        output = io.StringIO()
+        deferred = io.StringIO()
+        filter_postgresql(io.StringIO(PG_FOREIGN_KEY_DUMP), output, deferred=deferred, unlogged=unlogged)
+        return output.getvalue(), deferred.getvalue()
+
+    def test_it_adds_foreign_keys_as_not_valid_and_defers_validation(self):
+        result, deferred = self.filter(unlogged=False)
+
+        self.assertTrue('REFERENCES public.spam(id) DEFERRABLE INITIALLY DEFERRED NOT VALID;\n' in result)
+        self.assertTrue('REFERENCES public.spam(id);\n' in result)
+        self.assertFalse('UNLOGGED' in result)
+        self.assertEqual(deferred, 'ALTER TABLE public."Eggs" VALIDATE CONSTRAINT "Eggs_spam_id_fk";\n')
+
+    def test_it_creates_unlogged_tables_and_moves_foreign_keys_after_making_them_logged(self):
+        result, deferred = self.filter(unlogged=True)
+
+        self.assertTrue('CREATE UNLOGGED TABLE public.spam' in result)
+        self.assertTrue('CREATE UNLOGGED TABLE public."Eggs"' in result)
+        self.assertTrue('CREATE TABLE public.ham' in result)
+        self.assertFalse('Eggs_spam_id_fk' in result)
+        self.assertTrue('ham_id_fk' in result)
+        self.assertEqual(deferred, (
+            'ALTER TABLE public.spam SET LOGGED;\n'
+            'ALTER TABLE public."Eggs" SET LOGGED;\n'
+            'ALTER TABLE ONLY public."Eggs"\n'
+            '    ADD CONSTRAINT "Eggs_spam_id_fk" FOREIGN KEY (spam_id) REFERENCES public.spam(id) '
+            'DEFERRABLE INITIALLY DEFERRED NOT VALID;\n'
+            'ALTER TABLE public."Eggs" VALIDATE CONSTRAINT "Eggs_spam_id_fk";\n'
+        ))
+
+
+MYSQL_DUMP = """-- MySQL dump 10.13
+/*!40101 SET @OLD_CHARACTER_SET_CLIENT=@@CHARACTER_SET_CLIENT */;
+
+DROP TABLE IF EXISTS `spam`;
+CREATE TABLE `spam` (
+  `id` int(11) NOT NULL,
+  `name` varchar(100) DEFAULT 'semi;colon',
+  PRIMARY KEY (`id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+
+LOCK TABLES `spam` WRITE;
+INSERT INTO `spam` VALUES (1,'it\\'s'),(2,NULL);
+INSERT INTO `spam` VALUES (3,'tab\\there');
+UNLOCK TABLES;
+DELIMITER ;;
+CREATE TRIGGER `eggs` BEFORE INSERT ON `spam` FOR EACH ROW BEGIN
+  SET NEW.name = 'x';
+END ;;
+DELIMITER ;
+"""
+
+
+class IterMysqlDumpTestCase(unittest.TestCase):
+    def test_it_splits_statements(self):
+        items = list(iter_mysql_dump(io.StringIO(MYSQL_DUMP)))
+        statements = [text for kind, text in items if kind == 'statement']
+
+        self.assertEqual(len(statements), 8)
+        self.assertTrue(statements[2].startswith('CREATE TABLE') and statements[2].endswith('utf8;\n'))
+        self.assertTrue(statements[7].startswith('CREATE TRIGGER') and statements[7].endswith('END ;;\n'))
+        self.assertEqual(''.join(text for kind, text in items), MYSQL_DUMP)
+
+
+class ParseMysqlInsertTestCase(unittest.TestCase):
+    def test_it_parses_extended_inserts(self):
+        self.assertEqual(
+            parse_mysql_insert("INSERT INTO `spam` VALUES (1,'it\\'s',-2.5e3),(2,NULL,_binary 'a\\0b');\n"),
+            ('`spam`', None, [['1', "it\\'s", '-2.5e3'], ['2', '\\N', 'a\\0b']]),
+        )
+
+    def test_it_parses_column_lists(self):
+        self.assertEqual(
+            parse_mysql_insert("INSERT INTO `spam` (`id`, `name`) VALUES (1,'');\n"),
+            ('`spam`', '(`id`, `name`)', [['1', '']]),
+        )
+
+    def test_it_escapes_tabs_and_newlines(self):
+        self.assertEqual(
+            parse_mysql_insert("INSERT INTO `spam` VALUES ('a\tb','c\\\tdd\\ne\nf\\\\t');\n"),
+            ('`spam`', None, [['a\\tb', 'c\\tdd\\ne\\nf\\\\t']]),
+        )
+
+    def test_it_refuses_values_it_cant_convert(self):
+        self.assertTrue(parse_mysql_insert("INSERT INTO `spam` VALUES (1,0xDEADBEEF);\n") is None)
+        self.assertTrue(parse_mysql_insert("INSERT INTO `spam` VALUES (1,b'101');\n") is None)
+
+
+class FilterMysqlTestCase(unittest.TestCase):
+    def test_it_wraps_the_dump_for_bulk_loading(self):
+        output = io.StringIO()
+        filter_mysql(io.StringIO(MYSQL_DUMP), output, bulk_load=True, commit_every=1, disable_binlog=True)
+        result = output.getvalue()
+
+        self.assertTrue(result.startswith('SET @BACKUPDB_OLD_FOREIGN_KEY_CHECKS=@@FOREIGN_KEY_CHECKS, FOREIGN_KEY_CHECKS=0;\n'))
+        self.assertTrue('SET SESSION SQL_LOG_BIN=0;\n' in result)
+        self.assertEqual(result.count('COMMIT;\n'), 4)
+        self.assertTrue(MYSQL_DUMP in result.replace('COMMIT;\n', ''))
+
+    def test_it_passes_the_dump_through_without_bulk_loading(self):
+        output = io.StringIO()
+        filter_mysql(io.StringIO(MYSQL_DUMP), output)
+
+        self.assertEqual(output.getvalue(), MYSQL_DUMP)
+
+    def test_it_turns_inserts_into_load_data_statements(self):
+        load_data_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, load_data_dir)
+
+        class Client(io.StringIO):
+            """
+            Reads each FIFO as soon as its LOAD DATA statement is flushed,
+            like the mysql client does.
+            """
+            loaded = []
+
+            def flush(self):
+                path = re.findall(r"LOAD DATA LOCAL INFILE '([^']+)'", self.getvalue())[-1]
+
+                def read():
+                    with open(path) as f:
+                        self.loaded.append(f.read())
+                thread = threading.Thread(target=read)
+                thread.start()
+                self.threads.append(thread)
+
+        output = Client()
+        output.threads = []
+        filter_mysql(io.StringIO(MYSQL_DUMP), output, bulk_load=True, load_data_dir=load_data_dir)
+        for thread in output.threads:
+            thread.join()
+
+        self.assertEqual(output.getvalue().count('LOAD DATA LOCAL INFILE'), 2)
+        self.assertTrue("INTO TABLE `spam` CHARACTER SET binary" in output.getvalue())
+        self.assertFalse('INSERT INTO' in output.getvalue())
+        self.assertEqual(Client.loaded, ["1\tit\\'s\n2\t\\N\n", '3\ttab\\there\n'])
+        self.assertEqual(os.listdir(load_data_dir), [])
+
+
+class OpenFifoForWritingTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.fifo = os.path.join(self.dir, 'rows')
+        os.mkfifo(self.fifo)
+
+        read_fd, write_fd = os.pipe()
+        self.reader = os.fdopen(read_fd, 'rb')
+        self.output = os.fdopen(write_fd, 'wb')
+        self.addCleanup(self.output.close)
+
+    def test_it_waits_for_a_slow_reader(self):
+        def read():
+            time.sleep(0.2)
+            with open(self.fifo) as f:
+                self.rows = f.read()
+        thread = threading.Thread(target=read)
+        thread.start()
+
+        with open_fifo_for_writing(self.fifo, self.output) as f:
+            f.write('1\tspam\n')
+        thread.join()
+        self.reader.close()
+
+        self.assertEqual(self.rows, '1\tspam\n')
+
+    def test_it_gives_up_once_the_reader_of_the_output_exits(self):
+        self.reader.close()
+
+        with self.assertRaises(OSError) as cm:
+            open_fifo_for_writing(self.fifo, self.output)
+        self.assertEqual(cm.exception.errno, errno.ENXIO)
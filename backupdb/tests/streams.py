@@ -0,0 +1,122 @@
+import gzip
+import io
+import logging
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+import mock
+from django.conf import settings
+from django.core.management import call_command
+
+from backupdb.utils.settings import BACKUP_DIR
+from backupdb.utils.streams import MAGIC, StreamError, StreamReader, StreamWriter, open_input
+
+
+def write_stream(backups, aborted=()):
+    output = io.BytesIO()
+    writer = StreamWriter(output)
+    for name, data in backups:
+        backup = writer.begin(name, {'engine': 'django.db.backends.sqlite3', 'extension': 'sqlite'})
+        backup.write(data)
+        if name in aborted:
+            backup.abort()
+        else:
+            backup.end()
+    writer.close()
+    return output.getvalue()
+
+
+class StreamTestCase(unittest.TestCase):
+    def test_it_round_trips_several_backups(self):
+        data = write_stream([('default', b'spam' * 1000), ('other', b''), ('third', b'eggs')])
+
+        backups = [(b.name, b.info['extension'], b.read()) for b in StreamReader(io.BytesIO(data))]
+
+        self.assertEqual(backups, [
+            ('default', 'sqlite', b'spam' * 1000),
+            ('other', 'sqlite', b''),
+            ('third', 'sqlite', b'eggs'),
+        ])
+
+    def test_it_reads_backups_in_chunks(self):
+        reader = next(iter(StreamReader(io.BytesIO(write_stream([('default', b'spam')])))))
+
+        self.assertEqual([reader.read(3), reader.read(3), reader.read(3)], [b'spa', b'm', b''])
+
+    def test_it_skips_backups_which_are_not_read(self):
+        data = write_stream([('default', b'spam'), ('other', b'eggs')])
+
+        self.assertEqual([b.name for b in StreamReader(io.BytesIO(data))], ['default', 'other'])
+
+    def test_it_reports_aborted_backups_and_carries_on(self):
+        data = write_stream([('default', b'spam'), ('other', b'eggs')], aborted=['default'])
+
+        names = []
+        for backup in StreamReader(io.BytesIO(data)):
+            names.append(backup.name)
+            if backup.name == 'default':
+                self.assertRaises(StreamError, backup.read)
+
+        self.assertEqual(names, ['default', 'other'])
+
+    def test_it_detects_corrupt_backups(self):
+        data = write_stream([('default', b'spam')]).replace(b'spam', b'spat')
+        backup = next(iter(StreamReader(io.BytesIO(data))))
+
+        self.assertRaises(StreamError, backup.read)
+
+    def test_it_detects_truncated_streams(self):
+        data = write_stream([('default', b'spam'), ('other', b'eggs')])
+
+        for size in (len(MAGIC) + 3, len(data) // 2, len(data) - 1):
+            def read_all():
+                for backup in StreamReader(io.BytesIO(data[:size])):
+                    backup.read()
+            self.assertRaises(StreamError, read_all)
+
+
+class OpenInputTestCase(unittest.TestCase):
+    def test_it_recognizes_backup_streams(self):
+        is_backup_stream, reader = open_input(io.BytesIO(write_stream([('default', b'spam')])))
+
+        self.assertTrue(is_backup_stream)
+        self.assertEqual([b.read() for b in reader], [b'spam'])
+
+    def test_it_returns_single_backups_unchanged(self):
+        for data in (b'\x1f\x8b' + b'spam' * 10, b'x'):
+            is_backup_stream, reader = open_input(io.BytesIO(data))
+
+            self.assertFalse(is_backup_stream)
+            self.assertEqual(reader.read(3) + reader.read(), data)
+
+
+class BackupToOutputTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        logging.disable(logging.CRITICAL)
+        self.addCleanup(logging.disable, logging.NOTSET)
+
+        self.db_file = os.path.join(self.dir, 'db.sqlite3')
+        db = sqlite3.connect(self.db_file)
+        db.execute('CREATE TABLE spam (name text)')
+        db.execute("INSERT INTO spam VALUES ('eggs')")
+        db.commit()
+        db.close()
+
+    def test_backupdb_writes_to_the_output_file(self):
+        output = os.path.join(self.dir, 'out.gz')
+        databases = {'spam': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': self.db_file}}
+        backups = set(os.listdir(BACKUP_DIR)) if os.path.exists(BACKUP_DIR) else set()
+
+        with mock.patch.object(settings, 'DATABASES', databases):
+            call_command('backupdb', output=output)
+
+        with gzip.open(output) as f:
+            data = f.read()
+        self.assertTrue(data.startswith(b'SQLite format 3'))
+        self.assertIn(b'eggs', data)
+        self.assertEqual(set(os.listdir(BACKUP_DIR)) if os.path.exists(BACKUP_DIR) else set(), backups)
@@ -0,0 +1,202 @@
+import gzip
+import sqlite3
+import unittest
+
+from mock import patch
+
+from backupdb.utils.exceptions import BackupError
+from backupdb.utils.subset import (
+    MysqlSubsetEngine,
+    PostgresqlSubsetEngine,
+    Subset,
+    SqliteSubsetEngine,
+    chunk_values,
+    do_subset_backup,
+    parse_root,
+)
+
+from .utils import FileSystemScratchTestCase
+
+
+def make_sqlite_config(path):
+    return {'ENGINE': 'django.db.backends.sqlite3', 'NAME': path}
+
+
+class ParseRootTestCase(unittest.TestCase):
+    def test_it_parses_tables_with_and_without_predicates(self):
+        self.assertEqual(parse_root('auth_user'), ('auth_user', None))
+        self.assertEqual(parse_root('auth_user: id < 10 '), ('auth_user', 'id < 10'))
+        self.assertEqual(parse_root("shop_order:created > '2024-01-01 00:00'"),
+                         ('shop_order', "created > '2024-01-01 00:00'"))
+
+    def test_it_rejects_roots_without_a_table(self):
+        self.assertRaises(ValueError, parse_root, ':id = 1')
+
+
+class ChunkValuesTestCase(unittest.TestCase):
+    def test_it_limits_the_length_of_chunks(self):
+        chunks = list(chunk_values(range(1000), str, max_length=100))
+
+        self.assertEqual(sum(chunks, []), [str(i) for i in range(1000)])
+        self.assertTrue(all(len(','.join(c)) <= 100 for c in chunks))
+
+
+class SqliteSubsetTestCase(FileSystemScratchTestCase):
+    def setUp(self):
+        super(SqliteSubsetTestCase, self).setUp()
+        self.db_path = self.get_path('subset.db')
+        conn = sqlite3.connect(self.db_path)
+        conn.executescript('''
+            CREATE TABLE django_migrations (id INTEGER PRIMARY KEY, name TEXT);
+            CREATE TABLE country (code TEXT PRIMARY KEY, name TEXT);
+            CREATE TABLE customer (
+                id INTEGER PRIMARY KEY,
+                country_code TEXT REFERENCES country (code),
+                referrer_id INTEGER REFERENCES customer (id)
+            );
+            CREATE TABLE shop_order (id INTEGER PRIMARY KEY, customer_id INTEGER REFERENCES customer);
+            CREATE TABLE order_note (order_id INTEGER REFERENCES shop_order (id), text TEXT);
+        ''')
+        conn.executemany('INSERT INTO django_migrations (name) VALUES (?)', [('0001',), ('0002',)])
+        conn.executemany('INSERT INTO country VALUES (?, ?)', [('fr', 'France'), ('us', 'USA'), ('de', 'Germany')])
+        conn.executemany('INSERT INTO customer VALUES (?, ?, ?)', [
+            (1, 'fr', None),
+            (2, 'us', 1),
+            (3, 'us', 2),
+            (4, 'de', None),
+        ])
+        conn.executemany('INSERT INTO shop_order VALUES (?, ?)', [(i, 1 + i % 4) for i in range(1, 101)])
+        conn.executemany('INSERT INTO order_note VALUES (?, ?)', [(i, 'note') for i in range(1, 101)])
+        conn.commit()
+        conn.close()
+
+    def backup(self, roots, **kwargs):
+        backup_file = self.get_path('subset.sqlite.gz')
+        do_subset_backup(backup_file, make_sqlite_config(self.db_path), roots, **kwargs)
+
+        restored_path = self.get_path('restored.db')
+        with gzip.open(backup_file, 'rb') as f, open(restored_path, 'wb') as out:
+            out.write(f.read())
+        conn = sqlite3.connect(restored_path)
+        self.addCleanup(conn.close)
+        return conn
+
+    def get_ids(self, conn, sql):
+        return sorted(row[0] for row in conn.execute(sql))
+
+    def test_it_follows_foreign_keys_transitively(self):
+        conn = self.backup([('shop_order', 'id = 2')])
+
+        self.assertEqual(self.get_ids(conn, 'SELECT id FROM shop_order'), [2])
+        # Order 2 belongs to customer 3, who was referred by 2, referred by 1
+        self.assertEqual(self.get_ids(conn, 'SELECT id FROM customer'), [1, 2, 3])
+        self.assertEqual(self.get_ids(conn, 'SELECT code FROM country'), ['fr', 'us'])
+        self.assertEqual(self.get_ids(conn, 'SELECT count(*) FROM order_note'), [0])
+        self.assertEqual(self.get_ids(conn, 'PRAGMA foreign_key_check'), [])
+
+    def test_it_keeps_full_tables(self):
+        conn = self.backup([('shop_order', 'id = 2')])
+
+        self.assertEqual(self.get_ids(conn, 'SELECT name FROM django_migrations'), ['0001', '0002'])
+
+    def test_it_selects_tables_without_primary_keys_by_condition(self):
+        conn = self.backup([('order_note', 'order_id IN (4, 8)')])
+
+        self.assertEqual(self.get_ids(conn, 'SELECT order_id FROM order_note'), [4, 8])
+        self.assertEqual(self.get_ids(conn, 'SELECT id FROM shop_order'), [4, 8])
+        self.assertEqual(self.get_ids(conn, 'SELECT id FROM customer'), [1])
+
+    def test_it_samples_roots(self):
+        conn = self.backup([('shop_order', None)], sample=100)
+        self.assertEqual(len(self.get_ids(conn, 'SELECT id FROM shop_order')), 100)
+
+        conn = self.backup([('shop_order', None)], sample=0)
+        self.assertEqual(self.get_ids(conn, 'SELECT id FROM shop_order'), [])
+        self.assertEqual(self.get_ids(conn, 'SELECT id FROM customer'), [])
+
+    def test_it_can_not_sample_tables_without_primary_keys(self):
+        # Tables without any primary key are tracked by rowid
+        self.backup([('order_note', None)], sample=50)
+
+        conn = sqlite3.connect(self.db_path)
+        conn.execute('CREATE TABLE pair (a INTEGER, b INTEGER, PRIMARY KEY (a, b))')
+        conn.close()
+        self.assertRaises(BackupError, self.backup, [('pair', None)], sample=50)
+
+    def test_it_rejects_unknown_tables(self):
+        self.assertRaises(BackupError, self.backup, [('missing', None)])
+
+    def test_it_reports_invalid_predicates(self):
+        self.assertRaises(BackupError, self.backup, [('shop_order', 'no_such_column = 1')])
+
+    def test_the_original_database_is_left_untouched(self):
+        self.backup([('shop_order', 'id = 2')])
+
+        conn = sqlite3.connect(self.db_path)
+        self.assertEqual(conn.execute('SELECT count(*) FROM shop_order').fetchone()[0], 100)
+        conn.close()
+
+
+class SubsetTestCase(unittest.TestCase):
+    def test_it_reads_the_sqlite_catalog(self):
+        engine = SqliteSubsetEngine(make_sqlite_config(':memory:'))
+        engine.connection = sqlite3.connect(':memory:')
+        engine.connection.executescript('''
+            CREATE TABLE parent (id INTEGER PRIMARY KEY);
+            CREATE TABLE child (parent_id INTEGER REFERENCES parent);
+        ''')
+        subset = Subset(engine)
+
+        self.assertEqual(subset.tables, ['child', 'parent'])
+        self.assertEqual(subset.primary_keys, {'parent': 'id', 'child': 'rowid'})
+        self.assertEqual(subset.foreign_keys, {'child': [('parent_id', 'parent', 'id')]})
+
+
+class PostgresqlSubsetEngineTestCase(unittest.TestCase):
+    def setUp(self):
+        self.engine = PostgresqlSubsetEngine({'NAME': 'test', 'USER': 'test'})
+        self.engine.snapshot_id = '00000003-0000001B-1'
+
+    @patch('backupdb.utils.subset.get_command_output')
+    def test_it_queries_from_the_snapshot(self, get_command_output):
+        get_command_output.return_value = '1\tfr\n2\t\\N\n'
+
+        rows = self.engine.query('SELECT id, country FROM customer')
+
+        self.assertEqual(rows, [('1', 'fr'), ('2', None)])
+        cmd = get_command_output.call_args[0][0]
+        self.assertIn("SET TRANSACTION SNAPSHOT '00000003-0000001B-1'", cmd)
+        self.assertIn('SELECT id, country FROM customer', cmd)
+
+    def test_it_finds_tables_without_schema(self):
+        tables = ['public.customer', 'public."Order"', 'other.customer']
+
+        self.assertEqual(self.engine.find_table('public.customer', tables), 'public.customer')
+        self.assertEqual(self.engine.find_table('Order', tables), 'public."Order"')
+        self.assertEqual(self.engine.find_table('customer', tables), None)
+
+    def test_it_copies_selected_rows_in_the_snapshot(self):
+        subset = Subset.__new__(Subset)
+        subset.engine = self.engine
+        subset.tables = ['public.customer', 'public.log']
+        subset.primary_keys = {'public.customer': 'id'}
+        subset.rows = {'public.customer': set(['1'])}
+        subset.conditions = {'public.log': [None]}
+
+        script = self.engine.get_data_script(subset)
+
+        self.assertIn("SET TRANSACTION SNAPSHOT '00000003-0000001B-1';", script)
+        self.assertIn("SELECT 'COPY public.customer FROM stdin;';\n"
+                      "COPY (SELECT * FROM public.customer WHERE \"id\" IN ('1')) TO STDOUT;\n"
+                      "SELECT '\\.';", script)
+        self.assertIn('COPY (SELECT * FROM public.log) TO STDOUT;', script)
+
+
+class MysqlSubsetEngineTestCase(unittest.TestCase):
+    @patch('backupdb.utils.subset.get_command_output')
+    def test_it_reads_null_values(self, get_command_output):
+        get_command_output.return_value = '1\tNULL\n'
+        engine = MysqlSubsetEngine({'NAME': 'test', 'USER': 'test'})
+
+        self.assertEqual(engine.query('SELECT 1, NULL'), [('1', None)])
+        self.assertEqual(engine.quote_value("it's"), "'it''s'")
@@ -0,0 +1,150 @@
+import argparse
+import gzip
+import io
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+
+from backupdb.utils import frames
+from backupdb.utils.exceptions import RestoreError
+from backupdb.utils.files import get_latest_timestamped_file
+from backupdb.utils.processes import pipe_commands_to_file
+from backupdb.utils.volumes import VolumeReader, VolumeWriter, is_volumed, parse_size
+
+DATA = b''.join(b'INSERT INTO spam VALUES (%d);\n' % i for i in range(20000))
+
+
+class VolumesTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.backup_file = self.get_path('default-2024-01-31-1706745600.pgsql.gz')
+
+    def get_path(self, *names):
+        return os.path.join(self.dir, *names)
+
+    def read(self, *names):
+        with open(self.get_path(*names), 'rb') as f:
+            return f.read()
+
+    def write_volumes(self, data, volume_size, destinations=()):
+        writer = VolumeWriter(self.backup_file, volume_size, destinations)
+        for i in range(0, len(data), 1000):
+            writer.write(data[i:i + 1000])
+        return writer.close()
+
+    def read_volumes(self):
+        reader = VolumeReader(self.backup_file)
+        try:
+            return reader.read()
+        finally:
+            reader.close()
+
+
+class VolumeWriterTestCase(VolumesTestCase):
+    def test_it_cuts_framed_backups_between_frames(self):
+        compressed = io.BytesIO()
+        frames.compress(io.BytesIO(DATA), compressed, frame_size=16 * 1024)
+        compressed = compressed.getvalue()
+
+        manifest = self.write_volumes(compressed, volume_size=len(compressed) // 3)
+
+        self.assertTrue(manifest['framed'])
+        self.assertEqual(manifest['size'], len(compressed))
+        self.assertEqual(len(manifest['volumes']), 4)
+        decompressed = []
+        for volume in manifest['volumes']:
+            # Each volume can be decompressed on its own
+            data = self.read(volume['file'])
+            self.assertEqual(volume['size'], len(data))
+            self.assertIsNotNone(frames.get_frame_size(data))
+            decompressed.append(gzip.decompress(data))
+        self.assertEqual(b''.join(decompressed), DATA)
+        self.assertTrue(is_volumed(self.backup_file))
+        self.assertEqual(self.read_volumes(), compressed)
+
+    def test_it_cuts_other_backups_at_the_volume_size(self):
+        compressed = gzip.compress(DATA)
+
+        manifest = self.write_volumes(compressed, volume_size=4096)
+
+        self.assertFalse(manifest['framed'])
+        self.assertEqual([v['size'] for v in manifest['volumes'][:-1]], [4096] * (len(manifest['volumes']) - 1))
+        self.assertEqual(gzip.decompress(self.read_volumes()), DATA)
+
+    def test_it_writes_from_pipelines(self):
+        with gzip.open(self.get_path('dump.gz'), 'wb') as f:
+            f.write(DATA)
+        writer = VolumeWriter(self.backup_file, 4096)
+
+        pipe_commands_to_file([['cat', self.get_path('dump.gz')]], path=writer)
+        writer.close()
+
+        self.assertEqual(self.read_volumes(), self.read('dump.gz'))
+
+    def test_it_copies_volumes_and_the_manifest(self):
+        logging.disable(logging.CRITICAL)
+        self.addCleanup(logging.disable, logging.NOTSET)
+        with open(self.get_path('not-a-dir'), 'w'):
+            pass
+
+        manifest = self.write_volumes(
+            gzip.compress(DATA), volume_size=4096, destinations=[self.get_path('copy'), self.get_path('not-a-dir')])
+
+        names = [v['file'] for v in manifest['volumes']] + [os.path.basename(self.backup_file) + '.manifest']
+        self.assertEqual(sorted(os.listdir(self.get_path('copy'))), sorted(names))
+        for name in names:
+            self.assertEqual(self.read('copy', name), self.read(name))
+
+    def test_aborted_backups_leave_no_volumes(self):
+        writer = VolumeWriter(self.backup_file, 4096)
+        writer.write(gzip.compress(DATA))
+        writer.abort()
+
+        self.assertEqual(os.listdir(self.dir), [])
+
+
+    def test_aborted_backups_leave_no_copies(self):
+        writer = VolumeWriter(self.backup_file, 4096, [self.get_path('copy')], jobs=1)
+        writer.write(gzip.compress(DATA))
+        writer.write(gzip.compress(DATA))
+        writer.abort()
+
+        self.assertEqual(os.listdir(self.dir), ['copy'])
+        self.assertEqual(os.listdir(self.get_path('copy')), [])
+
+
+class VolumeReaderTestCase(VolumesTestCase):
+    def test_it_checks_the_hash_of_each_volume(self):
+        manifest = self.write_volumes(gzip.compress(DATA), volume_size=4096)
+        with open(self.get_path(manifest['volumes'][1]['file']), 'r+b') as f:
+            f.write(b'\0')
+
+        reader = VolumeReader(self.backup_file)
+        self.addCleanup(reader.close)
+        self.assertEqual(len(reader.read(8192)), 4096)
+        self.assertRaises(RestoreError, reader.read, 8192)
+
+    def test_missing_volumes_are_reported_before_reading(self):
+        manifest = self.write_volumes(gzip.compress(DATA), volume_size=4096)
+        os.remove(self.get_path(manifest['volumes'][-1]['file']))
+
+        self.assertRaises(RestoreError, VolumeReader, self.backup_file)
+
+    def test_volumed_backups_are_found_by_their_manifest(self):
+        self.write_volumes(gzip.compress(DATA), volume_size=4096)
+        with open(self.get_path('default-2024-01-30-1706659200.pgsql.gz'), 'wb'):
+            pass
+
+        self.assertEqual(get_latest_timestamped_file('pgsql', dir=self.dir), self.backup_file)
+
+
+class ParseSizeTestCase(unittest.TestCase):
+    def test_it_parses_sizes(self):
+        self.assertEqual(parse_size('4G'), 4 * 1024 ** 3)
+        self.assertEqual(parse_size('512MiB'), 512 * 1024 ** 2)
+        self.assertEqual(parse_size('1000'), 1000)
+        self.assertRaises(argparse.ArgumentTypeError, parse_size, '0')
+        self.assertRaises(argparse.ArgumentTypeError, parse_size, 'large')
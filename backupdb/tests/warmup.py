@@ -0,0 +1,132 @@
+from subprocess import CalledProcessError
+import logging
+import os
+import sqlite3
+import unittest
+
+from mock import patch
+
+from backupdb.utils.warmup import (
+    capture_hot_relations,
+    do_mysql_warm_up,
+    do_postgresql_warm_up,
+    do_sqlite_warm_up,
+    get_hot_relations_file,
+    read_hot_relations,
+    split,
+)
+
+from .utils import FileSystemScratchTestCase
+
+PG_CONFIG = {'ENGINE': 'django.db.backends.postgresql_psycopg2', 'NAME': 'test_db', 'USER': 'test_user'}
+MYSQL_CONFIG = {'ENGINE': 'django.db.backends.mysql', 'NAME': 'test_db', 'USER': 'test_user'}
+
+
+class SplitTestCase(unittest.TestCase):
+    def test_it_splits_items_evenly(self):
+        self.assertEqual(split([1, 2, 3, 4, 5], 2), [[1, 3, 5], [2, 4]])
+        self.assertEqual(split([1, 2], 4), [[1], [2]])
+        self.assertEqual(split([], 4), [[]])
+
+
+class HotRelationsTestCase(FileSystemScratchTestCase):
+    def setUp(self):
+        super(HotRelationsTestCase, self).setUp()
+        logging.disable(logging.CRITICAL)
+        self.addCleanup(logging.disable, logging.NOTSET)
+
+    def test_it_saves_hot_relations_next_to_the_backup(self):
+        backup_file = self.get_path('default.pgsql.gz')
+
+        def hot_relations_func(db_config, limit, show_output):
+            return ['public.spam', 'public.spam_pkey'][:limit]
+
+        relations = capture_hot_relations(backup_file, PG_CONFIG, hot_relations_func, limit=1)
+
+        self.assertEqual(relations, ['public.spam'])
+        self.assertTrue(os.path.exists(get_hot_relations_file(backup_file)))
+        self.assertEqual(read_hot_relations(backup_file), ['public.spam'])
+
+    def test_it_ignores_failures_to_read_statistics(self):
+        backup_file = self.get_path('default.pgsql.gz')
+
+        def hot_relations_func(db_config, limit, show_output):
+            raise CalledProcessError(cmd='psql', returncode=1)
+
+        self.assertEqual(capture_hot_relations(backup_file, PG_CONFIG, hot_relations_func), None)
+        self.assertEqual(read_hot_relations(backup_file), None)
+
+    def test_streams_have_no_hot_relations(self):
+        self.assertEqual(read_hot_relations(object()), None)
+
+
+class DoSqliteWarmUpTestCase(FileSystemScratchTestCase):
+    def test_it_analyzes_the_database(self):
+        path = self.get_path('warmup.db')
+        conn = sqlite3.connect(path)
+        conn.execute('CREATE TABLE spam (id INTEGER PRIMARY KEY, name TEXT)')
+        conn.execute('CREATE INDEX spam_name ON spam (name)')
+        conn.executemany('INSERT INTO spam (name) VALUES (?)', [('eggs',)] * 10)
+        conn.commit()
+        conn.close()
+
+        self.assertTrue(do_sqlite_warm_up({'NAME': path}, prewarm=True))
+
+        conn = sqlite3.connect(path)
+        self.assertEqual(conn.execute('SELECT tbl FROM sqlite_stat1').fetchall(), [('spam',)])
+        conn.close()
+
+
+@patch('backupdb.utils.warmup.run_postgresql_sql')
+@patch('backupdb.utils.warmup.pipe_commands')
+class DoPostgresqlWarmUpTestCase(unittest.TestCase):
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        self.addCleanup(logging.disable, logging.NOTSET)
+
+    def test_it_vacuums_and_analyzes_in_parallel(self, pipe_commands, run_postgresql_sql):
+        self.assertTrue(do_postgresql_warm_up(PG_CONFIG, jobs=3, hot_relations=['public.spam']))
+
+        self.assertEqual(pipe_commands.call_args[0][0], [
+            ['vacuumdb', '--analyze', '--jobs=3', '--username=test_user', 'test_db'],
+        ])
+        self.assertFalse(run_postgresql_sql.called)
+
+    def test_it_prewarms_hot_relations(self, pipe_commands, run_postgresql_sql):
+        hot_relations = ['public.spam', 'public.spam_pkey', "public.\"it's\""]
+
+        self.assertTrue(do_postgresql_warm_up(PG_CONFIG, jobs=2, prewarm=True, hot_relations=hot_relations))
+
+        statements = sorted(c[0][1] for c in run_postgresql_sql.call_args_list)
+        self.assertEqual(statements, [
+            'CREATE EXTENSION IF NOT EXISTS pg_prewarm',
+            "SELECT pg_prewarm(c.oid) FROM pg_class c WHERE c.oid IN "
+            "(to_regclass('public.spam'), to_regclass('public.\"it''s\"'))",
+            "SELECT pg_prewarm(c.oid) FROM pg_class c WHERE c.oid IN (to_regclass('public.spam_pkey'))",
+        ])
+
+    def test_it_reports_failures(self, pipe_commands, run_postgresql_sql):
+        run_postgresql_sql.side_effect = CalledProcessError(cmd='psql', returncode=1)
+
+        self.assertFalse(do_postgresql_warm_up(PG_CONFIG, prewarm=True, hot_relations=['public.spam']))
+
+
+def get_mysql_sql(cmd):
+    return cmd[cmd.index('-e') + 1]
+
+
+@patch('backupdb.utils.warmup.get_command_output')
+class DoMysqlWarmUpTestCase(unittest.TestCase):
+    def test_it_analyzes_tables_and_prewarms_hot_ones(self, get_command_output):
+        def output(cmd, **kwargs):
+            return 'spam\neggs\nham\n' if 'TABLE_NAME' in get_mysql_sql(cmd) else ''
+        get_command_output.side_effect = output
+
+        self.assertTrue(do_mysql_warm_up(MYSQL_CONFIG, jobs=2, prewarm=True, hot_relations=['ham', 'gone']))
+
+        statements = sorted(get_mysql_sql(c[0][0]) for c in get_command_output.call_args_list[1:])
+        self.assertEqual(statements, [
+            'ANALYZE TABLE `eggs`',
+            'ANALYZE TABLE `spam`, `ham`',
+            'SELECT COUNT(*) FROM `ham` FORCE INDEX (PRIMARY);',
+        ])
@@ -0,0 +1,285 @@
+"""
+Verification of the backup files in a backup directory.
+
+Each backup is read in full and decompressed, which detects the same damage
+as `gzip -t`, and its checksum is compared with the one recorded in a catalog
+if there is one.  The volumes of volumed backups are also checked against the
+sizes and hashes of their manifest.  Files are audited on a pool of processes while a semaphore
+shared between the processes limits how many of them read from disk at the
+same time.
+"""
+import hashlib
+import json
+import multiprocessing
+import os
+import re
+import time
+import zlib
+
+from .exceptions import RestoreError
+from .frames import COPY_CHUNK_SIZE, FrameError, TruncatedError, decompress
+from .volumes import MANIFEST_SUFFIX, VolumeReader, get_manifest_file, is_volumed, read_manifest
+
+OK = 'ok'
+CORRUPT = 'corrupt'
+TRUNCATED = 'truncated'
+CHECKSUM_MISMATCH = 'checksum_mismatch'
+MISSING = 'missing'
+ORPHANED = 'orphaned'
+
+GZIP_INDEX_SUFFIX = '.gzindex'
+HOT_RELATIONS_SUFFIX = '.hot'
+
+# Files kept next to a backup, which are only orphans once it is gone
+SIDECAR_SUFFIXES = (GZIP_INDEX_SUFFIX, HOT_RELATIONS_SUFFIX)
+
+VOLUME_RE = re.compile(r'^(.+)\.\d{3,}$')
+
+# Set in each worker process by `init_worker`
+io_semaphore = None
+
+
+class AuditReader(object):
+    """
+    Readable file-like object which counts and hashes the data read from `f`.
+    Reads are made while holding `semaphore` if one is given.
+    """
+    def __init__(self, f, semaphore=None, algorithm='sha256'):
+        self.f = f
+        self.semaphore = semaphore
+        self.hash = hashlib.new(algorithm)
+        self.bytes = 0
+
+    def read(self, size=-1):
+        if self.semaphore is not None:
+            with self.semaphore:
+                data = self.f.read(size)
+        else:
+            data = self.f.read(size)
+        self.hash.update(data)
+        self.bytes += len(data)
+        return data
+
+
+class NullWriter(object):
+    def write(self, data):
+        pass
+
+
+def get_stat_path(path):
+    """
+    Returns the path of the file whose size and modification time stand for
+    the backup at `path`: its manifest if it was written as volumes.
+    """
+    return get_manifest_file(path) if is_volumed(path) else path
+
+
+def check_volumes(path):
+    """
+    Returns a tuple `(status, error)` describing the first volume of the
+    volumed backup at `path` which is missing or doesn't have the size
+    recorded in its manifest, or None if they all do.
+    """
+    try:
+        manifest = read_manifest(path)
+        volumes = manifest['volumes']
+    except (RestoreError, KeyError, TypeError) as e:
+        return CORRUPT, str(e)
+
+    dir = os.path.dirname(os.path.abspath(path))
+    for volume in volumes:
+        try:
+            size = os.path.getsize(os.path.join(dir, volume['file']))
+        except OSError as e:
+            return MISSING, str(e)
+        if size < volume['size']:
+            return TRUNCATED, "Volume '{0}' is shorter than in the manifest".format(volume['file'])
+        if size > volume['size']:
+            return CORRUPT, "Volume '{0}' is longer than in the manifest".format(volume['file'])
+    return None
+
+
+def audit_file(path, checksum=None, algorithm='sha256', semaphore=None):
+    """
+    Decompresses the backup at `path` and compares the checksum of its
+    contents with `checksum` if given.  Returns a dict describing the result,
+    whose `status` is one of `OK`, `CORRUPT`, `TRUNCATED`,
+    `CHECKSUM_MISMATCH` or `MISSING`.  Volumes which don't match the hash
+    in their manifest are reported as `CHECKSUM_MISMATCH`.
+    """
+    result = {'path': path, 'audited': time.time()}
+    volumed = is_volumed(path)
+    try:
+        stat = os.stat(get_manifest_file(path) if volumed else path)
+    except OSError as e:
+        result.update(status=MISSING, error=str(e))
+        return result
+    result.update(size=stat.st_size, mtime=stat.st_mtime)
+
+    if volumed:
+        problem = check_volumes(path)
+        if problem is not None:
+            result.update(status=problem[0], error=problem[1])
+            return result
+
+    try:
+        f = VolumeReader(path, prefetch=0) if volumed else open(path, 'rb')
+        try:
+            reader = AuditReader(f, semaphore, algorithm)
+            decompress(reader, NullWriter())
+            # Hash any trailing data which the decompressor ignored
+            while reader.read(COPY_CHUNK_SIZE):
+                pass
+        finally:
+            f.close()
+    except RestoreError as e:
+        result.update(status=CHECKSUM_MISMATCH, error=str(e))
+        return result
+    except TruncatedError as e:
+        result.update(status=TRUNCATED, error=str(e))
+        return result
+    except (FrameError, zlib.error) as e:
+        result.update(status=CORRUPT, error=str(e))
+        return result
+    except (IOError, OSError) as e:
+        result.update(status=MISSING, error=str(e))
+        return result
+
+    if reader.bytes == 0:
+        result.update(status=TRUNCATED, error='Empty file')
+        return result
+
+    result['checksum'] = reader.hash.hexdigest()
+    if checksum and checksum != result['checksum']:
+        result.update(status=CHECKSUM_MISMATCH, expected_checksum=checksum)
+    else:
+        result['status'] = OK
+    return result
+
+
+def init_worker(semaphore):
+    global io_semaphore
+    io_semaphore = semaphore
+
+
+def audit_task(task):
+    path, checksum, algorithm = task
+    return audit_file(path, checksum, algorithm, semaphore=io_semaphore)
+
+
+def load_catalog(path):
+    """
+    Returns a dict mapping backup paths to the checksums recorded for them in
+    the JSON lines file at `path`, such as the results file written by
+    `backupdbd`.  Returns an empty dict if the file does not exist.
+    """
+    catalog = {}
+    if not path or not os.path.exists(path):
+        return catalog
+    with open(path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            backup_file = record.get('backup_file')
+            if record.get('status') == OK and backup_file and record.get('checksum'):
+                catalog[os.path.normpath(backup_file)] = record['checksum']
+    return catalog
+
+
+def load_report(path):
+    """
+    Returns a dict mapping paths to the last result recorded for them in the
+    audit report at `path`.  Returns an empty dict if the file does not exist.
+    """
+    report = {}
+    if not os.path.exists(path):
+        return report
+    with open(path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # The last line of an interrupted audit may be incomplete
+                continue
+            report[record['path']] = record
+    return report
+
+
+def find_backup_files(dir, extensions, ignore=()):
+    """
+    Returns a tuple `(backups, orphans)` of sorted lists of the paths in
+    `dir`.  `backups` holds the files ending in `.<ext>.gz` for any of
+    `extensions`, and the paths of the backups written as volumes next to a
+    manifest.  `orphans` holds decompression indexes, lists of hot relations
+    and volumes whose backup or manifest no longer exists and any other file
+    which is not a backup, except for the paths in `ignore`.
+    """
+    suffixes = tuple('.{0}.gz'.format(ext) for ext in extensions)
+    ignore = set(os.path.normpath(p) for p in ignore)
+
+    backups, orphans = [], []
+    if not os.path.isdir(dir):
+        return backups, orphans
+
+    names = set(os.listdir(dir))
+
+    def is_backup(name):
+        return name in names or name + MANIFEST_SUFFIX in names
+
+    for name in sorted(names):
+        path = os.path.normpath(os.path.join(dir, name))
+        if path in ignore or name.startswith('.') or not os.path.isfile(path):
+            continue
+        volume = VOLUME_RE.match(name)
+        if name.endswith(suffixes):
+            backups.append(path)
+        elif name.endswith(MANIFEST_SUFFIX) and name[:-len(MANIFEST_SUFFIX)].endswith(suffixes):
+            backups.append(path[:-len(MANIFEST_SUFFIX)])
+        elif volume and volume.group(1).endswith(suffixes) and volume.group(1) + MANIFEST_SUFFIX in names:
+            continue
+        elif any(name.endswith(s) and is_backup(name[:-len(s)]) for s in SIDECAR_SUFFIXES):
+            continue
+        else:
+            orphans.append(path)
+    return sorted(backups), orphans
+
+
+def is_unchanged(record, path):
+    """
+    Returns True if the file at `path` still has the size and modification
+    time stored in the audit result `record`.
+    """
+    try:
+        stat = os.stat(get_stat_path(path))
+    except OSError:
+        return record.get('status') == MISSING
+    return record.get('size') == stat.st_size and record.get('mtime') == stat.st_mtime
+
+
+def audit_files(paths, catalog=None, processes=1, io_limit=1, algorithm='sha256'):
+    """
+    Audits the backups at `paths` on up to `processes` processes with at most
+    `io_limit` of them reading at the same time.  Checksums are taken from
+    the dict `catalog`.  Yields results as they complete.
+    """
+    catalog = catalog or {}
+    tasks = [(path, catalog.get(path), algorithm) for path in paths]
+
+    if processes <= 1:
+        for task in tasks:
+            yield audit_task(task)
+        return
+
+    semaphore = multiprocessing.Semaphore(max(1, io_limit))
+    pool = multiprocessing.Pool(processes, initializer=init_worker, initargs=(semaphore,))
+    try:
+        for result in pool.imap_unordered(audit_task, tasks):
+            yield result
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
@@ -0,0 +1,427 @@
+"""
+Cache of restored backups for restoring the same backup over and over.
+
+The first cached restore of a backup keeps a pristine copy of the restored
+database, and later restores of the same backup clone that copy instead of
+decompressing and replaying the backup again:
+
+* postgres backups are restored into a template database on the server,
+  `backupdb_cache_<key>`, which later restores clone with `CREATE DATABASE
+  ... TEMPLATE` after dropping the database being restored,
+* sqlite backups are decompressed into a file of the cache directory, which
+  is copied over the database, as a reflink where the file system can.
+
+Backups are identified by their path, size and modification time, so a
+backup replaced by another one under the same name is not mistaken for it.
+The cache directory holds an index of the copies; once their total size goes
+over the limit, the least recently used copies are removed.
+"""
+from contextlib import contextmanager
+from subprocess import CalledProcessError
+import errno
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+from .commands import (
+    check_sqlite_file,
+    require_backup_exists,
+    get_db_host,
+    quote_pg_identifier,
+    quote_pg_literal,
+    run_postgresql_sql,
+    swap_sqlite_file,
+)
+
+logger = logging.getLogger(__name__)
+
+INDEX_FILE = 'index.json'
+INDEX_LOCK_FILE = 'index.lock'
+
+PG_TEMPLATE_PREFIX = 'backupdb_cache_'
+PG_DROP_RETRIES = 5
+
+# Settings whose values are lists of quoted names, stored ready to be reused
+PG_LIST_SETTINGS = ('search_path', 'temp_tablespaces', 'session_preload_libraries', 'local_preload_libraries')
+
+# Statements giving a new database the owner, connection limit, privileges
+# and settings of the database `{0}`
+PG_DATABASE_SETTINGS_SQL = (
+    "SELECT string_agg(statement, E';\\n' ORDER BY position) FROM ("
+    "SELECT 1 AS position, format('ALTER DATABASE %I OWNER TO %I', d.datname, pg_get_userbyid(d.datdba)) "
+    "AS statement FROM pg_database d WHERE d.datname = {0} "
+    "UNION ALL "
+    "SELECT 2, format('ALTER DATABASE %I CONNECTION LIMIT %s', d.datname, d.datconnlimit) "
+    "FROM pg_database d WHERE d.datname = {0} AND d.datconnlimit <> -1 "
+    "UNION ALL "
+    "SELECT 3, format('REVOKE ALL ON DATABASE %I FROM PUBLIC', d.datname) "
+    "FROM pg_database d WHERE d.datname = {0} AND d.datacl IS NOT NULL "
+    "UNION ALL "
+    "SELECT 4, format('GRANT %s ON DATABASE %I TO %s%s', a.privilege_type, d.datname, "
+    "CASE WHEN a.grantee = 0 THEN 'PUBLIC' ELSE quote_ident(pg_get_userbyid(a.grantee)) END, "
+    "CASE WHEN a.is_grantable THEN ' WITH GRANT OPTION' ELSE '' END) "
+    "FROM pg_database d, aclexplode(d.datacl) a WHERE d.datname = {0} "
+    "UNION ALL "
+    "SELECT 5, CASE WHEN s.setrole = 0 THEN format('ALTER DATABASE %I', d.datname) "
+    "ELSE format('ALTER ROLE %I IN DATABASE %I', pg_get_userbyid(s.setrole), d.datname) END || "
+    "format(CASE WHEN split_part(c, '=', 1) IN ({1}) THEN ' SET %I TO %s' ELSE ' SET %I TO %L' END, "
+    "split_part(c, '=', 1), substr(c, strpos(c, '=') + 1)) "
+    "FROM pg_db_role_setting s JOIN pg_database d ON d.oid = s.setdatabase, unnest(s.setconfig) c "
+    "WHERE d.datname = {0}"
+    ") statements"
+)
+
+# ioctl request cloning a whole file on Linux (btrfs, xfs)
+FICLONE = 0x40049409
+
+
+def get_backup_key(backup_file):
+    """
+    Returns a key identifying the backup file at `backup_file`, or the backup
+    read by the file-like object `backup_file` from the file of its `name`.
+    """
+    backup_file = getattr(backup_file, 'name', backup_file)
+    stat = os.stat(backup_file)
+    identity = '{0}:{1}:{2}'.format(os.path.abspath(backup_file), stat.st_size, stat.st_mtime)
+    return hashlib.sha1(identity.encode('utf-8')).hexdigest()[:16]
+
+
+@contextmanager
+def locked(path, blocking=True):
+    """
+    Holds an exclusive lock on the file at `path`.  Yields False instead of
+    waiting if `blocking` is False and the lock is held elsewhere.
+    """
+    with open(path, 'a') as f:
+        try:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except (IOError, OSError) as e:
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+def clone_file(src, dst):
+    """
+    Copies `src` into `dst`, sharing their blocks if the file system
+    supports it.
+    """
+    with open(src, 'rb') as f, open(dst, 'wb') as out:
+        try:
+            fcntl.ioctl(out.fileno(), FICLONE, f.fileno())
+        except (IOError, OSError):
+            shutil.copyfileobj(f, out, 1024 * 1024)
+        out.flush()
+        os.fsync(out.fileno())
+
+
+class CacheEngine(object):
+    """
+    Keeps restored copies of backups for one database engine.  Entries are
+    dicts stored in the index of the cache.
+    """
+    def __init__(self, cache):
+        self.cache = cache
+
+    def get_entry_id(self, key, db_config):
+        raise NotImplementedError
+
+    def new_entry(self, key, db_config):
+        raise NotImplementedError
+
+    def exists(self, entry, db_config):
+        raise NotImplementedError
+
+    def get_build_config(self, entry, db_config):
+        """
+        Returns the configuration of the database into which the backup is
+        restored to fill `entry`.
+        """
+        raise NotImplementedError
+
+    def prepare(self, entry, db_config):
+        pass
+
+    def finish(self, entry, db_config):
+        """
+        Seals the copy of `entry` once it has been restored and returns its
+        size in bytes.
+        """
+        raise NotImplementedError
+
+    def clone(self, entry, db_config):
+        raise NotImplementedError
+
+    def drop(self, entry, db_config):
+        raise NotImplementedError
+
+
+class SqliteCacheEngine(CacheEngine):
+    def get_entry_id(self, key, db_config):
+        return key
+
+    def new_entry(self, key, db_config):
+        return {'file': '{0}.sqlite'.format(key)}
+
+    def get_path(self, entry):
+        return os.path.join(self.cache.dir, entry['file'])
+
+    def exists(self, entry, db_config):
+        return os.path.exists(self.get_path(entry))
+
+    def get_build_config(self, entry, db_config):
+        return dict(db_config, NAME=self.get_path(entry))
+
+    def finish(self, entry, db_config):
+        return os.path.getsize(self.get_path(entry))
+
+    def clone(self, entry, db_config):
+        db_file = db_config['NAME']
+        db_dir = os.path.dirname(os.path.abspath(db_file))
+        fd, temp_file = tempfile.mkstemp(
+            dir=db_dir,
+            prefix='.{0}.'.format(os.path.basename(db_file)),
+            suffix='.restore',
+        )
+        os.close(fd)
+        try:
+            clone_file(self.get_path(entry), temp_file)
+            check_sqlite_file(temp_file)
+            swap_sqlite_file(temp_file, db_file)
+        except Exception:
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
+            raise
+
+    def drop(self, entry, db_config):
+        if os.path.exists(self.get_path(entry)):
+            os.remove(self.get_path(entry))
+
+
+class PostgresqlCacheEngine(CacheEngine):
+    def get_entry_id(self, key, db_config):
+        host, port = get_db_host(db_config)
+        return '{0}@{1}:{2}'.format(key, host, port or '')
+
+    def new_entry(self, key, db_config):
+        host, port = get_db_host(db_config)
+        return {'template': PG_TEMPLATE_PREFIX + key, 'host': host, 'port': port}
+
+    def get_maintenance_config(self, db_config):
+        return dict(db_config, NAME=self.cache.maintenance_db)
+
+    def run(self, db_config, sql, output=False):
+        return run_postgresql_sql(
+            self.get_maintenance_config(db_config), sql, show_output=self.cache.show_output, output=output)
+
+    def exists(self, entry, db_config):
+        return self.run(db_config, 'SELECT 1 FROM pg_database WHERE datname = {0}'.format(
+            quote_pg_literal(entry['template'])), output=True).strip() == '1'
+
+    def get_build_config(self, entry, db_config):
+        return dict(db_config, NAME=entry['template'])
+
+    def prepare(self, entry, db_config):
+        self.drop(entry, db_config)
+        self.run(db_config, 'CREATE DATABASE {0} TEMPLATE template0'.format(quote_pg_identifier(entry['template'])))
+
+    def finish(self, entry, db_config):
+        template = quote_pg_identifier(entry['template'])
+        run_postgresql_sql(
+            self.get_build_config(entry, db_config), 'ANALYZE', show_output=self.cache.show_output)
+        # Nobody may connect to a database while it is being cloned
+        self.run(db_config, 'ALTER DATABASE {0} WITH IS_TEMPLATE true ALLOW_CONNECTIONS false'.format(template))
+        return int(self.run(db_config, 'SELECT pg_database_size({0})'.format(
+            quote_pg_literal(entry['template'])), output=True).strip())
+
+    def clone(self, entry, db_config):
+        name = db_config['NAME']
+        create_sql = 'CREATE DATABASE {0} TEMPLATE {1}'.format(
+            quote_pg_identifier(name), quote_pg_identifier(entry['template']))
+
+        # The new database gets the owner and settings of the one it replaces
+        settings_sql = self.run(db_config, PG_DATABASE_SETTINGS_SQL.format(
+            quote_pg_literal(name), ', '.join(quote_pg_literal(setting) for setting in PG_LIST_SETTINGS),
+        ), output=True).strip()
+        if not settings_sql and db_config.get('USER'):
+            create_sql += ' OWNER {0}'.format(quote_pg_identifier(db_config['USER']))
+
+        # Terminated backends may take a moment to exit
+        for attempt in range(PG_DROP_RETRIES):
+            try:
+                self.run(db_config, (
+                    'SELECT pg_terminate_backend(pid) FROM pg_stat_activity '
+                    'WHERE datname = {0} AND pid <> pg_backend_pid()'
+                ).format(quote_pg_literal(name)), output=True)
+                self.run(db_config, 'DROP DATABASE IF EXISTS {0}'.format(quote_pg_identifier(name)))
+                break
+            except CalledProcessError:
+                if attempt == PG_DROP_RETRIES - 1:
+                    raise
+                time.sleep(1)
+        self.run(db_config, create_sql)
+        if settings_sql:
+            self.run(db_config, settings_sql)
+
+    def drop(self, entry, db_config):
+        template = quote_pg_identifier(entry['template'])
+        try:
+            self.run(db_config, 'ALTER DATABASE {0} WITH IS_TEMPLATE false'.format(template))
+        except CalledProcessError:
+            # The template does not exist
+            pass
+        self.run(db_config, 'DROP DATABASE IF EXISTS {0}'.format(template))
+
+
+CACHE_ENGINES = {
+    'django.db.backends.postgresql': PostgresqlCacheEngine,
+    'django.db.backends.postgresql_psycopg2': PostgresqlCacheEngine,
+    'django.contrib.gis.db.backends.postgis': PostgresqlCacheEngine,
+    'django.db.backends.sqlite3': SqliteCacheEngine,
+}
+
+
+class RestoreCache(object):
+    """
+    Cache of restored backups in the directory `dir`, holding at most
+    `max_size` bytes.  Postgres templates are dropped through connections
+    like those of `db_configs` to their server, to `maintenance_db`.
+    """
+    def __init__(self, dir, max_size, db_configs=(), maintenance_db='postgres', show_output=False):
+        self.dir = dir
+        self.max_size = max_size
+        self.db_configs = list(db_configs)
+        self.maintenance_db = maintenance_db
+        self.show_output = show_output
+        if not os.path.isdir(dir):
+            os.makedirs(dir)
+
+    def get_engine(self, engine):
+        engine_class = CACHE_ENGINES.get(engine)
+        return engine_class(self) if engine_class else None
+
+    def read_index(self):
+        try:
+            with open(os.path.join(self.dir, INDEX_FILE)) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def write_index(self, index):
+        path = os.path.join(self.dir, INDEX_FILE)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(index, f, indent=2, sort_keys=True)
+        os.rename(path + '.tmp', path)
+
+    @contextmanager
+    def index(self):
+        """
+        Yields the index of the cache, which is saved on exit, while holding
+        the lock of the index.
+        """
+        with locked(os.path.join(self.dir, INDEX_LOCK_FILE)):
+            index = self.read_index()
+            yield index
+            self.write_index(index)
+
+    def get_entry_lock(self, entry_id):
+        return os.path.join(self.dir, '{0}.lock'.format(hashlib.sha1(entry_id.encode('utf-8')).hexdigest()[:16]))
+
+    def can_restore(self, db_config):
+        return db_config['ENGINE'] in CACHE_ENGINES
+
+    @require_backup_exists
+    def restore(self, backup_file, db_config, restore_func, restore_kwargs):
+        """
+        Restores `backup_file` into the database of `db_config` from its
+        cached copy, first making the copy with `restore_func` and
+        `restore_kwargs` if there is none.  Returns True if the copy was
+        already cached.
+        """
+        engine = self.get_engine(db_config['ENGINE'])
+        key = get_backup_key(backup_file)
+        entry_id = engine.get_entry_id(key, db_config)
+
+        with locked(self.get_entry_lock(entry_id)):
+            with self.index() as index:
+                entry = index.get(entry_id)
+            hit = entry is not None and engine.exists(entry, db_config)
+
+            if not hit:
+                entry = dict(
+                    engine.new_entry(key, db_config),
+                    engine=db_config['ENGINE'],
+                    backup=getattr(backup_file, 'name', backup_file),
+                )
+                engine.prepare(entry, db_config)
+                try:
+                    restore_func(**dict(
+                        restore_kwargs, db_config=engine.get_build_config(entry, db_config), drop_tables=False))
+                    entry['size'] = engine.finish(entry, db_config)
+                except Exception:
+                    engine.drop(entry, db_config)
+                    raise
+
+            engine.clone(entry, db_config)
+
+            with self.index() as index:
+                entry['used'] = time.time()
+                index[entry_id] = entry
+
+        self.evict(keep=entry_id)
+        return hit
+
+    def get_config(self, entry):
+        """
+        Returns a database configuration for reaching the copy of `entry`, or
+        None if no database is on its server.
+        """
+        if entry['engine'] == 'django.db.backends.sqlite3':
+            return {'ENGINE': entry['engine']}
+        for db_config in self.db_configs:
+            if db_config['ENGINE'] in CACHE_ENGINES and get_db_host(db_config) == (entry['host'], entry['port']):
+                return db_config
+        return None
+
+    def evict(self, keep=None):
+        """
+        Removes the least recently used copies, except for `keep`, until the
+        total size of the cache is within its limit.  Returns the ids of the
+        removed entries.
+        """
+        evicted = []
+        with self.index() as index:
+            total = sum(e.get('size') or 0 for e in index.values())
+            for entry_id, entry in sorted(index.items(), key=lambda item: item[1].get('used', 0)):
+                if total <= self.max_size:
+                    break
+                if entry_id == keep:
+                    continue
+                db_config = self.get_config(entry)
+                if db_config is None:
+                    logger.debug("Can't reach the server of '{0}' to remove it".format(entry_id))
+                    continue
+                with locked(self.get_entry_lock(entry_id), blocking=False) as acquired:
+                    # Skip copies being cloned right now
+                    if not acquired:
+                        continue
+                    try:
+                        self.get_engine(entry['engine']).drop(entry, db_config)
+                    except CalledProcessError as e:
+                        logger.warning("Could not remove '{0}' from the restore cache: {1}".format(entry_id, e))
+                        continue
+                    os.remove(self.get_entry_lock(entry_id))
+                del index[entry_id]
+                total -= entry.get('size') or 0
+                evicted.append(entry_id)
+        return evicted
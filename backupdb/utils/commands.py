@@ -1,13 +1,25 @@
+from subprocess import CalledProcessError
 import logging
 import os
 import shlex
+import shutil
+import sqlite3
+import stat
+import sys
+import tempfile
+import time
 
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
 
+from . import frames, sqlfilters
 from .exceptions import RestoreError
-from .processes import pipe_commands, pipe_commands_to_file
+from .processes import get_command_output, is_stream, pipe_commands, pipe_commands_to_file
 
 
+logger = logging.getLogger(__name__)
+
+PG_MAX_IDENTIFIER_LENGTH = 63
+
 PG_DROP_SQL = """SELECT 'DROP TABLE IF EXISTS "' || tablename || '" CASCADE;' FROM pg_tables WHERE schemaname = 'public';"""
 
 
@@ -29,6 +41,18 @@ class BaseBackupDbCommand(BaseCommand):
     def handle(self, *args, **options):
         self._setup_logging(options['verbosity'])
 
+    def get_databases(self, names=None):
+        """
+        Returns a list of `(db_name, db_config)` tuples for the databases
+        called `names` or for all databases in `settings.DATABASES`.
+        """
+        from django.conf import settings
+
+        for name in names or ():
+            if name not in settings.DATABASES:
+                raise CommandError("Database '{0}' is not in settings.DATABASES".format(name))
+        return [(n, c) for n, c in settings.DATABASES.items() if not names or n in names]
+
 
 def apply_arg_values(arg_values):
     """
@@ -46,16 +70,103 @@ def apply_arg_values(arg_values):
 def require_backup_exists(func):
     """
     Requires that the file referred to by `backup_file` exists in the file
-    system before running the decorated function.
+    system before running the decorated function.  File-like objects are
+    passed through unchecked.
     """
     def new_func(*args, **kwargs):
         backup_file = kwargs['backup_file']
-        if not os.path.exists(backup_file):
+        if not is_stream(backup_file) and not os.path.exists(backup_file):
             raise RestoreError("Could not find file '{0}'".format(backup_file))
         return func(*args, **kwargs)
     return new_func
 
 
+def get_backup_source_cmds(backup_file, kwargs):
+    """
+    Returns the list of commands which write the compressed contents of
+    `backup_file` to stdout.  If `backup_file` is a file-like object, no
+    command is needed and it is added to `kwargs` as the `stdin` of the
+    pipeline instead.
+    """
+    if is_stream(backup_file):
+        kwargs['stdin'] = backup_file
+        return []
+    return [['cat', backup_file]]
+
+
+def get_script_cmd(module, *args):
+    """
+    Returns a command running the standalone `module` as a script with the
+    given arguments.
+    """
+    script = os.path.splitext(os.path.abspath(module.__file__))[0] + '.py'
+    return [sys.executable, script] + list(args)
+
+
+def get_frames_cmd(*args):
+    """
+    Returns a command running the `frames` module as a script with the given
+    arguments.
+    """
+    return get_script_cmd(frames, *args)
+
+
+def get_compress_cmd(threads=1, level=None):
+    """
+    Returns the command used to compress backups.  With more than one thread
+    or an adaptive `level` of `'auto'`, backups are compressed into
+    independent frames which can later be decompressed in parallel.  `level`
+    defaults to the default level of the compressor.
+    """
+    if threads <= 1 and level != frames.AUTO_LEVEL:
+        return ['gzip'] if level is None else ['gzip', '-{0}'.format(level)]
+    args = ['--threads={0}'.format(threads)]
+    if level is not None:
+        args.append('--level={0}'.format(level))
+    return get_frames_cmd(*args)
+
+
+def get_gzip_index_file(backup_file):
+    """
+    Returns the path of the cached decompression index of `backup_file`.
+    """
+    return backup_file + '.gzindex'
+
+
+def get_decompress_cmds(backup_file, kwargs, threads=1):
+    """
+    Returns the list of commands which write the decompressed contents of
+    `backup_file` to stdout, using `threads` threads if possible.
+
+    Framed backups are decompressed frame by frame in parallel.  Backups which
+    are a single gzip stream are decompressed with `rapidgzip` if it is
+    installed, which keeps an index of access points next to the backup after
+    the first read so that later reads can be split more efficiently.
+    Otherwise they are decompressed by `gunzip`.
+    """
+    if threads <= 1:
+        return get_backup_source_cmds(backup_file, kwargs) + [['gunzip']]
+
+    threads_arg = '--threads={0}'.format(threads)
+    if is_stream(backup_file):
+        kwargs['stdin'] = backup_file
+        return [get_frames_cmd('-d', threads_arg)]
+
+    if frames.is_framed(backup_file):
+        return [get_frames_cmd('-d', threads_arg, backup_file)]
+
+    if shutil.which('rapidgzip'):
+        cmd = ['rapidgzip', '-d', '-c', '-P', str(threads)]
+        index_file = get_gzip_index_file(backup_file)
+        if os.path.exists(index_file):
+            cmd += ['--import-index', index_file]
+        elif os.access(os.path.dirname(os.path.abspath(backup_file)), os.W_OK):
+            cmd += ['--export-index', index_file]
+        return [cmd + [backup_file]]
+
+    return get_backup_source_cmds(backup_file, kwargs) + [['gunzip']]
+
+
 def get_mysql_args(db_config):
     """
     Returns an array of argument values that will be passed to a `mysql` or
@@ -94,6 +205,22 @@ def get_postgresql_args(db_config, extra_args=None):
     return args
 
 
+def get_db_host(db_config):
+    """
+    Returns a `(host, port)` tuple identifying the server of the given
+    database configuration from the same `HOST` and `PORT` values which are
+    passed to `mysql` or `psql`.  Servers reached through the default local
+    socket are considered to be on `localhost`.  SQLite databases have no
+    server and are identified by the absolute path of their file, so that
+    limits on the jobs per server don't serialize them.
+    """
+    if db_config.get('ENGINE') == 'django.db.backends.sqlite3':
+        return os.path.abspath(db_config['NAME']), None
+    host = db_config.get('HOST') or 'localhost'
+    port = db_config.get('PORT')
+    return host, str(port) if port else None
+
+
 def get_postgresql_env(db_config):
     """
     Returns a dict containing extra environment variable values that will be
@@ -104,44 +231,318 @@ def get_postgresql_env(db_config):
     return {'PGPASSWORD': password} if password else None
 
 
-def do_mysql_backup(backup_file, db_config, show_output=False):
+def do_mysql_backup(backup_file, db_config, show_output=False, compress_threads=1, compress_level=None):
     args = get_mysql_args(db_config)
 
     cmd = ['mysqldump'] + args
-    pipe_commands_to_file([cmd, ['gzip']], path=backup_file, show_stderr=show_output)
+    compress_cmd = get_compress_cmd(compress_threads, compress_level)
+    return pipe_commands_to_file([cmd, compress_cmd], path=backup_file, show_stderr=show_output)
 
 
-def do_postgresql_backup(backup_file, db_config, pg_dump_options=None, show_output=False):
+def do_postgresql_backup(backup_file, db_config, pg_dump_options=None, show_output=False, compress_threads=1,
+                         compress_level=None, snapshot=None):
+    """
+    Backs up a PostgreSQL database.  If `snapshot` is given, the database is
+    dumped from this exported snapshot, which must be held by the caller until
+    the backup is done.
+    """
     env = get_postgresql_env(db_config)
     args = get_postgresql_args(db_config, pg_dump_options)
 
     cmd = ['pg_dump', '--clean'] + args
-    pipe_commands_to_file([cmd, ['gzip']], path=backup_file, extra_env=env, show_stderr=show_output)
+    if snapshot is not None:
+        cmd.insert(1, '--snapshot={0}'.format(snapshot))
+    compress_cmd = get_compress_cmd(compress_threads, compress_level)
+    return pipe_commands_to_file([cmd, compress_cmd], path=backup_file, extra_env=env, show_stderr=show_output)
 
 
-def do_sqlite_backup(backup_file, db_config, show_output=False):
+def do_sqlite_backup(backup_file, db_config, show_output=False, compress_threads=1, compress_level=None):
     db_file = db_config['NAME']
 
     cmd = ['cat', db_file]
-    pipe_commands_to_file([cmd, ['gzip']], path=backup_file, show_stderr=show_output)
+    compress_cmd = get_compress_cmd(compress_threads, compress_level)
+    return pipe_commands_to_file([cmd, compress_cmd], path=backup_file, show_stderr=show_output)
+
+
+def can_disable_mysql_binlog(db_config):
+    """
+    Returns True if the user in `db_config` is allowed to disable binary
+    logging for its session.
+    """
+    cmd = ['mysql'] + get_mysql_args(db_config) + ['-e', 'SET SESSION sql_log_bin=0']
+    try:
+        get_command_output(cmd)
+    except CalledProcessError:
+        return False
+    return True
+
+
+def drop_mysql_tables(db_config, show_output=False):
+    args = get_mysql_args(db_config)
+    dump_cmd = ['mysqldump'] + args + ['--no-data']
+    pipe_commands(
+        [dump_cmd, ['grep', '^DROP'], ['mysql'] + args], show_stderr=show_output, show_last_stdout=show_output)
 
 
 @require_backup_exists
-def do_mysql_restore(backup_file, db_config, drop_tables=False, show_output=False):
+def do_mysql_restore(backup_file, db_config, drop_tables=False, show_output=False, decompress_threads=1,
+                     bulk_load=False, load_data=False):
+    """
+    Restores a MySQL database.  With `bulk_load`, the dump is wrapped in a
+    session which disables foreign key and unique checks and binary logging
+    (when permitted) and commits inserts in batches.  With `load_data` as
+    well, extended inserts are loaded with `LOAD DATA LOCAL INFILE`, which
+    the server must allow.
+    """
     args = get_mysql_args(db_config)
     mysql_cmd = ['mysql'] + args
 
     kwargs = {'show_stderr': show_output, 'show_last_stdout': show_output}
 
     if drop_tables:
-        dump_cmd = ['mysqldump'] + args + ['--no-data']
-        pipe_commands([dump_cmd, ['grep', '^DROP'], mysql_cmd], **kwargs)
+        drop_mysql_tables(db_config, show_output)
+
+    decompress_cmds = get_decompress_cmds(backup_file, kwargs, decompress_threads)
+    if not bulk_load:
+        return pipe_commands(decompress_cmds + [mysql_cmd], **kwargs)
+
+    filter_cmd = get_script_cmd(sqlfilters, 'mysql', '--bulk-load')
+    if can_disable_mysql_binlog(db_config):
+        filter_cmd.append('--disable-binlog')
+
+    if not load_data:
+        return pipe_commands(decompress_cmds + [filter_cmd, mysql_cmd], **kwargs)
+
+    load_data_dir = tempfile.mkdtemp(prefix='backupdb-')
+    try:
+        filter_cmd.append('--load-data-dir={0}'.format(load_data_dir))
+        mysql_cmd = ['mysql', '--local-infile=1'] + args
+        return pipe_commands(decompress_cmds + [filter_cmd, mysql_cmd], **kwargs)
+    finally:
+        shutil.rmtree(load_data_dir, ignore_errors=True)
 
-    pipe_commands([['cat', backup_file], ['gunzip'], mysql_cmd], **kwargs)
+
+def quote_pg_identifier(name):
+    return '"{0}"'.format(name.replace('"', '""'))
+
+
+def truncate_pg_identifier(name, suffix):
+    """
+    Returns `name` followed by `suffix`, cutting `name` short so that the
+    result fits in the bytes PostgreSQL keeps of an identifier.
+    """
+    room = PG_MAX_IDENTIFIER_LENGTH - len(suffix.encode('utf-8'))
+    while len(name.encode('utf-8')) > room:
+        name = name[:-1]
+    return name + suffix
+
+
+def quote_pg_literal(value):
+    return "'{0}'".format(value.replace("'", "''"))
+
+
+def run_postgresql_sql(db_config, sql, show_output=False, output=False):
+    """
+    Runs `sql` with `psql` in the database described by `db_config`, stopping
+    at the first error.  Returns the unaligned output of the last statement if
+    `output` is True.
+    """
+    env = get_postgresql_env(db_config)
+    args = get_postgresql_args(db_config)
+    cmd = ['psql', '-v', 'ON_ERROR_STOP=1'] + args + ['-c', sql]
+
+    if output:
+        return get_command_output(cmd[:1] + ['-A', '-t'] + cmd[1:], extra_env=env, show_stderr=show_output)
+    return pipe_commands([cmd], extra_env=env, show_stderr=show_output, show_last_stdout=show_output)
+
+
+def do_postgresql_bulk_load(backup_file, db_config, show_output=False, decompress_threads=1, strip_clean=False,
+                            unlogged=False, maintenance_work_mem=None):
+    """
+    Loads a PostgreSQL backup in a single transaction with `synchronous_commit`
+    turned off and, if given, a larger `maintenance_work_mem` for building
+    indexes.  Foreign keys are added as `NOT VALID` and validated in a second
+    transaction once the data is loaded.  With `unlogged`, tables are created
+    as `UNLOGGED` and made logged in that second transaction.
+    """
+    env = dict(get_postgresql_env(db_config) or {})
+    pg_options = ['-c synchronous_commit=off']
+    if maintenance_work_mem:
+        pg_options.append('-c maintenance_work_mem={0}'.format(maintenance_work_mem))
+    env['PGOPTIONS'] = ' '.join(pg_options)
+    psql_cmd = ['psql', '-v', 'ON_ERROR_STOP=1', '--single-transaction'] + get_postgresql_args(db_config)
+
+    fd, deferred_file = tempfile.mkstemp(prefix='backupdb-', suffix='.sql')
+    os.close(fd)
+    try:
+        filter_args = ['--deferred-file={0}'.format(deferred_file)]
+        if strip_clean:
+            filter_args.insert(0, '--strip-clean')
+        if unlogged:
+            filter_args.append('--unlogged')
+        filter_cmd = get_script_cmd(sqlfilters, 'postgresql', *filter_args)
+
+        kwargs = {'extra_env': env, 'show_stderr': show_output, 'show_last_stdout': show_output}
+        decompress_cmds = get_decompress_cmds(backup_file, kwargs, decompress_threads)
+        timings = pipe_commands(decompress_cmds + [filter_cmd, psql_cmd], **kwargs)
+
+        kwargs.pop('stdin', None)
+        timings += pipe_commands([psql_cmd + ['--file={0}'.format(deferred_file)]], **kwargs)
+    finally:
+        os.remove(deferred_file)
+
+    return timings
+
+
+PG_SWAP_RETRIES = 5
+
+
+def do_postgresql_staging_restore(backup_file, db_config, show_output=False, decompress_threads=1,
+                                  keep_old=False, maintenance_db='postgres', bulk_load=False, unlogged=False,
+                                  maintenance_work_mem=None):
+    """
+    Restores a PostgreSQL database into a new staging database and then swaps
+    it with the live database by renaming both, so that the live database is
+    only unavailable for the duration of the rename.  The old database is
+    renamed to `<name>_old_<timestamp>` and dropped unless `keep_old` is True,
+    with `<name>` shortened if needed to keep within PostgreSQL's limit on
+    the length of names.  With `bulk_load`, the staging database is loaded with
+    `do_postgresql_bulk_load`.
+    """
+    name = db_config['NAME']
+    suffix = time.strftime('%Y%m%d%H%M%S')
+    staging_name = truncate_pg_identifier(name, '_restore_{0}'.format(suffix))
+    old_name = truncate_pg_identifier(name, '_old_{0}'.format(suffix))
+
+    maintenance_config = dict(db_config, NAME=maintenance_db)
+    staging_config = dict(db_config, NAME=staging_name)
+
+    # Create the staging database like the live one
+    info = run_postgresql_sql(
+        maintenance_config,
+        'SELECT pg_get_userbyid(datdba), pg_encoding_to_char(encoding), datcollate, datctype '
+        'FROM pg_database WHERE datname = {0}'.format(quote_pg_literal(name)),
+        show_output=show_output,
+        output=True,
+    ).strip()
+    create_sql = 'CREATE DATABASE {0} TEMPLATE template0'.format(quote_pg_identifier(staging_name))
+    if info:
+        owner, encoding, collate, ctype = info.split('|')
+        create_sql += ' OWNER {0} ENCODING {1} LC_COLLATE {2} LC_CTYPE {3}'.format(
+            quote_pg_identifier(owner),
+            quote_pg_literal(encoding),
+            quote_pg_literal(collate),
+            quote_pg_literal(ctype),
+        )
+    run_postgresql_sql(maintenance_config, create_sql, show_output=show_output)
+
+    # Load the staging database.  Nobody else uses it, so commits don't need
+    # to wait for the WAL to be flushed.
+    try:
+        if bulk_load:
+            timings = do_postgresql_bulk_load(
+                backup_file,
+                staging_config,
+                show_output=show_output,
+                decompress_threads=decompress_threads,
+                strip_clean=True,
+                unlogged=unlogged,
+                maintenance_work_mem=maintenance_work_mem,
+            )
+        else:
+            env = dict(get_postgresql_env(staging_config) or {})
+            env['PGOPTIONS'] = '-c synchronous_commit=off'
+            psql_cmd = ['psql', '-v', 'ON_ERROR_STOP=1'] + get_postgresql_args(staging_config)
+            filter_cmd = get_script_cmd(sqlfilters, 'postgresql', '--strip-clean')
+
+            kwargs = {'extra_env': env, 'show_stderr': show_output, 'show_last_stdout': show_output}
+            decompress_cmds = get_decompress_cmds(backup_file, kwargs, decompress_threads)
+            timings = pipe_commands(decompress_cmds + [filter_cmd, psql_cmd], **kwargs)
+
+        run_postgresql_sql(staging_config, 'ANALYZE', show_output=show_output)
+    except Exception:
+        run_postgresql_sql(
+            maintenance_config,
+            'DROP DATABASE IF EXISTS {0}'.format(quote_pg_identifier(staging_name)),
+            show_output=show_output,
+        )
+        raise
+
+    # Swap the databases.  New connections to the live database are refused
+    # first, then remaining connections are terminated and both databases are
+    # renamed in one transaction.  Terminated backends may take a moment to
+    # exit, so the swap is retried a few times.
+    run_postgresql_sql(
+        maintenance_config,
+        'ALTER DATABASE {0} ALLOW_CONNECTIONS false'.format(quote_pg_identifier(name)),
+        show_output=show_output,
+    )
+    swap_sql = (
+        'SELECT pg_terminate_backend(pid) FROM pg_stat_activity '
+        'WHERE datname IN ({name_literal}, {staging_literal}) AND pid <> pg_backend_pid(); '
+        'ALTER DATABASE {name} RENAME TO {old}; '
+        'ALTER DATABASE {staging} RENAME TO {name};'
+    ).format(
+        name_literal=quote_pg_literal(name),
+        staging_literal=quote_pg_literal(staging_name),
+        name=quote_pg_identifier(name),
+        old=quote_pg_identifier(old_name),
+        staging=quote_pg_identifier(staging_name),
+    )
+    for attempt in range(PG_SWAP_RETRIES):
+        try:
+            run_postgresql_sql(maintenance_config, swap_sql, show_output=show_output)
+            break
+        except CalledProcessError:
+            if attempt == PG_SWAP_RETRIES - 1:
+                run_postgresql_sql(
+                    maintenance_config,
+                    'ALTER DATABASE {0} ALLOW_CONNECTIONS true'.format(quote_pg_identifier(name)),
+                    show_output=show_output,
+                )
+                raise RestoreError(
+                    "Could not swap '{0}' in for '{1}'; the restored database was kept as '{0}'".format(
+                        staging_name, name))
+            time.sleep(1)
+
+    if not keep_old:
+        run_postgresql_sql(
+            maintenance_config,
+            'DROP DATABASE {0}'.format(quote_pg_identifier(old_name)),
+            show_output=show_output,
+        )
+
+    return timings
+
+
+def drop_postgresql_tables(db_config, show_output=False):
+    psql_cmd = ['psql'] + get_postgresql_args(db_config)
+    gen_drop_sql_cmd = psql_cmd + ['-t', '-c', PG_DROP_SQL]
+    pipe_commands(
+        [gen_drop_sql_cmd, psql_cmd],
+        extra_env=get_postgresql_env(db_config),
+        show_stderr=show_output,
+        show_last_stdout=show_output,
+    )
 
 
 @require_backup_exists
-def do_postgresql_restore(backup_file, db_config, drop_tables=False, show_output=False):
+def do_postgresql_restore(backup_file, db_config, drop_tables=False, show_output=False, decompress_threads=1,
+                          staging=False, keep_old=False, maintenance_db='postgres', bulk_load=False,
+                          unlogged=False, maintenance_work_mem=None):
+    if staging:
+        return do_postgresql_staging_restore(
+            backup_file,
+            db_config,
+            show_output=show_output,
+            decompress_threads=decompress_threads,
+            keep_old=keep_old,
+            maintenance_db=maintenance_db,
+            bulk_load=bulk_load,
+            unlogged=unlogged,
+            maintenance_work_mem=maintenance_work_mem,
+        )
+
     env = get_postgresql_env(db_config)
     args = get_postgresql_args(db_config)
     psql_cmd = ['psql'] + args
@@ -149,15 +550,162 @@ def do_postgresql_restore(backup_file, db_config, drop_tables=False, show_output
     kwargs = {'extra_env': env, 'show_stderr': show_output, 'show_last_stdout': show_output}
 
     if drop_tables:
-        gen_drop_sql_cmd = psql_cmd + ['-t', '-c', PG_DROP_SQL]
-        pipe_commands([gen_drop_sql_cmd, psql_cmd], **kwargs)
+        drop_postgresql_tables(db_config, show_output)
+
+    if bulk_load:
+        # The DROP statements written by `pg_dump --clean` fail for objects
+        # which don't exist, which would roll back the whole bulk load, so
+        # they are run on their own first.  They come before anything else,
+        # so the filter stops reading the dump after them, breaking the pipe
+        # of the decompression.  A stream can only be read once, so its
+        # objects must not exist or be dropped with `drop_tables`.
+        timings = []
+        if not drop_tables and not is_stream(backup_file):
+            clean_cmd = get_script_cmd(sqlfilters, 'postgresql', '--only-clean', '--stop-after-clean')
+            decompress_cmds = get_decompress_cmds(backup_file, kwargs, decompress_threads)
+            timings = pipe_commands(
+                decompress_cmds + [clean_cmd, psql_cmd], early_exit=len(decompress_cmds), **kwargs)
+        return timings + do_postgresql_bulk_load(
+            backup_file,
+            db_config,
+            show_output=show_output,
+            decompress_threads=decompress_threads,
+            strip_clean=True,
+            unlogged=unlogged,
+            maintenance_work_mem=maintenance_work_mem,
+        )
+
+    decompress_cmds = get_decompress_cmds(backup_file, kwargs, decompress_threads)
+    return pipe_commands(decompress_cmds + [psql_cmd], **kwargs)
+
+
+def preallocate(f, size):
+    """
+    Reserves `size` bytes on disk for the file object `f` if the platform and
+    file system support it.
+    """
+    if not size or not hasattr(os, 'posix_fallocate'):
+        return
+    try:
+        os.posix_fallocate(f.fileno(), 0, size)
+    except OSError:
+        pass
 
-    pipe_commands([['cat', backup_file], ['gunzip'], psql_cmd], **kwargs)
+
+def fsync_dir(path):
+    """
+    Flushes the directory entries of the directory at `path` to disk.
+    """
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def get_umask():
+    """
+    Returns the file mode creation mask of the current process.
+    """
+    mask = os.umask(0)
+    os.umask(mask)
+    return mask
+
+
+def copy_file_mode(path, from_path):
+    """
+    Gives the file at `path` the owner, group and permissions of the file at
+    `from_path`, or the permissions of a newly created file if there is no
+    such file.  Temporary files made by `tempfile.mkstemp` are only readable
+    by their owner, so they need this before being renamed into place.
+    """
+    try:
+        st = os.stat(from_path)
+    except FileNotFoundError:
+        os.chmod(path, 0o666 & ~get_umask())
+        return
+
+    own = os.stat(path)
+    if (st.st_uid, st.st_gid) != (own.st_uid, own.st_gid):
+        try:
+            os.chown(path, st.st_uid, st.st_gid)
+        except OSError as e:
+            logger.warning("Could not give '{0}' the owner of '{1}': {2}".format(path, from_path, e))
+    os.chmod(path, stat.S_IMODE(st.st_mode))
+
+
+def swap_sqlite_file(temp_file, db_file):
+    """
+    Renames the checked SQLite database `temp_file` to `db_file` with the
+    owner and permissions of the database it replaces.
+    """
+    copy_file_mode(temp_file, db_file)
+
+    # Journal files of the old database must not be applied to the new one,
+    # so remove them right before the swap
+    for suffix in ('-wal', '-shm', '-journal'):
+        if os.path.exists(db_file + suffix):
+            os.remove(db_file + suffix)
+    os.replace(temp_file, db_file)
+    fsync_dir(os.path.dirname(os.path.abspath(db_file)))
+
+
+def check_sqlite_file(path):
+    """
+    Raises RestoreError if the file at `path` is not an intact SQLite database.
+    """
+    try:
+        conn = sqlite3.connect(path)
+        try:
+            result = conn.execute('PRAGMA quick_check').fetchone()[0]
+        finally:
+            conn.close()
+    except sqlite3.DatabaseError as e:
+        raise RestoreError("Restored database failed integrity check: {0}".format(e))
+    if result != 'ok':
+        raise RestoreError("Restored database failed integrity check: {0}".format(result))
 
 
 @require_backup_exists
-def do_sqlite_restore(backup_file, db_config, drop_tables=False, show_output=False):
+def do_sqlite_restore(backup_file, db_config, drop_tables=False, show_output=False, decompress_threads=1):
+    """
+    Restores an SQLite database into a temporary file next to it and, once the
+    restored file has passed an integrity check and been flushed to disk,
+    swaps it into place with a single rename.  The live database is left
+    untouched if the restore fails.
+    """
     db_file = db_config['NAME']
-
-    cmd = ['cat', backup_file]
-    pipe_commands_to_file([cmd, ['gunzip']], path=db_file, show_stderr=show_output)
+    db_dir = os.path.dirname(os.path.abspath(db_file))
+
+    fd, temp_file = tempfile.mkstemp(
+        dir=db_dir,
+        prefix='.{0}.'.format(os.path.basename(db_file)),
+        suffix='.restore',
+    )
+    try:
+        with os.fdopen(fd, 'r+b') as f:
+            if not is_stream(backup_file):
+                preallocate(f, frames.get_uncompressed_size(backup_file))
+
+            kwargs = {'show_stderr': show_output}
+            decompress_cmds = get_decompress_cmds(backup_file, kwargs, decompress_threads)
+            timings = pipe_commands_to_file(decompress_cmds, path=f, **kwargs)
+
+            f.truncate(f.tell())
+            f.flush()
+            os.fsync(f.fileno())
+
+        check_sqlite_file(temp_file)
+        swap_sqlite_file(temp_file, db_file)
+    except Exception:
+        for path in (temp_file, temp_file + '-wal', temp_file + '-shm', temp_file + '-journal'):
+            if os.path.exists(path):
+                os.remove(path)
+        raise
+
+    return timings
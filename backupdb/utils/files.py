@@ -1,13 +1,16 @@
 import glob
+import os
+import time
 
 from .exceptions import RestoreError
 from .settings import BACKUP_DIR, BACKUP_TIMESTAMP_PATTERN
+from .volumes import MANIFEST_SUFFIX
 
 
 def get_latest_timestamped_file(ext, dir=BACKUP_DIR, pattern=BACKUP_TIMESTAMP_PATTERN):
     """
     Gets the latest timestamped backup file name with the given database type
-    extension.
+    extension.  Backups split into volumes are found by their manifest.
     """
     pattern = '{dir}/{pattern}.{ext}.gz'.format(
         dir=dir,
@@ -16,6 +19,7 @@ def get_latest_timestamped_file(ext, dir=BACKUP_DIR, pattern=BACKUP_TIMESTAMP_PA
     )
 
     l = glob.glob(pattern)
+    l.extend(f[:-len(MANIFEST_SUFFIX)] for f in glob.glob(pattern + MANIFEST_SUFFIX))
     l.sort()
     l.reverse()
 
@@ -23,3 +27,33 @@ def get_latest_timestamped_file(ext, dir=BACKUP_DIR, pattern=BACKUP_TIMESTAMP_PA
         raise RestoreError("No backups found matching '{0}' pattern".format(pattern))
 
     return l[0]
+
+
+def get_backup_file(db_name, backup_name, ext, dir=BACKUP_DIR):
+    """
+    Gets the path of the backup file for the given database name, backup name
+    and database type extension.
+    """
+    backup_base_name = '{db_name}-{backup_name}.{ext}.gz'.format(
+        db_name=db_name,
+        backup_name=backup_name,
+        ext=ext,
+    )
+    return os.path.join(dir, backup_base_name)
+
+
+def get_new_backup_file(db_name, ext, reserved=(), dir=BACKUP_DIR, now=None):
+    """
+    Gets the path of a new backup file for the given database name named
+    after the current time.  Names have a resolution of a second, so the
+    next free second is used instead if a backup, or a path in `reserved`,
+    already has the name.
+    """
+    now = int(time.time() if now is None else now)
+    while True:
+        backup_name = '{0}-{1}'.format(time.strftime('%F', time.localtime(now)), now)
+        backup_file = get_backup_file(db_name, backup_name, ext, dir=dir)
+        if (backup_file not in reserved and not os.path.exists(backup_file) and
+                not os.path.exists(backup_file + MANIFEST_SUFFIX)):
+            return backup_file
+        now += 1
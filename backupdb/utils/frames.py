@@ -0,0 +1,387 @@
+"""
+Framed gzip compression and decompression using several threads.
+
+A framed file is a sequence of independent gzip members ("frames"), each
+holding up to `DEFAULT_FRAME_SIZE` bytes of uncompressed data.  Every frame
+header carries an extra field with the total size of the frame, so frames can
+be found without inflating them and decompressed in parallel.  Framed files
+are ordinary multi-member gzip files and can still be read by `gunzip`.
+
+Files without frame information, such as those written by `gzip`, are
+decompressed sequentially.
+
+This module only depends on the standard library so that it can be run as a
+pipeline stage without importing Django::
+
+    python frames.py --threads=4 < dump.sql > dump.sql.gz
+    python frames.py -d --threads=4 dump.sql.gz > dump.sql
+
+With `--level=auto`, the compression level of each frame is chosen by a
+`LevelController` so that the compressor just keeps up with whatever writes
+its input.
+"""
+from __future__ import print_function
+import argparse
+import collections
+import struct
+import sys
+import time
+import zlib
+
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:  # pragma: no cover
+    ThreadPoolExecutor = None
+
+DEFAULT_FRAME_SIZE = 1024 * 1024
+DEFAULT_LEVEL = 6
+MIN_LEVEL = 1
+MAX_LEVEL = 9
+AUTO_LEVEL = 'auto'
+
+# Number of frames between two adjustments of an adaptive compression level
+ADJUST_INTERVAL = 8
+
+GZIP_MAGIC = b'\x1f\x8b'
+FEXTRA = 4
+
+# Extra subfield identifying a frame and holding its total size
+FRAME_SUBFIELD = b'BD'
+FRAME_HEADER = struct.Struct('<2sBBIBBH2sHI')
+FRAME_HEADER_SIZE = FRAME_HEADER.size
+FRAME_TRAILER = struct.Struct('<II')
+
+COPY_CHUNK_SIZE = 64 * 1024
+
+
+class FrameError(Exception):
+    pass
+
+
+class TruncatedError(FrameError):
+    pass
+
+
+def compress_frame(data, level=DEFAULT_LEVEL):
+    """
+    Returns `data` compressed as a single frame.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    body = compressor.compress(data) + compressor.flush()
+    size = FRAME_HEADER_SIZE + len(body) + FRAME_TRAILER.size
+    header = FRAME_HEADER.pack(
+        GZIP_MAGIC, 8, FEXTRA, 0, 0, 255,
+        8, FRAME_SUBFIELD, 4, size,
+    )
+    trailer = FRAME_TRAILER.pack(zlib.crc32(data) & 0xffffffff, len(data) & 0xffffffff)
+    return header + body + trailer
+
+
+def decompress_frame(frame):
+    """
+    Returns the uncompressed contents of a frame produced by `compress_frame`.
+    """
+    data = zlib.decompress(frame[FRAME_HEADER_SIZE:-FRAME_TRAILER.size], -zlib.MAX_WBITS)
+    crc, size = FRAME_TRAILER.unpack(frame[-FRAME_TRAILER.size:])
+    if crc != zlib.crc32(data) & 0xffffffff or size != len(data) & 0xffffffff:
+        raise FrameError('Frame checksum mismatch')
+    return data
+
+
+def get_frame_size(header):
+    """
+    Returns the total size of the frame starting with `header` or None if
+    `header` is not the start of a frame.
+    """
+    if len(header) < FRAME_HEADER_SIZE:
+        return None
+    magic, cm, flg, _, _, _, xlen, si, length, size = FRAME_HEADER.unpack(header[:FRAME_HEADER_SIZE])
+    if magic != GZIP_MAGIC or cm != 8 or flg != FEXTRA or xlen != 8:
+        return None
+    if si != FRAME_SUBFIELD or length != 4:
+        return None
+    return size
+
+
+def read_exactly(stream, size):
+    data = stream.read(size)
+    while len(data) < size:
+        more = stream.read(size - len(data))
+        if not more:
+            break
+        data += more
+    return data
+
+
+def is_framed(path):
+    """
+    Returns True if the file at `path` starts with a frame.
+    """
+    with open(path, 'rb') as f:
+        return get_frame_size(f.read(FRAME_HEADER_SIZE)) is not None
+
+
+def get_uncompressed_size(path):
+    """
+    Returns the uncompressed size of the gzip file at `path`.  The size of
+    framed files is exact.  For other files it is read from the trailer of
+    the last member and is only correct modulo 4 GiB, so it should only be
+    used as a hint.
+    """
+    total = 0
+    with open(path, 'rb') as f:
+        f.seek(0, 2)
+        end = f.tell()
+        f.seek(0)
+        offset = 0
+        while offset < end:
+            size = get_frame_size(f.read(FRAME_HEADER_SIZE))
+            if size is None:
+                break
+            f.seek(offset + size - 4)
+            total += struct.unpack('<I', f.read(4))[0]
+            offset += size
+        else:
+            return total
+
+        if end < FRAME_TRAILER.size:
+            return None
+        f.seek(end - 4)
+        return total + struct.unpack('<I', f.read(4))[0]
+
+
+def iter_frames(stream):
+    """
+    Yields `(frame, rest)` tuples from `stream`.  `frame` is the bytes of the
+    next frame.  Once data which is not framed is found, `frame` is None and
+    `rest` holds the data read so far; the remainder should be read from
+    `stream` by the caller.
+    """
+    while True:
+        header = read_exactly(stream, FRAME_HEADER_SIZE)
+        if not header:
+            return
+        size = get_frame_size(header)
+        if size is None:
+            yield None, header
+            return
+        frame = header + read_exactly(stream, size - FRAME_HEADER_SIZE)
+        if len(frame) < size:
+            raise TruncatedError('Truncated frame')
+        yield frame, None
+
+
+def iter_gzip_stream(stream, rest=b''):
+    """
+    Yields the decompressed contents of a possibly multi-member gzip stream,
+    starting with the already read bytes `rest`.  Raises TruncatedError if
+    the stream ends in the middle of a member.
+    """
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    started = False
+    data = rest
+    while True:
+        if not data:
+            data = stream.read(COPY_CHUNK_SIZE)
+            if not data:
+                break
+        started = True
+        yield decompressor.decompress(data)
+        if decompressor.eof:
+            data = decompressor.unused_data
+            if data and not GZIP_MAGIC.startswith(data[:2]):
+                # Trailing garbage after the last member is ignored, as
+                # gunzip does
+                return
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            started = False
+        else:
+            data = b''
+    if started and not decompressor.eof:
+        raise TruncatedError('Unexpected end of gzip stream')
+
+
+def map_ordered(func, items, threads):
+    """
+    Yields `func(item)` for each of `items` in order, computing up to
+    `threads * 2` results ahead on `threads` threads.
+    """
+    if threads <= 1 or ThreadPoolExecutor is None:
+        for item in items:
+            yield func(item)
+        return
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        window = collections.deque()
+        for item in items:
+            window.append(executor.submit(func, item))
+            if len(window) >= threads * 2:
+                yield window.popleft().result()
+        while window:
+            yield window.popleft().result()
+
+
+def iter_chunks(stream, size):
+    while True:
+        data = read_exactly(stream, size)
+        if not data:
+            return
+        yield data
+
+
+class LevelController(object):
+    """
+    Adapts the compression level to the speed of the producer of the input.
+
+    Time spent waiting for input means the producer is slower than the
+    compressor, which can afford a higher level.  Time spent waiting for
+    compressed frames means the compressor is the bottleneck and slows the
+    producer down, so the level is lowered.  The level moves by one step at
+    most every `interval` frames, so it settles around the highest level at
+    which the compressor keeps up.
+    """
+    def __init__(self, level=DEFAULT_LEVEL, interval=ADJUST_INTERVAL):
+        self.level = level
+        self.interval = interval
+        self.reset()
+
+    def reset(self):
+        self.frames = 0
+        self.input_wait = 0.0
+        self.output_wait = 0.0
+
+    def record(self, input_wait, output_wait):
+        """
+        Records the time spent reading the input and waiting for the
+        compressed data of one frame, and adjusts the level if needed.
+        """
+        self.frames += 1
+        self.input_wait += input_wait
+        self.output_wait += output_wait
+        if self.frames < self.interval:
+            return
+
+        if self.output_wait > self.input_wait:
+            self.level = max(MIN_LEVEL, self.level - 1)
+        elif self.output_wait * 4 < self.input_wait:
+            # Only raise the level when the compressor is well ahead, so the
+            # level doesn't flip between two values on every adjustment
+            self.level = min(MAX_LEVEL, self.level + 1)
+        self.reset()
+
+
+def compress(input, output, threads=1, level=DEFAULT_LEVEL, frame_size=DEFAULT_FRAME_SIZE):
+    """
+    Compresses `input` into `output` as frames of `frame_size` bytes, using
+    `threads` threads.  If `level` is `AUTO_LEVEL`, the level is adjusted
+    while compressing by a `LevelController`.
+    """
+    if level != AUTO_LEVEL:
+        def func(data):
+            return compress_frame(data, level)
+
+        for frame in map_ordered(func, iter_chunks(input, frame_size), threads):
+            output.write(frame)
+        return
+
+    controller = LevelController()
+    waits = {'input': 0.0}
+
+    def chunks():
+        while True:
+            started = time.time()
+            data = read_exactly(input, frame_size)
+            waits['input'] += time.time() - started
+            if not data:
+                return
+            yield data, controller.level
+
+    def func(item):
+        return compress_frame(*item)
+
+    frames = map_ordered(func, chunks(), threads)
+    while True:
+        waits['input'] = 0.0
+        started = time.time()
+        try:
+            frame = next(frames)
+        except StopIteration:
+            break
+        # Whatever wasn't spent reading was spent waiting for the compressor
+        input_wait = waits['input']
+        controller.record(input_wait, max(0.0, time.time() - started - input_wait))
+        output.write(frame)
+
+
+def decompress(input, output, threads=1):
+    """
+    Decompresses `input` into `output`.  Frames are decompressed on `threads`
+    threads, data which is not framed is decompressed sequentially.
+    """
+    leftovers = []
+
+    def frames():
+        for frame, rest in iter_frames(input):
+            if frame is None:
+                leftovers.append(rest)
+                return
+            yield frame
+
+    for data in map_ordered(decompress_frame, frames(), threads):
+        output.write(data)
+
+    if leftovers:
+        for data in iter_gzip_stream(input, leftovers[0]):
+            output.write(data)
+
+
+def get_binary_stdio():
+    stdin = getattr(sys.stdin, 'buffer', sys.stdin)
+    stdout = getattr(sys.stdout, 'buffer', sys.stdout)
+    return stdin, stdout
+
+
+def parse_level(value):
+    if value == AUTO_LEVEL:
+        return value
+    try:
+        level = int(value)
+    except ValueError:
+        level = None
+    if level is None or not MIN_LEVEL <= level <= MAX_LEVEL:
+        raise argparse.ArgumentTypeError("must be 'auto' or a level from {0} to {1}".format(MIN_LEVEL, MAX_LEVEL))
+    return level
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Framed gzip compression using several threads.')
+    parser.add_argument('-d', '--decompress', action='store_true', default=False)
+    parser.add_argument('-t', '--threads', type=int, default=1)
+    parser.add_argument('-l', '--level', type=parse_level, default=DEFAULT_LEVEL,
+                        help="Compression level from 1 to 9 or 'auto' to adapt it to the speed of the input.")
+    parser.add_argument('--frame-size', type=int, default=DEFAULT_FRAME_SIZE)
+    parser.add_argument('file', nargs='?')
+    options = parser.parse_args(argv)
+
+    stdin, stdout = get_binary_stdio()
+    input = open(options.file, 'rb') if options.file else stdin
+    try:
+        if options.decompress:
+            decompress(input, stdout, threads=options.threads)
+        else:
+            compress(input, stdout, threads=options.threads, level=options.level, frame_size=options.frame_size)
+        stdout.flush()
+    except (FrameError, zlib.error) as e:
+        print('frames: {0}'.format(e), file=sys.stderr)
+        return 1
+    except IOError as e:
+        print('frames: {0}'.format(e), file=sys.stderr)
+        return 1
+    finally:
+        if options.file:
+            input.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
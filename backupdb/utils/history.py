@@ -0,0 +1,185 @@
+"""
+History of backups and predictions of the duration and size of the next ones.
+
+Each backup made by `backupdb` appends a record to the history file with the
+size of the database when it started, the time the backup took, the size of
+the backup and, for framed backups, the size of the dump before compression.
+The next backup of a database is predicted by applying the median rates of its
+last `HISTORY_SAMPLES` backups, in seconds and backup bytes per byte of
+database, to the current size of the database.
+"""
+from subprocess import CalledProcessError
+import json
+import os
+import time
+
+from .commands import run_postgresql_sql
+from .frames import get_uncompressed_size, is_framed
+from .warmup import run_mysql_sql
+
+HISTORY_SAMPLES = 10
+
+MYSQL_DB_SIZE_SQL = (
+    "SELECT COALESCE(SUM(DATA_LENGTH + INDEX_LENGTH), 0) FROM information_schema.TABLES "
+    "WHERE TABLE_SCHEMA = DATABASE()"
+)
+
+
+def get_postgresql_db_size(db_config, show_output=False):
+    output = run_postgresql_sql(db_config, 'SELECT pg_database_size(current_database())', show_output, output=True)
+    return int(output.strip())
+
+
+def get_mysql_db_size(db_config, show_output=False):
+    return int(run_mysql_sql(db_config, MYSQL_DB_SIZE_SQL, show_output)[0][0])
+
+
+def get_sqlite_db_size(db_config, show_output=False):
+    return os.path.getsize(db_config['NAME'])
+
+
+def get_db_size(db_size_func, db_config, show_output=False):
+    """
+    Returns the size in bytes of the database as measured by `db_size_func`
+    or None if it could not be measured.
+    """
+    try:
+        return db_size_func(db_config, show_output)
+    except (CalledProcessError, OSError, ValueError, IndexError):
+        return None
+
+
+def record_backup(history, db_name, backup_file, db_size, started, duration):
+    """
+    Records a completed backup of `db_name` into `backup_file` in the
+    `ResultLog` `history`.
+    """
+    dump_bytes = get_uncompressed_size(backup_file) if is_framed(backup_file) else None
+    history.record(
+        database=db_name,
+        started=started,
+        duration=duration,
+        db_size=db_size,
+        bytes=os.path.getsize(backup_file),
+        dump_bytes=dump_bytes,
+    )
+
+
+def load_history(path):
+    """
+    Returns a dict mapping database names to the list of their records in the
+    history file at `path`, oldest first.  Returns an empty dict if the file
+    does not exist.
+    """
+    history = {}
+    if not os.path.exists(path):
+        return history
+    with open(path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            history.setdefault(record.get('database'), []).append(record)
+    return history
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+class Estimate(object):
+    """
+    Predicted `duration` in seconds and size in `bytes` of a backup, based on
+    `samples` previous backups.  Both are None if there is no usable history.
+    """
+    def __init__(self, db_name, db_size=None, duration=None, bytes=None, samples=0):
+        self.db_name = db_name
+        self.db_size = db_size
+        self.duration = duration
+        self.bytes = bytes
+        self.samples = samples
+
+    @property
+    def known(self):
+        return self.duration is not None
+
+
+def estimate_backup(db_name, records, db_size, samples=HISTORY_SAMPLES):
+    """
+    Returns the `Estimate` of the next backup of `db_name` from its history
+    `records` and its current size `db_size`.
+    """
+    usable = [
+        r for r in records
+        if r.get('db_size') and r.get('duration') is not None and r.get('bytes') is not None
+    ][-samples:]
+    if not usable or not db_size:
+        return Estimate(db_name, db_size)
+
+    duration_rate = median([r['duration'] / float(r['db_size']) for r in usable])
+    bytes_rate = median([r['bytes'] / float(r['db_size']) for r in usable])
+    return Estimate(db_name, db_size, duration_rate * db_size, int(bytes_rate * db_size), len(usable))
+
+
+def estimate_total(estimates, jobs=1):
+    """
+    Returns the `Estimate` of backing up all databases of `estimates` on
+    `jobs` workers.  Databases without an estimate are left out.
+    """
+    known = [e for e in estimates if e.known]
+    if not known:
+        return Estimate('total')
+    durations = [e.duration for e in known]
+    return Estimate(
+        'total',
+        db_size=sum(e.db_size for e in known),
+        duration=max(max(durations), sum(durations) / max(1, jobs)),
+        bytes=sum(e.bytes for e in known),
+        samples=min(e.samples for e in known),
+    )
+
+
+def get_free_space(path):
+    """
+    Returns the number of bytes available to unprivileged users on the file
+    system holding `path`.
+    """
+    stat = os.statvfs(path)
+    return stat.f_bavail * stat.f_frsize
+
+
+def check_estimate(total, max_duration=None, free_space=None):
+    """
+    Returns a list of messages describing how the `total` estimate goes over
+    `max_duration` seconds or `free_space` bytes.
+    """
+    problems = []
+    if not total.known:
+        return problems
+    if max_duration is not None and total.duration > max_duration:
+        problems.append('Backups are expected to take {0}, more than the allowed {1}'.format(
+            format_duration(total.duration), format_duration(max_duration)))
+    if free_space is not None and total.bytes > free_space:
+        problems.append('Backups are expected to need {0}, more than the {1} available'.format(
+            format_size(total.bytes), format_size(free_space)))
+    return problems
+
+
+def format_size(size):
+    if size < 1024:
+        return '{0} bytes'.format(int(size))
+    for unit in ('KiB', 'MiB', 'GiB', 'TiB'):
+        size /= 1024.0
+        if size < 1024 or unit == 'TiB':
+            return '{0:.1f} {1}'.format(size, unit)
+
+
+def format_duration(seconds):
+    if seconds >= 24 * 60 * 60:
+        return '{0:.1f} days'.format(seconds / (24 * 60 * 60.0))
+    return time.strftime('%H:%M:%S', time.gmtime(seconds))
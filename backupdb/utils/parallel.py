@@ -0,0 +1,223 @@
+import argparse
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+OK = 'ok'
+FAILED = 'failed'
+SKIPPED = 'skipped'
+
+
+def parse_job_count(value):
+    """
+    Returns the number of jobs given on the command line, which must be at
+    least 1.
+    """
+    try:
+        count = int(value)
+    except ValueError:
+        count = 0
+    if count < 1:
+        raise argparse.ArgumentTypeError("must be a number of jobs of at least 1, got '{0}'".format(value))
+    return count
+
+
+class Job(object):
+    """
+    A unit of work for `run_jobs`.  `func` is called without arguments and
+    the job is considered failed if it raises an exception or returns a false
+    value.  A job only starts once all jobs named in `depends_on` have
+    succeeded and, among the jobs which are ready, jobs with a higher
+    `priority` start first.  `host` identifies the server the job puts load
+    on, see `HostJobRunner`.
+    """
+    def __init__(self, name, func, depends_on=(), priority=0, host=None):
+        self.name = name
+        self.func = func
+        self.depends_on = list(depends_on)
+        self.priority = priority
+        self.host = host
+
+
+def check_dependencies(jobs):
+    """
+    Raises ValueError if the dependencies between `jobs` contain a cycle.
+    Dependencies on jobs which are not in `jobs` are ignored.
+    """
+    deps = dict((j.name, [d for d in j.depends_on if d != j.name]) for j in jobs)
+    visiting, done = set(), set()
+
+    def visit(name, path):
+        if name in done or name not in deps:
+            return
+        if name in visiting:
+            raise ValueError('Dependency cycle: {0}'.format(' -> '.join(path + [name])))
+        visiting.add(name)
+        for dep in deps[name]:
+            visit(dep, path + [name])
+        visiting.remove(name)
+        done.add(name)
+
+    for job in jobs:
+        visit(job.name, [])
+
+
+class JobRunner(object):
+    """
+    Runs jobs on up to `max_workers` threads.  Subclasses may override
+    `can_start` and `get_ready` to add further limits on which jobs may run at
+    the same time.
+    """
+    def __init__(self, jobs, max_workers=1):
+        check_dependencies(jobs)
+        self.jobs = jobs
+        self.max_workers = max(1, max_workers)
+        self.names = set(j.name for j in jobs)
+        self.order = dict((j.name, i) for i, j in enumerate(jobs))
+        self.results = {}
+        self.running = []
+        self.condition = threading.Condition()
+
+    def get_state(self, job):
+        """
+        Returns `None` if `job` may start now, `SKIPPED` if it can never
+        start because a dependency did not succeed, or `False` if it has to
+        wait.
+        """
+        for dep in job.depends_on:
+            if dep not in self.names or dep == job.name:
+                continue
+            result = self.results.get(dep)
+            if result is None:
+                return False
+            if result != OK:
+                return SKIPPED
+        return None
+
+    def can_start(self, job):
+        return len(self.running) < self.max_workers
+
+    def get_ready(self, pending):
+        ready = [j for j in pending if self.get_state(j) is None]
+        ready.sort(key=lambda j: (-j.priority, self.order[j.name]))
+        return ready
+
+    def on_start(self, job):
+        self.running.append(job)
+
+    def on_finish(self, job):
+        self.running.remove(job)
+
+    def _run(self, job):
+        try:
+            result = OK if job.func() else FAILED
+        except Exception:
+            logger.exception("Job '{0}' failed".format(job.name))
+            result = FAILED
+        with self.condition:
+            self.results[job.name] = result
+            self.on_finish(job)
+            self.condition.notify_all()
+
+    def run(self):
+        """
+        Runs all jobs and returns a dict mapping job names to `OK`, `FAILED`
+        or `SKIPPED`.  Raises ValueError if none of the remaining jobs can
+        ever start.
+        """
+        pending = list(self.jobs)
+        threads = []
+        with self.condition:
+            while pending or self.running:
+                for job in list(pending):
+                    if self.get_state(job) == SKIPPED:
+                        logger.warning("Skipping '{0}' because a dependency failed".format(job.name))
+                        self.results[job.name] = SKIPPED
+                        pending.remove(job)
+
+                for job in self.get_ready(pending):
+                    if not self.can_start(job):
+                        continue
+                    pending.remove(job)
+                    self.on_start(job)
+                    thread = threading.Thread(target=self._run, args=(job,))
+                    thread.daemon = True
+                    thread.start()
+                    threads.append(thread)
+
+                if self.running:
+                    self.condition.wait()
+                elif pending:
+                    raise ValueError('Jobs can never start: {0}'.format(', '.join(j.name for j in pending)))
+
+        for thread in threads:
+            thread.join()
+        return self.results
+
+
+class HostJobRunner(JobRunner):
+    """
+    Runs jobs on up to `max_workers` threads with at most `max_per_host` of
+    them running against the same `host` at the same time.  Ready jobs are
+    started in turns across hosts, so that the workers are spread over all
+    servers rather than spent on the jobs of one server which happen to come
+    first.  Within a turn, hosts running fewer jobs go first, then jobs with
+    a higher priority, then hosts which have started fewer jobs so far.
+    """
+    def __init__(self, jobs, max_workers=1, max_per_host=None):
+        super(HostJobRunner, self).__init__(jobs, max_workers)
+        if max_per_host is not None and max_per_host < 1:
+            raise ValueError('At least one job per host must be allowed, got {0}'.format(max_per_host))
+        self.max_per_host = max_per_host
+        self.running_per_host = {}
+        self.started_per_host = {}
+
+    def can_start(self, job):
+        if not super(HostJobRunner, self).can_start(job):
+            return False
+        if self.max_per_host is None:
+            return True
+        return self.running_per_host.get(job.host, 0) < self.max_per_host
+
+    def get_ready(self, pending):
+        by_host = {}
+        for job in super(HostJobRunner, self).get_ready(pending):
+            by_host.setdefault(job.host, []).append(job)
+
+        ready = []
+        turn = 0
+        while by_host:
+            jobs = [host_jobs[turn] for host_jobs in by_host.values()]
+            jobs.sort(key=lambda j: (
+                self.running_per_host.get(j.host, 0),
+                -j.priority,
+                self.started_per_host.get(j.host, 0),
+                self.order[j.name],
+            ))
+            ready.extend(jobs)
+            turn += 1
+            by_host = dict((h, host_jobs) for h, host_jobs in by_host.items() if len(host_jobs) > turn)
+        return ready
+
+    def on_start(self, job):
+        super(HostJobRunner, self).on_start(job)
+        self.running_per_host[job.host] = self.running_per_host.get(job.host, 0) + 1
+        self.started_per_host[job.host] = self.started_per_host.get(job.host, 0) + 1
+
+    def on_finish(self, job):
+        super(HostJobRunner, self).on_finish(job)
+        self.running_per_host[job.host] -= 1
+
+
+def run_jobs(jobs, max_workers=1, max_per_host=None):
+    """
+    Runs `jobs` on up to `max_workers` threads, respecting their dependencies
+    and priorities, with at most `max_per_host` jobs running against the same
+    host at the same time.  A failing job does not stop the others, but jobs
+    which depend on it are skipped.  Returns a dict mapping job names to
+    `OK`, `FAILED` or `SKIPPED`.  Raises ValueError if the dependencies
+    contain a cycle or `max_per_host` is less than 1.
+    """
+    return HostJobRunner(jobs, max_workers, max_per_host).run()
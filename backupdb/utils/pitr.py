@@ -0,0 +1,420 @@
+"""
+Point-in-time recovery.
+
+Each database has an archive directory holding its base backups, the logs
+written by the server since then and a catalog of both:
+
+* `base/` holds base backups.  Postgres base backups are physical copies of
+  the whole server taken by `pg_basebackup`, including the WAL needed to
+  make them consistent.  Mysql base backups are dumps taken by `mysqldump
+  --single-transaction --master-data`, which record the position in the
+  binary log at which the dump was taken.
+* `wal/` holds the WAL segments compressed by the postgres server itself,
+  which runs `walarchive.py` as its `archive_command`.
+* `binlog/` holds the closed mysql binary logs, compressed.  They are copied
+  from the server by `archive_mysql_logs`, which should run often since the
+  logs written after the last copy can't be recovered.
+* `catalog.jsonl` has a JSON line for each file added to the archive.
+
+A database is recovered to a point in time from the latest base backup from
+which that point can be reached.  Mysql databases are restored from the base
+dump and then replayed with `mysqlbinlog --stop-datetime`.  Postgres base
+backups are extracted into an empty data directory, set up to fetch WAL from
+the archive until the requested time; the recovery itself happens when a
+server is started on that directory.
+"""
+from subprocess import CalledProcessError
+import argparse
+import gzip
+import json
+import logging
+import os
+import re
+import shlex
+import shutil
+import tempfile
+import time
+
+from . import walarchive
+from .commands import (
+    do_mysql_restore,
+    fsync_dir,
+    get_compress_cmd,
+    get_decompress_cmds,
+    get_mysql_args,
+    get_postgresql_args,
+    get_postgresql_env,
+    get_script_cmd,
+    run_postgresql_sql,
+)
+from .exceptions import BackupError, RestoreError
+from .processes import pipe_commands, pipe_commands_to_file
+from .walarchive import CATALOG_FILE, record
+from .warmup import run_mysql_sql
+
+logger = logging.getLogger(__name__)
+
+BASE_DIR = 'base'
+BINLOG_DIR = 'binlog'
+
+UNTIL_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+MYSQL_POSITION_LINES = 100
+MYSQL_BINLOG_RE = re.compile(r'^(.+)\.(\d+)$')
+MYSQL_POSITION_RE = re.compile(
+    r"CHANGE (?:MASTER|REPLICATION SOURCE) TO "
+    r"(?:MASTER|SOURCE)_LOG_FILE='([^']+)', (?:MASTER|SOURCE)_LOG_POS=(\d+)"
+)
+
+
+def parse_until(value):
+    """
+    Returns the timestamp of a local time given as `YYYY-MM-DD HH:MM:SS` on
+    the command line.
+    """
+    try:
+        return time.mktime(time.strptime(value, UNTIL_FORMAT))
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected a time like '2024-01-31 23:59:00', got '{0}'".format(value))
+
+
+def format_until(until):
+    return time.strftime(UNTIL_FORMAT, time.localtime(until))
+
+
+def get_pitr_dir(db_name, dir):
+    return os.path.join(dir, db_name)
+
+
+def read_catalog(pitr_dir):
+    """
+    Returns the list of records in the catalog of `pitr_dir`, oldest first.
+    """
+    records = []
+    path = os.path.join(pitr_dir, CATALOG_FILE)
+    if not os.path.exists(path):
+        return records
+    with open(path) as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                continue
+    return records
+
+
+def find_base_backup(records, until):
+    """
+    Returns the record of the latest base backup from which the database can
+    be recovered to `until`.  Raises RestoreError if there is none.
+    """
+    bases = [r for r in records if r.get('kind') == 'base' and r['recoverable_from'] <= until]
+    if not bases:
+        raise RestoreError('No base backup was taken before {0}'.format(format_until(until)))
+    return max(bases, key=lambda r: r['recoverable_from'])
+
+
+def write_archive_file(cmds, path, **kwargs):
+    """
+    Writes the output of `cmds` into `path` under a temporary name first.
+    """
+    dir = os.path.dirname(path)
+    if not os.path.isdir(dir):
+        os.makedirs(dir)
+    tmp_path = path + '.tmp'
+    try:
+        pipe_commands_to_file(cmds, path=tmp_path, **kwargs)
+    except CalledProcessError:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    os.rename(tmp_path, path)
+    fsync_dir(dir)
+
+
+def get_pg_archive_command(pitr_dir):
+    """
+    Returns the `archive_command` with which the postgres server archives its
+    WAL segments into `pitr_dir`.
+    """
+    cmd = get_script_cmd(walarchive, 'archive', '%p', '%f', os.path.abspath(pitr_dir))
+    return ' '.join(shlex.quote(arg) for arg in cmd)
+
+
+def get_pg_restore_command(pitr_dir):
+    """
+    Returns the `restore_command` with which the postgres server reads WAL
+    segments from `pitr_dir` while recovering.
+    """
+    cmd = get_script_cmd(walarchive, 'restore', '%f', '%p', os.path.abspath(pitr_dir))
+    return ' '.join(shlex.quote(arg) for arg in cmd)
+
+
+def quote_pg_setting(value):
+    return "'{0}'".format(value.replace("'", "''"))
+
+
+def do_postgresql_base_backup(pitr_dir, db_config, show_output=False, compress_threads=1, compress_level=None):
+    """
+    Takes a base backup of the server of `db_config` into `pitr_dir`.  The
+    server must have a single tablespace and allow replication connections
+    for the user of `db_config`.  Returns the path of the base backup.
+    """
+    name = time.strftime('%F-%s')
+    base_file = os.path.join(pitr_dir, BASE_DIR, '{0}.tar.gz'.format(name))
+
+    # pg_basebackup copies the whole server and takes no database name
+    cmd = [
+        'pg_basebackup',
+        '--pgdata=-',
+        '--format=tar',
+        '--wal-method=fetch',
+        '--checkpoint=fast',
+        '--label=backupdb {0}'.format(name),
+    ] + get_postgresql_args(db_config)[:-1]
+
+    started = time.time()
+    write_archive_file(
+        [cmd, get_compress_cmd(compress_threads, compress_level)],
+        base_file,
+        extra_env=get_postgresql_env(db_config),
+        show_stderr=show_output,
+    )
+    finished = time.time()
+    # The backup is only consistent once the WAL written while copying it
+    # has been replayed
+    record(
+        pitr_dir,
+        kind='base',
+        file=os.path.relpath(base_file, pitr_dir),
+        started=started,
+        finished=finished,
+        recoverable_from=finished,
+        bytes=os.path.getsize(base_file),
+    )
+    return base_file
+
+
+def read_mysql_binlog_position(backup_file):
+    """
+    Returns the `(binlog_file, position)` recorded at the top of a dump made
+    with `--master-data`, or None if it is not there.
+    """
+    with gzip.open(backup_file, 'rt') as f:
+        for i, line in enumerate(f):
+            if i >= MYSQL_POSITION_LINES:
+                break
+            match = MYSQL_POSITION_RE.search(line)
+            if match:
+                return match.group(1), int(match.group(2))
+    return None
+
+
+def do_mysql_base_backup(pitr_dir, db_config, show_output=False, compress_threads=1, compress_level=None):
+    """
+    Dumps the database of `db_config` into `pitr_dir` along with its position
+    in the binary log.  The server must have binary logging enabled.
+    Returns the path of the base backup.
+    """
+    name = time.strftime('%F-%s')
+    base_file = os.path.join(pitr_dir, BASE_DIR, '{0}.mysql.gz'.format(name))
+
+    cmd = ['mysqldump', '--single-transaction', '--flush-logs', '--master-data=2'] + get_mysql_args(db_config)
+
+    started = time.time()
+    write_archive_file(
+        [cmd, get_compress_cmd(compress_threads, compress_level)], base_file, show_stderr=show_output)
+    position = read_mysql_binlog_position(base_file)
+    if position is None:
+        os.remove(base_file)
+        raise BackupError('The dump has no binary log position, is binary logging enabled?')
+
+    # The dump reads a snapshot taken when it started, at the position
+    record(
+        pitr_dir,
+        kind='base',
+        file=os.path.relpath(base_file, pitr_dir),
+        started=started,
+        finished=time.time(),
+        recoverable_from=started,
+        binlog_file=position[0],
+        binlog_position=position[1],
+        bytes=os.path.getsize(base_file),
+    )
+    return base_file
+
+
+def archive_postgresql_logs(pitr_dir, db_config, show_output=False):
+    """
+    Checks that the server of `db_config` archives its WAL into `pitr_dir`
+    and switches to a new WAL segment, so that everything written until now
+    is archived.  Raises BackupError if the server is not set up for it.
+    """
+    if not os.path.isdir(pitr_dir):
+        os.makedirs(pitr_dir)
+    output = run_postgresql_sql(
+        db_config,
+        "SELECT current_setting('archive_mode') || '|' || current_setting('archive_command')",
+        show_output,
+        output=True,
+    )
+    archive_mode, _, archive_command = output.strip().partition('|')
+    if archive_mode == 'off' or os.path.abspath(pitr_dir) not in archive_command:
+        raise BackupError('The WAL is not archived, set archive_mode = on and archive_command = {0}'.format(
+            quote_pg_setting(get_pg_archive_command(pitr_dir))))
+
+    try:
+        run_postgresql_sql(db_config, 'SELECT pg_switch_wal()', show_output, output=True)
+    except CalledProcessError:
+        # Switching requires a superuser, the segment is archived once full
+        logger.debug('Could not switch to a new WAL segment')
+
+
+def archive_mysql_logs(pitr_dir, db_config, show_output=False):
+    """
+    Closes the current binary log of the server of `db_config` and copies
+    the closed binary logs which are not archived yet into `pitr_dir`.
+    Returns the names of the copied logs.
+    """
+    if not os.path.isdir(pitr_dir):
+        os.makedirs(pitr_dir)
+    run_mysql_sql(db_config, 'FLUSH BINARY LOGS', show_output)
+    names = [row[0] for row in run_mysql_sql(db_config, 'SHOW BINARY LOGS', show_output)]
+    archived = set(r['name'] for r in read_catalog(pitr_dir) if r.get('kind') == 'binlog')
+
+    # The last log is still being written
+    copied = []
+    tmp_dir = tempfile.mkdtemp(dir=pitr_dir)
+    try:
+        for name in names[:-1]:
+            if name in archived:
+                continue
+            cmd = [
+                'mysqlbinlog',
+                '--read-from-remote-server',
+                '--raw',
+                '--result-file={0}{1}'.format(tmp_dir, os.sep),
+            ] + get_mysql_args(db_config)[:-1] + [name]
+            pipe_commands([cmd], show_stderr=show_output)
+
+            binlog_file = os.path.join(pitr_dir, BINLOG_DIR, name + '.gz')
+            write_archive_file([['cat', os.path.join(tmp_dir, name)], get_compress_cmd()], binlog_file)
+            os.remove(os.path.join(tmp_dir, name))
+            record(
+                pitr_dir,
+                kind='binlog',
+                name=name,
+                file=os.path.relpath(binlog_file, pitr_dir),
+                archived=time.time(),
+                bytes=os.path.getsize(binlog_file),
+            )
+            copied.append(name)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return copied
+
+
+def do_postgresql_pitr_restore(pitr_dir, db_config, until, target_dir=None, drop_tables=False, show_output=False,
+                               decompress_threads=1):
+    """
+    Extracts the base backup from which the server of `db_config` can be
+    recovered to `until` into the empty directory `target_dir` and sets it up
+    to replay the archived WAL until then.  The recovery happens when a
+    server (PostgreSQL 12 or later) is started on `target_dir`.
+    """
+    if not target_dir:
+        raise RestoreError('Postgres databases are recovered into a new data directory, which must be given')
+    if os.path.exists(target_dir) and os.listdir(target_dir):
+        raise RestoreError("Data directory '{0}' is not empty".format(target_dir))
+
+    base = find_base_backup(read_catalog(pitr_dir), until)
+    base_file = os.path.join(pitr_dir, base['file'])
+    if not os.path.exists(target_dir):
+        os.makedirs(target_dir)
+    os.chmod(target_dir, 0o700)
+
+    kwargs = {}
+    cmds = get_decompress_cmds(base_file, kwargs, decompress_threads)
+    pipe_commands(cmds + [['tar', '-x', '-C', target_dir]], show_stderr=show_output, **kwargs)
+
+    with open(os.path.join(target_dir, 'recovery.signal'), 'w'):
+        pass
+    with open(os.path.join(target_dir, 'postgresql.auto.conf'), 'a') as f:
+        f.write('\n# Added by backupdb for point-in-time recovery\n')
+        f.write('restore_command = {0}\n'.format(quote_pg_setting(get_pg_restore_command(pitr_dir))))
+        f.write('recovery_target_time = {0}\n'.format(
+            quote_pg_setting(time.strftime('%Y-%m-%d %H:%M:%S%z', time.localtime(until)))))
+        f.write("recovery_target_action = 'promote'\n")
+    logger.info("Start a server on '{0}' to recover until {1}".format(target_dir, format_until(until)))
+
+
+def check_binlog_sequence(names):
+    """
+    Raises RestoreError unless each of the binary logs `names` is the one
+    written after the previous.
+    """
+    for previous, name in zip(names, names[1:]):
+        previous_match = MYSQL_BINLOG_RE.match(previous)
+        match = MYSQL_BINLOG_RE.match(name)
+        if (not previous_match or not match or previous_match.group(1) != match.group(1) or
+                int(match.group(2)) != int(previous_match.group(2)) + 1):
+            raise RestoreError("Binary logs between '{0}' and '{1}' are missing from the archive".format(
+                previous, name))
+
+
+def do_mysql_pitr_restore(pitr_dir, db_config, until, target_dir=None, drop_tables=False, show_output=False,
+                          decompress_threads=1):
+    """
+    Restores the database of `db_config` from the base backup from which it
+    can be recovered to `until`, then replays the archived binary logs until
+    then.  Raises RestoreError before restoring anything if some of the logs
+    since the base backup are missing from the archive.
+    """
+    records = read_catalog(pitr_dir)
+    base = find_base_backup(records, until)
+    binlogs = sorted(
+        (r for r in records if r.get('kind') == 'binlog' and r['name'] >= base['binlog_file']),
+        key=lambda r: r['name'],
+    )
+    if binlogs and binlogs[0]['name'] != base['binlog_file']:
+        raise RestoreError("Binary log '{0}' of the base backup is missing from the archive".format(
+            base['binlog_file']))
+    check_binlog_sequence([r['name'] for r in binlogs])
+    # Logs are archived as soon as they are closed, so the last one ends
+    # about when it was archived
+    end = binlogs[-1].get('archived') if binlogs else base['recoverable_from']
+    if end is not None and end < until:
+        logger.warning("The archive ends at {0}, changes made since then until {1} can't be recovered".format(
+            format_until(end), format_until(until)))
+
+    do_mysql_restore(
+        os.path.join(pitr_dir, base['file']),
+        db_config,
+        drop_tables=drop_tables,
+        show_output=show_output,
+        decompress_threads=decompress_threads,
+    )
+    if not binlogs:
+        logger.warning('No binary logs were archived since the base backup, it is restored as is')
+        return
+
+    tmp_dir = tempfile.mkdtemp(dir=pitr_dir)
+    try:
+        paths = []
+        for binlog in binlogs:
+            path = os.path.join(tmp_dir, binlog['name'])
+            kwargs = {}
+            cmds = get_decompress_cmds(os.path.join(pitr_dir, binlog['file']), kwargs, decompress_threads)
+            pipe_commands_to_file(cmds, path=path, show_stderr=show_output, **kwargs)
+            paths.append(path)
+
+        # The start position only applies to the first log
+        cmd = [
+            'mysqlbinlog',
+            '--start-position={0}'.format(base['binlog_position']),
+            '--stop-datetime={0}'.format(format_until(until)),
+            '--database={0}'.format(db_config['NAME']),
+        ] + paths
+        pipe_commands([cmd, ['mysql'] + get_mysql_args(db_config)], show_stderr=show_output)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
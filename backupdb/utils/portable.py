@@ -0,0 +1,434 @@
+"""
+Portable backups made through the Django ORM.
+
+A portable backup holds the rows of the models of a database rather than a
+dump in the dialect of its engine, so it can be restored into a database of
+any engine which Django supports, such as a backup of a production postgres
+database into sqlite for a local test run.
+
+The rows of each model are read in batches with `iterator()`, which uses
+server-side cursors where the engine has them, on `jobs` connections at
+once.  Postgres connections share an exported snapshot, so they see the same
+data; other engines read each model in the transaction of its connection.
+Batches are written as pickled lists of value tuples, compressed like other
+backups.  Only the types returned by the fields of Django itself are
+unpickled when restoring.
+
+Restoring needs the tables of the target database to exist, e.g. through
+`migrate`.  Rows are inserted in batches in a single transaction with the
+constraint checks deferred, as `loaddata` does, and the sequences are reset
+afterwards.
+"""
+import logging
+import os
+import pickle
+import queue
+import threading
+import time
+
+from django.apps import apps
+from django.core.management.color import no_style
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections, router, transaction
+
+from .commands import get_compress_cmd, get_decompress_cmds, require_backup_exists
+from .exceptions import BackupError, RestoreError
+from .processes import is_stream, pipe_commands_to_file, pipe_commands_to_func
+
+logger = logging.getLogger(__name__)
+
+FORMAT = 'backupdb-portable'
+VERSION = 1
+
+DEFAULT_JOBS = 4
+DEFAULT_BATCH_SIZE = 2000
+
+PICKLE_PROTOCOL = 4
+
+# Types of the values of Django fields which are not pickled natively
+SAFE_GLOBALS = set([
+    ('builtins', 'bytearray'),
+    ('datetime', 'date'),
+    ('datetime', 'datetime'),
+    ('datetime', 'time'),
+    ('datetime', 'timedelta'),
+    ('datetime', 'timezone'),
+    ('decimal', 'Decimal'),
+    ('uuid', 'UUID'),
+])
+
+
+def get_models(using):
+    """
+    Returns the models whose tables are managed by Django in the database
+    `using`, including the tables of many-to-many fields.
+    """
+    return [
+        model for model in apps.get_models(include_auto_created=True)
+        if model._meta.managed and not model._meta.proxy and router.allow_migrate_model(using, model)
+    ]
+
+
+def get_field_names(model):
+    """
+    Returns the names of the columns of the table of `model`.  Models which
+    inherit from other concrete models are stored without the fields of
+    their parents, which are stored with the parents.
+    """
+    return [field.attname for field in model._meta.local_concrete_fields]
+
+
+def iter_rows(model, using, batch_size):
+    """
+    Yields the rows of `model` as lists of at most `batch_size` tuples.
+    """
+    field_names = get_field_names(model)
+    binary = [
+        i for i, field in enumerate(model._meta.local_concrete_fields)
+        if field.get_internal_type() == 'BinaryField'
+    ]
+    rows = model._base_manager.using(using).order_by().values_list(*field_names)
+
+    batch = []
+    for row in rows.iterator(chunk_size=batch_size):
+        if binary:
+            # Some drivers return memoryviews, which can't be pickled
+            row = list(row)
+            for i in binary:
+                if row[i] is not None:
+                    row[i] = bytes(row[i])
+            row = tuple(row)
+        batch.append(row)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def start_snapshot(using, snapshot=None):
+    """
+    Starts a repeatable read transaction seeing the data of the postgres
+    snapshot `snapshot`, or exports a new snapshot if None.  Returns the
+    snapshot id.  Must be called at the start of a transaction.
+    """
+    with connections[using].cursor() as cursor:
+        cursor.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ')
+        if snapshot is not None:
+            cursor.execute('SET TRANSACTION SNAPSHOT %s', [snapshot])
+            return snapshot
+        cursor.execute('SELECT pg_export_snapshot()')
+        return cursor.fetchone()[0]
+
+
+def export_models(models, using, batch_size, write, snapshot=None):
+    """
+    Reads the rows of each model taken from the queue `models` until it is
+    empty, and calls `write` with `(label, rows)` for each batch.
+    """
+    with transaction.atomic(using=using):
+        if snapshot is not None:
+            start_snapshot(using, snapshot)
+        while True:
+            try:
+                model = models.get_nowait()
+            except queue.Empty:
+                break
+            for rows in iter_rows(model, using, batch_size):
+                write((model._meta.label, rows))
+
+
+def export_in_parallel(models, using, batch_size, jobs, write, snapshot=None):
+    """
+    Reads the rows of `models` on `jobs` threads with connections of their
+    own, and calls `write` with each batch from the calling thread.
+    """
+    pending = queue.Queue()
+    for model in models:
+        pending.put(model)
+    batches = queue.Queue(maxsize=jobs * 2)
+    stop = threading.Event()
+    errors = []
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+        raise BackupError('Export stopped')
+
+    def run():
+        try:
+            export_models(pending, using, batch_size, put, snapshot)
+        except Exception as e:
+            errors.append(e)
+            stop.set()
+        finally:
+            connections[using].close()
+
+    threads = [threading.Thread(target=run) for i in range(jobs)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    try:
+        while True:
+            try:
+                item = batches.get(timeout=0.1)
+            except queue.Empty:
+                if any(thread.is_alive() for thread in threads):
+                    continue
+                # Batches put just before the threads finished
+                if batches.empty():
+                    break
+                item = batches.get()
+            if not errors:
+                write(item)
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+    if errors:
+        raise errors[0]
+
+
+def export_database(output, using=DEFAULT_DB_ALIAS, jobs=DEFAULT_JOBS, batch_size=DEFAULT_BATCH_SIZE, snapshot=None):
+    """
+    Writes the rows of every model of the database `using` to the writable
+    binary file-like object `output`.  `snapshot` is the id of an exported
+    postgres snapshot to read the data from.  Returns a dict mapping model
+    labels to the number of rows written.
+    """
+    connection = connections[using]
+    models = get_models(using)
+    counts = dict((model._meta.label, 0) for model in models)
+
+    def write(record):
+        label, rows = record
+        pickle.dump(('rows', label, rows), output, protocol=PICKLE_PROTOCOL)
+        counts[label] += len(rows)
+
+    pickle.dump({
+        'format': FORMAT,
+        'version': VERSION,
+        'vendor': connection.vendor,
+        'models': [(model._meta.label, get_field_names(model)) for model in models],
+    }, output, protocol=PICKLE_PROTOCOL)
+
+    if jobs <= 1 or len(models) <= 1:
+        pending = queue.Queue()
+        for model in models:
+            pending.put(model)
+        export_models(pending, using, batch_size, write, snapshot)
+    elif connection.vendor == 'postgresql':
+        with transaction.atomic(using=using):
+            snapshot = start_snapshot(using, snapshot)
+            export_in_parallel(models, using, batch_size, jobs, write, snapshot)
+    else:
+        logger.warning("The models of '{0}' are read in separate transactions".format(using))
+        export_in_parallel(models, using, batch_size, jobs, write)
+
+    pickle.dump(('end', counts), output, protocol=PICKLE_PROTOCOL)
+    return counts
+
+
+class RowUnpickler(pickle.Unpickler):
+    """
+    Unpickler which only creates the types listed in `SAFE_GLOBALS`.
+    """
+    def find_class(self, module, name):
+        if (module, name) not in SAFE_GLOBALS:
+            raise pickle.UnpicklingError("Values of type '{0}.{1}' can't be restored".format(module, name))
+        return super(RowUnpickler, self).find_class(module, name)
+
+
+def iter_records(input):
+    """
+    Yields the records of a portable backup read from the readable binary
+    file-like object `input`, starting with its header.
+    """
+    try:
+        header = RowUnpickler(input).load()
+    except EOFError:
+        raise RestoreError('The backup is empty')
+    if not isinstance(header, dict) or header.get('format') != FORMAT:
+        raise RestoreError('The backup is not a portable backup')
+    if header['version'] > VERSION:
+        raise RestoreError('The backup was made by a newer version of backupdb')
+    yield header
+
+    while True:
+        # Each record is pickled on its own, with a memo of its own
+        try:
+            record = RowUnpickler(input).load()
+        except EOFError:
+            raise RestoreError('The backup is incomplete')
+        yield record
+        if record[0] == 'end':
+            return
+
+
+class ModelLoader(object):
+    """
+    Inserts rows of `model` stored with the columns `field_names` into the
+    database `using`.
+    """
+    def __init__(self, model, field_names, using, batch_size):
+        self.model = model
+        self.using = using
+        self.fields = [f for f in model._meta.local_concrete_fields if f.attname in field_names]
+        self.field_names = [f.attname for f in self.fields]
+        self.indexes = [field_names.index(name) for name in self.field_names]
+        self.batch_size = batch_size
+
+        missing = set(field_names) - set(self.field_names)
+        if missing:
+            logger.warning("Ignoring the columns {0} of '{1}', which it doesn't have".format(
+                ', '.join(sorted(missing)), model._meta.label))
+
+    def load(self, rows):
+        objs = [
+            self.model.from_db(self.using, self.field_names, [row[i] for i in self.indexes])
+            for row in rows
+        ]
+        ops = connections[self.using].ops
+        batch_size = max(1, min(self.batch_size, ops.bulk_batch_size(self.fields, objs)))
+        for start in range(0, len(objs), batch_size):
+            # The raw insert of bulk_create, which keeps the values of
+            # auto_now fields and only writes the table of the model
+            self.model._base_manager._insert(
+                objs[start:start + batch_size], fields=self.fields, raw=True, using=self.using)
+
+
+def flush_models(models, using):
+    """
+    Deletes the rows of `models` from the database `using`.
+    """
+    connection = connections[using]
+    tables = [model._meta.db_table for model in models]
+    sql_list = connection.ops.sql_flush(no_style(), tables, reset_sequences=True, allow_cascade=True)
+    connection.ops.execute_sql_flush(sql_list)
+
+
+def load_database(input, using=DEFAULT_DB_ALIAS, flush=False, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Loads the portable backup read from the readable binary file-like object
+    `input` into the database `using`.  With `flush`, the rows of its models
+    are deleted first.  Returns a dict mapping model labels to the number of
+    rows loaded.
+    """
+    connection = connections[using]
+    records = iter_records(input)
+    header = next(records)
+    models = dict((model._meta.label, model) for model in get_models(using))
+
+    loaders = {}
+    for label, field_names in header['models']:
+        if label in models:
+            loaders[label] = ModelLoader(models[label], field_names, using, batch_size)
+        else:
+            logger.warning("Skipping the rows of '{0}', which is not a model of '{1}'".format(label, using))
+
+    counts = dict((label, 0) for label in loaders)
+    with transaction.atomic(using=using):
+        if flush:
+            flush_models(list(models.values()), using)
+
+        with connection.constraint_checks_disabled():
+            for record in records:
+                if record[0] == 'end':
+                    expected = record[1]
+                    break
+                kind, label, rows = record
+                if label in loaders:
+                    loaders[label].load(rows)
+                    counts[label] += len(rows)
+
+        for label, count in counts.items():
+            if count != expected.get(label):
+                raise RestoreError("Read {0} rows of '{1}' instead of {2}".format(count, label, expected.get(label)))
+
+        loaded = [loaders[label].model for label in loaders]
+        connection.check_constraints(table_names=[model._meta.db_table for model in loaded])
+
+        sql_list = connection.ops.sequence_reset_sql(no_style(), loaded)
+        if sql_list:
+            with connection.cursor() as cursor:
+                for sql in sql_list:
+                    cursor.execute(sql)
+    return counts
+
+
+def do_portable_backup(backup_file, using=DEFAULT_DB_ALIAS, show_output=False, compress_threads=1,
+                       compress_level=None, jobs=DEFAULT_JOBS, batch_size=DEFAULT_BATCH_SIZE, snapshot=None):
+    """
+    Makes a portable backup of the database `using`.
+    """
+    compress_cmd = get_compress_cmd(compress_threads, compress_level)
+    r, w = os.pipe()
+    reader = os.fdopen(r, 'rb')
+    writer = os.fdopen(w, 'wb')
+
+    def compress():
+        try:
+            thread.timings = pipe_commands_to_file([compress_cmd], backup_file, show_stderr=show_output, stdin=reader)
+        except Exception as e:
+            thread.error = e
+        finally:
+            reader.close()
+
+    thread = threading.Thread(target=compress)
+    thread.daemon = True
+    thread.timings = []
+    thread.error = None
+    thread.start()
+
+    started = time.time()
+    error = None
+    try:
+        counts = export_database(writer, using=using, jobs=jobs, batch_size=batch_size, snapshot=snapshot)
+    except (DatabaseError, IOError, OSError, pickle.PicklingError) as e:
+        error = BackupError("Could not export '{0}': {1}".format(using, e))
+    except BackupError as e:
+        error = e
+    finally:
+        try:
+            writer.close()
+        except (IOError, OSError):
+            pass
+        thread.join()
+
+    # A failed compression is the cause of a failed write
+    error = thread.error or error
+    if error is not None:
+        if not is_stream(backup_file) and os.path.exists(backup_file):
+            os.remove(backup_file)
+        raise error
+
+    logger.info("Exported {0} rows of {1} models from '{2}'".format(sum(counts.values()), len(counts), using))
+    return thread.timings + [('export', time.time() - started)]
+
+
+@require_backup_exists
+def do_portable_restore(backup_file, using=DEFAULT_DB_ALIAS, drop_tables=False, show_output=False,
+                        decompress_threads=1, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Restores a portable backup into the database `using`.  With
+    `drop_tables`, the rows of its models are deleted first rather than its
+    tables, which the restore needs.
+    """
+    kwargs = {'show_stderr': show_output}
+    decompress_cmds = get_decompress_cmds(backup_file, kwargs, decompress_threads)
+
+    counts = {}
+
+    def load(stream):
+        try:
+            counts.update(load_database(stream, using=using, flush=drop_tables, batch_size=batch_size))
+        except (DatabaseError, pickle.UnpicklingError) as e:
+            raise RestoreError("Could not load '{0}': {1}".format(using, e))
+
+    timings = pipe_commands_to_func(decompress_cmds, load, **kwargs)
+    logger.info("Loaded {0} rows of {1} models into '{2}'".format(sum(counts.values()), len(counts), using))
+    return timings
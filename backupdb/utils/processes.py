@@ -1,7 +1,12 @@
-from subprocess import Popen, PIPE, CalledProcessError
+from subprocess import Popen, PIPE, CalledProcessError, check_output
+import errno
 import logging
 import os
 import shutil
+import threading
+import time
+
+from .resources import LimitedStages
 
 logger = logging.getLogger(__name__)
 
@@ -24,9 +29,80 @@ def get_env_str(env):
     return ' '.join("{0}='{1}'".format(k, v) for k, v in env.items())
 
 
-def pipe_commands(cmds, extra_env=None, show_stderr=False, show_last_stdout=False):
+def is_stream(obj):
+    """
+    Returns True if `obj` is a file-like object rather than a path.
+    """
+    return hasattr(obj, 'read') or hasattr(obj, 'write')
+
+
+def feed_stream(stream, pipe):
+    """
+    Starts a thread which copies the contents of `stream` into `pipe` and
+    closes `pipe` afterwards.  A process which exits before consuming all of
+    its input is not treated as an error here; its exit status is checked by
+    the caller.  Other errors are kept in the `error` attribute of the thread
+    and raised by `join_feeder`.
+    """
+    def run():
+        try:
+            shutil.copyfileobj(stream, pipe)
+        except (IOError, OSError) as e:
+            if e.errno not in (errno.EPIPE, errno.EINVAL):
+                thread.error = e
+        finally:
+            try:
+                pipe.close()
+            except (IOError, OSError):
+                pass
+
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.error = None
+    thread.start()
+    return thread
+
+
+def join_feeder(thread):
+    """
+    Waits for a thread started by `feed_stream` and raises the error it
+    encountered while reading its stream, if any.
+    """
+    thread.join()
+    if thread.error is not None:
+        raise thread.error
+
+
+def wait_processes(processes, started, unchecked=0):
     """
-    Executes the list of commands piping each one into the next.
+    Waits for each of the given processes to exit and returns a list of
+    `(cmd_str, seconds)` tuples with the wall time spent by each stage.
+    Raises CalledProcessError if any process but the first `unchecked` ones
+    exited with a non-zero status.
+    """
+    timings = []
+    error = False
+    for i, (cmd_str, p) in enumerate(processes):
+        if p.stdout:
+            p.stdout.close()
+        if p.wait() != 0 and i >= unchecked:
+            error = True
+        timings.append((cmd_str, time.time() - started))
+    if error:
+        raise CalledProcessError(cmd=cmd_str, returncode=p.returncode)
+    return timings
+
+
+def pipe_commands(cmds, extra_env=None, show_stderr=False, show_last_stdout=False, stdin=None, early_exit=None):
+    """
+    Executes the list of commands piping each one into the next.  If `stdin`
+    is given, it must be a readable binary file-like object whose contents
+    are fed to the first command.  Returns a list of `(cmd_str, seconds)`
+    tuples with the time taken by each stage.
+
+    If `early_exit` is the index of one of the commands, that command may
+    exit before reading all of its input.  The commands before it then fail
+    with a broken pipe, so their exit status is ignored.
     """
     env = extend_env(extra_env) if extra_env else None
     env_str = (get_env_str(extra_env) + ' ') if extra_env else ''
@@ -34,8 +110,9 @@ def pipe_commands(cmds, extra_env=None, show_stderr=False, show_last_stdout=Fals
 
     logger.info('Running `{0}`'.format(' | '.join(cmd_strs)))
 
-    with open('/dev/null', 'w') as NULL:
+    with open('/dev/null', 'w') as NULL, LimitedStages(cmds) as limits:
         # Start processes
+        started = time.time()
         processes = []
         last_i = len(cmds) - 1
         for i, (cmd_str, cmd) in enumerate(zip(cmd_strs, cmds)):
@@ -43,27 +120,38 @@ def pipe_commands(cmds, extra_env=None, show_stderr=False, show_last_stdout=Fals
                 p_stdout = None if show_last_stdout else NULL
             else:
                 p_stdout = PIPE
-            p_stdin = processes[-1][1].stdout if processes else None
+            if processes:
+                p_stdin = processes[-1][1].stdout
+            else:
+                p_stdin = PIPE if stdin is not None else None
             p_stderr = None if show_stderr else NULL
 
-            p = Popen(cmd, env=env, stdout=p_stdout, stdin=p_stdin, stderr=p_stderr)
+            p = Popen(cmd, env=env, stdout=p_stdout, stdin=p_stdin, stderr=p_stderr, preexec_fn=limits[i])
+            if processes:
+                # Only the next process reads the pipe, so that the previous
+                # one gets a broken pipe if the next one exits early
+                processes[-1][1].stdout.close()
             processes.append((cmd_str, p))
 
+        if stdin is not None:
+            feeder = feed_stream(stdin, processes[0][1].stdin)
+
         # Close processes
-        error = False
-        for cmd_str, p in processes:
-            if p.stdout:
-                p.stdout.close()
-            if p.wait() != 0:
-                error = True
-        if error:
-            raise CalledProcessError(cmd=cmd_str, returncode=p.returncode)
+        timings = wait_processes(processes, started, early_exit or 0)
+        if stdin is not None:
+            join_feeder(feeder)
+        return timings
 
 
-def pipe_commands_to_file(cmds, path, extra_env=None, show_stderr=False):
+def pipe_commands_to_file(cmds, path, extra_env=None, show_stderr=False, stdin=None):
     """
     Executes the list of commands piping each one into the next and writing
-    stdout of the last process into a file at the given path.
+    stdout of the last process into a file at the given path.  `path` may
+    also be a writable binary file-like object, in which case the output is
+    written to it and it is left open.  If `stdin` is given, it must be a
+    readable binary file-like object whose contents are fed to the first
+    command.  Returns a list of `(cmd_str, seconds)` tuples with the time
+    taken by each stage.
     """
     env = extend_env(extra_env) if extra_env else None
     env_str = (get_env_str(extra_env) + ' ') if extra_env else ''
@@ -71,26 +159,100 @@ def pipe_commands_to_file(cmds, path, extra_env=None, show_stderr=False):
 
     logger.info('Saving output of `{0}`'.format(' | '.join(cmd_strs)))
 
-    with open('/dev/null', 'w') as NULL:
+    with open('/dev/null', 'w') as NULL, LimitedStages(cmds) as limits:
         # Start processes
+        started = time.time()
         processes = []
-        for cmd_str, cmd in zip(cmd_strs, cmds):
-            p_stdin = processes[-1][1].stdout if processes else None
+        for i, (cmd_str, cmd) in enumerate(zip(cmd_strs, cmds)):
+            if processes:
+                p_stdin = processes[-1][1].stdout
+            else:
+                p_stdin = PIPE if stdin is not None else None
             p_stderr = None if show_stderr else NULL
 
-            p = Popen(cmd, env=env, stdout=PIPE, stdin=p_stdin, stderr=p_stderr)
+            p = Popen(cmd, env=env, stdout=PIPE, stdin=p_stdin, stderr=p_stderr, preexec_fn=limits[i])
             processes.append((cmd_str, p))
 
+        if stdin is not None:
+            feeder = feed_stream(stdin, processes[0][1].stdin)
+
         p_last = processes[-1][1]
 
-        with open(path, 'wb') as f:
-            shutil.copyfileobj(p_last.stdout, f)
+        if is_stream(path):
+            shutil.copyfileobj(p_last.stdout, path)
+            timings = wait_processes(processes, started)
+        else:
+            with open(path, 'wb') as f:
+                shutil.copyfileobj(p_last.stdout, f)
+
+                # Close processes
+                timings = wait_processes(processes, started)
+
+        if stdin is not None:
+            join_feeder(feeder)
+        return timings
+
 
-            # Close processes
-            error = False
+def pipe_commands_to_func(cmds, func, extra_env=None, show_stderr=False, stdin=None):
+    """
+    Executes the list of commands piping each one into the next and calls
+    `func` with stdout of the last process, a readable binary stream.  If
+    `func` raises, the processes are killed.  If `stdin` is given, it must be
+    a readable binary file-like object whose contents are fed to the first
+    command.  Returns a list of `(cmd_str, seconds)` tuples with the time
+    taken by each stage.
+    """
+    env = extend_env(extra_env) if extra_env else None
+    env_str = (get_env_str(extra_env) + ' ') if extra_env else ''
+    cmd_strs = [env_str + ' '.join(cmd) for cmd in cmds]
+
+    logger.info('Reading output of `{0}`'.format(' | '.join(cmd_strs)))
+
+    with open('/dev/null', 'w') as NULL, LimitedStages(cmds) as limits:
+        # Start processes
+        started = time.time()
+        processes = []
+        for i, (cmd_str, cmd) in enumerate(zip(cmd_strs, cmds)):
+            if processes:
+                p_stdin = processes[-1][1].stdout
+            else:
+                p_stdin = PIPE if stdin is not None else None
+            p_stderr = None if show_stderr else NULL
+
+            p = Popen(cmd, env=env, stdout=PIPE, stdin=p_stdin, stderr=p_stderr, preexec_fn=limits[i])
+            processes.append((cmd_str, p))
+
+        if stdin is not None:
+            feeder = feed_stream(stdin, processes[0][1].stdin)
+
+        try:
+            func(processes[-1][1].stdout)
+        except BaseException:
             for cmd_str, p in processes:
-                p.stdout.close()
-                if p.wait() != 0:
-                    error = True
-            if error:
-                raise CalledProcessError(cmd=cmd_str, returncode=p.returncode)
+                if p.poll() is None:
+                    p.kill()
+            for cmd_str, p in processes:
+                if p.stdout:
+                    p.stdout.close()
+                p.wait()
+            raise
+
+        # Close processes
+        timings = wait_processes(processes, started)
+        if stdin is not None:
+            join_feeder(feeder)
+        return timings
+
+
+def get_command_output(cmd, extra_env=None, show_stderr=False):
+    """
+    Executes a single command and returns its stdout decoded as text.
+    """
+    env = extend_env(extra_env) if extra_env else None
+    env_str = (get_env_str(extra_env) + ' ') if extra_env else ''
+
+    logger.info('Running `{0}`'.format(env_str + ' '.join(cmd)))
+
+    with open('/dev/null', 'w') as NULL, LimitedStages([cmd]) as limits:
+        output = check_output(cmd, env=env, stderr=None if show_stderr else NULL, preexec_fn=limits[0])
+    return output.decode('utf-8')
@@ -0,0 +1,413 @@
+"""
+Parallel replay of plain SQL dumps.
+
+Plain dumps made by `pg_dump` and `mysqldump` are normally loaded by a
+single client.  A replay reads the decompressed dump as a stream and splits
+it into blocks, each of which is run by its own client:
+
+* the setup statements at the top of the dump, such as `SET` statements, are
+  repeated at the start of every block,
+* definitions are run by a single client, before the data of the tables
+  they define,
+* the data of each table, a `COPY` block or a run of `INSERT` statements, is
+  spooled to a temporary file and loaded on one of `jobs` clients while the
+  rest of the dump is read,
+* for postgres, the indexes and the primary key, unique, exclusion and
+  check constraints which follow the data are built on `jobs` clients, one
+  table per client at a time, and the remaining statements, such as foreign
+  keys, triggers and grants, are then run by a single client.
+
+`mysqldump` defines indexes along with their table, so mysql dumps have no
+indexes to build once the data is loaded.  Their definitions come between
+the data of two tables instead, and definitions naming a table whose data is
+still loading, such as triggers, wait for it.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import io
+import itertools
+import logging
+import os
+import re
+import shutil
+import tempfile
+import threading
+
+from .commands import (
+    drop_mysql_tables,
+    drop_postgresql_tables,
+    get_decompress_cmds,
+    get_mysql_args,
+    get_postgresql_args,
+    get_postgresql_env,
+    require_backup_exists,
+)
+from .exceptions import RestoreError
+from .processes import pipe_commands, pipe_commands_to_func
+from .sqlfilters import (
+    MYSQL_DELIMITER_RE,
+    PG_COPY_RE,
+    PG_NAME,
+    PG_QUALIFIED_NAME,
+    PG_SETUP_RE,
+    iter_mysql_dump,
+    iter_pg_dump,
+)
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_JOBS = 4
+
+PG_COPY_TABLE_RE = re.compile(r'^COPY\s+({0})'.format(PG_QUALIFIED_NAME), re.IGNORECASE)
+PG_SETVAL_RE = re.compile(r'^SELECT\s+pg_catalog\.setval\(', re.IGNORECASE)
+PG_SET_RE = re.compile(r'^SET\s', re.IGNORECASE)
+PG_INDEX_RE = re.compile(
+    r'^CREATE\s+(?:UNIQUE\s+)?INDEX\s+{0}\s+ON\s+(?:ONLY\s+)?({1})'.format(PG_NAME, PG_QUALIFIED_NAME),
+    re.IGNORECASE,
+)
+PG_TABLE_CONSTRAINT_RE = re.compile(
+    r'^ALTER\s+TABLE\s+(?:ONLY\s+)?({0})\s+ADD\s+CONSTRAINT\s+{1}\s+(?:PRIMARY\s+KEY|UNIQUE|EXCLUDE|CHECK)\b'.format(
+        PG_QUALIFIED_NAME, PG_NAME),
+    re.IGNORECASE,
+)
+PG_STOP_ON_ERROR = '\\set ON_ERROR_STOP on\n'
+
+MYSQL_NAME = r'`(?:[^`]|``)+`'
+MYSQL_NAME_RE = re.compile(MYSQL_NAME)
+MYSQL_SETUP_RE = re.compile(r'^/\*!\d+\s+SET\s', re.IGNORECASE)
+MYSQL_DATA_RE = re.compile(
+    r'^(?:LOCK TABLES\s+({0})\s+WRITE|INSERT INTO\s+({0})|/\*!40000 ALTER TABLE\s+({0})\s+(?:DISABLE|ENABLE) KEYS'
+    r'|UNLOCK TABLES)'.format(MYSQL_NAME),
+    re.IGNORECASE,
+)
+
+
+class Replay(object):
+    """
+    Runs the blocks of a dump as scripts spooled in a temporary directory.
+    `run_script(path)` runs a script with the database client and returns
+    its timings.  `stop_on_error` is written after the setup statements of
+    the scripts which must stop at their first error, for clients which
+    don't do so already.  At most `jobs * 2` blocks of data are spooled at a
+    time.
+    """
+    def __init__(self, run_script, jobs=DEFAULT_JOBS, stop_on_error='', spool_dir=None):
+        self.run_script = run_script
+        self.stop_on_error = stop_on_error
+        self.executor = ThreadPoolExecutor(max_workers=jobs)
+        self.slots = threading.Semaphore(jobs * 2)
+        self.dir = tempfile.mkdtemp(prefix='backupdb-replay-', dir=spool_dir)
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
+
+        self.setup = []
+        self.loads = {}
+        self.failed = []
+        self.timings = []
+
+    def open_script(self, name, stop_on_error=True):
+        """
+        Returns a new script starting with the setup statements of the dump.
+        """
+        file_name = '{0:06d}-{1}.sql'.format(next(self.counter), re.sub(r'\W+', '_', name))
+        script = io.open(
+            os.path.join(self.dir, file_name), 'w', encoding='utf-8', errors='surrogateescape', newline='')
+        script.writelines(self.setup)
+        if stop_on_error:
+            script.write(self.stop_on_error)
+        return script
+
+    def run(self, script):
+        """
+        Runs `script` and waits for it.
+        """
+        script.close()
+        try:
+            self.timings.extend(self.run_script(script.name))
+        finally:
+            os.remove(script.name)
+
+    def submit(self, name, script):
+        """
+        Runs `script` on one of the jobs.  Returns a future.
+        """
+        script.close()
+
+        def run():
+            try:
+                timings = self.run_script(script.name)
+                with self.lock:
+                    self.timings.extend(timings)
+            except Exception as e:
+                logger.error("Could not replay '{0}': {1}".format(name, e))
+                with self.lock:
+                    self.failed.append(name)
+            finally:
+                os.remove(script.name)
+        return self.executor.submit(run)
+
+    def open_data(self, table):
+        """
+        Returns a new script for the data of `table` once fewer than
+        `jobs * 2` are waiting to be loaded.
+        """
+        self.slots.acquire()
+        try:
+            # Stop reading the dump as soon as a block fails
+            self.check()
+            return self.open_script('data-' + table)
+        except Exception:
+            self.slots.release()
+            raise
+
+    def load_data(self, table, script):
+        future = self.submit(table, script)
+        future.add_done_callback(lambda f: self.slots.release())
+        self.loads[table] = future
+
+    def wait_for_data(self, tables=None):
+        """
+        Waits for the data of `tables`, or of every table, to be loaded.
+        Raises RestoreError if a block failed.
+        """
+        if tables is None:
+            tables = list(self.loads)
+        for table in tables:
+            if table in self.loads:
+                self.loads[table].result()
+        self.check()
+
+    def run_parallel(self, blocks):
+        """
+        Runs each of the `(name, statements)` pairs in `blocks` as a script
+        on one of the jobs and waits for them.
+        """
+        futures = []
+        for name, statements in blocks:
+            script = self.open_script(name)
+            script.writelines(statements)
+            futures.append(self.submit(name, script))
+        for future in futures:
+            future.result()
+        self.check()
+
+    def check(self):
+        with self.lock:
+            failed = sorted(self.failed)
+        if failed:
+            raise RestoreError('Could not replay {0}'.format(', '.join(failed)))
+
+    def close(self):
+        self.executor.shutdown()
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+
+def replay_pg_dump(lines, replay):
+    """
+    Replays the lines of a plain PostgreSQL dump with `replay`.
+    """
+    pre_data = None
+    table = None
+    copy = None
+    setvals = []
+    settings = []
+    indexes = {}
+    index_settings = {}
+    post_data = None
+
+    for kind, text in iter_pg_dump(lines):
+        if kind in ('copy', 'copy_end'):
+            copy.write(text)
+            if kind == 'copy_end':
+                if copy is not post_data:
+                    replay.load_data(table, copy)
+                copy = None
+            continue
+        if kind == 'other':
+            continue
+
+        stripped = text.strip()
+        if pre_data is None:
+            if PG_SETUP_RE.match(stripped):
+                replay.setup.append(text)
+                continue
+            # Like a plain restore, definitions don't stop at errors such as
+            # those of the `pg_dump --clean` statements in an empty database
+            pre_data = replay.open_script('pre-data', stop_on_error=False)
+
+        is_copy = PG_COPY_RE.match(stripped)
+        if post_data is None:
+            if is_copy:
+                if table is None:
+                    replay.run(pre_data)
+                table = PG_COPY_TABLE_RE.match(stripped).group(1)
+                copy = replay.open_data(table)
+                copy.write(text)
+                continue
+            if table is None:
+                pre_data.write(text)
+                continue
+            if PG_SETVAL_RE.match(stripped):
+                setvals.append(text)
+                continue
+            post_data = replay.open_script('post-data', stop_on_error=False)
+
+        match = PG_INDEX_RE.match(stripped) or PG_TABLE_CONSTRAINT_RE.match(stripped)
+        if match:
+            # Each table is built with the settings in effect at its place in
+            # the dump
+            statements = indexes.setdefault(match.group(1), [])
+            if index_settings.get(match.group(1)) != len(settings):
+                statements.extend(settings)
+                index_settings[match.group(1)] = len(settings)
+            statements.append(text)
+            continue
+        if PG_SET_RE.match(stripped):
+            settings.append(text)
+        post_data.write(text)
+        if is_copy:
+            copy = post_data
+
+    if table is None and pre_data is not None:
+        # A dump without data
+        replay.run(pre_data)
+    replay.wait_for_data()
+    if setvals:
+        script = replay.open_script('sequences')
+        script.writelines(setvals)
+        replay.run(script)
+    replay.run_parallel(sorted(('post-data-' + name, statements) for name, statements in indexes.items()))
+    if post_data is not None:
+        replay.run(post_data)
+
+
+def replay_mysql_dump(lines, replay):
+    """
+    Replays the lines of a `mysqldump` dump with `replay`.
+    """
+    definitions = None
+    pending = False
+    tables = set()
+    table = None
+    data = None
+
+    for kind, text in iter_mysql_dump(lines):
+        stripped = text.strip()
+        if definitions is None:
+            if kind == 'statement' and MYSQL_SETUP_RE.match(stripped):
+                replay.setup.append(text)
+                continue
+            if kind == 'other' and not MYSQL_DELIMITER_RE.match(stripped):
+                continue
+            definitions = replay.open_script('definitions')
+
+        if kind == 'other':
+            if MYSQL_DELIMITER_RE.match(stripped):
+                if data is not None:
+                    replay.load_data(table, data)
+                    data = None
+                definitions.write(text)
+            elif data is None:
+                definitions.write(text)
+            continue
+
+        match = MYSQL_DATA_RE.match(stripped)
+        if match is None:
+            if data is not None:
+                replay.load_data(table, data)
+                data = None
+            definitions.write(text)
+            pending = True
+            tables.update(MYSQL_NAME_RE.findall(text))
+            continue
+
+        name = match.group(1) or match.group(2) or match.group(3)
+        if data is not None and name is not None and name != table:
+            replay.load_data(table, data)
+            data = None
+        if data is None:
+            if name is None:
+                # UNLOCK TABLES without data
+                continue
+            if pending:
+                # Definitions naming a table which is loading wait for it
+                replay.wait_for_data(tables)
+                replay.run(definitions)
+                definitions = replay.open_script('definitions')
+                pending = False
+                tables.clear()
+            table = name
+            data = replay.open_data(table)
+        data.write(text)
+        if name is None:
+            replay.load_data(table, data)
+            data = None
+
+    if data is not None:
+        replay.load_data(table, data)
+    replay.wait_for_data()
+    if pending:
+        replay.run(definitions)
+    elif definitions is not None:
+        definitions.close()
+
+
+def run_replay(backup_file, replay_func, replay, show_output=False, decompress_threads=1):
+    """
+    Reads the decompressed `backup_file` with `replay_func` and returns the
+    timings of the decompression and of every block.
+    """
+    kwargs = {'show_stderr': show_output}
+    decompress_cmds = get_decompress_cmds(backup_file, kwargs, decompress_threads)
+
+    def read(stream):
+        lines = io.TextIOWrapper(stream, encoding='utf-8', errors='surrogateescape', newline='')
+        replay_func(lines, replay)
+
+    try:
+        timings = pipe_commands_to_func(decompress_cmds, read, **kwargs)
+        return timings + replay.timings
+    finally:
+        replay.close()
+
+
+@require_backup_exists
+def do_postgresql_replay(backup_file, db_config, drop_tables=False, show_output=False, decompress_threads=1,
+                         jobs=DEFAULT_JOBS, spool_dir=None):
+    """
+    Restores a plain PostgreSQL dump by loading the data of its tables and
+    building their indexes on `jobs` connections at once.  Blocks of data
+    waiting to be loaded are spooled in a temporary directory in `spool_dir`.
+    """
+    if drop_tables:
+        drop_postgresql_tables(db_config, show_output)
+
+    env = get_postgresql_env(db_config)
+    args = get_postgresql_args(db_config)
+
+    def run_script(path):
+        cmd = ['psql'] + args[:-1] + ['--file={0}'.format(path), args[-1]]
+        return pipe_commands([cmd], extra_env=env, show_stderr=show_output, show_last_stdout=show_output)
+
+    replay = Replay(run_script, jobs=jobs, stop_on_error=PG_STOP_ON_ERROR, spool_dir=spool_dir)
+    return run_replay(backup_file, replay_pg_dump, replay, show_output, decompress_threads)
+
+
+@require_backup_exists
+def do_mysql_replay(backup_file, db_config, drop_tables=False, show_output=False, decompress_threads=1,
+                    jobs=DEFAULT_JOBS, spool_dir=None):
+    """
+    Restores a `mysqldump` dump by loading the data of its tables on `jobs`
+    connections at once.  Blocks of data waiting to be loaded are spooled in
+    a temporary directory in `spool_dir`.
+    """
+    if drop_tables:
+        drop_mysql_tables(db_config, show_output)
+
+    mysql_cmd = ['mysql'] + get_mysql_args(db_config)
+
+    def run_script(path):
+        with open(path, 'rb') as f:
+            return pipe_commands([mysql_cmd], show_stderr=show_output, show_last_stdout=show_output, stdin=f)
+
+    replay = Replay(run_script, jobs=jobs, spool_dir=spool_dir)
+    return run_replay(backup_file, replay_mysql_dump, replay, show_output, decompress_threads)
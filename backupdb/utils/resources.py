@@ -0,0 +1,266 @@
+"""
+Resource limits for the processes started by backupdb.
+
+Limits are configured by program name in `settings.BACKUPDB_PROCESS_LIMITS`,
+with the limits under `'default'` applying to every program.  Python scripts
+run as a pipeline stage, such as `frames.py`, are named after the script.
+Each process is limited in the child before the program is run:
+
+* `nice`: niceness of the process.  A process which is already nicer than
+  that is left alone.
+* `ionice`: I/O scheduling class, `'idle'`, `'best-effort'` or `'realtime'`,
+  optionally followed by a priority from 0 to 7, e.g. `'best-effort:7'`.
+* `cpus`: CPUs the process may run on, as a list or a string like `'0-3,6'`.
+  CPUs outside of the affinity of the current process are ignored.
+* `cpu_max` and `io_max`: values written to the `cpu.max` and `io.max` files
+  of a transient cgroup v2 created for the process under
+  `settings.BACKUPDB_CGROUP_PARENT`, which must be writable and have the
+  `cpu` and `io` controllers in its `cgroup.subtree_control`.  For example,
+  `'50000 100000'` allows half a CPU and `'8:0 rbps=52428800'` 50MB/s of
+  reads from the device 8:0.  The cgroup is removed once the process exits.
+
+Limits which can't be applied on this system are skipped with a warning.
+"""
+import ctypes
+import errno
+import itertools
+import logging
+import os
+import platform
+import sys
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_STAGE = 'default'
+
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_SHIFT = 13
+IOPRIO_CLASSES = {
+    'realtime': 1,
+    'best-effort': 2,
+    'idle': 3,
+}
+IOPRIO_DEFAULT_LEVEL = 4
+
+SYS_IOPRIO_SET = {
+    'x86_64': 251,
+    'i386': 289,
+    'i686': 289,
+    'aarch64': 30,
+    'armv7l': 314,
+    'ppc64le': 273,
+    's390x': 282,
+}
+
+cgroup_counter = itertools.count()
+
+
+def parse_cpus(value):
+    """
+    Returns the set of CPUs given as a list of numbers or a string like
+    `'0-3,6'`.
+    """
+    if not isinstance(value, str):
+        return set(int(cpu) for cpu in value)
+    cpus = set()
+    for part in value.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        first, _, last = part.partition('-')
+        cpus.update(range(int(first), int(last or first) + 1))
+    return cpus
+
+
+def parse_ionice(value):
+    """
+    Returns the `ioprio` value of an I/O scheduling class given as `'idle'`,
+    `'best-effort'` or `'realtime'`, optionally followed by `:<priority>`.
+    """
+    name, _, level = value.partition(':')
+    if name not in IOPRIO_CLASSES:
+        raise ValueError("Unknown I/O scheduling class '{0}'".format(name))
+    level = int(level) if level else IOPRIO_DEFAULT_LEVEL
+    if not 0 <= level <= 7:
+        raise ValueError('I/O priorities go from 0 to 7, got {0}'.format(level))
+    if name == 'idle':
+        level = 0
+    return IOPRIO_CLASSES[name] << IOPRIO_CLASS_SHIFT | level
+
+
+def get_stage_names(cmd):
+    """
+    Returns the names under which the limits of `cmd` are configured.
+    """
+    names = [os.path.basename(cmd[0])]
+    if cmd[0] == sys.executable and len(cmd) > 1 and cmd[1].endswith('.py'):
+        names.append(os.path.splitext(os.path.basename(cmd[1]))[0])
+    return names
+
+
+def get_limits(cmd, config):
+    """
+    Returns the dict of limits configured in `config` for `cmd`.
+    """
+    limits = dict(config.get(DEFAULT_STAGE, {}))
+    for name in get_stage_names(cmd):
+        limits.update(config.get(name, {}))
+    return limits
+
+
+class Cgroup(object):
+    """
+    Transient cgroup v2 under `parent` holding a single process, with the
+    given `cpu.max` and `io.max` limits.
+    """
+    def __init__(self, parent, cpu_max=None, io_max=None):
+        self.path = os.path.join(parent, 'backupdb-{0}-{1}'.format(os.getpid(), next(cgroup_counter)))
+        os.mkdir(self.path)
+        try:
+            if cpu_max is not None:
+                self.write('cpu.max', cpu_max)
+            if io_max is not None:
+                self.write('io.max', io_max)
+        except (IOError, OSError):
+            self.remove()
+            raise
+        self.procs_file = os.path.join(self.path, 'cgroup.procs')
+
+    def write(self, name, value):
+        with open(os.path.join(self.path, name), 'w') as f:
+            f.write(value)
+
+    def add_self(self):
+        """
+        Moves the calling process into the cgroup.
+        """
+        fd = os.open(self.procs_file, os.O_WRONLY)
+        try:
+            os.write(fd, b'0')
+        finally:
+            os.close(fd)
+
+    def remove(self):
+        try:
+            os.rmdir(self.path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                logger.warning("Could not remove cgroup '{0}': {1}".format(self.path, e))
+
+
+def get_ioprio_set():
+    """
+    Returns a function setting the I/O priority of the calling process, or
+    None if it is not supported here.
+    """
+    number = SYS_IOPRIO_SET.get(platform.machine())
+    if number is None or not sys.platform.startswith('linux'):
+        return None
+    libc = ctypes.CDLL(None, use_errno=True)
+
+    def ioprio_set(ioprio):
+        if libc.syscall(number, IOPRIO_WHO_PROCESS, 0, ioprio) != 0:
+            raise OSError(ctypes.get_errno(), 'ioprio_set failed')
+    return ioprio_set
+
+
+class StageLimits(object):
+    """
+    Limits of a single process, turned into a `preexec_fn` for `Popen`.
+    """
+    def __init__(self, limits, cgroup_parent=None):
+        self.nice = None
+        self.ioprio = None
+        self.ioprio_set = None
+        self.cpus = None
+        self.cgroup = None
+
+        if limits.get('nice') is not None:
+            if hasattr(os, 'setpriority'):
+                self.nice = max(int(limits['nice']), os.getpriority(os.PRIO_PROCESS, 0))
+            else:
+                logger.warning('Process priorities are not supported here')
+
+        if limits.get('ionice') is not None:
+            self.ioprio_set = get_ioprio_set()
+            if self.ioprio_set is not None:
+                self.ioprio = parse_ionice(limits['ionice'])
+            else:
+                logger.warning('I/O priorities are not supported here')
+
+        if limits.get('cpus') is not None:
+            if hasattr(os, 'sched_setaffinity'):
+                self.cpus = parse_cpus(limits['cpus']) & os.sched_getaffinity(0)
+                if not self.cpus:
+                    logger.warning('None of the CPUs {0} are available, ignoring them'.format(limits['cpus']))
+                    self.cpus = None
+            else:
+                logger.warning('CPU affinity is not supported here')
+
+        if limits.get('cpu_max') is not None or limits.get('io_max') is not None:
+            if cgroup_parent is None:
+                logger.warning('cpu_max and io_max require settings.BACKUPDB_CGROUP_PARENT')
+            else:
+                try:
+                    self.cgroup = Cgroup(cgroup_parent, limits.get('cpu_max'), limits.get('io_max'))
+                except (IOError, OSError) as e:
+                    logger.warning('Could not create a cgroup under {0}: {1}'.format(cgroup_parent, e))
+
+    @property
+    def empty(self):
+        return self.nice is None and self.ioprio is None and self.cpus is None and self.cgroup is None
+
+    def apply(self):
+        """
+        Applies the limits to the calling process.  Runs in the child, between
+        fork and exec, so it only makes system calls.
+        """
+        if self.cgroup is not None:
+            self.cgroup.add_self()
+        if self.nice is not None:
+            os.setpriority(os.PRIO_PROCESS, 0, self.nice)
+        if self.ioprio is not None:
+            self.ioprio_set(self.ioprio)
+        if self.cpus is not None:
+            os.sched_setaffinity(0, self.cpus)
+
+    def release(self):
+        if self.cgroup is not None:
+            self.cgroup.remove()
+
+
+class LimitedStages(object):
+    """
+    Context manager holding the limits of each of `cmds`.  Indexing it gives
+    the `preexec_fn` of each command, None for commands without limits.
+    Transient cgroups are removed on exit, which must happen once the
+    processes have exited.
+    """
+    def __init__(self, cmds, config=None, cgroup_parent=None):
+        if config is None:
+            # Imported here as the settings import the modules running
+            # processes
+            from .settings import CGROUP_PARENT, PROCESS_LIMITS
+            config, cgroup_parent = PROCESS_LIMITS, CGROUP_PARENT
+
+        self.stages = []
+        try:
+            for cmd in cmds:
+                limits = get_limits(cmd, config) if config else {}
+                stage = StageLimits(limits, cgroup_parent) if limits else None
+                self.stages.append(stage if stage is not None and not stage.empty else None)
+        except ValueError:
+            self.__exit__()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        for stage in self.stages:
+            if stage is not None:
+                stage.release()
+
+    def __getitem__(self, i):
+        stage = self.stages[i]
+        return stage.apply if stage is not None else None
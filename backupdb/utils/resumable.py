@@ -0,0 +1,367 @@
+"""
+Resumable PostgreSQL backups.
+
+A resumable backup is dumped as a sequence of units into a `<backup>.parts`
+directory next to the backup file:
+
+* the `DROP` statements written by `pg_dump --clean`,
+* the schema (`--section=pre-data`),
+* the data of each table,
+* the values of all sequences and large objects,
+* indexes, constraints and triggers (`--section=post-data`).
+
+Each unit is compressed into a file of its own, written under a temporary
+name and renamed once complete, and recorded in `checkpoint.json`.  All units
+are dumped from the same snapshot, which is exported by a `psql` session kept
+open in the background for `snapshot_ttl` seconds, so that a rerun after a
+failure can skip finished units and still produce a consistent backup.  If the
+snapshot is gone by then, the backup starts over with a new one.  The server
+doesn't notice that a client went away while it sleeps, so the backend of the
+session is terminated from another connection once the snapshot is released.
+
+Compressed units are gzip members, so the final backup file is simply their
+concatenation and can be restored like any other backup.
+"""
+from subprocess import CalledProcessError, PIPE, Popen
+import json
+import logging
+import os
+import shutil
+import signal
+
+from . import sqlfilters
+from .commands import (
+    fsync_dir,
+    get_compress_cmd,
+    get_postgresql_args,
+    get_postgresql_env,
+    get_script_cmd,
+    quote_pg_literal,
+    run_postgresql_sql,
+)
+from .exceptions import BackupError
+from .processes import extend_env, get_command_output, pipe_commands_to_file
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SNAPSHOT_TTL = 24 * 60 * 60
+
+CHECKPOINT_FILE = 'checkpoint.json'
+
+PG_LIST_RELATIONS_SQL = (
+    "SELECT c.relkind, format('%I.%I', n.nspname, c.relname) "
+    "FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace "
+    "WHERE c.relkind IN ('r', 'S') "
+    "AND n.nspname <> 'information_schema' AND n.nspname NOT LIKE 'pg\\_%' "
+    "ORDER BY 2"
+)
+
+
+# Only terminates the backend if it is still a snapshot holder, as process ids
+# of the server are reused
+PG_TERMINATE_HOLDER_SQL = (
+    "SELECT pg_terminate_backend(pid) FROM pg_stat_activity "
+    "WHERE pid = {0} AND query LIKE 'SELECT pg_sleep(%'"
+)
+
+
+class SnapshotExpired(Exception):
+    pass
+
+
+def get_parts_dir(backup_file):
+    return backup_file + '.parts'
+
+
+def write_json_atomically(path, value):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(value, f, indent=2, sort_keys=True)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp_path, path)
+    fsync_dir(os.path.dirname(path) or '.')
+
+
+def read_checkpoint(parts_dir):
+    """
+    Returns the checkpoint stored in `parts_dir` or None if there is none.
+    """
+    try:
+        with open(os.path.join(parts_dir, CHECKPOINT_FILE)) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def open_snapshot_holder(db_config, ttl=DEFAULT_SNAPSHOT_TTL, detach=False):
+    """
+    Starts a `psql` session which exports a snapshot, prints its id, its
+    `txid_current_snapshot()` and the process id of its backend and then
+    keeps its transaction open for `ttl` seconds.  With `detach`, the session runs in its own process group so
+    that it outlives the current process, as the snapshots of resumable
+    backups must.  Otherwise it is killed along with the process group of
+    the caller.  Returns the `Popen` object without waiting for the
+    snapshot, see `read_snapshot_holder`.
+    """
+    env = extend_env(get_postgresql_env(db_config) or {})
+    cmd = ['psql', '-q', '-A', '-t', '-v', 'ON_ERROR_STOP=1'] + get_postgresql_args(db_config)
+    script = (
+        'BEGIN ISOLATION LEVEL REPEATABLE READ READ ONLY;\n'
+        'SELECT pg_export_snapshot(), txid_current_snapshot(), pg_backend_pid();\n'
+        'SELECT pg_sleep({0});\n'
+        'COMMIT;\n'
+    ).format(int(ttl))
+
+    p = Popen(
+        cmd, stdin=PIPE, stdout=PIPE, env=env, preexec_fn=os.setsid if detach else None, universal_newlines=True)
+    p.stdin.write(script)
+    p.stdin.close()
+    return p
+
+
+def read_snapshot_holder(p):
+    """
+    Waits for the session `p` started by `open_snapshot_holder` to export
+    its snapshot.  Returns a tuple `(snapshot_id, txid_snapshot, pid,
+    backend_pid)`.
+    """
+    line = p.stdout.readline().strip()
+    if not line:
+        p.wait()
+        raise CalledProcessError(cmd='psql', returncode=p.returncode)
+    snapshot_id, txid_snapshot, backend_pid = line.split('|')
+    return snapshot_id, txid_snapshot, p.pid, int(backend_pid)
+
+
+def start_snapshot_holder(db_config, ttl=DEFAULT_SNAPSHOT_TTL, detach=False):
+    """
+    Starts a session holding an exported snapshot, see
+    `open_snapshot_holder`.  Returns a tuple `(snapshot_id, pid,
+    backend_pid)`.
+    """
+    snapshot_id, _, pid, backend_pid = read_snapshot_holder(open_snapshot_holder(db_config, ttl, detach))
+    return snapshot_id, pid, backend_pid
+
+
+def terminate_holder_backend(db_config, backend_pid, show_output=False):
+    """
+    Terminates the backend `backend_pid` of a snapshot holder from another
+    connection, which ends its transaction.
+    """
+    try:
+        run_postgresql_sql(
+            db_config, PG_TERMINATE_HOLDER_SQL.format(int(backend_pid)), show_output=show_output, output=True)
+    except (CalledProcessError, OSError) as e:
+        logger.warning('Could not terminate the backend {0} holding a snapshot: {1}'.format(backend_pid, e))
+
+
+def stop_snapshot_holder(pid, db_config=None, backend_pid=None):
+    """
+    Stops the `psql` session `pid` holding a snapshot and terminates its
+    backend `backend_pid` on the server of `db_config`.
+    """
+    if backend_pid is not None and db_config is not None:
+        terminate_holder_backend(db_config, backend_pid)
+    if pid is None:
+        return
+    try:
+        os.kill(pid, signal.SIGTERM)
+    except OSError:
+        pass
+
+
+def get_process_identity(pid):
+    """
+    Returns the start time and command line of the process `pid` as a
+    string, or None if there is no such process.
+    """
+    try:
+        output = get_command_output(['ps', '-o', 'lstart=', '-o', 'args=', '-p', str(pid)])
+    except (CalledProcessError, OSError):
+        return None
+    return output.strip() or None
+
+
+def stop_checkpoint_holder(checkpoint, db_config):
+    """
+    Stops the session holding the snapshot of `checkpoint` if it is still
+    running.  A checkpoint can be days old and its process id reused since,
+    so the process is only signalled if its start time and command line
+    still match the ones recorded with the checkpoint.  The backend of the
+    session is terminated even if the local process is gone.
+    """
+    pid = checkpoint.get('holder_pid')
+    identity = checkpoint.get('holder_identity')
+    if pid is None or identity is None or get_process_identity(pid) != identity:
+        pid = None
+    backend_pid = checkpoint.get('holder_backend_pid')
+    if pid is not None or backend_pid is not None:
+        stop_snapshot_holder(pid, db_config, backend_pid)
+
+
+def list_relations(db_config, snapshot_id, show_output=False):
+    """
+    Returns a tuple `(tables, sequences)` of the names of the tables and
+    sequences visible in the snapshot `snapshot_id`.  Raises SnapshotExpired
+    if the snapshot can no longer be imported.
+    """
+    cmd = ['psql', '-q', '-A', '-t', '-v', 'ON_ERROR_STOP=1'] + get_postgresql_args(db_config) + [
+        '-c', 'BEGIN ISOLATION LEVEL REPEATABLE READ READ ONLY',
+        '-c', 'SET TRANSACTION SNAPSHOT {0}'.format(quote_pg_literal(snapshot_id)),
+        '-c', PG_LIST_RELATIONS_SQL,
+        '-c', 'COMMIT',
+    ]
+    try:
+        output = get_command_output(cmd, extra_env=get_postgresql_env(db_config), show_stderr=show_output)
+    except CalledProcessError:
+        raise SnapshotExpired(snapshot_id)
+
+    tables, sequences = [], []
+    for line in output.splitlines():
+        if not line.strip():
+            continue
+        relkind, name = line.split('|', 1)
+        (sequences if relkind == 'S' else tables).append(name)
+    return tables, sequences
+
+
+def get_units(tables, sequences):
+    """
+    Returns the list of `(name, pg_dump_args)` units of a resumable backup.
+    """
+    units = [
+        ('clean', ['--clean', '--schema-only']),
+        ('pre-data', ['--section=pre-data']),
+    ]
+    for table in tables:
+        units.append(('table {0}'.format(table), ['--section=data', '--table={0}'.format(table)]))
+    units.append(('sequences and large objects', (
+        ['--section=data', '--blobs', '--schema=pg_catalog'] +
+        ['--table={0}'.format(s) for s in sequences]
+    )))
+    units.append(('post-data', ['--section=post-data']))
+    return units
+
+
+def new_checkpoint(db_config, snapshot_ttl, show_output, snapshot=None):
+    """
+    Returns a new checkpoint dumping the database from `snapshot`, which is
+    held by the caller, or from a new snapshot held for `snapshot_ttl`
+    seconds.
+    """
+    if snapshot is not None:
+        snapshot_id, pid, backend_pid = snapshot, None, None
+    else:
+        snapshot_id, pid, backend_pid = start_snapshot_holder(db_config, snapshot_ttl, detach=True)
+    try:
+        tables, sequences = list_relations(db_config, snapshot_id, show_output)
+    except SnapshotExpired:
+        stop_snapshot_holder(pid, db_config, backend_pid)
+        raise BackupError("Could not import the snapshot '{0}' which was just exported".format(snapshot_id))
+    return {
+        'snapshot': snapshot_id,
+        'holder_pid': pid,
+        'holder_identity': get_process_identity(pid) if pid is not None else None,
+        'holder_backend_pid': backend_pid,
+        'units': [{'name': name, 'args': args, 'done': False} for name, args in get_units(tables, sequences)],
+    }
+
+
+def get_unit_cmds(unit_args, db_config, snapshot_id, pg_dump_options=None, compress_threads=1, compress_level=None):
+    """
+    Returns the commands writing the compressed dump of the unit with the
+    `pg_dump` arguments `unit_args` from the snapshot `snapshot_id`.
+    """
+    args = get_postgresql_args(db_config, pg_dump_options)
+    cmds = [['pg_dump', '--snapshot={0}'.format(snapshot_id)] + unit_args + args]
+    if '--clean' in unit_args:
+        cmds.append(get_script_cmd(sqlfilters, 'postgresql', '--only-clean'))
+    cmds.append(get_compress_cmd(compress_threads, compress_level))
+    return cmds
+
+
+def dump_unit(unit, path, db_config, snapshot_id, pg_dump_options, compress_threads, compress_level, show_output):
+    """
+    Dumps `unit` into `path`, writing it under a temporary name first.
+    """
+    env = get_postgresql_env(db_config)
+    cmds = get_unit_cmds(unit['args'], db_config, snapshot_id, pg_dump_options, compress_threads, compress_level)
+
+    tmp_path = path + '.tmp'
+    timings = pipe_commands_to_file(cmds, path=tmp_path, extra_env=env, show_stderr=show_output)
+    with open(tmp_path, 'rb') as f:
+        os.fsync(f.fileno())
+    os.rename(tmp_path, path)
+    return timings
+
+
+def do_postgresql_resumable_backup(backup_file, db_config, pg_dump_options=None, show_output=False,
+                                   compress_threads=1, compress_level=None, snapshot_ttl=DEFAULT_SNAPSHOT_TTL,
+                                   snapshot=None):
+    """
+    Backs up a PostgreSQL database unit by unit, resuming from the checkpoint
+    left by a previous run for the same `backup_file` if its snapshot is
+    still available.  Returns the timings of the units dumped by this run.
+
+    If `snapshot` is given, the database is dumped from this exported
+    snapshot, which must be held by the caller until the backup is done, and
+    a checkpoint from any other snapshot is discarded.
+    """
+    parts_dir = get_parts_dir(backup_file)
+    checkpoint = read_checkpoint(parts_dir)
+
+    if checkpoint is not None and snapshot is not None and checkpoint['snapshot'] != snapshot:
+        logger.warning("Snapshot of '{0}' is not the one requested, starting over".format(backup_file))
+        stop_checkpoint_holder(checkpoint, db_config)
+        checkpoint = None
+
+    if checkpoint is not None:
+        try:
+            list_relations(db_config, checkpoint['snapshot'], show_output)
+        except SnapshotExpired:
+            logger.warning("Snapshot of '{0}' has expired, starting over".format(backup_file))
+            stop_checkpoint_holder(checkpoint, db_config)
+            checkpoint = None
+        else:
+            done = len([u for u in checkpoint['units'] if u['done']])
+            logger.info("Resuming '{0}' after {1} of {2} units".format(
+                backup_file, done, len(checkpoint['units'])))
+
+    if checkpoint is None:
+        # Take the new snapshot before removing any previous units, so they
+        # are kept if the database can't be reached at all
+        checkpoint = new_checkpoint(db_config, snapshot_ttl, show_output, snapshot)
+        shutil.rmtree(parts_dir, ignore_errors=True)
+        os.makedirs(parts_dir)
+        write_json_atomically(os.path.join(parts_dir, CHECKPOINT_FILE), checkpoint)
+
+    timings = []
+    unit_files = []
+    for i, unit in enumerate(checkpoint['units']):
+        path = os.path.join(parts_dir, '{0:06d}.gz'.format(i))
+        unit_files.append(path)
+        if unit['done'] and os.path.exists(path):
+            continue
+
+        logger.debug("Dumping {0}...".format(unit['name']))
+        timings.extend(dump_unit(
+            unit, path, db_config, checkpoint['snapshot'], pg_dump_options, compress_threads, compress_level,
+            show_output))
+        unit['done'] = True
+        write_json_atomically(os.path.join(parts_dir, CHECKPOINT_FILE), checkpoint)
+
+    # Assemble the backup from the units
+    tmp_file = backup_file + '.tmp'
+    with open(tmp_file, 'wb') as out:
+        for path in unit_files:
+            with open(path, 'rb') as f:
+                shutil.copyfileobj(f, out)
+        out.flush()
+        os.fsync(out.fileno())
+    os.rename(tmp_file, backup_file)
+    fsync_dir(os.path.dirname(backup_file) or '.')
+
+    stop_checkpoint_holder(checkpoint, db_config)
+    shutil.rmtree(parts_dir, ignore_errors=True)
+    return timings
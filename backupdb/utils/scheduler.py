@@ -0,0 +1,171 @@
+import json
+import logging
+import random
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class Schedule(object):
+    """
+    Backup schedule for a single database.  Runs are planned every `interval`
+    seconds and each run is delayed by a random amount of up to `jitter`
+    seconds so that databases sharing a server don't all start at once.  No
+    more than `max_jobs` runs of the same database happen at the same time.
+    """
+    def __init__(self, db_name, interval, jitter=0, max_jobs=1, options=None):
+        self.db_name = db_name
+        self.interval = interval
+        self.jitter = jitter
+        self.max_jobs = max_jobs
+        self.options = options or {}
+
+    @classmethod
+    def from_settings(cls, schedules):
+        """
+        Builds a list of schedules from the `BACKUPDB_SCHEDULES` setting.
+        """
+        result = []
+        for db_name, config in sorted(schedules.items()):
+            config = dict(config)
+            result.append(cls(
+                db_name,
+                interval=config.pop('interval'),
+                jitter=config.pop('jitter', 0),
+                max_jobs=config.pop('max_jobs', 1),
+                options=config,
+            ))
+        return result
+
+
+class Scheduler(object):
+    """
+    Runs `run_job(schedule)` for each schedule when it is due in a separate
+    thread, with at most `max_jobs` jobs running in total.  Jobs which are due
+    while their limits are reached are started as soon as a slot frees up.
+    """
+    def __init__(self, schedules, run_job, max_jobs=1, clock=time.time, random=random.random):
+        self.schedules = schedules
+        self.run_job = run_job
+        self.max_jobs = max_jobs
+        self.clock = clock
+        self.random = random
+
+        self.lock = threading.Lock()
+        self.running = {}
+        self.threads = []
+        self.stopped = threading.Event()
+        # Set when a job finishes or the scheduler is stopped
+        self.wakeup = threading.Event()
+
+        now = self.clock()
+        self.slots = dict((s.db_name, now) for s in schedules)
+        self.next_runs = dict((s.db_name, self.get_run_time(s)) for s in schedules)
+
+    def get_run_time(self, schedule):
+        """
+        Returns the time at which the current slot of `schedule` should run.
+        """
+        return self.slots[schedule.db_name] + schedule.jitter * self.random()
+
+    def get_running_count(self):
+        with self.lock:
+            return sum(self.running.values())
+
+    def tick(self):
+        """
+        Starts every job which is due and fits within the concurrency limits.
+        Returns the list of started schedules.
+        """
+        now = self.clock()
+        due = [s for s in self.schedules if self.next_runs[s.db_name] <= now]
+        due.sort(key=lambda s: self.next_runs[s.db_name])
+
+        started = []
+        for schedule in due:
+            with self.lock:
+                if sum(self.running.values()) >= self.max_jobs:
+                    break
+                if self.running.get(schedule.db_name, 0) >= schedule.max_jobs:
+                    continue
+                self.running[schedule.db_name] = self.running.get(schedule.db_name, 0) + 1
+
+            # Plan the next slot from the previous one so that runs don't
+            # drift, skipping any slots which were missed entirely
+            slot = self.slots[schedule.db_name] + schedule.interval
+            while slot + schedule.interval <= now:
+                slot += schedule.interval
+            self.slots[schedule.db_name] = slot
+            self.next_runs[schedule.db_name] = self.get_run_time(schedule)
+
+            thread = threading.Thread(target=self._run, args=(schedule,))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+            started.append(schedule)
+
+        self.threads = [t for t in self.threads if t.is_alive()]
+        return started
+
+    def _run(self, schedule):
+        try:
+            self.run_job(schedule)
+        except Exception:
+            logger.exception("Scheduled backup of '{0}' failed".format(schedule.db_name))
+        finally:
+            with self.lock:
+                self.running[schedule.db_name] -= 1
+            self.wakeup.set()
+
+    def get_sleep_time(self, poll_interval=1.0):
+        """
+        Returns how long to sleep before the next job can possibly be due.
+        Jobs blocked by the concurrency limits can't start before another
+        job finishes, which wakes the scheduler up, so they are left out.
+        """
+        with self.lock:
+            if sum(self.running.values()) >= self.max_jobs:
+                return poll_interval
+            next_runs = [
+                self.next_runs[s.db_name] for s in self.schedules
+                if self.running.get(s.db_name, 0) < s.max_jobs
+            ]
+        if not next_runs:
+            return poll_interval
+        wait = min(next_runs) - self.clock()
+        return max(0, min(wait, poll_interval))
+
+    def run(self, poll_interval=1.0):
+        """
+        Runs jobs until `stop()` is called and then waits for running jobs to
+        finish.
+        """
+        while not self.stopped.is_set():
+            self.tick()
+            self.wakeup.wait(self.get_sleep_time(poll_interval))
+            self.wakeup.clear()
+        self.join()
+
+    def stop(self):
+        self.stopped.set()
+        self.wakeup.set()
+
+    def join(self):
+        for thread in self.threads:
+            thread.join()
+
+
+class ResultLog(object):
+    """
+    Appends the results of scheduled runs to a file as JSON lines.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def record(self, **fields):
+        line = json.dumps(fields, sort_keys=True)
+        with self.lock:
+            with open(self.path, 'a') as f:
+                f.write(line + '\n')
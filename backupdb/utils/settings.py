@@ -1,3 +1,5 @@
+import os
+
 from .commands import (
     do_mysql_backup,
     do_mysql_restore,
@@ -6,31 +8,206 @@ from .commands import (
     do_sqlite_backup,
     do_sqlite_restore,
 )
+from .history import get_mysql_db_size, get_postgresql_db_size, get_sqlite_db_size
+from .pitr import (
+    archive_mysql_logs,
+    archive_postgresql_logs,
+    do_mysql_base_backup,
+    do_mysql_pitr_restore,
+    do_postgresql_base_backup,
+    do_postgresql_pitr_restore,
+)
+from .portable import DEFAULT_BATCH_SIZE, do_portable_backup, do_portable_restore
+from .replay import do_mysql_replay, do_postgresql_replay
+from .subset import DEFAULT_FULL_TABLES
+from .warmup import (
+    DEFAULT_HOT_RELATIONS,
+    do_mysql_warm_up,
+    do_postgresql_warm_up,
+    do_sqlite_warm_up,
+    get_mysql_hot_relations,
+    get_postgresql_hot_relations,
+    get_sqlite_hot_relations,
+)
 from django.conf import settings
 
 
 DEFAULT_BACKUP_DIR = 'backups'
 BACKUP_DIR = getattr(settings, 'BACKUPDB_DIRECTORY', DEFAULT_BACKUP_DIR)
+PG_MAINTENANCE_DB = getattr(settings, 'BACKUPDB_PG_MAINTENANCE_DB', 'postgres')
+PG_MAINTENANCE_WORK_MEM = getattr(settings, 'BACKUPDB_PG_MAINTENANCE_WORK_MEM', '512MB')
+# Seconds for which the snapshot of a resumable postgres backup is kept
+PG_SNAPSHOT_TTL = getattr(settings, 'BACKUPDB_PG_SNAPSHOT_TTL', 24 * 60 * 60)
+# Seconds for which the snapshots of --consistent-snapshot are kept when the
+# duration of the backups can't be predicted
+PG_CONSISTENT_SNAPSHOT_TTL = getattr(settings, 'BACKUPDB_PG_CONSISTENT_SNAPSHOT_TTL', 6 * 60 * 60)
 BACKUP_TIMESTAMP_PATTERN = '*-[0-9][0-9][0-9][0-9]-[0-9][0-9]-[0-9][0-9]-[0-9][0-9][0-9][0-9][0-9][0-9][0-9][0-9][0-9][0-9]'
 BACKUP_CONFIG = {
     'django.db.backends.mysql': {
         'backup_extension': 'mysql',
         'backup_func': do_mysql_backup,
         'restore_func': do_mysql_restore,
+        'warm_up_func': do_mysql_warm_up,
+        'hot_relations_func': get_mysql_hot_relations,
+        'db_size_func': get_mysql_db_size,
+        'base_backup_func': do_mysql_base_backup,
+        'archive_logs_func': archive_mysql_logs,
+        'pitr_restore_func': do_mysql_pitr_restore,
+        'replay_func': do_mysql_replay,
+    },
+    'django.db.backends.postgresql': {
+        'backup_extension': 'pgsql',
+        'backup_func': do_postgresql_backup,
+        'restore_func': do_postgresql_restore,
+        'warm_up_func': do_postgresql_warm_up,
+        'hot_relations_func': get_postgresql_hot_relations,
+        'db_size_func': get_postgresql_db_size,
+        'base_backup_func': do_postgresql_base_backup,
+        'archive_logs_func': archive_postgresql_logs,
+        'pitr_restore_func': do_postgresql_pitr_restore,
+        'replay_func': do_postgresql_replay,
     },
     'django.db.backends.postgresql_psycopg2': {
         'backup_extension': 'pgsql',
         'backup_func': do_postgresql_backup,
         'restore_func': do_postgresql_restore,
+        'warm_up_func': do_postgresql_warm_up,
+        'hot_relations_func': get_postgresql_hot_relations,
+        'db_size_func': get_postgresql_db_size,
+        'base_backup_func': do_postgresql_base_backup,
+        'archive_logs_func': archive_postgresql_logs,
+        'pitr_restore_func': do_postgresql_pitr_restore,
+        'replay_func': do_postgresql_replay,
     },
     'django.contrib.gis.db.backends.postgis': {
         'backup_extension': 'pgsql',
         'backup_func': do_postgresql_backup,
         'restore_func': do_postgresql_restore,
+        'warm_up_func': do_postgresql_warm_up,
+        'hot_relations_func': get_postgresql_hot_relations,
+        'db_size_func': get_postgresql_db_size,
+        'base_backup_func': do_postgresql_base_backup,
+        'archive_logs_func': archive_postgresql_logs,
+        'pitr_restore_func': do_postgresql_pitr_restore,
+        'replay_func': do_postgresql_replay,
     },
     'django.db.backends.sqlite3': {
         'backup_extension': 'sqlite',
         'backup_func': do_sqlite_backup,
         'restore_func': do_sqlite_restore,
+        'warm_up_func': do_sqlite_warm_up,
+        'hot_relations_func': get_sqlite_hot_relations,
+        'db_size_func': get_sqlite_db_size,
+        'base_backup_func': None,
+        'archive_logs_func': None,
+        'pitr_restore_func': None,
+        'replay_func': None,
     },
 }
+
+# Backups made through the Django ORM with `backupdb --portable`, which can be
+# restored into a database of any engine with `restoredb --portable`
+PORTABLE_CONFIG = {
+    'backup_extension': 'portable',
+    'backup_func': do_portable_backup,
+    'restore_func': do_portable_restore,
+    'replay_func': None,
+}
+
+# Number of rows read and inserted at a time by portable backups and restores
+PORTABLE_BATCH_SIZE = getattr(settings, 'BACKUPDB_PORTABLE_BATCH_SIZE', DEFAULT_BATCH_SIZE)
+
+# Tables copied in full into subset backups made with `backupdb
+# --subset-root`, in addition to the rows selected from the roots.  Tables
+# which don't exist in a database are ignored.
+SUBSET_FULL_TABLES = getattr(settings, 'BACKUPDB_SUBSET_FULL_TABLES', DEFAULT_FULL_TABLES)
+
+# Number of the most used tables and indexes which `backupdb --capture-hot`
+# saves next to backups, to be loaded into the cache by `restoredb --prewarm`
+HOT_RELATIONS = getattr(settings, 'BACKUPDB_HOT_RELATIONS', DEFAULT_HOT_RELATIONS)
+
+# Directory holding a base backup archive for point-in-time recovery of each
+# database, written by `backupdb --base-backup` and `backupdb --archive-logs`
+# and read by `restoredb --until`
+PITR_DIR = getattr(settings, 'BACKUPDB_PITR_DIRECTORY', os.path.join(BACKUP_DIR, 'pitr'))
+
+# Other destinations to which `backupdb` writes a copy of each backup while
+# making it, as directories or as dicts with the Django `storage` to save to,
+# an alias of settings.STORAGES or a dotted path to a storage class with its
+# `options`, and an optional `prefix`.  Example:
+#
+#   BACKUPDB_COPY_DESTINATIONS = ['/mnt/second-disk/backups', {'storage': 'offsite', 'prefix': 'db/'}]
+COPY_DESTINATIONS = getattr(settings, 'BACKUPDB_COPY_DESTINATIONS', [])
+
+# Bytes buffered for each destination of a backup, and seconds after which a
+# destination which accepts no data is given up on
+COPY_BUFFER_SIZE = getattr(settings, 'BACKUPDB_COPY_BUFFER_SIZE', 64 * 1024 * 1024)
+COPY_STALL_TIMEOUT = getattr(settings, 'BACKUPDB_COPY_STALL_TIMEOUT', 300)
+
+# Directory holding the index of the restored copies kept by `restoredb
+# --cache`, and the copies of sqlite databases, and the maximum number of
+# bytes which the copies take up before the least recently used are removed
+RESTORE_CACHE_DIR = getattr(settings, 'BACKUPDB_RESTORE_CACHE_DIR', os.path.join(BACKUP_DIR, 'restore-cache'))
+RESTORE_CACHE_SIZE = getattr(settings, 'BACKUPDB_RESTORE_CACHE_SIZE', 10 * 1024 ** 3)
+
+# Resource limits of the processes started while backing up and restoring,
+# by program name, with the limits of all programs under 'default'.  See
+# `backupdb.utils.resources` for the available limits.  Example:
+#
+#   BACKUPDB_PROCESS_LIMITS = {
+#       'default': {'nice': 10, 'ionice': 'idle'},
+#       'gzip': {'nice': 19, 'cpus': '2-3'},
+#       'pg_dump': {'cpu_max': '50000 100000'},
+#   }
+PROCESS_LIMITS = getattr(settings, 'BACKUPDB_PROCESS_LIMITS', {})
+
+# Writable cgroup v2 directory under which a transient cgroup is created for
+# each process with a `cpu_max` or `io_max` limit
+CGROUP_PARENT = getattr(settings, 'BACKUPDB_CGROUP_PARENT', None)
+
+# Mapping of database names to backup schedules used by the `backupdbd`
+# command.  Example:
+#
+#   BACKUPDB_SCHEDULES = {
+#       'default': {'interval': 24 * 60 * 60, 'jitter': 30 * 60},
+#   }
+BACKUP_SCHEDULES = getattr(settings, 'BACKUPDB_SCHEDULES', {})
+DAEMON_MAX_JOBS = getattr(settings, 'BACKUPDB_DAEMON_MAX_JOBS', 1)
+DAEMON_RESULTS_FILE = getattr(
+    settings,
+    'BACKUPDB_DAEMON_RESULTS_FILE',
+    os.path.join(BACKUP_DIR, 'backupdbd-results.jsonl'),
+)
+
+# Sizes and durations of past backups made by `backupdb`, used to predict the
+# next ones with `backupdb --estimate`
+HISTORY_FILE = getattr(
+    settings,
+    'BACKUPDB_HISTORY_FILE',
+    os.path.join(BACKUP_DIR, 'backupdb-history.jsonl'),
+)
+
+# Maximum number of seconds which a `backupdb` run is predicted to take before
+# it warns, or refuses to start with --enforce-estimate.  None means no limit.
+MAX_DURATION = getattr(settings, 'BACKUPDB_MAX_DURATION', None)
+
+# Report of the last backup audit written by the `auditbackups` command
+AUDIT_REPORT_FILE = getattr(
+    settings,
+    'BACKUPDB_AUDIT_REPORT_FILE',
+    os.path.join(BACKUP_DIR, 'backupdb-audit.jsonl'),
+)
+
+# Maximum number of backups or restores run against the same database server
+# (the same HOST and PORT) at the same time by `backupdb --jobs` and
+# `restoredb --jobs`.  None means only the number of jobs limits them.
+MAX_JOBS_PER_HOST = getattr(settings, 'BACKUPDB_MAX_JOBS_PER_HOST', None)
+
+# Restore ordering used by `restoredb`.  Databases only start restoring once
+# the databases they depend on have been restored, and databases with a
+# higher priority start first.  Example:
+#
+#   BACKUPDB_RESTORE_DEPENDENCIES = {'billing': ['default']}
+#   BACKUPDB_RESTORE_PRIORITIES = {'default': 10}
+RESTORE_DEPENDENCIES = getattr(settings, 'BACKUPDB_RESTORE_DEPENDENCIES', {})
+RESTORE_PRIORITIES = getattr(settings, 'BACKUPDB_RESTORE_PRIORITIES', {})
@@ -0,0 +1,357 @@
+"""
+Writing a backup to several destinations while it is being made.
+
+A `FanOut` is a writable file-like object which can be given to
+`pipe_commands_to_file` in place of a path.  Each chunk written to it is
+queued for every sink, and each sink is written by its own thread, so the
+dump is only read once however many copies are made.
+
+Each sink buffers at most `buffer_size` bytes.  A sink whose buffer is full
+holds up the others until it accepts more data; one which accepts nothing
+for `stall_timeout` seconds is given up on, and the others carry on without
+it.  Sinks write to a temporary name and only appear under their final name
+once all the data has been written, so a failed copy leaves nothing behind.
+"""
+import collections
+import logging
+import os
+import tempfile
+import threading
+import time
+
+from django.utils.module_loading import import_string
+
+from .commands import fsync_dir, get_umask
+from .exceptions import BackupError
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUFFER_SIZE = 64 * 1024 * 1024
+DEFAULT_STALL_TIMEOUT = 300
+
+
+class Sink(object):
+    """
+    Destination of a copy of a backup.  `open`, `write`, `close` and `abort`
+    are called from the thread of the sink.
+    """
+    name = None
+
+    def open(self):
+        pass
+
+    def write(self, data):
+        raise NotImplementedError
+
+    def close(self):
+        """
+        Makes the data written so far available under the name of the sink.
+        """
+        pass
+
+    def abort(self):
+        """
+        Discards the data written so far.
+        """
+        pass
+
+    def remove(self):
+        """
+        Removes the data made available by `close`.
+        """
+        pass
+
+
+class FileSink(Sink):
+    """
+    Writes to the file at `path`, through a temporary file next to it.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.name = path
+        self.file = None
+
+    def open(self):
+        dir = os.path.dirname(os.path.abspath(self.path))
+        # Volumes of the same backup are copied from several threads
+        os.makedirs(dir, exist_ok=True)
+        fd, self.temp_file = tempfile.mkstemp(
+            dir=dir,
+            prefix='.{0}.'.format(os.path.basename(self.path)),
+            suffix='.part',
+        )
+        # Give the file the permissions of a file created by open()
+        os.fchmod(fd, 0o666 & ~get_umask())
+        self.file = os.fdopen(fd, 'wb')
+
+    def write(self, data):
+        self.file.write(data)
+
+    def close(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        os.replace(self.temp_file, self.path)
+        fsync_dir(os.path.dirname(os.path.abspath(self.path)))
+
+    def abort(self):
+        if self.file is not None:
+            self.file.close()
+            if os.path.exists(self.temp_file):
+                os.remove(self.temp_file)
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class StorageSink(Sink):
+    """
+    Saves the data as `name` in the Django storage `storage`.  The storage
+    reads the data from a pipe while it is being written.  Storages which
+    need the size of the file up front can't be used.
+    """
+    def __init__(self, storage, name):
+        self.storage = storage
+        self.name = '{0}:{1}'.format(type(storage).__name__, name)
+        self.storage_name = name
+        self.pipe = None
+        self.saver = None
+
+    def open(self):
+        from django.core.files import File
+
+        r, w = os.pipe()
+        self.pipe = os.fdopen(w, 'wb')
+        reader = os.fdopen(r, 'rb')
+        self.saver = threading.Thread(target=self.save, args=(File(reader, self.storage_name),))
+        self.saver.daemon = True
+        self.saver.error = None
+        self.saver.start()
+
+    def save(self, content):
+        try:
+            self.storage_name = self.storage.save(self.storage_name, content)
+        except Exception as e:
+            self.saver.error = e
+        finally:
+            content.close()
+
+    def write(self, data):
+        try:
+            self.pipe.write(data)
+        except (IOError, OSError):
+            # The storage stopped reading, most likely because it failed
+            self.pipe = None
+            self.saver.join()
+            raise self.saver.error or BackupError('The storage stopped reading')
+
+    def close(self):
+        self.pipe.close()
+        self.saver.join()
+        if self.saver.error is not None:
+            raise self.saver.error
+
+    def abort(self):
+        if self.saver is None:
+            return
+        if self.pipe is not None:
+            try:
+                self.pipe.close()
+            except (IOError, OSError):
+                pass
+            self.saver.join()
+        if self.saver.error is None and self.storage.exists(self.storage_name):
+            self.storage.delete(self.storage_name)
+
+    def remove(self):
+        if self.storage.exists(self.storage_name):
+            self.storage.delete(self.storage_name)
+
+
+SinkResult = collections.namedtuple('SinkResult', ['name', 'bytes', 'error'])
+
+
+class SinkWriter(object):
+    """
+    Thread writing the chunks queued by a `FanOut` into a single sink.
+    """
+    def __init__(self, sink, buffer_size, stall_timeout):
+        self.sink = sink
+        self.buffer_size = buffer_size
+        self.stall_timeout = stall_timeout
+        self.chunks = collections.deque()
+        self.buffered = 0
+        self.written = 0
+        self.writing = False
+        self.closed = False
+        self.done = False
+        self.error = None
+        self.condition = threading.Condition()
+
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def fail(self, error):
+        """
+        Gives up on the sink.  Must be called with the condition held.
+        """
+        if self.error is None:
+            self.error = error
+        self.chunks.clear()
+        self.buffered = 0
+        self.condition.notify_all()
+
+    def wait_for_progress(self, ready):
+        """
+        Waits until `ready()` returns True, giving up on the sink if it
+        writes nothing for `stall_timeout` seconds.  Must be called with the
+        condition held.
+        """
+        written = self.written
+        deadline = time.time() + self.stall_timeout
+        while not ready() and self.error is None:
+            if self.written != written:
+                written = self.written
+                deadline = time.time() + self.stall_timeout
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                self.fail(BackupError('Accepted no data for {0} seconds'.format(self.stall_timeout)))
+                break
+            self.condition.wait(remaining)
+
+    def put(self, data):
+        with self.condition:
+            # A chunk larger than the whole buffer is let through alone
+            self.wait_for_progress(lambda: not self.buffered or self.buffered + len(data) <= self.buffer_size)
+            if self.error is None:
+                self.chunks.append(data)
+                self.buffered += len(data)
+                self.condition.notify_all()
+
+    def run(self):
+        try:
+            self.sink.open()
+            while True:
+                with self.condition:
+                    while not self.chunks and not self.closed and self.error is None:
+                        self.condition.wait()
+                    if self.error is not None or not self.chunks:
+                        break
+                    data = self.chunks.popleft()
+                    self.writing = True
+                self.sink.write(data)
+                with self.condition:
+                    self.writing = False
+                    if self.error is None:
+                        self.buffered -= len(data)
+                        self.written += len(data)
+                    self.condition.notify_all()
+
+            if self.error is None:
+                self.sink.close()
+            else:
+                self.sink.abort()
+        except Exception as e:
+            with self.condition:
+                self.writing = False
+                self.fail(e)
+            try:
+                self.sink.abort()
+            except Exception as e:
+                logger.debug("Could not clean up '{0}': {1}".format(self.sink.name, e))
+        finally:
+            with self.condition:
+                self.done = True
+                self.condition.notify_all()
+
+    def finish(self):
+        """
+        Waits for the sink to write its buffer and returns a `SinkResult`.
+        """
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+            self.wait_for_progress(lambda: self.done)
+            # A failed sink cleans up after itself, unless it is stuck writing,
+            # in which case it is left to its daemon thread
+            while not self.done and not self.writing:
+                self.condition.wait()
+        return SinkResult(self.sink.name, self.written, self.error)
+
+
+class FanOut(object):
+    """
+    Writable binary file-like object copying its data into each of `sinks`.
+    The first sink is required: `close` raises BackupError if it failed,
+    while failures of the other sinks are only reported.
+    """
+    def __init__(self, sinks, buffer_size=DEFAULT_BUFFER_SIZE, stall_timeout=DEFAULT_STALL_TIMEOUT):
+        self.writers = [SinkWriter(sink, buffer_size, stall_timeout) for sink in sinks]
+        self.results = None
+
+    def write(self, data):
+        for writer in self.writers:
+            writer.put(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        """
+        Waits for the sinks to write all the data and returns a `SinkResult`
+        for each of them.
+        """
+        if self.results is None:
+            self.results = [writer.finish() for writer in self.writers]
+            for result in self.results:
+                if result.error is None:
+                    logger.info("Wrote {0} bytes to '{1}'".format(result.bytes, result.name))
+                else:
+                    logger.warning("Could not write to '{0}': {1}".format(result.name, result.error))
+
+        if self.results and self.results[0].error is not None:
+            raise BackupError("Could not write to '{0}': {1}".format(self.results[0].name, self.results[0].error))
+        return self.results
+
+    def abort(self):
+        """
+        Discards the data of the sinks which have not finished writing it.
+        """
+        for writer in self.writers:
+            with writer.condition:
+                writer.fail(BackupError('Aborted'))
+            writer.finish()
+
+
+def get_sink(destination, file_name):
+    """
+    Returns the sink writing `file_name` to `destination`, which is either a
+    directory or a dict with the Django `storage` to save to, as an alias of
+    settings.STORAGES or a dotted path to a storage class, and optionally the
+    `prefix` of the name it is saved as.
+    """
+    if not isinstance(destination, dict):
+        return FileSink(os.path.join(destination, file_name))
+
+    from django.core.files.storage import storages
+
+    storage = destination['storage']
+    if '.' in storage:
+        storage = import_string(storage)(**destination.get('options', {}))
+    else:
+        storage = storages[storage]
+    return StorageSink(storage, destination.get('prefix', '') + file_name)
+
+
+def get_fan_out(backup_file, destinations, buffer_size=DEFAULT_BUFFER_SIZE,
+                stall_timeout=DEFAULT_STALL_TIMEOUT):
+    """
+    Returns a `FanOut` writing to `backup_file` and to a file of the same
+    name in each of `destinations`.
+    """
+    file_name = os.path.basename(backup_file)
+    sinks = [FileSink(backup_file)] + [get_sink(d, file_name) for d in destinations]
+    return FanOut(sinks, buffer_size=buffer_size, stall_timeout=stall_timeout)
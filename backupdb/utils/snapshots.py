@@ -0,0 +1,132 @@
+"""
+Consistent snapshots of several PostgreSQL databases.
+
+Each database is dumped from a snapshot exported by a `psql` session which is
+kept open until all backups are done, see `resumable.open_snapshot_holder`.
+An exported snapshot can only be imported in the database it was taken in, so
+the databases of a server each get their own session.  These are started
+together and their `txid_current_snapshot()` compared: transaction ids are
+shared by all databases of a server, so sessions with the same transaction
+snapshot see exactly the same committed transactions.  When a transaction
+commits between two of them, all sessions of the server are taken again.
+
+The sessions are killed along with the process group of the backup and keep
+their transactions open for no longer than the backups are expected to take,
+see `get_snapshot_ttl`, since an open transaction holds back the cleanup of
+the whole server.  Their backends are terminated when the snapshots are
+released, as the server would otherwise keep them until the end of the TTL.
+"""
+from collections import OrderedDict
+from subprocess import CalledProcessError
+import logging
+
+from .commands import get_db_host
+from .exceptions import BackupError
+from .resumable import DEFAULT_SNAPSHOT_TTL, open_snapshot_holder, read_snapshot_holder, stop_snapshot_holder
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_ATTEMPTS = 10
+
+# Bounds of the number of seconds for which snapshots are held
+MIN_TTL = 10 * 60
+DEFAULT_TTL = 6 * 60 * 60
+
+
+def get_snapshot_ttl(expected_duration=None, max_duration=None, default=DEFAULT_TTL):
+    """
+    Returns the number of seconds for which to hold the snapshots of backups
+    expected to take `expected_duration` seconds and allowed to take
+    `max_duration` seconds: twice the expected duration or the allowed one,
+    whichever is longer, or `default` if neither is known.
+    """
+    bounds = []
+    if expected_duration is not None:
+        bounds.append(expected_duration * 2)
+    if max_duration is not None:
+        bounds.append(max_duration)
+    if not bounds:
+        return default
+    return int(max(max(bounds), MIN_TTL))
+
+
+def group_by_server(databases):
+    """
+    Returns an ordered dict mapping `(host, port)` tuples to the list of
+    `(db_name, db_config)` tuples of `databases` on that server.
+    """
+    servers = OrderedDict()
+    for db_name, db_config in databases:
+        servers.setdefault(get_db_host(db_config), []).append((db_name, db_config))
+    return servers
+
+
+def start_snapshot_holders(databases, ttl=DEFAULT_SNAPSHOT_TTL):
+    """
+    Starts one snapshot holder for each of `databases` at the same time.
+    Returns a dict mapping database names to `(snapshot_id, txid_snapshot,
+    pid, backend_pid)` tuples.  Raises BackupError if one of them could not be started,
+    after stopping the others.
+    """
+    processes = [(db_name, open_snapshot_holder(db_config, ttl)) for db_name, db_config in databases]
+
+    holders, failed = {}, []
+    for db_name, p in processes:
+        try:
+            holders[db_name] = read_snapshot_holder(p)
+        except CalledProcessError:
+            failed.append(db_name)
+    if failed:
+        release_snapshots(holders, databases)
+        raise BackupError('Could not export a snapshot of {0}'.format(
+            ', '.join("'{0}'".format(db_name) for db_name in failed)))
+    return holders
+
+
+def take_server_snapshots(databases, ttl=DEFAULT_SNAPSHOT_TTL, attempts=DEFAULT_ATTEMPTS):
+    """
+    Exports snapshots of `databases`, which are on the same server, showing
+    the same committed transactions, trying up to `attempts` times.  Returns
+    the last dict returned by `start_snapshot_holders`, with a warning if
+    the snapshots still differ.
+    """
+    attempts = max(1, attempts)
+    for attempt in range(attempts):
+        holders = start_snapshot_holders(databases, ttl)
+        if len(set(holder[1] for holder in holders.values())) <= 1:
+            return holders
+        logger.debug('Transactions were committed while taking snapshots, trying again')
+        if attempt < attempts - 1:
+            release_snapshots(holders, databases)
+
+    logger.warning('Could not take snapshots of {0} at the same instant, their backups may not match'.format(
+        ', '.join("'{0}'".format(db_name) for db_name, _ in databases)))
+    return holders
+
+
+def take_snapshots(databases, ttl=DEFAULT_SNAPSHOT_TTL, attempts=DEFAULT_ATTEMPTS):
+    """
+    Exports one snapshot for each of the PostgreSQL `databases`, the
+    snapshots of databases on the same server being taken at the same
+    instant.  Returns a dict mapping database names to `(snapshot_id,
+    txid_snapshot, pid, backend_pid)` tuples, which must be passed to
+    `release_snapshots` along with `databases` once the backups are done.
+    """
+    snapshots = {}
+    try:
+        for server_databases in group_by_server(databases).values():
+            snapshots.update(take_server_snapshots(server_databases, ttl, attempts))
+    except BackupError:
+        release_snapshots(snapshots, databases)
+        raise
+    return snapshots
+
+
+def release_snapshots(snapshots, databases):
+    """
+    Stops the sessions holding `snapshots` of `databases` and terminates
+    their backends.
+    """
+    db_configs = dict(databases)
+    for db_name, (_, _, pid, backend_pid) in snapshots.items():
+        stop_snapshot_holder(pid, db_configs[db_name], backend_pid)
@@ -0,0 +1,555 @@
+"""
+Stream filters for plain SQL dumps.
+
+The filters read a dump from stdin and write a rewritten dump to stdout, so
+they can run as a stage between decompression and the database client.  Like
+`frames`, this module only depends on the standard library and can be run as
+a script::
+
+    gunzip -c default.pgsql.gz | python sqlfilters.py postgresql --strip-clean | psql
+    gunzip -c default.pgsql.gz | python sqlfilters.py postgresql --deferred-file=fks.sql | psql
+    gunzip -c default.mysql.gz | python sqlfilters.py mysql --bulk-load | mysql
+"""
+from __future__ import print_function
+import argparse
+import errno
+import fcntl
+import io
+import os
+import re
+import select
+import sys
+import time
+
+PG_TOKEN_RE = re.compile(r"""'|"|\$[A-Za-z_][A-Za-z_0-9]*\$|\$\$|--|/\*|\*/|;""")
+PG_COPY_RE = re.compile(r'^COPY\s.*\sFROM\s+stdin;\s*$', re.IGNORECASE | re.DOTALL)
+PG_COPY_END = '\\.'
+
+
+class ScanState(object):
+    """
+    Tracks whether the scanner is inside a quoted string, quoted identifier,
+    dollar-quoted string or block comment across lines.
+    """
+    def __init__(self):
+        self.quote = None
+        self.comment_depth = 0
+
+    def at_top_level(self):
+        return self.quote is None and self.comment_depth == 0
+
+
+def scan_pg_line(line, state):
+    """
+    Updates `state` with the tokens found in `line` and returns True if the
+    line ends a statement.
+    """
+    last_semicolon = False
+    for match in PG_TOKEN_RE.finditer(line):
+        token = match.group()
+        if state.comment_depth:
+            if token == '/*':
+                state.comment_depth += 1
+            elif token == '*/':
+                state.comment_depth -= 1
+        elif state.quote is not None:
+            if token == state.quote:
+                state.quote = None
+        elif token == '--':
+            break
+        elif token == '/*':
+            state.comment_depth = 1
+            last_semicolon = False
+        elif token == ';':
+            last_semicolon = True
+        elif token != '*/':
+            state.quote = token
+            last_semicolon = False
+    return last_semicolon and state.at_top_level() and line.rstrip().endswith(';')
+
+
+def iter_pg_dump(lines):
+    """
+    Splits the lines of a plain PostgreSQL dump into items.  Yields
+    `('statement', text)` for each SQL statement including its trailing
+    newline, `('copy', line)` for each data line of a `COPY ... FROM stdin`
+    block, `('copy_end', line)` for the line ending such a block and
+    `('other', line)` for blank lines and comments between statements.
+    """
+    state = ScanState()
+    statement = []
+    in_copy = False
+    for line in lines:
+        if in_copy:
+            if line.rstrip('\r\n') == PG_COPY_END:
+                in_copy = False
+                yield 'copy_end', line
+            else:
+                yield 'copy', line
+            continue
+
+        if not statement and state.at_top_level():
+            stripped = line.strip()
+            if not stripped or stripped.startswith('--'):
+                yield 'other', line
+                continue
+
+        statement.append(line)
+        if scan_pg_line(line, state):
+            text = ''.join(statement)
+            statement = []
+            yield 'statement', text
+            if PG_COPY_RE.match(text.strip()):
+                in_copy = True
+
+    if statement:
+        yield 'statement', ''.join(statement)
+
+
+PG_CLEAN_RE = re.compile(r'^(DROP\s|ALTER\s.*\sDROP\s)', re.IGNORECASE | re.DOTALL)
+PG_SETUP_RE = re.compile(r'^(SET\s|SELECT\s+pg_catalog\.set_config\()', re.IGNORECASE)
+
+
+def strip_pg_clean(items):
+    """
+    Removes the `DROP` statements which `pg_dump --clean` writes before any
+    object is created.  They fail when the dump is loaded into an empty
+    database.
+    """
+    cleaning = True
+    for kind, text in items:
+        if cleaning and kind == 'statement':
+            stripped = text.strip()
+            if PG_CLEAN_RE.match(stripped):
+                continue
+            if not PG_SETUP_RE.match(stripped):
+                cleaning = False
+        yield kind, text
+
+
+def only_pg_clean(items):
+    """
+    Keeps only the setup and `DROP` statements which `pg_dump --clean` writes
+    before any object is created, so they can be run on their own.
+    """
+    for kind, text in items:
+        if kind == 'statement':
+            stripped = text.strip()
+            if not PG_CLEAN_RE.match(stripped) and not PG_SETUP_RE.match(stripped):
+                return
+        yield kind, text
+
+
+PG_NAME = r'(?:"(?:[^"]|"")+"|[A-Za-z_][A-Za-z_0-9$]*)'
+PG_QUALIFIED_NAME = r'{0}(?:\.{0})?'.format(PG_NAME)
+PG_CREATE_TABLE_RE = re.compile(r'^CREATE TABLE\s+({0})'.format(PG_QUALIFIED_NAME), re.IGNORECASE)
+PG_PARTITION_RE = re.compile(r'\bPARTITION\s+(BY|OF)\b', re.IGNORECASE)
+PG_FOREIGN_KEY_RE = re.compile(
+    r'^ALTER TABLE\s+(?:ONLY\s+)?({0})\s+ADD CONSTRAINT\s+({1})\s+FOREIGN KEY\b'.format(PG_QUALIFIED_NAME, PG_NAME),
+    re.IGNORECASE,
+)
+
+
+def pg_bulk_load(items, deferred, unlogged=False):
+    """
+    Adds the foreign keys of a plain PostgreSQL dump as `NOT VALID`, so rows
+    aren't checked while they are loaded, and writes the statements validating
+    them to the stream `deferred`.
+
+    With `unlogged`, tables are created as `UNLOGGED` and the statements
+    making them logged again are written to `deferred` as well.  Foreign keys
+    between logged and unlogged tables aren't allowed, so the foreign keys are
+    then moved to `deferred` after those statements.  Partitioned tables and
+    partitions are left alone.
+    """
+    partitioned = set()
+    tables = []
+    foreign_keys = []
+    validations = []
+    for kind, text in items:
+        if kind == 'statement':
+            match = PG_CREATE_TABLE_RE.match(text)
+            if match:
+                if PG_PARTITION_RE.search(text):
+                    partitioned.add(match.group(1))
+                elif unlogged:
+                    text = 'CREATE UNLOGGED TABLE' + text[len('CREATE TABLE'):]
+                    tables.append(match.group(1))
+
+            match = PG_FOREIGN_KEY_RE.match(text)
+            if match and match.group(1) not in partitioned and text.rstrip().endswith(';'):
+                text = text.rstrip()[:-1] + ' NOT VALID;\n'
+                validations.append('ALTER TABLE {0} VALIDATE CONSTRAINT {1};\n'.format(*match.groups()))
+                if unlogged:
+                    foreign_keys.append(text)
+                    continue
+        yield kind, text
+
+    for table in tables:
+        deferred.write('ALTER TABLE {0} SET LOGGED;\n'.format(table))
+    for text in foreign_keys:
+        deferred.write(text)
+    for text in validations:
+        deferred.write(text)
+
+
+def filter_postgresql(input, output, strip_clean=False, deferred=None, unlogged=False, only_clean=False,
+                      drain=True):
+    items = iter_pg_dump(input)
+    if strip_clean:
+        items = strip_pg_clean(items)
+    elif only_clean:
+        items = only_pg_clean(items)
+    if deferred is not None:
+        items = pg_bulk_load(items, deferred, unlogged)
+    for kind, text in items:
+        output.write(text)
+    if only_clean and drain:
+        # Read the rest of the dump, or pg_dump is killed by SIGPIPE
+        while input.read(65536):
+            pass
+
+
+MYSQL_TOKEN_RE = re.compile(r"""\\.|'|"|`|--\s|#|/\*|\*/|;""")
+MYSQL_DELIMITER_RE = re.compile(r'^DELIMITER\s+(\S+)\s*$', re.IGNORECASE)
+MYSQL_INSERT_RE = re.compile(
+    r'^INSERT INTO (`(?:[^`]|``)+`)\s*(\((?:`(?:[^`]|``)+`\s*,?\s*)+\))?\s*VALUES\s*',
+    re.IGNORECASE,
+)
+MYSQL_VALUE_RE = re.compile(
+    r"""\s*(?:'((?:[^'\\]|\\.)*)'|_binary\s*'((?:[^'\\]|\\.)*)'|(NULL)|(-?[0-9][0-9.eE+-]*))\s*([,)])""",
+    re.DOTALL,
+)
+# Characters which end fields and lines in `LOAD DATA` files, raw or escaped
+MYSQL_LOAD_DATA_SEPARATOR_RE = re.compile(r'\\(.)|[\t\n]', re.DOTALL)
+MYSQL_LOAD_DATA_SEPARATORS = {'\t': '\\t', '\n': '\\n'}
+MYSQL_COMMIT_EVERY = 100
+
+
+def scan_mysql_line(line, state, delimiter=';'):
+    """
+    Updates `state` with the tokens found in `line` and returns True if the
+    line ends a statement.
+    """
+    for match in MYSQL_TOKEN_RE.finditer(line):
+        token = match.group()
+        if state.comment_depth:
+            if token == '*/':
+                state.comment_depth = 0
+        elif state.quote is not None:
+            if token == state.quote:
+                state.quote = None
+        elif token.startswith('--') or token == '#':
+            break
+        elif token == '/*':
+            state.comment_depth = 1
+        elif token in ("'", '"', '`'):
+            state.quote = token
+    return state.at_top_level() and line.rstrip().endswith(delimiter)
+
+
+def iter_mysql_dump(lines):
+    """
+    Splits the lines of a `mysqldump` dump into items.  Yields
+    `('statement', text)` for each SQL statement including its trailing
+    newline and `('other', line)` for blank lines, comments and `DELIMITER`
+    commands.
+    """
+    state = ScanState()
+    statement = []
+    delimiter = ';'
+    for line in lines:
+        if not statement:
+            stripped = line.strip()
+            if not stripped or stripped.startswith('-- '):
+                yield 'other', line
+                continue
+            match = MYSQL_DELIMITER_RE.match(stripped)
+            if match:
+                delimiter = match.group(1)
+                yield 'other', line
+                continue
+            # mysqldump writes each INSERT on a single line, which is by far
+            # the most common case, so it isn't scanned
+            if stripped.startswith('INSERT INTO ') and stripped.endswith(');'):
+                yield 'statement', line
+                continue
+
+        statement.append(line)
+        if scan_mysql_line(line, state, delimiter):
+            yield 'statement', ''.join(statement)
+            statement = []
+
+    if statement:
+        yield 'statement', ''.join(statement)
+
+
+def escape_mysql_load_data(string):
+    """
+    Escapes the tabs and newlines of the string literal `string` of a
+    mysqldump dump, which mysqldump only escapes the latter of, so that they
+    don't end the field or line in a `LOAD DATA` file.  The escape sequences
+    of the literal mean the same in `LOAD DATA` files and are kept.
+    """
+    def escape(match):
+        char = match.group(1)
+        if char is None:
+            return MYSQL_LOAD_DATA_SEPARATORS[match.group()]
+        return MYSQL_LOAD_DATA_SEPARATORS.get(char, match.group())
+    return MYSQL_LOAD_DATA_SEPARATOR_RE.sub(escape, string)
+
+
+def parse_mysql_insert(statement):
+    """
+    Parses an extended INSERT statement written by mysqldump.  Returns a
+    `(table, columns, rows)` tuple where `columns` is the column list or None
+    and each row is a list of values in `LOAD DATA` format.  Returns None if
+    the statement uses values which can't be converted.
+    """
+    match = MYSQL_INSERT_RE.match(statement)
+    if not match:
+        return None
+    table, columns = match.group(1), match.group(2)
+
+    text = statement.rstrip()
+    if not text.endswith(';'):
+        return None
+    end = len(text) - 1
+    pos = match.end()
+
+    rows = []
+    while pos < end:
+        if text[pos] != '(':
+            return None
+        pos += 1
+        row = []
+        while True:
+            value = MYSQL_VALUE_RE.match(text, pos)
+            if not value:
+                return None
+            string, binary, null, number, sep = value.groups()
+            if null:
+                row.append('\\N')
+            elif number is not None:
+                row.append(number)
+            else:
+                row.append(escape_mysql_load_data(string if string is not None else binary))
+            pos = value.end()
+            if sep == ')':
+                break
+        rows.append(row)
+        while pos < end and text[pos] in ', \n':
+            pos += 1
+    return table, columns, rows
+
+
+def is_reader_alive(stream):
+    """
+    Returns False if `stream` is a pipe whose reading end has been closed,
+    i.e. the process reading it has exited.
+    """
+    try:
+        fd = stream.fileno()
+    except (AttributeError, io.UnsupportedOperation):
+        return True
+    if not hasattr(select, 'poll'):
+        return True
+    poller = select.poll()
+    poller.register(fd, 0)
+    return not any(event & (select.POLLERR | select.POLLHUP) for _, event in poller.poll(0))
+
+
+def open_fifo_for_writing(path, output=None):
+    """
+    Opens the FIFO at `path` for writing once a reader has opened it.  The
+    statement reading it may have to wait for long statements before it, so
+    there is no deadline, but the wait ends with ENXIO if the process reading
+    `output` exits.
+    """
+    delay = 0.01
+    while True:
+        try:
+            fd = os.open(path, os.O_WRONLY | os.O_NONBLOCK)
+        except OSError as e:
+            if e.errno != errno.ENXIO or (output is not None and not is_reader_alive(output)):
+                raise
+            time.sleep(delay)
+            delay = min(delay * 2, 0.5)
+            continue
+        flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+        fcntl.fcntl(fd, fcntl.F_SETFL, flags & ~os.O_NONBLOCK)
+        return io.open(fd, 'w', encoding='utf-8', errors='surrogateescape', newline='')
+
+
+def mysql_bulk_load(items, output, commit_every=MYSQL_COMMIT_EVERY, disable_binlog=False, load_data_dir=None):
+    """
+    Wraps a mysqldump dump in a session preamble which disables foreign key
+    and unique checks (and binary logging if `disable_binlog` is True) and
+    runs the inserts in explicit transactions of `commit_every` statements.
+
+    If `load_data_dir` is given, extended INSERT statements are turned into
+    `LOAD DATA LOCAL INFILE` statements reading from FIFOs created in that
+    directory, which requires the client to allow local infiles.  Statements
+    which can't be converted are passed through unchanged.
+    """
+    output.write(
+        'SET @BACKUPDB_OLD_FOREIGN_KEY_CHECKS=@@FOREIGN_KEY_CHECKS, FOREIGN_KEY_CHECKS=0;\n'
+        'SET @BACKUPDB_OLD_UNIQUE_CHECKS=@@UNIQUE_CHECKS, UNIQUE_CHECKS=0;\n'
+        'SET @BACKUPDB_OLD_AUTOCOMMIT=@@AUTOCOMMIT, AUTOCOMMIT=0;\n'
+    )
+    if disable_binlog:
+        output.write('SET SESSION SQL_LOG_BIN=0;\n')
+
+    inserts = 0
+    fifo_count = 0
+    for kind, text in items:
+        if kind == 'statement' and text.startswith('INSERT INTO '):
+            parsed = parse_mysql_insert(text) if load_data_dir else None
+            if parsed:
+                table, columns, rows = parsed
+                fifo_count += 1
+                fifo = os.path.join(load_data_dir, '{0:06d}.tsv'.format(fifo_count))
+                os.mkfifo(fifo)
+                output.write(
+                    "LOAD DATA LOCAL INFILE '{0}' INTO TABLE {1} CHARACTER SET binary "
+                    "FIELDS TERMINATED BY '\\t' ESCAPED BY '\\\\' LINES TERMINATED BY '\\n'{2};\n".format(
+                        fifo.replace('\\', '\\\\').replace("'", "\\'"),
+                        table,
+                        ' ' + columns if columns else '',
+                    )
+                )
+                output.flush()
+                with open_fifo_for_writing(fifo, output) as f:
+                    for row in rows:
+                        f.write('\t'.join(row))
+                        f.write('\n')
+                os.remove(fifo)
+            else:
+                output.write(text)
+            inserts += 1
+            if inserts % commit_every == 0:
+                output.write('COMMIT;\n')
+        else:
+            output.write(text)
+
+    output.write(
+        'COMMIT;\n'
+        'SET AUTOCOMMIT=@BACKUPDB_OLD_AUTOCOMMIT;\n'
+        'SET UNIQUE_CHECKS=@BACKUPDB_OLD_UNIQUE_CHECKS;\n'
+        'SET FOREIGN_KEY_CHECKS=@BACKUPDB_OLD_FOREIGN_KEY_CHECKS;\n'
+    )
+    if disable_binlog:
+        output.write('SET SESSION SQL_LOG_BIN=1;\n')
+
+
+def filter_mysql(input, output, bulk_load=False, commit_every=MYSQL_COMMIT_EVERY,
+                 disable_binlog=False, load_data_dir=None):
+    items = iter_mysql_dump(input)
+    if bulk_load:
+        mysql_bulk_load(items, output, commit_every, disable_binlog, load_data_dir)
+    else:
+        for kind, text in items:
+            output.write(text)
+
+
+def get_text_stdio():
+    stdin = sys.stdin
+    stdout = sys.stdout
+    if hasattr(stdin, 'buffer'):
+        stdin = io.TextIOWrapper(stdin.buffer, encoding='utf-8', errors='surrogateescape', newline='')
+        stdout = io.TextIOWrapper(stdout.buffer, encoding='utf-8', errors='surrogateescape', newline='')
+    return stdin, stdout
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Stream filters for plain SQL dumps.')
+    subparsers = parser.add_subparsers(dest='engine')
+    subparsers.required = True
+
+    pg_parser = subparsers.add_parser('postgresql')
+    pg_parser.add_argument(
+        '--strip-clean',
+        action='store_true',
+        default=False,
+        help='Remove the DROP statements written by `pg_dump --clean`.',
+    )
+    pg_parser.add_argument(
+        '--only-clean',
+        action='store_true',
+        default=False,
+        help='Keep only the DROP statements written by `pg_dump --clean`.',
+    )
+    pg_parser.add_argument(
+        '--stop-after-clean',
+        action='store_true',
+        default=False,
+        help='With --only-clean, exit after the DROP statements instead of reading the rest of the dump.',
+    )
+    pg_parser.add_argument(
+        '--deferred-file',
+        help=(
+            'Add foreign keys as NOT VALID and write the statements validating '
+            'them to this file, to be run once the dump is loaded.'
+        ),
+    )
+    pg_parser.add_argument(
+        '--unlogged',
+        action='store_true',
+        default=False,
+        help='With --deferred-file, create tables as UNLOGGED and make them logged in the deferred statements.',
+    )
+
+    mysql_parser = subparsers.add_parser('mysql')
+    mysql_parser.add_argument(
+        '--bulk-load',
+        action='store_true',
+        default=False,
+        help='Disable checks and run inserts in explicit transactions.',
+    )
+    mysql_parser.add_argument('--commit-every', type=int, default=MYSQL_COMMIT_EVERY)
+    mysql_parser.add_argument('--disable-binlog', action='store_true', default=False)
+    mysql_parser.add_argument(
+        '--load-data-dir',
+        help='Turn extended inserts into LOAD DATA LOCAL INFILE statements using FIFOs in this directory.',
+    )
+
+    options = parser.parse_args(argv)
+    stdin, stdout = get_text_stdio()
+
+    try:
+        if options.engine == 'postgresql':
+            if options.deferred_file:
+                with io.open(options.deferred_file, 'w', encoding='utf-8', errors='surrogateescape') as deferred:
+                    filter_postgresql(
+                        stdin,
+                        stdout,
+                        strip_clean=options.strip_clean,
+                        deferred=deferred,
+                        unlogged=options.unlogged,
+                    )
+            else:
+                filter_postgresql(
+                    stdin,
+                    stdout,
+                    strip_clean=options.strip_clean,
+                    only_clean=options.only_clean,
+                    drain=not options.stop_after_clean,
+                )
+        elif options.engine == 'mysql':
+            filter_mysql(
+                stdin,
+                stdout,
+                bulk_load=options.bulk_load,
+                commit_every=options.commit_every,
+                disable_binlog=options.disable_binlog,
+                load_data_dir=options.load_data_dir,
+            )
+        stdout.flush()
+    except IOError as e:
+        print('sqlfilters: {0}'.format(e), file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
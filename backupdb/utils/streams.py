@@ -0,0 +1,238 @@
+"""
+Stream format holding the backups of several databases one after another.
+
+A stream starts with `MAGIC` followed by records.  Each record has a header
+packed as `RECORD_HEADER` with its type, the length of the database name and
+the length of its payload, followed by the name and the payload:
+
+* `BEGIN` starts the backup of a database.  Its payload is a JSON object
+  with the engine and backup extension of the database.
+* `DATA` holds the next chunk of the compressed backup.
+* `END` finishes the backup.  Its payload is a JSON object with the size
+  and SHA-256 checksum of the compressed backup.
+* `ABORT` marks a backup which failed while it was being written.
+* `CLOSE` ends the stream, so that a stream cut short between two backups is
+  detected as well.
+
+Backups are written and read chunk by chunk, so streams of any size are
+handled with constant memory.
+"""
+import hashlib
+import json
+import struct
+
+MAGIC = b'BACKUPDB-STREAM\x01'
+
+RECORD_HEADER = struct.Struct('<cHI')
+
+BEGIN = b'B'
+DATA = b'D'
+END = b'E'
+ABORT = b'A'
+CLOSE = b'Z'
+
+CHUNK_SIZE = 1024 * 1024
+
+
+class StreamError(IOError):
+    pass
+
+
+def read_exactly(stream, size):
+    data = stream.read(size)
+    while len(data) < size:
+        more = stream.read(size - len(data))
+        if not more:
+            break
+        data += more
+    return data
+
+
+class PrefixedReader(object):
+    """
+    Readable file-like object which returns `prefix` before the contents of
+    `stream`.
+    """
+    def __init__(self, prefix, stream):
+        self.prefix = prefix
+        self.stream = stream
+
+    def read(self, size=-1):
+        if not self.prefix:
+            return self.stream.read(size)
+        if size is None or size < 0:
+            data, self.prefix = self.prefix + self.stream.read(), b''
+        else:
+            data, self.prefix = self.prefix[:size], self.prefix[size:]
+        return data
+
+
+def open_input(stream):
+    """
+    Returns `(True, reader)` with a `StreamReader` if `stream` holds a stream
+    of several backups or `(False, reader)` with a reader returning the single
+    backup in `stream` otherwise.
+    """
+    head = read_exactly(stream, len(MAGIC))
+    if head == MAGIC:
+        return True, StreamReader(stream, check_magic=False)
+    return False, PrefixedReader(head, stream)
+
+
+class BackupWriter(object):
+    """
+    Writable file-like object which writes the backup of one database into a
+    stream as data records.
+    """
+    def __init__(self, stream, name):
+        self.stream = stream
+        self.name = name
+        self.hash = hashlib.sha256()
+        self.bytes = 0
+
+    def write(self, data):
+        self.hash.update(data)
+        self.bytes += len(data)
+        for i in range(0, len(data), CHUNK_SIZE):
+            self.stream.write_record(DATA, self.name, data[i:i + CHUNK_SIZE])
+
+    def end(self):
+        self.stream.write_record(END, self.name, json.dumps({
+            'bytes': self.bytes,
+            'checksum': self.hash.hexdigest(),
+        }).encode('utf-8'))
+
+    def abort(self):
+        self.stream.write_record(ABORT, self.name)
+
+
+class StreamWriter(object):
+    """
+    Writes backups of several databases to the writable binary file-like
+    object `output`::
+
+        writer = StreamWriter(sys.stdout.buffer)
+        backup = writer.begin('default', {'engine': ..., 'extension': 'pgsql'})
+        api.backup('default', backup)
+        backup.end()
+        writer.close()
+    """
+    def __init__(self, output):
+        self.output = output
+        self.output.write(MAGIC)
+
+    def write_record(self, type, name, payload=b''):
+        name = name.encode('utf-8')
+        self.output.write(RECORD_HEADER.pack(type, len(name), len(payload)))
+        self.output.write(name)
+        self.output.write(payload)
+
+    def begin(self, name, info):
+        """
+        Starts the backup of the database `name` and returns a `BackupWriter`
+        for its data.
+        """
+        self.write_record(BEGIN, name, json.dumps(info).encode('utf-8'))
+        return BackupWriter(self, name)
+
+    def close(self):
+        self.write_record(CLOSE, '')
+        self.output.flush()
+
+
+class BackupReader(object):
+    """
+    Readable file-like object returning the backup of one database from a
+    stream.  Raises StreamError if the backup is incomplete or does not match
+    its checksum.
+    """
+    def __init__(self, stream, name, info):
+        self.stream = stream
+        self.name = name
+        self.info = info
+        self.hash = hashlib.sha256()
+        self.bytes = 0
+        self.buffer = b''
+        self.finished = False
+
+    def fill(self):
+        while not self.buffer and not self.finished:
+            type, name, payload = self.stream.read_record()
+            if name != self.name:
+                raise StreamError("Unexpected record for '{0}' in backup of '{1}'".format(name, self.name))
+            if type == DATA:
+                self.hash.update(payload)
+                self.bytes += len(payload)
+                self.buffer = payload
+            elif type == END:
+                self.finished = True
+                expected = json.loads(payload.decode('utf-8'))
+                if expected['bytes'] != self.bytes or expected['checksum'] != self.hash.hexdigest():
+                    raise StreamError("Backup of '{0}' does not match its checksum".format(self.name))
+            elif type == ABORT:
+                self.finished = True
+                raise StreamError("Backup of '{0}' failed while it was written".format(self.name))
+            else:
+                raise StreamError("Unexpected record in backup of '{0}'".format(self.name))
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            chunks = []
+            while True:
+                self.fill()
+                if not self.buffer:
+                    return b''.join(chunks)
+                chunks.append(self.buffer)
+                self.buffer = b''
+        self.fill()
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def finish(self):
+        """
+        Skips the rest of the backup and checks it.
+        """
+        while not self.finished:
+            self.buffer = b''
+            self.fill()
+        self.buffer = b''
+
+
+class StreamReader(object):
+    """
+    Iterates over the backups in a stream written by `StreamWriter`, yielding
+    a `BackupReader` for each.  A backup which has not been read to the end
+    when the next one is requested is skipped.
+    """
+    def __init__(self, input, check_magic=True):
+        self.input = input
+        if check_magic and read_exactly(input, len(MAGIC)) != MAGIC:
+            raise StreamError('Not a backup stream')
+
+    def read_record(self):
+        header = read_exactly(self.input, RECORD_HEADER.size)
+        if len(header) < RECORD_HEADER.size:
+            raise StreamError('Unexpected end of backup stream')
+        type, name_length, payload_length = RECORD_HEADER.unpack(header)
+        name = read_exactly(self.input, name_length)
+        payload = read_exactly(self.input, payload_length)
+        if len(name) < name_length or len(payload) < payload_length:
+            raise StreamError('Unexpected end of backup stream')
+        return type, name.decode('utf-8'), payload
+
+    def __iter__(self):
+        while True:
+            type, name, payload = self.read_record()
+            if type == CLOSE:
+                return
+            if type != BEGIN:
+                raise StreamError('Expected the start of a backup in backup stream')
+            reader = BackupReader(self, name, json.loads(payload.decode('utf-8')))
+            yield reader
+            try:
+                reader.finish()
+            except StreamError:
+                # Errors within a complete backup have been reported to
+                # whoever read it; only a damaged stream stops iteration
+                if not reader.finished:
+                    raise
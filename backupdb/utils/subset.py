@@ -0,0 +1,607 @@
+"""
+Referentially consistent subset backups.
+
+A subset backup only holds some of the rows of a database:
+
+* the rows of the root tables matching a predicate, or a random sample of
+  them,
+* every row referenced by a selected row through a foreign key, followed
+  transitively so that the backup can be restored with all of its
+  constraints,
+* all rows of the tables given as full tables, such as `django_migrations`.
+
+Foreign keys and primary keys are read from the catalog of the database, so
+tables which aren't managed by Django are followed as well.  Only
+single-column foreign keys are followed.  Rows of tables with a single-column
+primary key are tracked by key, the rows of other tables by the conditions
+which selected them.
+
+The result is written in the same format as a full backup of the database, so
+it is named and restored like any other backup:
+
+* postgres subsets are dumped by `pg_dump` for the schema and `COPY` for the
+  selected rows, all from the snapshot the rows were selected in,
+* mysql subsets are dumped by `mysqldump --where`.  Rows are selected and
+  dumped in separate transactions, so rows changed in between may be missing
+  their references,
+* sqlite subsets are a copy of the database with the other rows deleted.
+"""
+from subprocess import CalledProcessError
+import collections
+import logging
+import os
+import sqlite3
+import tempfile
+
+from .commands import (
+    get_compress_cmd,
+    get_mysql_args,
+    get_postgresql_args,
+    get_postgresql_env,
+    quote_pg_identifier,
+    quote_pg_literal,
+)
+from .exceptions import BackupError
+from .processes import get_command_output, is_stream, pipe_commands_to_file
+from .resumable import (
+    DEFAULT_SNAPSHOT_TTL,
+    get_unit_cmds,
+    get_units,
+    list_relations,
+    start_snapshot_holder,
+    stop_snapshot_holder,
+)
+
+logger = logging.getLogger(__name__)
+
+# Maximum length of the list of values in a single condition, which keeps
+# queries and `mysqldump --where` arguments well below the size limit of
+# command-line arguments
+MAX_CONDITION_LENGTH = 64 * 1024
+
+DEFAULT_FULL_TABLES = (
+    'django_migrations',
+    'django_content_type',
+    'django_site',
+    'auth_permission',
+    'auth_group',
+    'auth_group_permissions',
+)
+
+PG_NULL = '\\N'
+
+PG_PRIMARY_KEYS_SQL = (
+    "SELECT format('%I.%I', n.nspname, c.relname), a.attname "
+    "FROM pg_constraint k "
+    "JOIN pg_class c ON c.oid = k.conrelid "
+    "JOIN pg_namespace n ON n.oid = c.relnamespace "
+    "JOIN pg_attribute a ON a.attrelid = k.conrelid AND a.attnum = k.conkey[1] "
+    "WHERE k.contype = 'p' AND array_length(k.conkey, 1) = 1"
+)
+
+PG_FOREIGN_KEYS_SQL = (
+    "SELECT format('%I.%I', n.nspname, c.relname), a.attname, "
+    "format('%I.%I', rn.nspname, r.relname), ra.attname "
+    "FROM pg_constraint k "
+    "JOIN pg_class c ON c.oid = k.conrelid "
+    "JOIN pg_namespace n ON n.oid = c.relnamespace "
+    "JOIN pg_class r ON r.oid = k.confrelid "
+    "JOIN pg_namespace rn ON rn.oid = r.relnamespace "
+    "JOIN pg_attribute a ON a.attrelid = k.conrelid AND a.attnum = k.conkey[1] "
+    "JOIN pg_attribute ra ON ra.attrelid = k.confrelid AND ra.attnum = k.confkey[1] "
+    "WHERE k.contype = 'f' AND array_length(k.conkey, 1) = 1"
+)
+
+MYSQL_TABLES_SQL = (
+    "SELECT TABLE_NAME FROM information_schema.TABLES "
+    "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_TYPE = 'BASE TABLE'"
+)
+
+MYSQL_PRIMARY_KEYS_SQL = (
+    "SELECT TABLE_NAME, MIN(COLUMN_NAME) FROM information_schema.KEY_COLUMN_USAGE "
+    "WHERE TABLE_SCHEMA = DATABASE() AND CONSTRAINT_NAME = 'PRIMARY' "
+    "GROUP BY TABLE_NAME HAVING COUNT(*) = 1"
+)
+
+MYSQL_FOREIGN_KEYS_SQL = (
+    "SELECT TABLE_NAME, MIN(COLUMN_NAME), MIN(REFERENCED_TABLE_NAME), MIN(REFERENCED_COLUMN_NAME) "
+    "FROM information_schema.KEY_COLUMN_USAGE "
+    "WHERE TABLE_SCHEMA = DATABASE() AND REFERENCED_TABLE_SCHEMA = DATABASE() "
+    "GROUP BY TABLE_NAME, CONSTRAINT_NAME HAVING COUNT(*) = 1"
+)
+
+
+def parse_root(value):
+    """
+    Parses a root given as `TABLE` or `TABLE:PREDICATE` into a tuple
+    `(table, predicate)`.  `predicate` is None if no predicate is given.
+    """
+    table, _, predicate = value.partition(':')
+    table = table.strip()
+    if not table:
+        raise ValueError("Invalid subset root '{0}'".format(value))
+    return table, predicate.strip() or None
+
+
+def chunk_values(values, quote, max_length=MAX_CONDITION_LENGTH):
+    """
+    Yields lists of the quoted `values` whose total length is at most about
+    `max_length`.
+    """
+    chunk, length = [], 0
+    for value in values:
+        literal = quote(value)
+        if chunk and length + len(literal) > max_length:
+            yield chunk
+            chunk, length = [], 0
+        chunk.append(literal)
+        length += len(literal) + 1
+    if chunk:
+        yield chunk
+
+
+class SubsetEngine(object):
+    """
+    Queries the catalog and rows of a database and writes subset backups of
+    it.  Subclasses implement the engine specific parts.
+    """
+    def __init__(self, db_config, show_output=False):
+        self.db_config = db_config
+        self.show_output = show_output
+
+    def open(self):
+        pass
+
+    def close(self):
+        pass
+
+    def query(self, sql):
+        """
+        Returns the rows of `sql` as a list of tuples with None for NULL.
+        """
+        raise NotImplementedError
+
+    def quote_name(self, name):
+        raise NotImplementedError
+
+    def quote_table(self, table):
+        return self.quote_name(table)
+
+    def quote_value(self, value):
+        raise NotImplementedError
+
+    def sample_condition(self, percent):
+        """
+        Returns a condition matching a random `percent` of the rows.
+        """
+        raise NotImplementedError
+
+    def get_tables(self):
+        raise NotImplementedError
+
+    def get_primary_keys(self):
+        """
+        Returns a dict mapping tables to their single-column primary key.
+        """
+        raise NotImplementedError
+
+    def get_foreign_keys(self):
+        """
+        Returns a dict mapping tables to lists of `(column, table, column)`
+        tuples of their single-column foreign keys.
+        """
+        raise NotImplementedError
+
+    def find_table(self, name, tables):
+        return name if name in tables else None
+
+    def write_backup(self, output, subset, compress_cmd):
+        """
+        Writes the compressed backup of `subset` to the writable binary
+        file-like object `output`.  Returns the timings of the commands run.
+        """
+        raise NotImplementedError
+
+    def select(self, table, columns, condition=None, distinct=False):
+        sql = 'SELECT {0}{1} FROM {2}'.format(
+            'DISTINCT ' if distinct else '',
+            ', '.join(self.quote_name(c) for c in columns),
+            self.quote_table(table),
+        )
+        if condition:
+            sql += ' WHERE {0}'.format(condition)
+        return self.query(sql)
+
+
+class SqliteSubsetEngine(SubsetEngine):
+    """
+    Selects rows from a copy of the database, which is then trimmed down to
+    the subset.
+    """
+    def open(self):
+        fd, self.path = tempfile.mkstemp(suffix='.sqlite')
+        os.close(fd)
+        source = sqlite3.connect(self.db_config['NAME'])
+        self.connection = sqlite3.connect(self.path)
+        try:
+            source.backup(self.connection)
+        finally:
+            source.close()
+
+    def close(self):
+        self.connection.close()
+        os.remove(self.path)
+
+    def query(self, sql):
+        return [tuple(row) for row in self.connection.execute(sql)]
+
+    def quote_name(self, name):
+        return '"{0}"'.format(name.replace('"', '""'))
+
+    def quote_value(self, value):
+        if isinstance(value, (int, float)):
+            return repr(value)
+        if isinstance(value, bytes):
+            return "X'{0}'".format(''.join('{0:02x}'.format(b) for b in bytearray(value)))
+        return "'{0}'".format(value.replace("'", "''"))
+
+    def sample_condition(self, percent):
+        return 'abs(random()) % 1000000 < {0}'.format(int(percent * 10000))
+
+    def get_tables(self):
+        return [row[0] for row in self.query(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite\\_%' ESCAPE '\\'")]
+
+    def get_columns(self, table):
+        return self.query('PRAGMA table_info({0})'.format(self.quote_name(table)))
+
+    def get_primary_keys(self):
+        primary_keys = {}
+        for table in self.get_tables():
+            columns = [c for c in self.get_columns(table) if c[5]]
+            if len(columns) == 1:
+                primary_keys[table] = columns[0][1]
+            elif not columns:
+                primary_keys[table] = 'rowid'
+        return primary_keys
+
+    def get_foreign_keys(self):
+        primary_keys = self.get_primary_keys()
+        foreign_keys = {}
+        for table in self.get_tables():
+            constraints = collections.defaultdict(list)
+            for row in self.query('PRAGMA foreign_key_list({0})'.format(self.quote_name(table))):
+                constraints[row[0]].append(row)
+            for rows in constraints.values():
+                if len(rows) != 1:
+                    continue
+                _, _, parent, column, parent_column = rows[0][:5]
+                parent_column = parent_column or primary_keys.get(parent)
+                if parent_column:
+                    foreign_keys.setdefault(table, []).append((column, parent, parent_column))
+        return foreign_keys
+
+    def write_backup(self, output, subset, compress_cmd):
+        for table in subset.tables:
+            conditions = subset.conditions.get(table)
+            if conditions and None in conditions:
+                continue
+            quoted_table = self.quote_table(table)
+            if table in subset.rows:
+                self.connection.execute('CREATE TEMP TABLE backupdb_subset_keys (value PRIMARY KEY)')
+                self.connection.executemany(
+                    'INSERT INTO backupdb_subset_keys VALUES (?)', ((v,) for v in subset.rows[table]))
+                self.connection.execute('DELETE FROM {0} WHERE {1} NOT IN (SELECT value FROM backupdb_subset_keys)'.format(
+                    quoted_table, self.quote_name(subset.primary_keys[table])))
+                self.connection.execute('DROP TABLE backupdb_subset_keys')
+            elif conditions:
+                self.connection.execute('DELETE FROM {0} WHERE NOT ({1})'.format(
+                    quoted_table, ' OR '.join(conditions)))
+            else:
+                self.connection.execute('DELETE FROM {0}'.format(quoted_table))
+        self.connection.commit()
+        self.connection.execute('VACUUM')
+
+        return pipe_commands_to_file([['cat', self.path], compress_cmd], path=output, show_stderr=self.show_output)
+
+
+class PostgresqlSubsetEngine(SubsetEngine):
+    """
+    Selects rows and dumps them from a snapshot exported when the engine is
+    opened.
+    """
+    def open(self):
+        self.snapshot_id, self.holder_pid, self.holder_backend_pid = start_snapshot_holder(
+            self.db_config, DEFAULT_SNAPSHOT_TTL)
+
+    def close(self):
+        stop_snapshot_holder(self.holder_pid, self.db_config, self.holder_backend_pid)
+
+    def get_psql_cmd(self):
+        return ['psql', '-q', '-A', '-t', '-X', '-v', 'ON_ERROR_STOP=1']
+
+    def query(self, sql):
+        cmd = self.get_psql_cmd() + ['-F', '\t', '-P', 'null={0}'.format(PG_NULL)] + get_postgresql_args(self.db_config) + [
+            '-c', 'BEGIN ISOLATION LEVEL REPEATABLE READ READ ONLY',
+            '-c', 'SET TRANSACTION SNAPSHOT {0}'.format(quote_pg_literal(self.snapshot_id)),
+            '-c', sql,
+            '-c', 'COMMIT',
+        ]
+        output = get_command_output(cmd, extra_env=get_postgresql_env(self.db_config), show_stderr=self.show_output)
+        return [
+            tuple(None if v == PG_NULL else v for v in line.split('\t'))
+            for line in output.splitlines() if line
+        ]
+
+    def quote_name(self, name):
+        return quote_pg_identifier(name)
+
+    def quote_table(self, table):
+        # Tables are already quoted and qualified by the catalog queries
+        return table
+
+    def quote_value(self, value):
+        return quote_pg_literal(str(value))
+
+    def sample_condition(self, percent):
+        return 'random() < {0!r}'.format(percent / 100.0)
+
+    def get_tables(self):
+        self.tables, self.sequences = list_relations(self.db_config, self.snapshot_id, self.show_output)
+        return self.tables
+
+    def get_primary_keys(self):
+        return dict(self.query(PG_PRIMARY_KEYS_SQL))
+
+    def get_foreign_keys(self):
+        foreign_keys = {}
+        for table, column, parent, parent_column in self.query(PG_FOREIGN_KEYS_SQL):
+            foreign_keys.setdefault(table, []).append((column, parent, parent_column))
+        return foreign_keys
+
+    def find_table(self, name, tables):
+        if name in tables:
+            return name
+        # Also accept names without the schema or quotes
+        matches = [t for t in tables if name in (t.replace('"', ''), t.split('.', 1)[1].replace('"', ''))]
+        return matches[0] if len(matches) == 1 else None
+
+    def get_data_script(self, subset):
+        lines = [
+            'BEGIN ISOLATION LEVEL REPEATABLE READ READ ONLY;',
+            'SET TRANSACTION SNAPSHOT {0};'.format(quote_pg_literal(self.snapshot_id)),
+        ]
+        for table in subset.tables:
+            for condition in subset.get_conditions(table):
+                lines.extend([
+                    'SELECT {0};'.format(quote_pg_literal('COPY {0} FROM stdin;'.format(table))),
+                    'COPY (SELECT * FROM {0}{1}) TO STDOUT;'.format(
+                        table, ' WHERE {0}'.format(condition) if condition else ''),
+                    "SELECT '\\.';",
+                ])
+        lines.append('COMMIT;')
+        return '\n'.join(lines) + '\n'
+
+    def write_backup(self, output, subset, compress_cmd):
+        env = get_postgresql_env(self.db_config)
+
+        fd, script_file = tempfile.mkstemp(suffix='.sql')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(self.get_data_script(subset))
+
+            # The data goes between the schema and the values of sequences
+            units = get_units([], self.sequences)
+            data_cmds = [
+                self.get_psql_cmd() + get_postgresql_args(self.db_config) + ['--file={0}'.format(script_file)],
+                compress_cmd,
+            ]
+
+            timings = []
+            for i, (name, args) in enumerate(units):
+                if i == 2:
+                    logger.debug('Dumping selected rows...')
+                    timings.extend(pipe_commands_to_file(
+                        data_cmds, path=output, extra_env=env, show_stderr=self.show_output))
+                logger.debug('Dumping {0}...'.format(name))
+                cmds = get_unit_cmds(args, self.db_config, self.snapshot_id)[:-1] + [compress_cmd]
+                timings.extend(pipe_commands_to_file(cmds, path=output, extra_env=env, show_stderr=self.show_output))
+            return timings
+        finally:
+            os.remove(script_file)
+
+
+class MysqlSubsetEngine(SubsetEngine):
+    def query(self, sql):
+        cmd = ['mysql', '--batch', '--skip-column-names', '-e', sql] + get_mysql_args(self.db_config)
+        output = get_command_output(cmd, show_stderr=self.show_output)
+        return [
+            tuple(None if v == 'NULL' else v for v in line.split('\t'))
+            for line in output.splitlines() if line
+        ]
+
+    def quote_name(self, name):
+        return '`{0}`'.format(name.replace('`', '``'))
+
+    def quote_value(self, value):
+        return "'{0}'".format(str(value).replace('\\', '\\\\').replace("'", "''"))
+
+    def sample_condition(self, percent):
+        return 'RAND() < {0!r}'.format(percent / 100.0)
+
+    def get_tables(self):
+        return [row[0] for row in self.query(MYSQL_TABLES_SQL)]
+
+    def get_primary_keys(self):
+        return dict(self.query(MYSQL_PRIMARY_KEYS_SQL))
+
+    def get_foreign_keys(self):
+        foreign_keys = {}
+        for table, column, parent, parent_column in self.query(MYSQL_FOREIGN_KEYS_SQL):
+            foreign_keys.setdefault(table, []).append((column, parent, parent_column))
+        return foreign_keys
+
+    def write_backup(self, output, subset, compress_cmd):
+        args = get_mysql_args(self.db_config)
+
+        logger.debug('Dumping schema...')
+        timings = pipe_commands_to_file(
+            [['mysqldump', '--no-data'] + args, compress_cmd], path=output, show_stderr=self.show_output)
+        for table in subset.tables:
+            for condition in subset.get_conditions(table):
+                logger.debug('Dumping rows of {0}...'.format(table))
+                cmd = ['mysqldump', '--no-create-info', '--skip-triggers', '--single-transaction']
+                if condition:
+                    cmd.append('--where={0}'.format(condition))
+                timings.extend(pipe_commands_to_file(
+                    [cmd + args + [table], compress_cmd], path=output, show_stderr=self.show_output))
+        return timings
+
+
+SUBSET_ENGINES = {
+    'django.db.backends.mysql': MysqlSubsetEngine,
+    'django.db.backends.postgresql': PostgresqlSubsetEngine,
+    'django.db.backends.postgresql_psycopg2': PostgresqlSubsetEngine,
+    'django.contrib.gis.db.backends.postgis': PostgresqlSubsetEngine,
+    'django.db.backends.sqlite3': SqliteSubsetEngine,
+}
+
+
+class Subset(object):
+    """
+    The rows selected from the tables of the database queried by `engine`.
+    `rows` maps tables with a single-column primary key to the set of keys
+    of their selected rows.  `conditions` maps other tables to the list of
+    conditions matching their selected rows, where None matches all rows.
+    """
+    def __init__(self, engine):
+        self.engine = engine
+        self.tables = sorted(engine.get_tables())
+        self.primary_keys = engine.get_primary_keys()
+        self.foreign_keys = engine.get_foreign_keys()
+        self.rows = collections.defaultdict(set)
+        self.conditions = collections.defaultdict(list)
+        # Values already followed to tables without a primary key
+        self.followed = collections.defaultdict(set)
+
+    def find_table(self, name):
+        return self.engine.find_table(name, self.tables)
+
+    def add_root(self, table, predicate=None, sample=None):
+        """
+        Selects the rows of `table` matching the SQL `predicate` if given,
+        or a random `sample` percent of them, along with the rows they
+        reference.
+        """
+        conditions = []
+        if predicate:
+            conditions.append('({0})'.format(predicate))
+        if sample is not None:
+            if not self.primary_keys.get(table):
+                # A random condition can't be used again when dumping
+                raise BackupError("Can't sample '{0}' which has no single-column primary key".format(table))
+            conditions.append(self.engine.sample_condition(sample))
+
+        pending = [(table, ' AND '.join(conditions) or None)]
+        while pending:
+            pending.extend(self.add_rows(*pending.pop()))
+
+    def add_rows(self, table, condition):
+        """
+        Selects the rows of `table` matching `condition` and returns a list
+        of `(table, condition)` tuples matching the rows they reference which
+        aren't selected yet.
+        """
+        primary_key = self.primary_keys.get(table)
+        foreign_keys = self.foreign_keys.get(table, [])
+        columns = [c for c, _, _ in foreign_keys]
+
+        if primary_key:
+            rows = []
+            for row in self.engine.select(table, [primary_key] + columns, condition):
+                if row[0] not in self.rows[table]:
+                    self.rows[table].add(row[0])
+                    rows.append(row[1:])
+        else:
+            self.conditions[table].append(condition)
+            rows = self.engine.select(table, columns, condition, distinct=True) if columns else []
+
+        references = collections.defaultdict(set)
+        for row in rows:
+            for value, (_, parent, parent_column) in zip(row, foreign_keys):
+                if value is not None:
+                    references[(parent, parent_column)].add(value)
+
+        pending = []
+        for (parent, column), values in references.items():
+            if column == self.primary_keys.get(parent):
+                values -= self.rows[parent]
+            else:
+                values -= self.followed[(parent, column)]
+                self.followed[(parent, column)].update(values)
+            for chunk in chunk_values(values, self.engine.quote_value):
+                pending.append((parent, '{0} IN ({1})'.format(self.engine.quote_name(column), ', '.join(chunk))))
+        return pending
+
+    def get_conditions(self, table):
+        """
+        Returns a list of disjoint conditions matching the selected rows of
+        `table`, or an empty list if none are selected.  A condition of None
+        matches all rows.
+        """
+        if table in self.rows:
+            column = self.engine.quote_name(self.primary_keys[table])
+            return [
+                '{0} IN ({1})'.format(column, ', '.join(chunk))
+                for chunk in chunk_values(self.rows[table], self.engine.quote_value)
+            ]
+        conditions = self.conditions.get(table)
+        if not conditions:
+            return []
+        if None in conditions:
+            return [None]
+        return [' OR '.join('({0})'.format(c) for c in conditions)]
+
+    def count(self):
+        return sum(len(keys) for keys in self.rows.values())
+
+
+def do_subset_backup(backup_file, db_config, roots, sample=None, full_tables=DEFAULT_FULL_TABLES,
+                     show_output=False, compress_threads=1, compress_level=None):
+    """
+    Backs up the subset of the database selected by `roots`, a list of
+    `(table, predicate)` tuples, and `full_tables` into `backup_file`, which
+    may be a path or a writable binary file-like object.  If `sample` is
+    given, only that percentage of the rows of each root is selected.
+    Returns the timings of the commands run.
+    """
+    engine_class = SUBSET_ENGINES.get(db_config['ENGINE'])
+    if engine_class is None:
+        raise BackupError("Subset backups of '{0}' databases are not supported".format(db_config['ENGINE']))
+
+    engine = engine_class(db_config, show_output)
+    engine.open()
+    try:
+        try:
+            subset = Subset(engine)
+            for name in full_tables:
+                table = subset.find_table(name)
+                if table is not None:
+                    subset.add_root(table)
+            for name, predicate in roots:
+                table = subset.find_table(name)
+                if table is None:
+                    raise BackupError("Unknown table '{0}'".format(name))
+                subset.add_root(table, predicate, sample)
+        except (CalledProcessError, sqlite3.Error) as e:
+            raise BackupError('Could not select the subset: {0}'.format(e))
+        logger.info('Selected {0} rows from {1} tables'.format(
+            subset.count(), len([t for t in subset.tables if subset.get_conditions(t)])))
+
+        compress_cmd = get_compress_cmd(compress_threads, compress_level)
+        if is_stream(backup_file):
+            return engine.write_backup(backup_file, subset, compress_cmd)
+        with open(backup_file, 'wb') as f:
+            return engine.write_backup(f, subset, compress_cmd)
+    finally:
+        engine.close()
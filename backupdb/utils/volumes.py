@@ -0,0 +1,342 @@
+"""
+Backups split into volumes of a fixed size.
+
+A volumed backup is written as the files `<backup>.000`, `<backup>.001`,
+... and a manifest, `<backup>.manifest`, listing the size and SHA-256 hash of
+each volume.  Framed backups are cut on frame boundaries, so that each
+volume can be decompressed on its own, and volumes only go over the volume
+size when a single frame does.  Other backups are cut at the volume size.
+The volumes of a backup concatenated in order are the backup itself.
+
+While a volume is being written, the previous ones are flushed to disk,
+hashed and copied to other destinations on other threads.  The manifest is
+written last, so a backup without a manifest is incomplete.  Restores read
+the volumes back as a single stream with `VolumeReader`, which hashes the
+next volumes while the current one is being read.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import hashlib
+import json
+import logging
+import os
+import re
+
+from .commands import fsync_dir
+from .exceptions import BackupError, RestoreError
+from .frames import FRAME_HEADER_SIZE, get_frame_size
+from .sinks import get_sink
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_SUFFIX = '.manifest'
+
+READ_CHUNK_SIZE = 1024 * 1024
+
+SIZE_UNITS = {'': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3, 't': 1024 ** 4}
+
+
+def parse_size(value):
+    """
+    Returns the number of bytes given as a number with an optional `K`, `M`,
+    `G` or `T` binary suffix, e.g. `'4G'`.
+    """
+    match = re.match(r'^(\d+)([kmgt]?)i?b?$', value.strip().lower())
+    if not match or not int(match.group(1)):
+        raise argparse.ArgumentTypeError("must be a size like '4G' or '512M'")
+    return int(match.group(1)) * SIZE_UNITS[match.group(2)]
+
+
+def get_manifest_file(backup_file):
+    return backup_file + MANIFEST_SUFFIX
+
+
+def get_volume_file(backup_file, index):
+    return '{0}.{1:03d}'.format(backup_file, index)
+
+
+def is_volumed(backup_file):
+    """
+    Returns True if `backup_file` was written as volumes.
+    """
+    return not os.path.exists(backup_file) and os.path.exists(get_manifest_file(backup_file))
+
+
+def read_manifest(backup_file):
+    try:
+        with open(get_manifest_file(backup_file)) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError) as e:
+        raise RestoreError("Could not read the manifest of '{0}': {1}".format(backup_file, e))
+
+
+def hash_file(path, sinks=()):
+    """
+    Returns the SHA-256 hash of the file at `path`, writing its contents to
+    each of the already open `sinks` while reading it.
+    """
+    hash = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(READ_CHUNK_SIZE)
+            if not data:
+                break
+            hash.update(data)
+            for sink in sinks:
+                sink.write(data)
+    return hash.hexdigest()
+
+
+def copy_file(path, destinations, copies=None):
+    """
+    Copies the file at `path` to each of `destinations` and returns a dict
+    mapping the indexes of the destinations which failed to the error.  The
+    sinks of the copies made are appended to the list `copies` if given.
+    """
+    failed = {}
+    for i, destination in enumerate(destinations):
+        sink = get_sink(destination, os.path.basename(path))
+        try:
+            sink.open()
+            hash_file(path, [sink])
+            sink.close()
+            if copies is not None:
+                copies.append(sink)
+        except Exception as e:
+            failed[i] = e
+            try:
+                sink.abort()
+            except Exception:
+                pass
+    return failed
+
+
+class VolumeWriter(object):
+    """
+    Writable binary file-like object splitting what is written to it into
+    volumes of `volume_size` bytes next to `backup_file`.  Volumes are
+    finished and copied to `destinations` on `jobs` threads.  `close` writes
+    the manifest once every volume is finished.
+    """
+    def __init__(self, backup_file, volume_size, destinations=(), jobs=2):
+        self.backup_file = backup_file
+        self.volume_size = volume_size
+        self.destinations = list(destinations)
+        self.executor = ThreadPoolExecutor(max_workers=jobs)
+        self.futures = []
+        self.copies = []
+
+        self.framed = None
+        self.pending = b''
+        self.frame_left = 0
+
+        self.volume = None
+        self.volume_bytes = 0
+        self.volumes = []
+
+    def open_volume(self):
+        path = get_volume_file(self.backup_file, len(self.volumes))
+        self.volume = open(path, 'wb')
+        self.volume_bytes = 0
+        self.volumes.append(path)
+
+    def close_volume(self):
+        if self.volume is None:
+            return
+        self.volume.close()
+        self.futures.append(self.executor.submit(self.finish_volume, self.volume.name, self.volume_bytes))
+        self.volume = None
+
+    def finish_volume(self, path, size):
+        """
+        Flushes a written volume to disk, hashes it and copies it.  Runs on
+        the threads of the writer.
+        """
+        with open(path, 'rb') as f:
+            os.fsync(f.fileno())
+        return {
+            'file': os.path.basename(path),
+            'size': size,
+            'sha256': hash_file(path),
+            'failed_copies': copy_file(path, self.destinations, self.copies),
+        }
+
+    def write_volume(self, data):
+        if self.volume is None:
+            self.open_volume()
+        self.volume.write(data)
+        self.volume_bytes += len(data)
+
+    def write(self, data):
+        data = self.pending + bytes(data)
+        self.pending = b''
+
+        if self.framed is None:
+            if len(data) < FRAME_HEADER_SIZE:
+                self.pending = data
+                return
+            self.framed = get_frame_size(data) is not None
+
+        if not self.framed:
+            while data:
+                if self.volume is not None and self.volume_bytes >= self.volume_size:
+                    self.close_volume()
+                room = self.volume_size - (self.volume_bytes if self.volume is not None else 0)
+                self.write_volume(data[:room])
+                data = data[room:]
+            return
+
+        while data:
+            if self.frame_left:
+                # The rest of a frame goes into the volume holding its start
+                chunk = data[:self.frame_left]
+                self.write_volume(chunk)
+                self.frame_left -= len(chunk)
+                data = data[len(chunk):]
+                continue
+            if len(data) < FRAME_HEADER_SIZE:
+                self.pending = data
+                return
+            size = get_frame_size(data)
+            if size is None:
+                raise BackupError('Framed backup contains data which is not framed')
+            # Start a new volume before the frame if it does not fit
+            if self.volume is not None and self.volume_bytes + size > self.volume_size:
+                self.close_volume()
+            self.frame_left = size
+
+    def flush(self):
+        if self.volume is not None:
+            self.volume.flush()
+
+    def close(self):
+        """
+        Finishes the last volume and writes the manifest.  Returns the
+        manifest.
+        """
+        if self.pending or self.frame_left:
+            if self.framed:
+                raise BackupError('Backup ends in the middle of a frame')
+            self.write_volume(self.pending)
+            self.pending = b''
+        if not self.volumes:
+            # An empty backup still has a volume
+            self.open_volume()
+        self.close_volume()
+
+        try:
+            results = [future.result() for future in self.futures]
+        except (IOError, OSError) as e:
+            raise BackupError('Could not finish the volumes of the backup: {0}'.format(e))
+        finally:
+            self.executor.shutdown()
+
+        failed = {}
+        for result in results:
+            for i, error in result.pop('failed_copies').items():
+                failed.setdefault(i, error)
+        for i, error in sorted(failed.items()):
+            logger.warning("Could not copy the volumes of '{0}' to {1!r}: {2}".format(
+                self.backup_file, self.destinations[i], error))
+
+        manifest = {
+            'framed': bool(self.framed),
+            'size': sum(result['size'] for result in results),
+            'volume_size': self.volume_size,
+            'volumes': results,
+        }
+        manifest_file = get_manifest_file(self.backup_file)
+        with open(manifest_file + '.tmp', 'w') as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(manifest_file + '.tmp', manifest_file)
+        fsync_dir(os.path.dirname(os.path.abspath(manifest_file)))
+
+        # Destinations which got every volume get the manifest too
+        destinations = [d for i, d in enumerate(self.destinations) if i not in failed]
+        for i, error in copy_file(manifest_file, destinations, self.copies).items():
+            logger.warning("Could not copy '{0}' to {1!r}: {2}".format(manifest_file, destinations[i], error))
+        return manifest
+
+    def abort(self):
+        """
+        Removes the volumes written so far and their copies.
+        """
+        if self.volume is not None:
+            self.volume.close()
+            self.volume = None
+        for future in self.futures:
+            future.cancel()
+        self.executor.shutdown()
+        for sink in self.copies:
+            try:
+                sink.remove()
+            except Exception as e:
+                logger.warning("Could not remove '{0}': {1}".format(sink.name, e))
+        for path in self.volumes:
+            if os.path.exists(path):
+                os.remove(path)
+
+
+class VolumeReader(object):
+    """
+    Readable binary file-like object reading the volumes of `backup_file` as
+    a single stream.  Each volume is checked against the hash in the
+    manifest before it is read; the next `prefetch` volumes are hashed, and
+    thereby read into the system cache, ahead of time.
+    """
+    def __init__(self, backup_file, prefetch=1):
+        self.name = get_manifest_file(backup_file)
+        self.dir = os.path.dirname(os.path.abspath(backup_file))
+        self.volumes = read_manifest(backup_file)['volumes']
+        for volume in self.volumes:
+            if not os.path.exists(os.path.join(self.dir, volume['file'])):
+                raise RestoreError("Volume '{0}' of '{1}' is missing".format(volume['file'], backup_file))
+
+        self.prefetch = prefetch
+        self.executor = ThreadPoolExecutor(max_workers=max(1, prefetch))
+        self.checks = {}
+        self.index = -1
+        self.file = None
+
+    def check(self, index):
+        return self.checks.setdefault(
+            index, self.executor.submit(hash_file, os.path.join(self.dir, self.volumes[index]['file'])))
+
+    def next_volume(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        self.index += 1
+        if self.index >= len(self.volumes):
+            return False
+
+        volume = self.volumes[self.index]
+        digest = self.check(self.index).result()
+        for index in range(self.index + 1, min(self.index + 1 + self.prefetch, len(self.volumes))):
+            self.check(index)
+        if digest != volume['sha256']:
+            raise RestoreError("Volume '{0}' does not match its hash".format(volume['file']))
+
+        self.file = open(os.path.join(self.dir, volume['file']), 'rb')
+        return True
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            return b''.join(iter(lambda: self.read(READ_CHUNK_SIZE), b''))
+        while True:
+            if self.file is None and not self.next_volume():
+                return b''
+            data = self.file.read(size)
+            if data:
+                return data
+            self.file.close()
+            self.file = None
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        self.index = len(self.volumes)
+        self.executor.shutdown()
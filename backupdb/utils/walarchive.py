@@ -0,0 +1,139 @@
+"""
+Archive of PostgreSQL WAL segments for point-in-time recovery.
+
+The server runs this module as its `archive_command` to copy each finished
+WAL segment, compressed, into the `wal` directory of an archive, and as its
+`restore_command` to read them back while recovering.  Each archived segment
+is recorded in the catalog of the archive, see `backupdb.utils.pitr`.
+
+This module only depends on the standard library so that it can be run by
+the server without importing Django::
+
+    archive_command = 'python walarchive.py archive %p %f /backups/pitr/default'
+    restore_command = 'python walarchive.py restore %f %p /backups/pitr/default'
+"""
+from __future__ import print_function
+import argparse
+import gzip
+import json
+import os
+import shutil
+import sys
+import time
+
+CATALOG_FILE = 'catalog.jsonl'
+WAL_DIR = 'wal'
+
+
+class ArchiveError(Exception):
+    pass
+
+
+def get_archived_file(archive_dir, name):
+    return os.path.join(archive_dir, WAL_DIR, name + '.gz')
+
+
+def fsync_dir(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def record(archive_dir, **fields):
+    """
+    Appends a record with `fields` to the catalog of `archive_dir`.
+    """
+    with open(os.path.join(archive_dir, CATALOG_FILE), 'a') as f:
+        f.write(json.dumps(fields, sort_keys=True) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def is_same_segment(path, archived_file):
+    with open(path, 'rb') as f, gzip.open(archived_file, 'rb') as archived:
+        return f.read() == archived.read()
+
+
+def archive_wal(path, name, archive_dir):
+    """
+    Compresses the WAL segment at `path` into `archive_dir` as `name`.
+    Archiving a segment again succeeds if it has not changed, as the server
+    may retry after a crash, and raises ArchiveError otherwise.
+    """
+    archived_file = get_archived_file(archive_dir, name)
+    if os.path.exists(archived_file):
+        if is_same_segment(path, archived_file):
+            return
+        raise ArchiveError("'{0}' is already archived with different contents".format(name))
+
+    wal_dir = os.path.dirname(archived_file)
+    if not os.path.isdir(wal_dir):
+        os.makedirs(wal_dir)
+
+    tmp_file = archived_file + '.tmp'
+    with open(path, 'rb') as f, open(tmp_file, 'wb') as out:
+        with gzip.GzipFile(filename=name, mode='wb', fileobj=out) as z:
+            shutil.copyfileobj(f, z)
+        out.flush()
+        os.fsync(out.fileno())
+    os.rename(tmp_file, archived_file)
+    fsync_dir(wal_dir)
+
+    record(
+        archive_dir,
+        kind='wal',
+        name=name,
+        file=os.path.relpath(archived_file, archive_dir),
+        archived=time.time(),
+        bytes=os.path.getsize(archived_file),
+    )
+
+
+def restore_wal(name, path, archive_dir):
+    """
+    Decompresses the segment `name` from `archive_dir` into `path`.  Returns
+    False if it was never archived, which is how the server learns that it
+    reached the end of the archive.
+    """
+    archived_file = get_archived_file(archive_dir, name)
+    if not os.path.exists(archived_file):
+        return False
+
+    tmp_file = path + '.tmp'
+    with gzip.open(archived_file, 'rb') as f, open(tmp_file, 'wb') as out:
+        shutil.copyfileobj(f, out)
+    os.rename(tmp_file, path)
+    return True
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Archive and restore PostgreSQL WAL segments.')
+    commands = parser.add_subparsers(dest='command')
+    archive = commands.add_parser('archive', help='Archive a WAL segment (archive_command).')
+    archive.add_argument('path', help='Path of the segment, %%p.')
+    archive.add_argument('name', help='Name of the segment, %%f.')
+    archive.add_argument('archive_dir')
+    restore = commands.add_parser('restore', help='Restore a WAL segment (restore_command).')
+    restore.add_argument('name', help='Name of the segment, %%f.')
+    restore.add_argument('path', help='Path to restore the segment to, %%p.')
+    restore.add_argument('archive_dir')
+    args = parser.parse_args(argv)
+
+    try:
+        if args.command == 'archive':
+            archive_wal(args.path, args.name, args.archive_dir)
+        elif args.command == 'restore':
+            if not restore_wal(args.name, args.path, args.archive_dir):
+                return 1
+        else:
+            parser.error('a command is required')
+    except (ArchiveError, IOError, OSError) as e:
+        print('walarchive: {0}'.format(e), file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
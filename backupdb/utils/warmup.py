@@ -0,0 +1,243 @@
+"""
+Warm-up of restored databases.
+
+A freshly restored database has no planner statistics and a cold cache, so
+the first queries against it are slow.  A warm-up refreshes the statistics of
+all tables, split over several connections:
+
+* postgres tables are vacuumed and analyzed by `vacuumdb --analyze --jobs`,
+  which also fills in the visibility map used by index-only scans,
+* mysql tables are analyzed with `ANALYZE TABLE`,
+* sqlite databases are analyzed with `ANALYZE`.
+
+It can then load the relations which were the most used when the database was
+backed up into the cache.  They are captured at backup time by
+`capture_hot_relations` into a file next to the backup:
+
+* postgres tables and indexes are loaded with `pg_prewarm`,
+* mysql tables are read through their primary key into the InnoDB buffer
+  pool,
+* sqlite databases are read once into the page cache of the system.
+"""
+from subprocess import CalledProcessError
+import json
+import logging
+import sqlite3
+
+from .commands import (
+    get_mysql_args,
+    get_postgresql_args,
+    get_postgresql_env,
+    quote_pg_literal,
+    run_postgresql_sql,
+)
+from .parallel import FAILED, Job, run_jobs
+from .processes import get_command_output, pipe_commands
+
+logger = logging.getLogger(__name__)
+
+HOT_RELATIONS_SUFFIX = '.hot'
+
+DEFAULT_HOT_RELATIONS = 50
+
+READ_CHUNK_SIZE = 1024 * 1024
+
+PG_HOT_RELATIONS_SQL = (
+    "SELECT name FROM ("
+    "SELECT format('%I.%I', schemaname, relname) AS name, "
+    "coalesce(heap_blks_read, 0) + coalesce(heap_blks_hit, 0) AS blocks "
+    "FROM pg_statio_user_tables "
+    "UNION ALL "
+    "SELECT format('%I.%I', schemaname, indexrelname), "
+    "coalesce(idx_blks_read, 0) + coalesce(idx_blks_hit, 0) "
+    "FROM pg_statio_user_indexes"
+    ") relations WHERE blocks > 0 ORDER BY blocks DESC, name LIMIT {0}"
+)
+
+MYSQL_TABLES_SQL = (
+    "SELECT TABLE_NAME FROM information_schema.TABLES "
+    "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_TYPE = 'BASE TABLE'"
+)
+
+MYSQL_HOT_RELATIONS_SQL = (
+    "SELECT OBJECT_NAME FROM performance_schema.table_io_waits_summary_by_table "
+    "WHERE OBJECT_SCHEMA = DATABASE() AND COUNT_READ > 0 "
+    "ORDER BY COUNT_READ DESC, OBJECT_NAME LIMIT {0}"
+)
+
+
+def get_hot_relations_file(backup_file):
+    """
+    Returns the path of the list of hot relations saved with `backup_file`.
+    """
+    return backup_file + HOT_RELATIONS_SUFFIX
+
+
+def split(items, count):
+    """
+    Splits `items` into at most `count` lists of about the same length.
+    """
+    count = max(1, min(count, len(items)))
+    return [items[i::count] for i in range(count)]
+
+
+def run_parallel(funcs, jobs):
+    """
+    Calls the `(name, func)` tuples of `funcs` on up to `jobs` threads.
+    Returns the names of those which failed.
+    """
+    results = run_jobs([Job(name, func) for name, func in funcs], max_workers=jobs)
+    return [name for name, _ in funcs if results[name] == FAILED]
+
+
+def quote_mysql_identifier(name):
+    return '`{0}`'.format(name.replace('`', '``'))
+
+
+def run_mysql_sql(db_config, sql, show_output=False, force=False):
+    """
+    Runs `sql` with `mysql` in the database described by `db_config` and
+    returns its output as a list of rows.  With `force`, statements after a
+    failing one are still run.
+    """
+    cmd = ['mysql', '--batch', '--skip-column-names']
+    if force:
+        cmd.append('--force')
+    output = get_command_output(cmd + ['-e', sql] + get_mysql_args(db_config), show_stderr=show_output)
+    return [line.split('\t') for line in output.splitlines() if line]
+
+
+def get_postgresql_hot_relations(db_config, limit=DEFAULT_HOT_RELATIONS, show_output=False):
+    output = run_postgresql_sql(db_config, PG_HOT_RELATIONS_SQL.format(int(limit)), show_output, output=True)
+    return [line for line in output.splitlines() if line]
+
+
+def get_mysql_hot_relations(db_config, limit=DEFAULT_HOT_RELATIONS, show_output=False):
+    return [row[0] for row in run_mysql_sql(db_config, MYSQL_HOT_RELATIONS_SQL.format(int(limit)), show_output)]
+
+
+def get_sqlite_hot_relations(db_config, limit=DEFAULT_HOT_RELATIONS, show_output=False):
+    # Sqlite databases are prewarmed as a whole
+    return []
+
+
+def capture_hot_relations(backup_file, db_config, hot_relations_func, limit=DEFAULT_HOT_RELATIONS,
+                          show_output=False):
+    """
+    Saves the names of the `limit` most used relations of the database, as
+    returned by `hot_relations_func`, next to `backup_file`.  Returns the
+    list of names, or None if they could not be read.
+    """
+    try:
+        relations = hot_relations_func(db_config, limit, show_output)
+    except CalledProcessError as e:
+        logger.warning('Could not read the most used relations: {0}'.format(e))
+        return None
+    with open(get_hot_relations_file(backup_file), 'w') as f:
+        json.dump(relations, f, indent=2)
+    return relations
+
+
+def read_hot_relations(backup_file):
+    """
+    Returns the list of hot relations saved with `backup_file` or None if
+    there is none.
+    """
+    if not isinstance(backup_file, str):
+        return None
+    try:
+        with open(get_hot_relations_file(backup_file)) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def do_postgresql_warm_up(db_config, jobs=1, prewarm=False, hot_relations=None, show_output=False):
+    """
+    Vacuums and analyzes all tables on `jobs` connections, then loads
+    `hot_relations` into shared buffers with `pg_prewarm` if `prewarm` is
+    True.  Returns False if a step failed.
+    """
+    env = get_postgresql_env(db_config)
+    cmd = ['vacuumdb', '--analyze', '--jobs={0}'.format(max(1, jobs))] + get_postgresql_args(db_config)
+    ok = True
+    try:
+        pipe_commands([cmd], extra_env=env, show_stderr=show_output)
+    except CalledProcessError as e:
+        logger.warning('Could not analyze the restored database: {0}'.format(e))
+        ok = False
+
+    if not prewarm or not hot_relations:
+        return ok
+    try:
+        run_postgresql_sql(db_config, 'CREATE EXTENSION IF NOT EXISTS pg_prewarm', show_output)
+    except CalledProcessError as e:
+        logger.warning('Could not enable pg_prewarm: {0}'.format(e))
+        return False
+
+    def load(relations):
+        def func():
+            # Relations missing from the restored database are skipped
+            run_postgresql_sql(db_config, (
+                'SELECT pg_prewarm(c.oid) FROM pg_class c WHERE c.oid IN ({0})'
+            ).format(', '.join('to_regclass({0})'.format(quote_pg_literal(r)) for r in relations)), show_output)
+            return True
+        return func
+
+    failed = run_parallel(
+        [('prewarm {0}'.format(i), load(r)) for i, r in enumerate(split(hot_relations, jobs))], jobs)
+    return ok and not failed
+
+
+def do_mysql_warm_up(db_config, jobs=1, prewarm=False, hot_relations=None, show_output=False):
+    """
+    Analyzes all tables on `jobs` connections, then reads `hot_relations`
+    through their primary key into the buffer pool if `prewarm` is True.
+    Returns False if a step failed.
+    """
+    def run(sql):
+        def func():
+            run_mysql_sql(db_config, sql, show_output, force=True)
+            return True
+        return func
+
+    try:
+        tables = [row[0] for row in run_mysql_sql(db_config, MYSQL_TABLES_SQL, show_output)]
+    except CalledProcessError as e:
+        logger.warning('Could not list the restored tables: {0}'.format(e))
+        return False
+
+    funcs = [
+        ('analyze {0}'.format(i), run('ANALYZE TABLE {0}'.format(', '.join(quote_mysql_identifier(t) for t in group))))
+        for i, group in enumerate(split(tables, jobs)) if group
+    ]
+    if prewarm and hot_relations:
+        hot_tables = [r for r in hot_relations if r in tables]
+        funcs.extend(
+            ('prewarm {0}'.format(i), run(' '.join(
+                'SELECT COUNT(*) FROM {0} FORCE INDEX (PRIMARY);'.format(quote_mysql_identifier(t)) for t in group)))
+            for i, group in enumerate(split(hot_tables, jobs)) if group
+        )
+    return not run_parallel(funcs, jobs)
+
+
+def do_sqlite_warm_up(db_config, jobs=1, prewarm=False, hot_relations=None, show_output=False):
+    """
+    Analyzes the database, then reads its file into the page cache if
+    `prewarm` is True.
+    """
+    connection = sqlite3.connect(db_config['NAME'])
+    try:
+        connection.execute('ANALYZE')
+        connection.commit()
+    except sqlite3.Error as e:
+        logger.warning('Could not analyze the restored database: {0}'.format(e))
+        return False
+    finally:
+        connection.close()
+
+    if prewarm:
+        with open(db_config['NAME'], 'rb') as f:
+            while f.read(READ_CHUNK_SIZE):
+                pass
+    return True
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+"""
+Compares the startup time and memory use of the `backupdb` management command
+with the standalone `backupdb.cli` entry point.  Each variant is run in a fresh
+interpreter up to the point where it is ready to start a backup.
+
+Usage:
+    python benchmarks/startup.py [--settings=test_settings] [--runs=10]
+"""
+from __future__ import print_function
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+VARIANTS = [
+    (
+        'manage.py backupdb',
+        'import django; django.setup(); '
+        'from django.core.management import load_command_class; '
+        'load_command_class("backupdb", "backupdb")',
+    ),
+    (
+        'backupdb.cli',
+        'from backupdb import cli; '
+        'cli.configure(cli.load_config(settings_module={settings!r})); '
+        'from backupdb import api',
+    ),
+]
+
+
+def run(code, env):
+    """
+    Runs `code` in a new interpreter and returns its wall time in seconds and
+    maximum resident set size in kilobytes.
+    """
+    started = time.time()
+    p = subprocess.Popen([sys.executable, '-c', code], env=env)
+    _, status, rusage = os.wait4(p.pid, 0)
+    elapsed = time.time() - started
+    if status != 0:
+        raise RuntimeError('Benchmark failed: {0}'.format(code))
+    return elapsed, rusage.ru_maxrss
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--settings', default=os.environ.get('DJANGO_SETTINGS_MODULE', 'test_settings'))
+    parser.add_argument('--runs', type=int, default=10)
+    options = parser.parse_args()
+
+    env = os.environ.copy()
+    env['DJANGO_SETTINGS_MODULE'] = options.settings
+    env['PYTHONPATH'] = os.pathsep.join([os.getcwd(), env.get('PYTHONPATH', '')])
+
+    print('{0:<20} {1:>10} {2:>10} {3:>12}'.format('variant', 'min (ms)', 'avg (ms)', 'max RSS (MB)'))
+    for name, code in VARIANTS:
+        code = code.format(settings=options.settings)
+        results = [run(code, env) for _ in range(options.runs)]
+        times = [t for t, _ in results]
+        rss = max(r for _, r in results)
+        print('{0:<20} {1:>10.1f} {2:>10.1f} {3:>12.1f}'.format(
+            name,
+            min(times) * 1000,
+            sum(times) / len(times) * 1000,
+            rss / 1024.0,
+        ))
+
+
+if __name__ == '__main__':
+    main()
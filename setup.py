@@ -28,6 +28,9 @@ setup(
     packages=['backupdb', 'backupdb.utils', 'backupdb.management',
               'backupdb.management.commands', 'backupdb.tests',
               'backupdb.tests.app'],
+    entry_points={
+        'console_scripts': ['backupdb = backupdb.cli:main'],
+    },
     platforms='any',
     license='Fusionbox',
     test_suite='backupdb.tests.all_tests',
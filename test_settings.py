@@ -6,7 +6,7 @@ import tempfile
 
 DEBUG = True
 
-DATABASE = {
+DATABASES = {
     'default': dj_database_url.config(default='sqlite://:memory:'),
 }
 